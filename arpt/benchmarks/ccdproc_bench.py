@@ -0,0 +1,400 @@
+"""
++
+
+ CCDPROC_BENCH
+
+ This times the ccdproc processing steps and the full ccdproc() run
+ on synthetic mosaics (see ccdproc_synth) and appends the results
+ to a JSON lines file so runs can be compared across commits.
+
+ Every step runs in its own fresh process so that the peak resident
+ set size (maxrss) belongs to that step alone.  The time is the best
+ of REPEAT runs over all extensions of all raw files.  Throughput is
+ given in MPix/s (raw pixels) and MB/s (raw bytes).
+
+ Steps (the STEPS dictionary, new steps can be added to it):
+  read      Read every extension and convert it to float.
+  xtalk     Cross-talk correction of every exposure (ccdproc_xtalkfile).
+  overscan  Overscan subtraction of all amplifiers (ccdproc_overscan).
+  trim, lincorr, fixpix, zero, flat, illum, bootstrap, bpm
+            The single step in the fused kernel (ccdproc_fused).
+  fused     All of the per-pixel steps in the fused kernel.
+  strips    The same in the bounded-memory mode (ccdproc_strips) with
+              a 64MB ceiling.
+  write     Write the calibrated exposure (fitswrite).
+  full      The whole per-file processing of ccdproc() with all steps:
+              cross-talk, fixpix, overscan, trim, zero, flat, illum,
+              bootstrap and BPM with the shared calibration cache, and
+              the calibrated files written over copies of the raw ones.
+              ccdproc.py itself can't be imported, this drives the
+              same modules the way ccdproc_fusedext does.
+
+ INPUTS:
+  =outfile     The results file.  Default is 'ccdproc_bench.jsonl'.
+  =workdir     The directory for the synthetic data.  Default is a
+                 temporary directory that is removed at the end.
+  =steps       The list of steps to run.  Default is all.
+  =repeat      The number of timing runs per step.  Default is 3.
+  =label       Label that is stored with the results.
+  =synth       Dictionary of ccdproc_synth keywords (nfiles, nextend,
+                 nx, ny, namp, ...).
+  /silent      Don't print anything to the screen.
+
+ OUTPUTS:
+  result       The result dictionary that was appended to OUTFILE:
+                 DATE, COMMIT, LABEL, HOST, PYTHON, NUMPY, CONFIG and
+                 STEPS, a list with NAME, TIME, NPIX, NBYTES, MPIXS,
+                 MBS, MAXRSS (bytes) and ERROR for every step.
+
+ ccdproc_benchtable(outfile) prints the results of all runs in the
+ file, one column per run, to compare commits.
+
+ USAGE:
+  result = ccdproc_bench(synth={'nextend':8,'namp':2},repeat=5)
+  ccdproc_benchtable('ccdproc_bench.jsonl')
+
+  or from the shell:
+  python ccdproc_bench.py --nextend 8 --namp 2 --steps overscan fused
+
+-
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+
+import numpy as np
+
+IMAGEDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'image')
+sys.path.insert(0, IMAGEDIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ccdproc_synth import ccdproc_synth
+
+
+def _maxrss():
+    try:
+        import resource
+    except ImportError:
+        return -1
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+def _rawexts(files):
+    # All raw (file, exten) pairs
+    from fitsindex import fitsindex
+    out = []
+    for f in files['raw']:
+        fits, error = fitsindex(f)
+        if error!='': raise IOError(error)
+        out.extend([(f, i) for i in range(1, fits.nextend+1)])
+    return out
+
+
+def _readtext(file, types):
+    # Columns of a text file, # are comments
+    rows = []
+    for line in open(file):
+        line = line.split('#')[0].split()
+        if len(line)>0: rows.append(tuple(t(v) for t,v in zip(types, line)))
+    return rows
+
+
+def _fusedstep(files, overscan=False, trim=False, lincoef=None, fixpix=False,
+               bootstrap=False, maxmem=0, **cals):
+    # One fused kernel run over all raw extensions
+    #  MAXMEM>0 runs the bounded-memory (band by band) mode instead
+    #  LINCOEF are linearity coefficients (constant first) for all extensions
+    from fitsindex import fitsindex, fitskey
+    from ccdproc_fused import ccdproc_fused
+    from ccdproc_strips import ccdproc_strips
+    from ccdproc_overscan import ccdproc_overscangeom
+    from ccdproc_splitsec import ccdproc_splitsec
+    from ccdproc_mask import PixMask
+    from ccdproc_lincorr import ccdproc_loadlincorr, ccdproc_linplan
+    from ccdproc_loadfixpix import ccdproc_loadfixpix
+    from ccdproc_fixpix import ccdproc_fixpixplan
+    cal = dict((name, fitsindex(files[name])[0]) for name in cals if cals[name])
+    # The linearity correction from a file, like ccdproc(linCorr=)
+    linstr = None
+    if lincoef is not None:
+        linfile = os.path.join(os.path.dirname(files['raw'][0]), 'bench_lincorr.txt')
+        with open(linfile, 'w') as fh:
+            for f,i in _rawexts(files):
+                fh.write(str(i)+' '+' '.join(repr(float(c)) for c in lincoef)+'\n')
+        linstr, error = ccdproc_loadlincorr(linfile)
+        if error!='': raise RuntimeError(error)
+    fixstr = None
+    if fixpix:
+        fixstr, error = ccdproc_loadfixpix(files['fixpix'])
+        if error!='': raise RuntimeError(error)
+    boot = dict(_readtext(files['bootstrap'], (int, float))) if bootstrap else {}
+    # The calibration images have the trimmed size
+    trim = trim or len(cal)>0
+    for f,i in _rawexts(files):
+        fits = fitsindex(f)[0]
+        im, head = fits.data(i), fits.header(i)
+        ovgeom = ccdproc_overscangeom(head, im.shape) if overscan else None
+        trimsec = None
+        if trim: trimsec = [t-1 for t in ccdproc_splitsec(fitskey(head, 'TRIMSEC'))]
+        calim = dict((name, cal[name].data(i)) for name in cal)
+        # The bad pixels as sorted flat indices of the output image
+        bpmind = None
+        if 'bpm' in calim: bpmind = PixMask.frombpm(calim['bpm']).indices()
+        linplan = ccdproc_linplan(linstr, i, head, im.shape, im.dtype)
+        fixplan = ccdproc_fixpixplan(fixstr, im.shape) if fixpix else None
+        kw = dict(ovgeom=ovgeom, trimsec=trimsec, trim=trim, linplan=linplan, fixplan=fixplan,
+                  bootscale=boot.get(i), zeroim=calim.get('zero'), flatim=calim.get('flat'),
+                  illumim=calim.get('illum'), bpmind=bpmind)
+        if maxmem>0:
+            error = ccdproc_strips(im, lambda row0,band: None, maxmem=maxmem, **kw)
+        else:
+            out, error = ccdproc_fused(im, **kw)
+        if error!='': raise RuntimeError(error)
+
+
+def step_read(files):
+    from fitsindex import fitsindex
+    for f,i in _rawexts(files):
+        np.array(fitsindex(f)[0].data(i), dtype=np.float32)
+
+
+def step_xtalk(files):
+    from ccdproc_xtalkcube import ccdproc_xtalkmatrix, ccdproc_xtalkfile
+    xmat, error = ccdproc_xtalkmatrix(_readtext(files['xtalk'], (int, int, float)))
+    if error!='': raise RuntimeError(error)
+    for f in files['raw']:
+        xcor, error = ccdproc_xtalkfile(f, xmat)
+        if error!='': raise RuntimeError(error)
+
+
+def step_overscan(files):
+    from fitsindex import fitsindex
+    from ccdproc_overscan import ccdproc_overscan
+    for f,i in _rawexts(files):
+        fits = fitsindex(f)[0]
+        error = ccdproc_overscan(fits.data(i).astype(np.float32), fits.header(i))
+        if error!='': raise RuntimeError(error)
+
+
+def step_write(files):
+    from fitsindex import fitsindex
+    from fitswrite import fitswrite
+    for k,f in enumerate(files['raw']):
+        fits = fitsindex(f)[0]
+        data = [None]+[fits.data(i).astype(np.float32) for i in range(1, fits.nextend+1)]
+        heads = [fits.header(i) for i in range(fits.nextend+1)]
+        outfile = os.path.join(os.path.dirname(f), 'bench_write%03d.fits' % k)
+        error = fitswrite(outfile, data, heads=heads)
+        os.remove(outfile)
+        if error!='': raise RuntimeError(error)
+
+
+def step_full(files):
+    # The whole processing of copies of the raw files, like ccdproc()
+    from fitsindex import fitsindex, fitskey
+    from fitswrite import FitsWriter
+    from ccdproc_xtalkcube import ccdproc_xtalkmatrix, ccdproc_xtalkfile
+    from ccdproc_loadfixpix import ccdproc_loadfixpix
+    from ccdproc_fixpix import ccdproc_fixpixplan
+    from ccdproc_overscan import ccdproc_overscangeom
+    from ccdproc_splitsec import ccdproc_splitsec
+    from ccdproc_calcache import CalCache, ccdproc_calflat
+    from ccdproc_mask import MaskStore
+    from ccdproc_fused import ccdproc_fused
+    def calload(file, exten):
+        return fitsindex(file)[0].data(exten)
+    indir = os.path.join(os.path.dirname(files['raw'][0]), 'bench_full')
+    if os.path.exists(indir): shutil.rmtree(indir)
+    os.makedirs(indir)
+    raw = [shutil.copy(f, indir) for f in files['raw']]
+    # Loaded once per run, like ccdproc()
+    xmat, error = ccdproc_xtalkmatrix(_readtext(files['xtalk'], (int, int, float)))
+    if error!='': raise RuntimeError(error)
+    fixstr, error = ccdproc_loadfixpix(files['fixpix'])
+    if error!='': raise RuntimeError(error)
+    boot = dict(_readtext(files['bootstrap'], (int, float)))
+    cache = CalCache(loader=calload)
+    maskstore = MaskStore(files['bpm'], loader=calload)
+    for f in raw:
+        fits = fitsindex(f)[0]
+        xcor, error = ccdproc_xtalkfile(f, xmat)
+        if error!='': raise RuntimeError(error)
+        outfh = FitsWriter(f, outtype='float32')
+        try:
+            outfh.primary(fits.header(0), nextend=fits.nextend)
+            for i in range(1, fits.nextend+1):
+                head = fits.header(i)
+                im = xcor[i] if i in xcor else fits.data(i).astype(np.float32)
+                flatim, medflat = ccdproc_calflat(cache, files['flat'], i)
+                illumim, medillum = ccdproc_calflat(cache, files['illum'], i)
+                out, error = ccdproc_fused(im, ovgeom=ccdproc_overscangeom(head, im.shape),
+                                           trimsec=[t-1 for t in ccdproc_splitsec(fitskey(head, 'TRIMSEC'))],
+                                           trim=True, fixplan=ccdproc_fixpixplan(fixstr, im.shape),
+                                           zeroim=cache.get(files['zero'], i), flatim=flatim,
+                                           medflat=medflat, illumim=illumim, medillum=medillum,
+                                           bootscale=boot.get(i),
+                                           bpmind=maskstore.get(i).indices('bad'))
+                if error!='': raise RuntimeError(error)
+                outfh.append(out, head)
+            del fits
+            outfh.commit()
+        except BaseException:
+            outfh.abort()
+            raise
+    shutil.rmtree(indir)
+
+
+# The benchmark steps
+STEPS = {'read':step_read, 'xtalk':step_xtalk, 'overscan':step_overscan,
+         'trim':lambda files: _fusedstep(files, trim=True),
+         'lincorr':lambda files: _fusedstep(files, lincoef=[0.0, 1.0, 1e-7]),
+         'fixpix':lambda files: _fusedstep(files, fixpix=True),
+         'zero':lambda files: _fusedstep(files, zero=True),
+         'flat':lambda files: _fusedstep(files, flat=True),
+         'illum':lambda files: _fusedstep(files, illum=True),
+         'bootstrap':lambda files: _fusedstep(files, bootstrap=True),
+         'bpm':lambda files: _fusedstep(files, bpm=True),
+         'fused':lambda files: _fusedstep(files, overscan=True, trim=True, zero=True,
+                                          flat=True, illum=True, bootstrap=True, bpm=True,
+                                          lincoef=[0.0, 1.0, 1e-7], fixpix=True),
+         'strips':lambda files: _fusedstep(files, overscan=True, trim=True, zero=True,
+                                           flat=True, illum=True, bootstrap=True, bpm=True,
+                                           lincoef=[0.0, 1.0, 1e-7], fixpix=True,
+                                           maxmem=64*1024**2),
+         'write':step_write, 'full':step_full}
+STEPORDER = ['read', 'xtalk', 'lincorr', 'fixpix', 'overscan', 'trim', 'zero', 'flat', 'illum',
+             'bootstrap', 'bpm', 'fused', 'strips', 'write', 'full']
+
+
+def _runstep(name, files, repeat, conn):
+    # Run one step in this (fresh) process and send back the timing
+    result = {'name':name, 'time':None, 'error':''}
+    try:
+        times = []
+        for r in range(repeat):
+            t0 = time.time()
+            STEPS[name](files)
+            times.append(time.time()-t0)
+        result['time'] = min(times)
+    except Exception as e:
+        result['error'] = type(e).__name__+': '+str(e)
+    result['maxrss'] = _maxrss()
+    conn.send(result)
+    conn.close()
+
+
+def _commit():
+    # The current git commit of the repository
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=IMAGEDIR,
+                                      stderr=subprocess.STDOUT)
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def ccdproc_bench(outfile='ccdproc_bench.jsonl', workdir=None, steps=None, repeat=3,
+                  label='', synth=None, silent=False):
+
+    if steps is None: steps = STEPORDER
+    for s in steps:
+        if s not in STEPS: raise ValueError('Unknown step '+s)
+    synth = dict(synth or {})
+    tmpdir = None
+    if workdir is None: workdir = tmpdir = tempfile.mkdtemp(prefix='ccdproc_bench')
+
+    try:
+        if not silent: print('Generating synthetic data in '+workdir)
+        files = ccdproc_synth(workdir, **synth)
+        config = files['config']
+        npix = 0
+        nbytes = 0
+        from fitsindex import fitsindex
+        for f,i in _rawexts(files):
+            hdu = fitsindex(f)[0].hdu[i]
+            npix += int(np.prod(hdu['naxis']))
+            nbytes += hdu['dsize']
+
+        # Each step in a fresh process, for its own peak memory
+        ctx = multiprocessing.get_context('spawn')
+        results = []
+        for name in steps:
+            recv, send = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_runstep, args=(name, files, repeat, send))
+            proc.start()
+            send.close()
+            try:
+                res = recv.recv()
+            except EOFError:
+                res = {'name':name, 'time':None, 'maxrss':-1,
+                       'error':'Process died'}
+            proc.join()
+            res['npix'] = npix
+            res['nbytes'] = nbytes
+            res['mpixs'] = npix/res['time']/1e6 if res['time'] else None
+            res['mbs'] = nbytes/res['time']/1048576. if res['time'] else None
+            results.append(res)
+            if not silent:
+                if res['error']!='':
+                    print('%-10s FAILED %s' % (name, res['error']))
+                else:
+                    print('%-10s %8.3f s %8.1f MPix/s %8.1f MB/s %8.1f MB peak' %
+                          (name, res['time'], res['mpixs'], res['mbs'], res['maxrss']/1048576.))
+    finally:
+        if tmpdir is not None: shutil.rmtree(tmpdir, ignore_errors=True)
+
+    result = {'date':time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit':_commit(), 'label':label,
+              'host':socket.gethostname(), 'python':platform.python_version(),
+              'numpy':np.__version__, 'repeat':repeat, 'config':config, 'steps':results}
+    with open(outfile, 'a') as fh:
+        fh.write(json.dumps(result)+'\n')
+
+    return result
+
+
+def ccdproc_benchtable(outfile='ccdproc_bench.jsonl', value='mpixs'):
+    # Print VALUE of every step for all runs in the results file
+    runs = [json.loads(line) for line in open(outfile) if line.strip()!='']
+    if len(runs)==0: return
+    names = []
+    for r in runs:
+        for s in r['steps']:
+            if s['name'] not in names: names.append(s['name'])
+    print('%-10s' % 'step'+''.join(['%12s' % (r['commit'] or r['label'] or '?')[0:11] for r in runs]))
+    for name in names:
+        line = '%-10s' % name
+        for r in runs:
+            s = [x for x in r['steps'] if x['name']==name]
+            v = s[0].get(value) if len(s)>0 else None
+            line += '%12s' % ('-' if v is None else '%.2f' % (v/1048576. if value=='maxrss' else v))
+        print(line)
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the ccdproc steps')
+    parser.add_argument('--outfile', default='ccdproc_bench.jsonl')
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--steps', nargs='+', default=None, choices=STEPORDER)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--label', default='')
+    for key,default in (('nfiles',2), ('nextend',4), ('nx',2048), ('ny',4096),
+                        ('nbias',50), ('namp',1), ('seed',0)):
+        parser.add_argument('--'+key, type=int, default=default)
+    parser.add_argument('--table', action='store_true', help='Only print the results table')
+    args = parser.parse_args()
+    if args.table:
+        ccdproc_benchtable(args.outfile)
+    else:
+        synth = dict((k, getattr(args, k)) for k in ('nfiles', 'nextend', 'nx', 'ny',
+                                                     'nbias', 'namp', 'seed'))
+        ccdproc_bench(outfile=args.outfile, workdir=args.workdir, steps=args.steps,
+                      repeat=args.repeat, label=args.label, synth=synth)
@@ -0,0 +1,194 @@
+"""
++
+
+ CCDPROC_SYNTH
+
+ This generates synthetic raw mosaic exposures and the matching
+ calibration inputs for ccdproc, for benchmarks and tests.  Every
+ raw extension has one or two amplifiers, each with its own bias
+ level, a bias (overscan) strip with read noise and a slow bias
+ drift along the readout, a sky level that is modulated by the flat
+ and illumination patterns, stars, saturated pixels and bad columns.
+ Cross-talk between the extensions is added to the raw data with the
+ same coefficients that are written to the cross-talk file.
+
+ INPUTS:
+  outdir       The output directory.  It is created if needed.
+  =nfiles      The number of raw exposures.  Default is 2.
+  =nextend     The number of extensions per exposure.  Default is 4.
+  =nx          The number of data columns per extension (both
+                 amplifiers).  Default is 2048.
+  =ny          The number of rows.  Default is 4096.
+  =nbias       The width of the bias strip of each amplifier.
+                 Default is 50.
+  =namp        The number of amplifiers per extension, 1 or 2.  With
+                 two amplifiers the bias strips are on both sides and
+                 the header has BIASSECA/DATASECA/TRIMSECA and
+                 BIASSECB/DATASECB/TRIMSECB.  Default is 1.
+  =saturate    The saturation level.  Default is 65535.
+  =nsat        The number of saturated stars per extension.  Default is 20.
+  =nbadcol     The number of bad columns per extension.  Default is 3.
+  =nstars      The number of stars per extension.  Default is 200.
+  =sky         The sky level in ADU.  Default is 2000.
+  =seed        The random seed.  Default is 0.
+
+ OUTPUTS:
+  files        Dictionary with the file names: RAW (list), ZERO, FLAT,
+                 ILLUM, BPM (FITS files with trimmed extensions),
+                 XTALK ("victim source scale"), BOOTSTRAP ("exten scale")
+                 and FIXPIX ("x1 x2 y1 y2" per bad column) text files,
+                 and CONFIG with the generator settings.
+
+ The raw images are uint16 (BITPIX=16, BZERO=32768) like the data
+ off the telescope.  The calibration images match the trimmed size.
+
+ USAGE:
+  files = ccdproc_synth('/scratch/bench',nfiles=4,nextend=8,namp=2)
+
+-
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'image'))
+from fitsindex import fitscard
+from fitswrite import fitswrite
+
+
+def _secstr(x0, x1, y0, y1):
+    # 0-based inclusive indices to an IRAF section string
+    return '[%d:%d,%d:%d]' % (x0+1, x1+1, y0+1, y1+1)
+
+
+def ccdproc_synthlayout(nx, ny, nbias, namp):
+    # The raw layout: list of (name, biassec, datasec) 0-based and the raw width
+    if namp==1:
+        # Data then the bias strip on the right
+        return [('', (nx, nx+nbias-1, 0, ny-1), (0, nx-1, 0, ny-1))], nx+nbias
+    if namp==2:
+        # Bias A | data A | data B | bias B
+        half = nx//2
+        return [('A', (0, nbias-1, 0, ny-1), (nbias, nbias+half-1, 0, ny-1)),
+                ('B', (nbias+nx, 2*nbias+nx-1, 0, ny-1), (nbias+half, nbias+nx-1, 0, ny-1))], \
+               nx+2*nbias
+    raise ValueError('NAMP must be 1 or 2')
+
+
+def _xtalkcoef(nextend, rng):
+    # Neighboring extensions (same CCD pairs) talk to each other
+    xtalk = []
+    for e in range(1, nextend+1, 2):
+        if e+1>nextend: break
+        xtalk.append((e, e+1, float(rng.uniform(1e-4, 2e-3))))
+        xtalk.append((e+1, e, float(rng.uniform(1e-4, 2e-3))))
+    return xtalk
+
+
+def ccdproc_synth(outdir, nfiles=2, nextend=4, nx=2048, ny=4096, nbias=50, namp=1,
+                  saturate=65535, nsat=20, nbadcol=3, nstars=200, sky=2000.0, seed=0):
+
+    if not os.path.exists(outdir): os.makedirs(outdir)
+    rng = np.random.default_rng(seed)
+    layout, rawnx = ccdproc_synthlayout(nx, ny, nbias, namp)
+    # The trimmed image covers all amplifiers
+    tx0 = min(d[0] for n,b,d in layout)
+    tx1 = max(d[1] for n,b,d in layout)
+    yy, xx = np.mgrid[0:ny, 0:nx].astype(np.float32)
+
+    files = {'raw':[], 'config':{'nfiles':nfiles, 'nextend':nextend, 'nx':nx,
+                                 'ny':ny, 'nbias':nbias, 'namp':namp,
+                                 'saturate':saturate, 'nsat':nsat,
+                                 'nbadcol':nbadcol, 'nstars':nstars,
+                                 'sky':sky, 'seed':seed}}
+
+    # Calibration frames, one extension per raw extension
+    #-----------------------------------------------------
+    zero, flat, illum, bpm, badcols = [None], [None], [None], [None], {}
+    for e in range(1, nextend+1):
+        zero.append(rng.normal(0.0, 2.0, (ny, nx)).astype(np.float32))
+        f = (1.0+0.05*np.sin(xx/300.0+e)*np.cos(yy/500.0)).astype(np.float32)
+        f += rng.normal(0.0, 0.005, (ny, nx)).astype(np.float32)
+        # A few dead flat pixels, ccdproc replaces those with the median
+        f[rng.integers(0, ny, 20), rng.integers(0, nx, 20)] = 0.0
+        flat.append(f)
+        illum.append((1.0+0.02*((xx-nx/2.)**2+(yy-ny/2.)**2)/float(nx*nx+ny*ny)).astype(np.float32))
+        m = np.zeros((ny, nx), dtype=np.uint8)
+        badcols[e] = sorted(rng.choice(nx, nbadcol, replace=False).tolist())
+        for c in badcols[e]: m[:, c] = 1
+        bpm.append(m)
+    for name,cube in (('zero',zero), ('flat',flat), ('illum',illum), ('bpm',bpm)):
+        files[name] = os.path.join(outdir, name+'.fits')
+        heads = [[fitscard('OBSTYPE', name), fitscard('NEXTEND', nextend)]]+ \
+                [[fitscard('EXTNAME', 'im'+str(e))] for e in range(1, nextend+1)]
+        error = fitswrite(files[name], cube, heads=heads)
+        if error!='': raise IOError(error)
+
+    # Text calibration inputs
+    #-------------------------
+    xtalk = _xtalkcoef(nextend, rng)
+    files['xtalk'] = os.path.join(outdir, 'xtalk.txt')
+    with open(files['xtalk'], 'w') as fh:
+        fh.write('# victim source scale\n')
+        for v,s,c in xtalk: fh.write('%d %d %.6g\n' % (v, s, c))
+    files['bootstrap'] = os.path.join(outdir, 'bootstrap.txt')
+    with open(files['bootstrap'], 'w') as fh:
+        for e in range(1, nextend+1): fh.write('%d %.5f\n' % (e, rng.uniform(0.95, 1.05)))
+    files['fixpix'] = os.path.join(outdir, 'fixpix.txt')
+    with open(files['fixpix'], 'w') as fh:
+        # Raw coordinates, 1-based
+        for e in range(1, nextend+1):
+            for c in badcols[e]: fh.write('%d %d %d %d\n' % (c+tx0+1, c+tx0+1, 1, ny))
+
+    # Raw exposures
+    #---------------
+    for k in range(nfiles):
+        sci = []
+        for e in range(1, nextend+1):
+            im = np.full((ny, nx), sky, dtype=np.float32)*flat[e]*illum[e]
+            # Stars, a few of them saturated
+            for s in range(nstars+nsat):
+                x0, y0 = rng.integers(5, nx-5), rng.integers(5, ny-5)
+                amp = saturate*2.0 if s<nsat else rng.uniform(500, 20000)
+                sl = (slice(y0-4, y0+5), slice(x0-4, x0+5))
+                im[sl] += amp*np.exp(-((xx[sl]-x0)**2+(yy[sl]-y0)**2)/4.0)
+            im += rng.normal(0.0, 1.0, (ny, nx)).astype(np.float32)*np.sqrt(np.maximum(im, 1.0))
+            sci.append(im)
+        # Cross-talk from the undisturbed sources
+        xsci = [s.copy() for s in sci]
+        for v,s,c in xtalk: xsci[v-1] += c*sci[s-1]
+
+        data, heads = [None], []
+        heads.append([fitscard('OBSTYPE', 'object'), fitscard('FILTER', 'r'),
+                      fitscard('DATE-OBS', '2014-01-%02dT03:00:00' % (k % 28+1)),
+                      fitscard('EXPTIME', 90.0), fitscard('NEXTEND', nextend)])
+        for e in range(1, nextend+1):
+            raw = np.zeros((ny, rawnx), dtype=np.float32)
+            head = [fitscard('EXTNAME', 'im'+str(e))]
+            for name,b,d in layout:
+                level = 1000.0+100.0*e+(50.0 if name=='B' else 0.0)
+                drift = level+5.0*np.sin(np.arange(ny, dtype=np.float32)/700.0)
+                raw[b[2]:b[3]+1, b[0]:b[1]+1] = drift[:, np.newaxis]+ \
+                    rng.normal(0.0, 3.0, (ny, b[1]-b[0]+1))
+                dx0 = d[0]-tx0
+                raw[d[2]:d[3]+1, d[0]:d[1]+1] = drift[:, np.newaxis]+zero[e][:, dx0:dx0+d[1]-d[0]+1]+ \
+                    xsci[e-1][:, dx0:dx0+d[1]-d[0]+1]
+                head.append(fitscard('BIASSEC'+name, _secstr(*b)))
+                head.append(fitscard('DATASEC'+name, _secstr(*d)))
+                head.append(fitscard('TRIMSEC'+name, _secstr(*d)))
+            if namp>1:
+                # The whole trimmed image
+                head.append(fitscard('DATASEC', _secstr(tx0, tx1, 0, ny-1)))
+                head.append(fitscard('TRIMSEC', _secstr(tx0, tx1, 0, ny-1)))
+            for c in badcols[e]: raw[:, c+tx0] = rng.choice([0.0, saturate])
+            np.clip(raw, 0, saturate, out=raw)
+            data.append(np.round(raw).astype(np.uint16))
+            heads.append(head)
+        rawfile = os.path.join(outdir, 'raw%03d.fits' % (k+1))
+        error = fitswrite(rawfile, data, heads=heads)
+        if error!='': raise IOError(error)
+        files['raw'].append(rawfile)
+
+    return files
@@ -4,20 +4,144 @@
  This is a generic CCD image processing program.
 
  INPUTS:
-  input       The input list of images.
+  input       The input list of images: names, wildcards (also "**"),
+                comma lists and "@list" files (see loadinput).  The
+                input is expanded while the first files are processed.
   optional keyword arguments:
   =xTalk
-  =linCorr    Apply linearity correction
-  =fixPix
+  =linCorr    Apply linearity correction with this file, polynomial
+                coefficients per extension or amplifier, or tabulated
+                corrections (see ccdproc_lincorr).  With /fused, raw
+                16-bit data is corrected with lookup tables while it
+                is converted to float.
+  =fixPix     Interpolate over the bad pixel regions of this file
+                ("X Y" or "X1 X2 Y1 Y2" lines, see ccdproc_loadfixpix).
+                The regions are compiled once per image size into a
+                cached plan (ccdproc_fixpixplan).
   =zero
   =flat
   =illum      Apply
   =bootstrap  Apply bootstrap correction.
-  =bpm        Apply bad pixel mask using
+  =bpm        Apply bad pixel mask using this BPM file.  It is read
+                once per run into bit-packed flag planes with
+                precomputed indices (see ccdproc_mask).
   optional boolean keyword arugments:
   /trim
   /overscan
   /clobber
+  /fused      Apply all of the per-pixel steps after cross-talk in a
+                single in-place pass over one working buffer (see
+                ccdproc_fused).  The peak memory is printed per extension.
+  =dtype      The working buffer type for /fused, 'float32' (default)
+                or 'float64'.
+  =cachesize  Memory budget of the calibration frame cache in MB.
+                Default is 2048.
+  =workers    Number of worker processes to process the files with.
+                Default is 1.  Use 0 for one worker per CPU.  The
+                calibration cache statistics of the workers are only
+                printed with /profile.
+  =threads    Number of threads to calibrate the extensions of a
+                file with.  Default is 1.  The output is still written
+                in extension order.  An extension that fails does not
+                stop the others, all failures are reported.
+  =catalog    The header catalog file (see ccdproc_catalog).  Files
+                whose extensions the catalog shows have all of the
+                requested steps done are skipped without opening
+                them.  The catalog is updated as outputs are written.
+  =journal    The processing journal file (see ccdproc_journal).  It
+                records content hashes of every input, of the
+                calibration files and of the step configuration.  A
+                rerun skips the files whose key is unchanged, redoes
+                the ones whose calibrations changed and cleans up
+                after runs that were killed (orphaned _temp files).
+  /stream     Overlap reading, calibration and writing.  Extensions
+                (across files) are read ahead by a reader thread and
+                written behind by a writer thread (see ccdproc_stream).
+                The queue depths are printed at the end.
+  =readahead  The depth of the /stream read and write queues.
+                Default is 4.
+  =ovfunction The overscan estimator: 'median' (default), 'mean',
+                'sigclip', 'poly' or 'spline' (see ccdproc_overscan).
+                All amplifiers (BIASSECA/DATASECA, ...) are corrected.
+  =ovorder    The order of the 'poly' or 'spline' overscan fit.
+                Default is 3.
+  =maxmem     Memory ceiling in MB for the bounded-memory (strip) mode
+                for frames larger than memory.  Reading, calibration
+                and writing are done in horizontal bands that fit in
+                MAXMEM (see ccdproc_strips), the output is identical.
+                The flat/illum medians come from a pre-pass.  This
+                implies /fused and cannot be used with xTalk or
+                /stream.  Default is 0 (whole frames).
+  =compress   Write the output extensions tile-compressed (fpack
+                style) with this compression type: 'RICE_1', 'GZIP_1'
+                or 'GZIP_2' (see fitscomp).  Tile-compressed inputs
+                (.fits.fz) are always read directly and are written
+                back with RICE_1 unless another type is given.  Not
+                possible with MAXMEM.  Default is '' (uncompressed).
+  =quantize   The quantization level of compressed floating point
+                output, the step is the noise of each row divided by
+                QUANTIZE.  0 is lossless (GZIP only).  Default is 4.
+  =outtype    The output data type (see fitswrite): '' (default,
+                float32 or float64 like DTYPE), 'float32', 'int16'
+                (scaled with BSCALE/BZERO, NaNs are BLANK) or
+                'quantized' (RICE tile-compressed quantized floats).
+                Every output is written in one open of a temporary
+                file, preallocated to its final size, and renamed over
+                the input at the end.  'int16' and 'quantized' are not
+                possible with MAXMEM.
+  =fsync      When the outputs are flushed to disk: 'none' (default),
+                'file' (every file before its rename) or 'batch:N'
+                (every N files, and at the end of the run).
+  /profile    Time every step of every extension (reading, the
+                processing steps, header updates, writing) and count
+                the bytes read and written, calibration cache hits and
+                the peak memory per file (see ccdproc_profile).  The
+                summary table is printed at the end.  The overhead is
+                a clock read per step.
+  =proffile   Write the profile as JSON lines to this file, one record
+                per file (also from the worker processes).  This
+                implies /profile.  The file is started fresh.
+  /mask       Write the pixel masks (bad pixels from the BPM, fixpix
+                pixels) to a RICE-compressed mask file next to the
+                output, BASE_mask.fits.fz with one mask extension per
+                image extension, instead of setting the bad pixels to
+                65535.  This implies /fused.
+  =steporder  The order of the processing stages (see ccdproc_graph):
+                a comma list of stage names, i.e.
+                'xtalk,lincorr,fixpix,overscan,trim,zero,flat,illum,
+                bootstrap,bpm' (the default), or a file with an order
+                per instrument (INSTRUME).  Inactive stages are
+                dropped when the run is set up and, with /fused,
+                adjacent stages are run in one pass.
+  =queue      The shared work queue of a campaign (see ccdproc_queue),
+                i.e. 'sqlite:/survey/season1.queue'.  The input is added
+                to the queue as work units (files already in it are
+                kept) and the WORKERS processes lease units from it
+                until the whole queue is done.  Workers on other hosts
+                run ccdproc with the same options and the same QUEUE,
+                with or without input.  Units of workers that died are
+                retried when their lease runs out.  Use a JOURNAL, so a
+                file whose unit is retried after its output was written
+                is skipped.  The progress of the campaign and the
+                failed units are printed at the end.
+  /byext      Queue one unit per extension of a file and a merge unit
+                that assembles the output from the extension parts
+                (BASE_partN.fits next to the input).  Needs QUEUE, not
+                possible with xTalk, MAXMEM or /mask.
+  =lease      The lease time of a queue unit in seconds, it is renewed
+                while the unit is processed.  Default is 600.
+  =maxtries   The attempts of a queue unit before it is FAILED.
+                Default is 3.
+  =batch      Calibrate the files in batches of BATCH exposures.  The
+                same extension of all of the files in a batch is read,
+                the steps before zero run per file, and zero, flat,
+                illum and bootstrap are applied to the 3D stack of the
+                exposures at once, each calibration frame broadcast
+                over the stack (see ccdproc_stack).  The outputs are
+                still written per file and are the same as without
+                BATCH.  With WORKERS every process takes whole
+                batches.  Not possible with xTalk, MAXMEM, /mask,
+                /stream or QUEUE.  Default is 0 (file by file).
   /silent     Don't print anything to the screen.
 
  OUTPUTS:
@@ -30,30 +154,1279 @@
 #KENZA - Q: is gainCorr a dead variable?
 #KENZA - Q: is verbose a dead variable?
 
-def bombfile(error1):
+def bombfile(error1, outfile, silent):
     # An error occured
     if error1!='':
-        error[f] = error1
-        if not silent: print error[f]
+        if not silent: print error1
         # delete temporary file
         FILE_DELETE(outfile, allow_nonexistent=True, quiet=True)
+    return error1
+
+
+def ccdproc_outbitpix(outtype, dtype):
+    # BITPIX of the output pixels
+    if outtype=='int16': return 16
+    if outtype=='' and dtype=='float64': return -64
+    return -32
+
+
+def calload(file, exten):
+    # Load a calibration image for the calibration cache
+    fits, message = fitsindex(file)
+    if message!='': raise IOError(message)
+    return fits.data(exten)
+
+
+def ccdproc_fusedext(im, head, exten, linstr=None, fixstr=None, \
+                         overscan=False, trim=False, zero='', flat='', \
+                         illum='', bootstr=None, bpm='', dtype='float32', \
+                         ovfunction='median', ovorder=3, cache=None, \
+                         maskstore=None, masks=None, maxmem=0, outfh=None, \
+                         lap=NOLAPS, plan=None, silent=False):
+    # Gather the inputs for ccdproc_fused and update the header
+    #  With MAXMEM>0 the extension is processed and written to OUTFH
+    #  (a FitsWriter) band by band (ccdproc_strips), nothing is
+    #  returned then
+    #  With MASKS (a dictionary) the pixel mask of the extension is put
+    #  there and the bad pixels are not changed
+    #  LAP is the lap timer of the extension (ccdproc_profile)
+    #  PLAN is the validated plan of the run (ccdproc_plan), the trim
+    #  sections and bootstrap scales come from it
+    errprefix = 'CCDPROC: '   # error message prefix
+
+    # Have we done these processing steps already?
+    for key,name,on in [('LINCORR','Linearity',linstr is not None), \
+                        ('FIXPIX','Fixpix',fixstr is not None), \
+                        ('OVERSCAN','Overscan',overscan), \
+                        ('TRIM','Trim',trim), ('ZEROCOR','Zero',zero!=''), \
+                        ('FLATCOR','Flat',flat!=''), \
+                        ('ILLUMCOR','Illumination',illum!=''), \
+                        ('BTSTRP','Bootstrap',bootstr is not None), \
+                        ('BPM','BPM',bpm!='')]:
+        if on and fitshaskey(head, key):
+            error = errprefix+name+' correction already applied.'
+            if not silent: print error
+            return None, error
+
+    if plan is None:
+        plan, error = ccdproc_plan(bootstr=bootstr, trim=trim, silent=silent)
+        if error!='': return None, error
+
+    # Sections, parsed once per detector layout
+    ovgeom = None
+    trimsec = None
+    if trim:
+        trimsec = plan.trimsec(head)
+        if trimsec==-1:
+            error = errprefix+'Header must have TRIMSEC or DATASEC'
+            if not silent: print error
+            return None, error
+        trimsec = list(trimsec)
+    if overscan:
+        # All amplifiers, the geometry is cached per detector layout
+        try:
+            ovgeom = ccdproc_overscangeom(head, im.shape)
+        except ValueError as e:
+            error = errprefix+str(e)
+            if not silent: print error
+            return None, error
+
+    # Scalar and polynomial corrections
+    #  the linearity lookup tables are cached per correction
+    try:
+        linplan = ccdproc_linplan(linstr, exten, head, im.shape, im.dtype, dtype=dtype)
+    except ValueError as e:
+        error = errprefix+str(e)
+        if not silent: print error
+        return None, error
+    fixplan = None
+    if fixstr is not None:
+        fixplan = ccdproc_fixpixplan(fixstr, im.shape)
+    bootscale = plan.bootscale(exten)
+    if bootstr is not None and bootscale is None:
+        error = errprefix+'Right extension NOT FOUND in Bootstrap structure.'
+        if not silent: print error
+        return None, error
+    lap('plan')
+
+    # Calibration images, shared by all files through the cache
+    if cache is None: cache = CalCache(loader=calload)
+    zeroim = None
+    flatim = None
+    medflat = None
+    illumim = None
+    medillum = None
+    if zero!='': zeroim = cache.get(zero, exten)
+    if maxmem>0:
+        # The raw frames on the memory maps, exact medians band by band
+        def stripmedian(calim):
+            return float(ccdproc_stripmedian(calim))
+        if flat!='':
+            flatim = cache.get(flat, exten)
+            medflat = cache.derived(flat, exten, 'median', stripmedian)
+        if illum!='':
+            illumim = cache.get(illum, exten)
+            medillum = cache.derived(illum, exten, 'median', stripmedian)
+    else:
+        if flat!='': flatim, medflat = ccdproc_calflat(cache, flat, exten)
+        if illum!='': illumim, medillum = ccdproc_calflat(cache, illum, exten)
+    lap('calib')
+
+    # Pixel mask, the BPM planes are loaded once per run
+    outshape = im.shape
+    if trim: outshape = (trimsec[3]-trimsec[2]+1, trimsec[1]-trimsec[0]+1)
+    if maskstore is None and (bpm!='' or masks is not None):
+        maskstore = MaskStore(bpm, loader=calload)
+    bpmind = None
+    if bpm!='':
+        pixmask = maskstore.get(exten)
+        if pixmask.shape!=outshape:
+            error = errprefix+'BPM image has wrong size, must be ['+ \
+                str(outshape[1])+','+str(outshape[0])+'].'
+            if not silent: print error
+            return None, error
+        bpmind = pixmask.indices('bad')
+    if masks is not None:
+        pixmask = maskstore.get(exten, shape=outshape).copy()
+        if fixplan is not None:
+            # Fixpix targets in output coordinates
+            ty, tx = fixplan['ty'], fixplan['tx']
+            if trim:
+                ty, tx = ty-trimsec[2], tx-trimsec[0]
+            inside = (ty>=0) & (ty<outshape[0]) & (tx>=0) & (tx<outshape[1])
+            pixmask.set('fixpix', ty[inside].astype(np.int64)*outshape[1]+tx[inside])
+        masks[exten] = pixmask
+    lap('mask')
+
+    def addhead(stats):
+        # Add processing information to header
+        date = systime(0)
+        datearr = strtrim(strsplit(date, ' ', extract=True), 2)
+        timarr = strsplit(datearr[3], ':', extract=True)
+        datestr = datearr[1] + ' ' + datearr[2] + ' ' + \
+            strjoin(timarr[0:1] ,':')
+        if linplan is not None:
+            fitsaddpar(head, 'LINCORR', datestr+' Lincorr applied'+ \
+                           (', lookup table' if linplan['lut'] else ''))
+        if fixplan is not None:
+            fitsaddpar(head, 'FIXPIX', datestr+' Fixpix '+str(fixplan['npix'])+ \
+                           ' pixels in '+str(fixplan['nregion'])+' regions')
+        if overscan:
+            fitsaddpar(head, 'OVSNMEAN', stats['ovsnmean'])
+            for amp,m in zip(ovgeom, stats['ovsnamp']):
+                if amp['name']!='': fitsaddpar(head, 'OVSNMN'+amp['name'], m)
+            fitsaddpar(head, 'OVERSCAN', datestr+' Overscan is '+ \
+                           strjoin([amp['biassec'] for amp in ovgeom], ',')+ \
+                           ', '+ovfunction+' mean '+str(stats['ovsnmean']))
+        if trim:
+            fitsaddpar(head, 'TRIM', datestr+' Trim is '+ \
+                           '[%d:%d,%d:%d]' % tuple([t+1 for t in trimsec]))
+        if zero!='':
+            fitsaddpar(head, 'ZEROCOR', datestr+' Zero is '+zero)
+        if flat!='':
+            fitsaddpar(head, 'FLATCOR', datestr+' Flat is '+flat+', scale '+ \
+                           '%.2f' % stats['medflat'])
+        if illum!='':
+            fitsaddpar(head, 'ILLUMCOR', datestr+' Illum is '+illum+', scale '+ \
+                           '%.2f' % stats['medillum'])
+        if bootscale is not None:
+            fitsaddpar(head, 'BTSTRP', datestr+' Bootstrap scale '+str(bootscale))
+        if bpm!='':
+            fitsaddpar(head, 'BPM', datestr+' BPM is '+bpm+', '+ \
+                           str(len(bpmind))+' bad pixels'+ \
+                           (' masked' if masks is not None else ''))
+        return datestr
+
+    # Bounded memory, the header is complete before the data is written
+    if maxmem>0:
+        stats, error = ccdproc_stripstats(im, ovgeom=ovgeom, \
+                                          ovfunction=ovfunction, \
+                                          ovorder=ovorder, linplan=linplan, \
+                                          fixplan=fixplan, flatim=flatim, \
+                                          illumim=illumim, \
+                                          medflat=medflat, medillum=medillum, \
+                                          dtype=dtype, silent=silent)
+        if error!='': return None, error
+        lap('stripstats')
+        datestr = addhead(stats)
+        fitsaddpar(head, 'CCDPROC', datestr+' CCD processing done')
+        lap('header')
+        ny, nx = im.shape
+        if trim: ny, nx = trimsec[3]-trimsec[2]+1, trimsec[1]-trimsec[0]+1
+        try:
+            outfh.starthdu((ny,nx), dtype, head, primary=(exten==0))
+        except (IOError, OSError, ValueError) as e:
+            error = errprefix+str(e)
+            if not silent: print error
+            return None, error
+        def writeband(row0, band):
+            outfh.writerows(band)
+        error = ccdproc_strips(im, writeband, ovgeom=ovgeom, \
+                               trimsec=trimsec, trim=trim, linplan=linplan, \
+                               fixplan=fixplan, zeroim=zeroim, flatim=flatim, \
+                               illumim=illumim, bootscale=bootscale, \
+                               bpmind=None if masks is not None else bpmind, \
+                               dtype=dtype, prestats=stats, \
+                               maxmem=maxmem, stats=stats, silent=silent)
+        if error!='': return None, error
+        outfh.endhdu()
+        lap('strips')
+        lap.peak('peakmem', stats['peakmem'])
+        if not silent:
+            print 'Exten '+str(exten)+' '+str(stats['nstrips'])+' bands, peak memory '+ \
+                str(stats['peakmem']/1048576.)+' MB'
+        return None, error
+
+    # Run all of the steps in one pass
+    stats = {}
+    out, error = ccdproc_fused(im, trimsec=trimsec, trim=trim, \
+                               ovgeom=ovgeom, ovfunction=ovfunction, \
+                               ovorder=ovorder, linplan=linplan, fixplan=fixplan, \
+                               zeroim=zeroim, flatim=flatim, medflat=medflat, \
+                               illumim=illumim, medillum=medillum, \
+                               bootscale=bootscale, \
+                               bpmind=None if masks is not None else bpmind, dtype=dtype, \
+                               stats=stats, silent=silent)
+    if error!='': return None, error
+    lap('fused')
+    lap.peak('peakmem', stats['peakmem'])
+    if not silent:
+        print 'Exten '+str(exten)+' peak memory '+ \
+            str(stats['peakmem']/1048576.)+' MB'
+    addhead(stats)
+    lap('header')
+
+    return out, error
+
+
+def ccdproc_ext(file, i, no_pdu, opts, im=None, head=None, xcor=None, \
+                outfh=None, masks=None, nodes=None, final=True):
+    # Process one extension, returns the image, header and error message
+    #  IM and HEAD can be given if they were already read
+    #  XCOR has the cross-talk corrected images of the exposure
+    #  OUTFH is the output FitsWriter for the bounded-memory mode (opts['maxmem']),
+    #  the extension is then written band by band and IM is None
+    #  MASKS is the dictionary for the pixel masks (opts['mask'])
+    #  The steps are timed with the lap timer of opts['profile']
+    #  The stages and their order come from the step graph opts['graphs']
+    #  NODES runs only these nodes of the graph, without FINAL the
+    #  extension is not marked as done (the batch mode runs the rest)
+    errprefix = 'CCDPROC: '   # error message prefix
+    silent = opts['silent']
+    if nodes is None: nodes = opts['graphs'].get(file).nodes
+    lap = opts['profile'].laps(file, i)
+
+    # Load the file, the index is shared with ccdproc_fileinfo
+    if im is None:
+        fits, error1 = fitsindex(file)
+        if error1!='': return None, None, error1
+        im = fits.data(i)
+        head = fits.header(i)
+    # Indexed header, the keyword updates are applied when it is written
+    if not isinstance(head, FitsHeader): head = FitsHeader(head)
+    origim = im
+    # A fused first stage converts to float block by block
+    if len(nodes)==0 or nodes[0]['name']!='fused': im = float(im)
+    lap('read')
+
+    # Check the image and header
+    #  the inputs were validated when the run was set up (ccdproc_plan),
+    #  only the type and size of this extension are checked
+    error1 = opts['plan'].guard(i, im, head)
+    if error1!='':
+        error1 = errprefix+error1
+        if not silent: print error1
+        return None, None, error1
+
+    #str = {im:im, head:head, fixPix:keyword_set(fixPix), \
+    #    overtrim:keyword_set(overtrim), zero:'', flat:''}
+    
+    # Run the stages of the compiled step graph (ccdproc_graph), only
+    #  the active ones are there, in the order of the instrument
+    im, error1 = ccdproc_runnodes(im, head, i, nodes, opts, lap=lap, xcor=xcor, \
+                                  outfh=outfh, masks=masks)
+    if error1!='': return None, None, error1
+
+    if final:
+        ccdproc_stamp(head)
+        lap('header')
+
+    return im, head, ''
+
+
+def ccdproc_stamp(head):
+    # Mark an extension as processed
+
+    # Example of how the header is modified.
+    #XTALKCOR= 'Oct  8 21:19 No crosstalk correction required'
+    #OVSNMEAN=             1503.989
+    #TRIM    = 'Oct  8 21:19 Trim is [25:1048,1:4096]'
+    #FIXPIX  = 'Oct  8 21:19 Fix mscdb$noao/Mosaic2/CAL0102/bpm3_0102 + sat + bleed'
+    #OVERSCAN= 'Oct  8 21:19 Overscan is [1063:1112,1:4096], mean 1503.989'
+    #ZEROCOR = 'Oct  8 21:19 Zero is Zero[im5]'
+    #FLATCOR = 'Oct  8 21:19 Flat is DFlatM.fits[im5], scale 10490.72'
+    #CCDPROC = 'Oct 18 11:34 CCD processing done'
+    #PROCID  = 'ct4m.20070817T081040V3'
+    #SFLATCOR= 'Oct 18 11:34 Sky flat is Sflatn12M.fits[im5], scale 833.0756'
+    # Add final processing info to header
+    date = systime(0)
+    datearr = strtrim(strsplit(date, ' ', extract=True), 2)
+    timarr = strsplit(datearr[3], ':', extract=True)
+    datestr = datearr[1] + ' ' + datearr[2] + ' ' + \
+        strjoin(timarr[0:1] ,':')
+    fitsaddpar(head, 'CCDPROC', datestr+' CCD processing done')
+
+
+def ccdproc_runnodes(im, head, i, nodes, opts, lap=NOLAPS, xcor=None, \
+                     outfh=None, masks=None):
+    # Run the NODES of a compiled step graph on extension I, returns
+    #  the image and the error message, see ccdproc_ext
+    errprefix = 'CCDPROC: '   # error message prefix
+    error1 = ''
+    zero = opts['zero']
+    flat = opts['flat']
+    illum = opts['illum']
+    bpm = opts['bpm']
+    ovfunction = opts['ovfunction']
+    ovorder = opts['ovorder']
+    dtype = opts['dtype']
+    silent = opts['silent']
+    linstr = opts['linstr']
+    bootstr = opts['bootstr']
+    xstr = opts['xstr']
+    fixstr = opts['fixstr']
+    cache = opts['cache']
+
+    for node in nodes:
+        name = node['name']
+        # Cross-talk
+        #-----------
+        if name=='xtalk' and xcor is not None:
+            # Already done for the whole exposure by ccdproc_xtalkfile
+            if fitshaskey(head, 'XTALKCOR'):
+                return None, errprefix+'Xtalkcor correction already done.'
+            if i in xcor:
+                im = xcor[i]
+                date = systime(0)
+                datearr = strtrim(strsplit(date, ' ', extract=True), 2)
+                timarr = strsplit(datearr[3], ':', extract=True)
+                datestr = datearr[1] + ' ' + datearr[2] + ' ' + \
+                    strjoin(timarr[0:1] ,':')
+                fitsaddpar(head, 'XTALKCOR', datestr+' Crosstalk is '+ \
+                               opts['xmat']['text'][i])
+        elif name=='xtalk':
+            ccdproc_xtalk(im, head, i, xstr, error=error1, silent=silent)
+            if error1!='': return None, error1
+        # Fused stages
+        #-------------
+        #  adjacent per-pixel steps in one in-place pass
+        elif name=='fused':
+            steps = node['steps']
+            im, error1 = ccdproc_fusedext(im, head, i, \
+                                          linstr=linstr if 'lincorr' in steps else None, \
+                                          fixstr=fixstr if 'fixpix' in steps else None, \
+                                          overscan='overscan' in steps, \
+                                          trim='trim' in steps, \
+                                          zero=zero if 'zero' in steps else '', \
+                                          flat=flat if 'flat' in steps else '', \
+                                          illum=illum if 'illum' in steps else '', \
+                                          bootstr=bootstr if 'bootstrap' in steps else None, \
+                                          bpm=bpm if 'bpm' in steps else '', \
+                                          dtype=dtype, ovfunction=ovfunction, \
+                                          ovorder=ovorder, cache=cache, \
+                                          maskstore=opts['maskstore'], masks=masks, \
+                                          maxmem=opts['maxmem'], outfh=outfh, \
+                                          lap=lap, plan=opts['plan'], silent=silent)
+            if error1!='': return None, error1
+        # Stacked stages
+        #---------------
+        #  the batch mode runs these over all exposures at once
+        elif name=='stack':
+            cube, error1 = ccdproc_stackext(im[np.newaxis], [head], i, node['steps'], \
+                                            opts, lap=lap)
+            if error1!='': return None, error1
+            im = cube[0]
+        # Linearity Correction
+        #---------------------
+        elif name=='lincorr':
+            error1 = ccdproc_lincorr(im, head, i, linstr, silent=silent)
+            if error1!='': return None, error1
+        # FixPix
+        #----------
+        elif name=='fixpix':
+            error1 = ccdproc_fixpix(im, head, fixstr, silent=silent)
+            if error1!='': return None, error1
+        # Overscan
+        #---------
+        elif name=='overscan':
+            error1 = ccdproc_overscan(im, head, function=ovfunction, \
+                                      order=ovorder, silent=silent)
+            if error1!='': return None, error1
+        # Trim
+        #-----
+        elif name=='trim':
+            ccdproc_trim(im, head, error=error1, silent=silent)
+            if error1!='': return None, error1
+        # Zero Correct
+        #-------------
+        elif name=='zero':
+            ccdproc_zero(im, head, zero, exten=i, error=error1, \
+                             silent=silent)
+            if error1!='': return None, error1
+        # Domeflat Correct
+        #-----------------
+        elif name=='flat':
+            ccdproc_flat(im, head, zero, exten=i, error=error1, \
+                             silent=silent)
+            if error1!='': return None, error1
+        # Illumination Correction
+        #-------------------------
+        # maybe this should be called sflatcor
+        elif name=='illum':
+            ccdproc_illum(im, head, zero, exten=i, error=error1, \
+                              silent=silent)
+            if error1!='': return None, error1
+        # Bootstrap
+        #----------
+        elif name=='bootstrap':
+            ccdproc_bootstrap(im, head, bootstr, exten=i, checked=True, \
+                              error=error1, silent=silent)
+            if error1!='': return None, error1
+        # Bad Pixel Mask
+        #----------------
+        elif name=='bpm':
+            ccdproc_bpm(im, head, bpm, exten=i, cache=cache, \
+                            maskstore=opts['maskstore'], checked=True, \
+                            error=error1, silent=silent)
+            if error1!='': return None, error1
+        # the fused and stack nodes time their own phases
+        if name!='fused' and name!='stack': lap(name)
+
+    # The stage order is set per instrument with STEPORDER (see
+    # ccdproc_graph), dark and fringe corrections would be new stages
+
+    return im, ''
+
+
+def ccdproc_stackcheck(head, steps):
+    # Have the stacked STEPS been applied already? returns the error message
+    for key,name,step in [('ZEROCOR','Zero','zero'), ('FLATCOR','Flat','flat'), \
+                          ('ILLUMCOR','Illumination','illum'), \
+                          ('BTSTRP','Bootstrap','bootstrap')]:
+        if step in steps and fitshaskey(head, key):
+            return 'CCDPROC: '+name+' correction already applied.'
+    return ''
+
+
+def ccdproc_stackext(cube, heads, i, steps, opts, lap=NOLAPS):
+    # Apply the stacked STEPS (zero, flat, illum, bootstrap) of extension
+    #  I to a cube of exposures, the calibration frames are broadcast
+    #  over the stack (ccdproc_stack), returns the cube and the error message
+    #  HEADS are the headers of the exposures in the cube
+    errprefix = 'CCDPROC: '   # error message prefix
+    zero = opts['zero'] if 'zero' in steps else ''
+    flat = opts['flat'] if 'flat' in steps else ''
+    illum = opts['illum'] if 'illum' in steps else ''
+    silent = opts['silent']
+    cache = opts['cache']
+
+    for head in heads:
+        error1 = ccdproc_stackcheck(head, steps)
+        if error1!='':
+            if not silent: print error1
+            return None, error1
+    bootscale = None
+    if 'bootstrap' in steps:
+        bootscale = opts['plan'].bootscale(i)
+        if bootscale is None:
+            error1 = errprefix+'Right extension NOT FOUND in Bootstrap structure.'
+            if not silent: print error1
+            return None, error1
+
+    # Calibration images, shared by all files through the cache
+    zeroim = None
+    flatim = None
+    medflat = None
+    illumim = None
+    medillum = None
+    if zero!='': zeroim = cache.get(zero, i)
+    if flat!='': flatim, medflat = ccdproc_calflat(cache, flat, i)
+    if illum!='': illumim, medillum = ccdproc_calflat(cache, illum, i)
+    lap('calib')
+
+    stats = {}
+    cube, error1 = ccdproc_stack(cube, zeroim=zeroim, flatim=flatim, illumim=illumim, \
+                                 bootscale=bootscale, medflat=medflat, \
+                                 medillum=medillum, stats=stats, silent=silent)
+    if error1!='': return None, error1
+
+    # Add processing information to the headers
+    date = systime(0)
+    datearr = strtrim(strsplit(date, ' ', extract=True), 2)
+    timarr = strsplit(datearr[3], ':', extract=True)
+    datestr = datearr[1] + ' ' + datearr[2] + ' ' + \
+        strjoin(timarr[0:1] ,':')
+    for head in heads:
+        if zero!='':
+            fitsaddpar(head, 'ZEROCOR', datestr+' Zero is '+zero)
+        if flat!='':
+            fitsaddpar(head, 'FLATCOR', datestr+' Flat is '+flat+', scale '+ \
+                           '%.2f' % stats['medflat'])
+        if illum!='':
+            fitsaddpar(head, 'ILLUMCOR', datestr+' Illum is '+illum+', scale '+ \
+                           '%.2f' % stats['medillum'])
+        if bootscale is not None:
+            fitsaddpar(head, 'BTSTRP', datestr+' Bootstrap scale '+str(bootscale))
+    lap('stack')
+
+    return cube, ''
+
+
+def ccdproc_file(file, opts):
+    # Process one input file, returns the error message
+    #  With opts['profile'] the file is profiled, its record is
+    #  written when it is done
+    prof = opts['profile']
+    cache = opts['cache']
+    prof.begin(file)
+    hits, misses = cache.hits, cache.misses
+    error = ccdproc_dofile(file, opts)
+    prof.count(file, 'cache_hits', cache.hits-hits)
+    prof.count(file, 'cache_misses', cache.misses-misses)
+    prof.done(file, error=error)
+    return error
+
+
+def ccdproc_startfile(file, opts):
+    # Check a file and open its output, returns the output state and
+    #  the error message.  The state is None if the file is skipped
+    #  (already processed) or failed.
+    clobber = opts['clobber']
+    silent = opts['silent']
+    hcat = opts['catalog']
+
+    # Nothing left to do according to the catalog
+    if hcat is not None and os.path.exists(file):
+        try:
+            ntodo = len(hcat.todo(file, opts['steps']))
+        except IOError:
+            ntodo = -1   # not valid FITS, the checks below report it
+        if ntodo==0:
+            if not silent: print file+' already processed'
+            return None, ''
+
+    # File information and headers
+    info = ccdproc_fileinfo(file, xtrafits=True)
+    origfile = info.file
+    outfile = info.dir+'/'+info.base+'_temp.fits'
+    maskfile = info.dir+'/'+info.base+'_mask_temp.fits'
+
+    # File does not exist
+    if info.exists==0:
+        return None, bombfile(origfile+' NOT FOUND', outfile, silent)
+
+    # Already done with the same inputs according to the journal
+    jrn = opts['journal']
+    if jrn is not None:
+        action = jrn.begin(file, opts['jkey'], outfile, inplace=not clobber)
+        if action=='skip':
+            if not silent: print file+' already processed'
+            return None, ''
+        if action=='stale':
+            return None, bombfile(origfile+' WAS PROCESSED WITH OTHER CALIBRATIONS, '+ \
+                                  'THE RAW DATA IS GONE', outfile, silent)
+        # Header state of files that changed since they were processed
+        info = ccdproc_fileinfo(file, xtrafits=True)
+
+    # Not a FITS file
+    if info.ext!='fits' and info.ext!='fz':
+        return None, bombfile(origfile+' NOT A FITS FILE', outfile, silent)
+
+    # The calibrations against a layout that was not seen yet
+    error1 = opts['plan'].checklayout(file)
+    if error1!='': return None, bombfile('CCDPROC_PLAN: '+error1, outfile, silent)
+
+    if not silent: print 'Processing ',file_basename(info.file)
+    prof = opts['profile']
+    prof.count(file, 'bytes_read', os.path.getsize(file))
+
+    # Compressed inputs stay compressed, the strip mode needs
+    #  memory-mapped uncompressed data
+    compress = opts['compress']
+    if info.ext=='fz' and opts['maxmem']>0:
+        return None, bombfile(origfile+' IS COMPRESSED, MAXMEM NOT POSSIBLE', outfile, silent)
+    if compress=='' and info.ext=='fz': compress = 'RICE_1'
+
+    next = info.nextend
+
+    # Initialize output file
+    #  all HDUs are written in one open, preallocated to the expected
+    #  size, and the file is renamed into place at the end
+    FILE_DELETE(outfile, allow_nonexistent=True, quiet=True)
+    outtype = opts['outtype']
+    try:
+        size = 0
+        if compress=='' and outtype!='quantized':
+            fits, error1 = fitsindex(file)
+            if error1=='': size = fitsoutsize(fits.hdu, ccdproc_outbitpix(outtype, opts['dtype']))
+        writer = FitsWriter(None if clobber else file, tmpfile=outfile, size=size, \
+                            outtype=outtype, compress=compress, quantize=opts['quantize'], \
+                            threads=max(opts['threads'],1), sync=opts['sync'])
+        # compressed images are always extensions
+        if next>0 or writer.compress!='':
+            writer.primary(info.hdu[0].head if next>0 else None, nextend=max(next,1))
+    except (IOError, OSError, ValueError) as e:
+        return None, bombfile('CCDPROC: '+str(e), outfile, silent)
+
+    if next==0:
+        loext = 0L
+        no_pdu = 0
+    else:
+        loext = 1L
+        no_pdu = 1
+
+    return {'file':file, 'info':info, 'outfile':outfile, 'maskfile':maskfile, \
+            'writer':writer, 'next':next, 'no_pdu':no_pdu, \
+            'extens':range(loext,loext+max(next,1))}, ''
+
+
+def ccdproc_writeext(out, i, im, head, opts):
+    # Write one calibrated extension to the output, returns the error
+    #  message.  BITPIX follows the OUTTYPE policy
+    writer = out['writer']
+    try:
+        with opts['profile'].step('write', out['file'], i):
+            if out['next']==0 and writer.compress=='':
+                writer.primary(head, im=im)
+            else:
+                writer.append(im, head)
+    except (IOError, OSError, ValueError) as e:
+        writer.abort()
+        return bombfile('CCDPROC: '+str(e), out['outfile'], opts['silent'])
+    return ''
+
+
+def ccdproc_leaselost(opts):
+    # Error message if the queue lease of the unit being processed was
+    #  lost, another worker may hold it now and only it may commit
+    lease = opts['lease']
+    if lease is None or not lease.lost: return ''
+    return 'CCDPROC: LEASE OF '+lease.unit['id']+' WAS LOST, NOT COMMITTED'
+
+
+def ccdproc_endfile(out, opts, masks=None, maskheads=None):
+    # Finish the output of a file and move it into place, returns the
+    #  error message
+    file = out['file']
+    info = out['info']
+    writer = out['writer']
+    clobber = opts['clobber']
+    silent = opts['silent']
+    hcat = opts['catalog']
+    jrn = opts['journal']
+    prof = opts['profile']
+
+    # The mask file, next to the output
+    if masks is not None:
+        error1 = ccdproc_writemask(out['maskfile'], [masks[i] for i in out['extens']], \
+                                   heads=maskheads)
+        if error1!='':
+            writer.abort()
+            return bombfile(error1, out['outfile'], silent)
+
+    # Move temporary file to original file, an atomic rename
+    try:
+        with prof.step('commit', file):
+            writer.close()
+            error1 = ccdproc_leaselost(opts)
+            if error1!='':
+                writer.abort()
+                if masks is not None:
+                    FILE_DELETE(out['maskfile'], allow_nonexistent=True, quiet=True)
+                return bombfile(error1, out['outfile'], silent)
+            if not clobber and jrn is not None: jrn.moving(file)
+            writer.commit()
+    except (IOError, OSError) as e:
+        return bombfile('CCDPROC: '+str(e), out['outfile'], silent)
+    prof.count(file, 'bytes_written', writer.nbytes)
+    if not clobber:
+        if masks is not None:
+            FILE_MOVE(out['maskfile'], info.dir+'/'+info.base+'_mask.fits.fz', \
+                      overwrite=True, allow=True)
+
+        # Record the new processing state
+        if hcat is not None: hcat.update(file)
+    if jrn is not None: jrn.done(file)
+
+    return ''
+
+
+def ccdproc_dofile(file, opts):
+    # Process one input file, returns the error message
+    threads = opts['threads']
+    silent = opts['silent']
+    prof = opts['profile']
+
+    # Checks, journal and the output file
+    out, error1 = ccdproc_startfile(file, opts)
+    if out is None: return error1
+    writer = out['writer']
+    outfile = out['outfile']
+    no_pdu = out['no_pdu']
+    extens = out['extens']
+
+    #---------------------------
+    # LOOP OVER THE EXTENSIONS
+    #---------------------------
+    # Cross-talk for all extensions at once
+    xcor = None
+    if opts['xmat'] is not None:
+        with prof.step('xtalk', file):
+            xcor, error1 = ccdproc_xtalkfile(file, opts['xmat'])
+        if error1!='':
+            writer.abort()
+            return bombfile(error1, outfile, silent)
+
+    # Bounded memory, the extensions are written band by band
+    outfh = None
+    if opts['maxmem']>0: outfh = writer
+
+    # Pixel masks of the extensions
+    masks = None
+    maskheads = []
+    if opts['mask']: masks = {}
+
+    # Calibrate the extensions on a thread pool
+    if threads>1 and outfh is None:
+        results = ccdproc_threadmap(ccdproc_ext, \
+                                    [(file,i,no_pdu,opts,None,None,xcor,None,masks) \
+                                     for i in extens], threads=threads)
+        exterrors = []
+    else:
+        results = ((ccdproc_ext(file,i,no_pdu,opts,xcor=xcor,outfh=outfh, \
+                                masks=masks),'') for i in extens)
+
+    # Write the output in extension order
+    for i,(result,error1) in zip(extens,results):
+        if error1=='': im, head, error1 = result
+        if error1!='':
+            if threads>1:
+                # Report it and let the other extensions finish
+                exterrors.append('Exten '+str(i)+' '+error1)
+                if not silent: print exterrors[-1]
+                continue
+            writer.abort()
+            return bombfile(error1, outfile, silent)
+        if threads>1 and len(exterrors)>0: continue
+
+        # Write output, unless it was already written band by band
+        if outfh is None:
+            error1 = ccdproc_writeext(out, i, im, head, opts)
+            if error1!='': return error1
+        maskheads.append(head)
+
+    #exit extension for loop
+    # THE PROCESSING STEPS SHOULD GO IN THE PRIMARY HEADER!!!
+
+    # Some extensions failed, don't keep the file
+    if threads>1 and len(exterrors)>0:
+        writer.abort()
+        return bombfile(', '.join(exterrors), outfile, True)
+
+    return ccdproc_endfile(out, opts, masks=masks, maskheads=maskheads)
+
+
+def ccdproc_groups(files, n):
+    # The input files in batches of N
+    group = []
+    for file in files:
+        group.append(file)
+        if len(group)==n:
+            yield group
+            group = []
+    if len(group)>0: yield group
+
+
+def ccdproc_batch(group, opts):
+    # Process a batch of files extension by extension, the same
+    #  extension of all of the files is calibrated as one stack of
+    #  exposures (the 'stack' nodes of the step graph), so each
+    #  calibration frame is used for the whole batch while it is in
+    #  the cache.  The outputs are written per file.  Returns the
+    #  error messages of the files.
+    silent = opts['silent']
+    prof = opts['profile']
+    cache = opts['cache']
+    hits, misses = cache.hits, cache.misses
+
+    # Checks, journal and the output files
+    errors = {}
+    outs = []
+    for file in group:
+        prof.begin(file)
+        out, error1 = ccdproc_startfile(file, opts)
+        if out is None:
+            errors[file] = error1
+        else:
+            outs.append(out)
+
+    def failed(item, error1):
+        # Drop a file from the batch
+        errors[item[0]['file']] = error1
+        item[0]['writer'].abort()
+
+    #---------------------------
+    # LOOP OVER THE EXTENSIONS
+    #---------------------------
+    extens = sorted(set([i for out in outs for i in out['extens']]))
+    for i in extens:
+        # Files with the same stage graph are run together
+        bygraph = {}
+        for out in outs:
+            if out['file'] in errors or i not in out['extens']: continue
+            graph = opts['graphs'].get(out['file'])
+            bygraph.setdefault(graph.describe(), (graph.nodes, []))[1].append(out)
+
+        for nodes,members in bygraph.values():
+            # Read each file and run the stages before the first stack
+            #  node, items are [out, im, head]
+            names = [n['name'] for n in nodes]
+            nstack = names.index('stack') if 'stack' in names else len(nodes)
+            items = []
+            for out in members:
+                im, head, error1 = ccdproc_ext(out['file'], i, out['no_pdu'], opts, \
+                                               nodes=nodes[0:nstack], final=False)
+                item = [out, im, head]
+                if error1!='':
+                    failed(item, bombfile(error1, out['outfile'], silent))
+                    continue
+                items.append(item)
+
+            # The rest of the graph, node by node over the batch
+            for node in nodes[nstack:]:
+                if node['name']!='stack':
+                    for item in items:
+                        lap = prof.laps(item[0]['file'], i)
+                        item[1], error1 = ccdproc_runnodes(item[1], item[2], i, [node], \
+                                                           opts, lap=lap)
+                        if error1!='': failed(item, bombfile(error1, item[0]['outfile'], silent))
+                    items = [item for item in items if item[0]['file'] not in errors]
+                    continue
+
+                # One cube per image size and type
+                stacks = {}
+                for item in items:
+                    error1 = ccdproc_stackcheck(item[2], node['steps'])
+                    if error1!='':
+                        failed(item, bombfile(error1, item[0]['outfile'], silent))
+                        continue
+                    stacks.setdefault((item[1].shape, str(item[1].dtype)), []).append(item)
+                for stack in stacks.values():
+                    t0 = systime(1)
+                    cube, error1 = ccdproc_stackext(np.stack([item[1] for item in stack]), \
+                                                    [item[2] for item in stack], i, \
+                                                    node['steps'], opts)
+                    dt = (systime(1)-t0)/len(stack)
+                    for k,item in enumerate(stack):
+                        if error1!='':
+                            failed(item, bombfile(error1, item[0]['outfile'], True))
+                            continue
+                        item[1] = cube[k]
+                        prof.add(item[0]['file'], 'stack', dt, exten=i)
+                items = [item for item in items if item[0]['file'] not in errors]
+
+            # Write the extension of each file
+            for item in items:
+                ccdproc_stamp(item[2])
+                error1 = ccdproc_writeext(item[0], i, item[1], item[2], opts)
+                if error1!='': errors[item[0]['file']] = error1
+
+    # Move the outputs into place
+    for out in outs:
+        if out['file'] not in errors:
+            errors[out['file']] = ccdproc_endfile(out, opts)
+
+    # The cache use of the batch is on its first file
+    prof.count(group[0], 'cache_hits', cache.hits-hits)
+    prof.count(group[0], 'cache_misses', cache.misses-misses)
+    for file in group: prof.done(file, error=errors.get(file, ''))
+
+    return [errors.get(file, '') for file in group]
+
+
+def ccdproc_streamfiles(files, opts):
+    # Process the files with reading, calibration and writing overlapped
+    clobber = opts['clobber']
+    silent = opts['silent']
+    hcat = opts['catalog']
+    jrn = opts['journal']
+    prof = opts['profile']
+    cache = opts['cache']
+    error = []
+    maskheads = {}   # headers of the masks, by file
+    writers = {}     # output writers, by file
+
+    # The extensions of all files, in output order
+    def tasks():
+        for f,file in enumerate(files):
+            error.append('')
+            info = ccdproc_fileinfo(file, xtrafits=True)
+            outfile = info.dir+'/'+info.base+'_temp.fits'
+            if info.exists==0:
+                error[f] = bombfile(info.file+' NOT FOUND', outfile, silent)
+                continue
+            if info.ext!='fits' and info.ext!='fz':
+                error[f] = bombfile(info.file+' NOT A FITS FILE', outfile, silent)
+                continue
+            error1 = opts['plan'].checklayout(file)
+            if error1!='':
+                error[f] = bombfile('CCDPROC_PLAN: '+error1, outfile, silent)
+                continue
+            if hcat is not None:
+                try:
+                    ntodo = len(hcat.todo(file, opts['steps']))
+                except IOError:
+                    ntodo = -1
+                if ntodo==0:
+                    if not silent: print file+' already processed'
+                    continue
+            if jrn is not None:
+                action = jrn.begin(file, opts['jkey'], outfile, inplace=not clobber)
+                if action=='skip':
+                    if not silent: print file+' already processed'
+                    continue
+                if action=='stale':
+                    error[f] = bombfile(info.file+' WAS PROCESSED WITH OTHER '+ \
+                                        'CALIBRATIONS, THE RAW DATA IS GONE', outfile, silent)
+                    continue
+            if not silent: print 'Processing ',file_basename(info.file)
+            prof.begin(file)
+            prof.count(file, 'bytes_read', os.path.getsize(file))
+            next = info.nextend
+            if next==0:
+                loext = 0L
+            else:
+                loext = 1L
+            extens = range(loext,loext+max(next,1))
+            # Cross-talk for all extensions at once
+            xcor = None
+            if opts['xmat'] is not None:
+                with prof.step('xtalk', file):
+                    xcor, error1 = ccdproc_xtalkfile(file, opts['xmat'])
+                if error1!='':
+                    error[f] = bombfile(error1, outfile, silent)
+                    prof.done(file, error=error[f])
+                    continue
+            # Compressed inputs stay compressed
+            compress = opts['compress']
+            if compress=='' and info.ext=='fz': compress = 'RICE_1'
+            # Pixel masks of the file, filled by the extensions
+            masks = {} if opts['mask'] else None
+            for i in extens:
+                yield {'f':f, 'file':file, 'outfile':outfile, 'exten':i, \
+                       'first':i==extens[0], 'last':i==extens[-1], \
+                       'info':info, 'xcor':xcor, 'compress':compress, \
+                       'masks':masks, 'extens':extens}
+
+    # Reader thread, copying makes the I/O happen here
+    def readfunc(task):
+        with prof.step('read', task['file'], task['exten']):
+            fits, error1 = fitsindex(task['file'])
+            if error1!='': raise IOError(error1)
+            return np.array(fits.data(task['exten'])), fits.header(task['exten'])
+
+    # Calibrate
+    def procfunc(task, data):
+        if error[task['f']]!='': return None   # an earlier extension failed
+        im, head = data
+        hits, misses = cache.hits, cache.misses
+        im, head, error1 = ccdproc_ext(task['file'], task['exten'], 0, opts, \
+                                       im=im, head=head, xcor=task['xcor'], \
+                                       masks=task['masks'])
+        prof.count(task['file'], 'cache_hits', cache.hits-hits)
+        prof.count(task['file'], 'cache_misses', cache.misses-misses)
+        if error1!='': raise ValueError(error1)
+        return im, head
+
+    # Writer thread
+    def writetask(task, result, error1):
+        f = task['f']
+        outfile = task['outfile']
+        if error1!='' and error[f]=='':
+            error[f] = bombfile(error1, outfile, silent)
+        if error[f]!='':
+            if f in writers: writers.pop(f).abort()
+            if task['last']: prof.done(task['file'], error=error[f])
+            return
+        # Initialize output file, one open writer per file
+        next = task['info'].nextend
+        im, head = result
+        try:
+            with prof.step('write', task['file'], task['exten']):
+                if task['first']:
+                    FILE_DELETE(outfile, allow_nonexistent=True, quiet=True)
+                    writers[f] = FitsWriter(None if clobber else task['file'], tmpfile=outfile, \
+                                            outtype=opts['outtype'], compress=task['compress'], \
+                                            quantize=opts['quantize'], sync=opts['sync'])
+                    # compressed images are always extensions
+                    if next>0 or writers[f].compress!='':
+                        writers[f].primary(task['info'].hdu[0].head if next>0 else None, \
+                                           nextend=max(next,1))
+                if next==0 and writers[f].compress=='':
+                    writers[f].primary(head, im=im)
+                else:
+                    writers[f].append(im, head)
+        except (IOError, OSError, ValueError) as e:
+            if f in writers: writers.pop(f).abort()
+            error[f] = bombfile('CCDPROC: '+str(e), outfile, silent)
+            if task['last']: prof.done(task['file'], error=error[f])
+            return
+        # The mask file, next to the output
+        masks = task['masks']
+        info = task['info']
+        maskfile = info.dir+'/'+info.base+'_mask_temp.fits'
+        if masks is not None:
+            maskheads[f] = maskheads.get(f, [])+[head]
+            if task['last']:
+                error1 = ccdproc_writemask(maskfile, [masks[i] for i in task['extens']], \
+                                           heads=maskheads.pop(f))
+                if error1!='':
+                    writers.pop(f).abort()
+                    error[f] = bombfile(error1, outfile, silent)
+                    prof.done(task['file'], error=error[f])
+                    return
+        # Move temporary file to original file, an atomic rename
+        if task['last']:
+            writer = writers.pop(f)
+            try:
+                with prof.step('commit', task['file']):
+                    writer.close()
+                    if not clobber and jrn is not None: jrn.moving(task['file'])
+                    writer.commit()
+            except (IOError, OSError) as e:
+                error[f] = bombfile('CCDPROC: '+str(e), outfile, silent)
+                prof.done(task['file'], error=error[f])
+                return
+            prof.count(task['file'], 'bytes_written', writer.nbytes)
+        if task['last'] and not clobber:
+            if masks is not None:
+                FILE_MOVE(maskfile, info.dir+'/'+info.base+'_mask.fits.fz', \
+                          overwrite=True, allow=True)
+            if hcat is not None: hcat.update(task['file'])
+        if task['last'] and jrn is not None: jrn.done(task['file'])
+        if task['last']: prof.done(task['file'])
+
+    def writefunc(task, result, error1):
+        # An unexpected error fails the file, its later extensions
+        #  must not be written or committed
+        try:
+            writetask(task, result, error1)
+        except Exception as e:
+            f = task['f']
+            if f in writers: writers.pop(f).abort()
+            if error[f]=='':
+                error[f] = bombfile('CCDPROC: '+str(e), task['outfile'], silent)
+                prof.done(task['file'], error=error[f])
+
+    stats = StreamStats()
+    results = ccdproc_stream(tasks(), readfunc, procfunc, writefunc, \
+                             readahead=opts['readahead'], writebehind=opts['readahead'], \
+                             stats=stats)
+    # The task generator failed while setting up the last file in
+    #  ERROR, none of its extensions were queued.  The remaining files
+    #  are not processed.
+    for task,error1 in results:
+        if task is None and error1!='':
+            if len(error)==0 or error[-1]!='': error.append('')
+            error[-1] = 'CCDPROC: '+error1
+            if not silent: print error[-1]
+    if not silent:
+        meandepth = stats.meandepth()
+        print 'Read queue: mean depth %.1f, max %d' % \
+            (meandepth['read'], stats.maxdepth['read'])
+        print 'Write queue: mean depth %.1f, max %d' % \
+            (meandepth['write'], stats.maxdepth['write'])
+        print 'Waiting for reads %.1f s, for writes %.1f s' % \
+            (stats.wait['calib'], stats.wait['write'])
+
+    return error
+
+
+def ccdproc_partfile(file, exten):
+    # The part file of one extension of a /byext queue unit
+    info = ccdproc_fileinfo(file)
+    return info.dir+'/'+info.base+'_part'+str(exten)+'.fits'
+
+
+def ccdproc_extunit(unit, opts):
+    # Process one extension of a file into its part file, returns the
+    #  error message.  The parts are assembled by the merge unit.
+    file = unit['file']
+    exten = unit['exten']
+    silent = opts['silent']
+    hcat = opts['catalog']
+    partfile = ccdproc_partfile(file, exten)
+
+    # Nothing left to do according to the catalog
+    if hcat is not None and os.path.exists(file):
+        try:
+            if len(hcat.todo(file, opts['steps']))==0: return ''
+        except IOError:
+            pass
+    if not os.path.exists(file):
+        return bombfile(file+' NOT FOUND', partfile, silent)
+
+    im, head, error1 = ccdproc_ext(file, exten, 1, opts)
+    if error1!='': return bombfile(error1, partfile, silent)
+
+    # Full precision, the output type is applied by the merge
+    try:
+        writer = FitsWriter(partfile)
+        with opts['profile'].step('write', file, exten):
+            writer.primary(head, im=im)
+        error1 = ccdproc_leaselost(opts)
+        if error1!='':
+            writer.abort()
+            return error1
+        writer.commit()
+    except (IOError, OSError, ValueError) as e:
+        return bombfile('CCDPROC: '+str(e), partfile, silent)
+    return ''
+
+
+def ccdproc_extmerge(unit, opts):
+    # Assemble the output of a file from its extension parts, returns
+    #  the error message.  This replaces the input like ccdproc_dofile.
+    file = unit['file']
+    clobber = opts['clobber']
+    silent = opts['silent']
+    hcat = opts['catalog']
+    prof = opts['profile']
+
+    info = ccdproc_fileinfo(file, xtrafits=True)
+    outfile = info.dir+'/'+info.base+'_temp.fits'
+    if info.exists==0:
+        return bombfile(info.file+' NOT FOUND', outfile, silent)
+    parts = [ccdproc_partfile(file, i) for i in range(1, info.nextend+1)]
+
+    # The extension units skipped a file that the catalog has as done
+    if hcat is not None and not any([os.path.exists(p) for p in parts]):
+        try:
+            if len(hcat.todo(file, opts['steps']))==0: return ''
+        except IOError:
+            pass
+
+    # Already done with the same inputs according to the journal
+    jrn = opts['journal']
+    if jrn is not None:
+        action = jrn.begin(file, opts['jkey'], outfile, inplace=not clobber)
+        if action=='skip':
+            for p in parts: FILE_DELETE(p, allow_nonexistent=True, quiet=True)
+            return ''
+        if action=='stale':
+            return bombfile(info.file+' WAS PROCESSED WITH OTHER CALIBRATIONS, '+ \
+                            'THE RAW DATA IS GONE', outfile, silent)
+
+    compress = opts['compress']
+    if compress=='' and info.ext=='fz': compress = 'RICE_1'
+    try:
+        with prof.step('merge', file):
+            writer = FitsWriter(None if clobber else file, tmpfile=outfile, \
+                                outtype=opts['outtype'], compress=compress, \
+                                quantize=opts['quantize'], threads=max(opts['threads'],1), \
+                                sync=opts['sync'])
+            writer.primary(info.hdu[0].head, nextend=len(parts))
+            for p in parts:
+                part, error1 = fitsindex(p)
+                if error1!='':
+                    writer.abort()
+                    return bombfile(info.file+' PART '+p+' NOT FOUND', outfile, silent)
+                writer.append(part.data(0), part.header(0, shared=True))
+            writer.close()
+            error1 = ccdproc_leaselost(opts)
+            if error1!='':
+                writer.abort()
+                return bombfile(error1, outfile, silent)
+            if not clobber and jrn is not None: jrn.moving(file)
+            writer.commit()
+    except (IOError, OSError, ValueError) as e:
+        return bombfile('CCDPROC: '+str(e), outfile, silent)
+    prof.count(file, 'bytes_written', writer.nbytes)
+
+    if not clobber and hcat is not None: hcat.update(file)
+    if jrn is not None: jrn.done(file)
+    for p in parts: FILE_DELETE(p, allow_nonexistent=True, quiet=True)
+
+    return ''
+
+
+def ccdproc_queueloop(tag, opts):
+    # Lease units from opts['queue'] and process them until the whole
+    #  queue is done, returns the errors of this worker
+    queue = opts['queue']
+    silent = opts['silent']
+    prof = opts['profile']
+    worker = queue.worker(tag)
+    error = []
+    nunits = 0L
+    while True:
+        units = queue.lease(worker)
+        if len(units)==0:
+            # Other workers are busy, their merges and expired leases
+            #  can still come back
+            if queue.active()==0: break
+            queue.wait()
+            continue
+        unit = units[0]
+        # The writers check the lease before they commit
+        with queue.held(unit, worker) as keeper:
+            opts['lease'] = keeper
+            if unit['kind']=='file':
+                error1 = ccdproc_file(unit['file'], opts)
+            else:
+                prof.begin(unit['file'])
+                if unit['kind']=='ext':
+                    error1 = ccdproc_extunit(unit, opts)
+                else:
+                    error1 = ccdproc_extmerge(unit, opts)
+                prof.done(unit['file'], error=error1)
+            opts['lease'] = None
+        # A lost lease is not a success, another worker holds the unit
+        if error1=='' and (keeper.lost or not queue.done(unit, worker)):
+            error1 = 'CCDPROC: LEASE OF '+unit['id']+' WAS LOST'
+            if not silent: print error1
+            error.append(unit['id']+' '+error1)
+        elif error1!='':
+            queue.fail(unit, worker, error1)
+            error.append(unit['id']+' '+error1)
+        nunits += 1
+        if not silent and nunits % 100==0: print worker+': '+queue.progress()
+
+    return error
 
 
 def ccdproc(input, xTalk='', linCorr='', fixPix='', zero='', flat='', \
                 illum='', bootstrap='', bpm='', trim=False, overscan=False, \
-                clobber=False, silent=False):
+                clobber=False, fused=False, dtype='float32', cachesize=2048, \
+                workers=1, threads=1, catalog='', stream=False, readahead=4, \
+                ovfunction='median', ovorder=3, maxmem=0, compress='', \
+                quantize=4.0, journal='', mask=False, outtype='', fsync='none', \
+                profile=False, proffile='', steporder='', queue='', byext=False, \
+                lease=600, maxtries=3, batch=0, silent=False):
 
     #====================
     # CHECK THE INPUTS
     #====================
     # Load the input files
-    loadinput(input, files, count=nFiles)
-#KENZA - Check loadinput later
-    files.strip()
-    if nFiles==0:
+    #  streamed, processing starts before the expansion is done
+    files = iloadinput(input)
+    first = next(files, None)
+    # a queue worker can start without input, it pulls the units
+    if first is None and queue=='':
         error = 'No files to process'
         if not silent: print error
         return error
+    if first is not None: files = itertools.chain([first], files)
 
     # No processing steps requested
     if not trim and not overscan and len(xTalk)==0 \
@@ -100,23 +1473,146 @@ def ccdproc(input, xTalk='', linCorr='', fixPix='', zero='', flat='', \
         if not silent: print error
         return error
 
+    # Bounded-memory mode, only steps that work on bands of rows
+    if maxmem>0:
+        if len(xTalk)>0 or stream:
+            error = 'MAXMEM cannot be used with xTalk or /stream'
+            if not silent: print error
+            return error
+        if compress!='':
+            error = 'MAXMEM cannot be used with COMPRESS'
+            if not silent: print error
+            return error
+        if outtype=='int16' or outtype=='quantized':
+            error = 'MAXMEM cannot be used with OUTTYPE='+outtype
+            if not silent: print error
+            return error
+        fused = True
+    # The masks come from the fused mode
+    if mask: fused = True
+
+    # Tile compression of the output
+    if compress!='' and compress.upper() not in ('RICE_1','GZIP_1','GZIP_2'):
+        error = 'COMPRESS must be RICE_1, GZIP_1 or GZIP_2'
+        if not silent: print error
+        return error
+
+    # Output type and when the outputs are flushed to disk
+    if outtype not in OUTTYPES:
+        error = 'OUTTYPE must be one of '+', '.join([repr(t) for t in OUTTYPES])
+        if not silent: print error
+        return error
+    try:
+        sync = FsyncPolicy(fsync)
+    except ValueError as e:
+        error = str(e)
+        if not silent: print error
+        return error
+
+    # The shared work queue of a campaign
+    wq = None
+    if queue!='':
+        if stream:
+            error = 'QUEUE cannot be used with /stream'
+            if not silent: print error
+            return error
+        wq, error = ccdproc_queue(queue, lease=lease, maxtries=maxtries, silent=silent)
+        if error!='': return error
+    # Extension units are assembled by a merge, the steps that need
+    #  the whole exposure or write with the extension are not possible
+    if byext:
+        if wq is None or len(xTalk)>0 or maxmem>0 or mask:
+            error = 'BYEXT needs QUEUE and cannot be used with xTalk, MAXMEM or /mask'
+            if not silent: print error
+            return error
+
+    # Batches of exposures are calibrated extension by extension, the
+    #  steps that need the whole exposure or write it are not possible
+    if batch>1:
+        if len(xTalk)>0 or maxmem>0 or mask or stream or wq is not None:
+            error = 'BATCH cannot be used with xTalk, MAXMEM, /mask, /stream or QUEUE'
+            if not silent: print error
+            return error
+
+    # Profiling, the worker processes append their records to one file
+    if proffile!='': profile = True
+    profspool = ''
+    if profile and proffile=='' and workers!=1:
+        fd, profspool = tempfile.mkstemp(suffix='.prof.jsonl')
+        os.close(fd)
+    if proffile!='': FILE_DELETE(proffile, allow_nonexistent=True, quiet=True)
+    prof = ProcProfile(file=proffile if proffile!='' else profspool, enabled=profile)
+
     # That that NEXTEND for the cal files is big enough for the input files
     #=========================================
     # LOAD CALIBRATION DATA USED BY ALL FILES
     #=========================================
+    # Zero, flat and illum frames are read once and shared, the BPM
+    #  is kept as packed mask planes (MaskStore)
+    cache = CalCache(maxbytes=cachesize*1024L*1024L, loader=calload)
+    linstr = None
+    bootstr = None
+    xstr = None
+    fixstr = None
+    # Bad pixel masks, each extension is read once into packed planes
+    maskstore = None
+    if len(bpm)>0 or mask: maskstore = MaskStore(bpm, loader=calload)
 
     # Load bootstrap file
     if len(bootstrap)>0:
         ccdproc_loadbootstrap(bootstrap, bootstr, error=error, silent=silent)
         if error!='': return error1
     # Load xTalk values
+    xmat = None
     if len(xTalk)>0:
         ccdproc_loadxtalk(xTalk, xstr, error=error, silent=silent)
         if error!='': return error1
+        # Sparse victim x source matrix, applied once per exposure
+        xmat, error = ccdproc_xtalkmatrix(xstr, silent=silent)
+        if error!='': return error
+    # Load the linearity corrections
+    if len(linCorr)>0:
+        linstr, error = ccdproc_loadlincorr(linCorr, silent=silent)
+        if error!='': return error
     # Load fixPix file
     if len(fixPix)>0:
-        ccdproc_loadfixpix(fixPix, fixstr, error=error, silent=silent)
-        if error!='': return error1
+        fixstr, error = ccdproc_loadfixpix(fixPix, silent=silent)
+        if error!='': return error
+
+    # Validate the calibrations once, against the first file, before
+    #  any science file is touched.  The streamed files that follow are
+    #  checked when they bring a new layout (plan.checklayout).
+    plan, error = ccdproc_plan(zero=zero, flat=flat, illum=illum, bpm=bpm, \
+                               bootstr=bootstr, trim=trim, overscan=overscan, \
+                               ref=first if first is not None else '', silent=silent)
+    if error!='': return error
+
+    # Compile the step graph, only the active stages are kept and the
+    #  orders of all instruments are checked now
+    graphs, error = ccdproc_graph({'xTalk':xTalk, 'linCorr':linCorr, 'fixPix':fixPix, \
+                                   'overscan':overscan, 'trim':trim, 'zero':zero, \
+                                   'flat':flat, 'illum':illum, 'bootstrap':bootstrap, \
+                                   'bpm':bpm}, order=steporder, fused=fused, \
+                                  single=(maxmem>0 or mask), batch=(batch>1), \
+                                  silent=silent)
+    if error!='': return error
+
+    # Header catalog of the processing state
+    hcat = None
+    if catalog!='': hcat = HeaderCatalog(catalog)
+    steps = graphs.default.catalog
+
+    # Journal of the processing, the key covers the contents of the
+    #  calibration files and everything that changes the output
+    jrn = None
+    jkey = ''
+    if journal!='':
+        jrn = ProcJournal(journal)
+        orderfile = steporder if os.path.exists(steporder) else ''
+        jkey = jrn.key([xTalk, linCorr, fixPix, zero, flat, illum, bootstrap, bpm, orderfile], \
+                       {'steps':steps, 'steporder':steporder, 'ovfunction':ovfunction, 'ovorder':ovorder, \
+                        'dtype':dtype, 'compress':compress.upper(), 'quantize':quantize, \
+                        'mask':mask, 'outtype':outtype})
 
     # Print out processing steps
     if not silent:
@@ -130,161 +1626,109 @@ def ccdproc(input, xTalk='', linCorr='', fixPix='', zero='', flat='', \
         if len(bootstrap)>0: print 'BOOTSTRAP ',bootstrap
         if len(bpm)>0: print 'BPM ',bpm
         if trim: print 'TRIM'
-        if overscan: print 'OVERSCAN'
+        if overscan: print 'OVERSCAN ',ovfunction
+        print 'Stages: '+graphs.default.describe()
 
     #=================
     # PROCESS FILES
     #=================
     # Loop over input files
-    error = strarr(nfiles)
+    error = []
 
-    for f in range(0,nfiles):
-        # File information and headers
-        info = ccdproc_fileinfo(files[f])
-        origfile = info.file
-        outfile = info.dir+'/'+info.base+'_temp.fits'
+    opts = {'xTalk':xTalk, 'linCorr':linCorr, 'fixPix':fixPix, 'zero':zero, \
+            'flat':flat, 'illum':illum, 'bootstrap':bootstrap, 'bpm':bpm, \
+            'trim':trim, 'overscan':overscan, 'ovfunction':ovfunction, \
+            'ovorder':ovorder, 'clobber':clobber, \
+            'fused':fused, 'dtype':dtype, 'silent':silent, 'linstr':linstr, \
+            'bootstr':bootstr, 'xstr':xstr, 'fixstr':fixstr, 'cache':cache, \
+            'threads':threads, 'catalog':hcat, 'steps':steps, \
+            'readahead':readahead, 'xmat':xmat, \
+            'maxmem':long(maxmem*1024L*1024L), 'compress':compress.upper(), \
+            'quantize':quantize, 'journal':jrn, 'jkey':jkey, 'mask':mask, \
+            'maskstore':maskstore, 'outtype':outtype, 'sync':sync, \
+            'profile':prof, 'plan':plan, 'graphs':graphs, 'queue':wq, \
+            'lease':None}
 
-        # File does not exist
-        if info.exists==0:
-            error[f] = origfile+' NOT FOUND'
-            if not silent: print error[f]
-            bombfile(error[f])
+    # Add the input to the queue, units that are already in it (i.e.
+    #  added by another host) are kept as they are
+    if wq is not None:
+        nnew = wq.put(queueunits(files, byext=byext))
+        if not silent:
+            print 'Queue '+queue+': '+str(nnew)+' new units'
+            print wq.progress()
 
-        # Not a FITS file
-        if info.ext!='fits':
-            error[f] = origfile+' NOT A FITS FILE'
-            if not silent: print error[f]
-            bombfile(error[f])
+    # Overlap the reading, calibration and writing
+    if stream:
+        error = ccdproc_streamfiles(files, opts)
 
-        if not silent: print 'Processing ',info.base+'.fits'
-
-        # Initialize output file
-        FILE_DELETE(outfile, allow_nonexistent=True, quiet=True)
-        # for multi-extension
-        if next>1:
-            FITS_WRITE(outfile, 0, *(info.hdu[0].head), no_abort=True)
-
-        #---------------------------
-        # LOOP OVER THE EXTENSIONS
-        #---------------------------
-        if next==0:
-            loext = 0L
-            no_pdu = 0
+    # Farm the files (or batches of files) out to a pool of worker
+    #  processes, or lease the units of the queue with them
+    elif workers!=1 or wq is not None or batch>1:
+        # Load the calibration frames here so the workers share them
+        for calfile,calinfo in [(zero,zero_info), (flat,flat_info), \
+                                (illum,illum_info), (bpm,bpm_info)]:
+            if calfile=='': continue
+            if calinfo.nextend>0:
+                extens = range(1,calinfo.nextend+1)
+            else:
+                extens = [0]
+            # only the packed planes of the BPM are kept
+            if calfile==bpm:
+                maskstore.preload(extens)
+                continue
+            cache.preload(calfile, extens)
+            # and the flat/illum medians and cleaned frames
+            if calfile==flat or calfile==illum:
+                for e in extens: ccdproc_calflat(cache, calfile, e)
+        if batch>1:
+            for result in ccdproc_pool(ccdproc_batch, ccdproc_groups(files, batch), \
+                                       shared=opts, workers=workers):
+                if isinstance(result, list):
+                    error.extend(result)
+                else:
+                    error.append(result)
+        elif wq is None:
+            error = ccdproc_pool(ccdproc_file, files, shared=opts, workers=workers)
         else:
-            loext = 1L
-            no_pdu = 1
-
-        for i in (loext,loext+next):
-            # Load the file
-            FITS_READ(file, im, head, exten=i, no_pdu=no_pdu, no_abort=True, \
-                          message=error1)
-            if error1!='': bombfile(error1)
-            origim = im
-            im = float(im)
-
-            # Check the image and header
-             # Check that IM is a data (type=1-5 or 12-15) 2D array
-            if CHECKPAR(zeroim, [1,2,3,4,5,12,13,14,15], [2], \
-                            caller=errprefix+'Image - ', silent=silent, \
-                            errstr=error1): bombfile(error1)
-            # Check that HEAD is a string array
-            if CHECKPAR(zerohead, 7, 1, caller=errprefix+'Header - ', \
-                            silent=silent, errstr=error1): bombfile(error1)
-
-            #str = {im:im, head:head, fixPix:keyword_set(fixPix), \
-            #    overtrim:keyword_set(overtrim), zero:'', flat:''}
-            
-            # Cross-talk
-            #-----------
-            if len(xTalk)>0:
-                ccdproc_xtalk(im, head, i, xstr, error=error1, silent=silent)
-                if error1!='': bombfile(error1)
-            # Linearity Correction
-            #---------------------
-            if len(linCorr)>0:
-                ccdproc_lincorr(im, head, i, linstr, error=error1, \
-                                    silent=silent)
-                if error1!='': bombfile(error1)
-            # FixPix
-            #----------
-            if len(fixPix)>0:
-                ccdproc_fixpix(im, head, fixstr, error=error1, silent=silent)
-                if error1!='': bombfile(error1)
-            # Overscan
-            #---------
-            if overscan:
-                ccdproc_overscan(im, head, error=error1, silent=silent)
-                if error1!='': bombfile(error1)
-            # Trim
-            #-----
-            if trim:
-                ccdproc_trim(im, head, error=error1, silent=silent)
-                if error1!='': bombfile(error1)
-            # Zero Correct
-            #-------------
-            if zero!='':
-                ccdproc_zero(im, head, zero, exten=i, error=error1, \
-                                 silent=silent)
-                if error1!='': bombfile(error1)
-            # Domeflat Correct
-            #-----------------
-            if flat!='':
-                ccdproc_flat(im, head, zero, exten=i, error=error1, \
-                                 silent=silent)
-                if error1!='': bombfile(error1)
-            # Illumination Correction
-            #-------------------------
-            # maybe this should be called sflatcor
-            if illum!='':
-                ccdproc_illum(im, head, zero, exten=i, error=error1, \
-                                  silent=silent)
-                if error1!='': bombfile(error1)
-            # Bootstrap
-            #----------
-            if len(bootstrap)>0:
-                ccdproc_bootstrap(im, head, bootstr, exten=i, error=error1, \
-                                  silent=silent)
-                if error1!='': bombfile(error1)
-            # Bad Pixel Mask
-            #----------------
-            if len(bpm)>0:
-                ccdproc_bpm(im, head, bpm, exten=i, error=error1, \
-                                silent=silent)
-                if error1!='': bombfile(error1)
-
-            # SHOULD LINEARITY CORRECTION GO BEFORE XTALK-CORRECTION????
-            # Dark correction??
-            # Fringe correction?
-        
-            # Example of how the header is modified.
-            #XTALKCOR= 'Oct  8 21:19 No crosstalk correction required'
-            #OVSNMEAN=             1503.989
-            #TRIM    = 'Oct  8 21:19 Trim is [25:1048,1:4096]'
-            #FIXPIX  = 'Oct  8 21:19 Fix mscdb$noao/Mosaic2/CAL0102/bpm3_0102 + sat + bleed'
-            #OVERSCAN= 'Oct  8 21:19 Overscan is [1063:1112,1:4096], mean 1503.989'
-            #ZEROCOR = 'Oct  8 21:19 Zero is Zero[im5]'
-            #FLATCOR = 'Oct  8 21:19 Flat is DFlatM.fits[im5], scale 10490.72'
-            #CCDPROC = 'Oct 18 11:34 CCD processing done'
-            #PROCID  = 'ct4m.20070817T081040V3'
-            #SFLATCOR= 'Oct 18 11:34 Sky flat is Sflatn12M.fits[im5], scale 833.0756'
-            # Add final processing info to header
-            date = systime(0)
-            datearr = strtrim(strsplit(date, ' ', extract=True), 2)
-            timarr = strsplit(datearr[3], ':', extract=True)
-            datestr = datearr[1] + ' ' + datearr[2] + ' ' + \
-                strjoin(timarr[0:1] ,':')
-            fxaddpar(head, 'CCDPROC', datestr+' CCD processing done')
-
-            # Do we need to change BITPIX, BSCALE, BZERO, etc??
-            # Write output
-            MWRFITS(im, outfile, head, silent=True)
-
-        #exit extension for loop
-        # THE PROCESSING STEPS SHOULD GO IN THE PRIMARY HEADER!!!
-
-        # Move temporary file to original file
-        if not clobber:
-            FILE_MOVE(outfile, file, overwrite=True, allow=True)
+            nloop = workers
+            if nloop<=0: nloop = os.cpu_count() or 1
+            for result in ccdproc_pool(ccdproc_queueloop, range(nloop), shared=opts, \
+                                       workers=nloop):
+                if isinstance(result, list):
+                    error.extend(result)
+                else:
+                    error.append(result)
+
+    else:
+        for file in files:
+            error.append(ccdproc_file(file, opts))
 
     #exit file for loop
+
+    # The last batch of outputs to disk
+    sync.flush()
+
+    # Where the whole campaign stands
+    if wq is not None and not silent:
+        print wq.progress()
+        for unit in wq.failed(): print 'FAILED '+unit['id']+' '+str(unit['error'])
+
+    # Where the time went
+    if profile and not silent:
+        print 'Profile of '+str(len(prof.records()))+' files:'
+        print prof.table()
+
+    # The cache counters live in the process that used the cache, the
+    #  workers' counts only come back through their profile records
+    pooled = not stream and workers!=1
+    if not silent and not pooled:
+        cstats = cache.stats()
+        print 'Calibration cache: '+str(cstats['hits'])+' hits, '+ \
+            str(cstats['misses'])+' misses, '+str(cstats['evictions'])+' evictions'
+    if not silent and pooled and profile:
+        counts = prof.summary()['counts']
+        print 'Calibration cache (all workers): '+str(counts.get('cache_hits',0))+' hits, '+ \
+            str(counts.get('cache_misses',0))+' misses'
+    if profspool!='': FILE_DELETE(profspool, allow_nonexistent=True, quiet=True)
+
     return error
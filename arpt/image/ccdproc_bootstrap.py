@@ -10,6 +10,8 @@
   head         The image header string array.
   bootstr      The bootstrap structure.
   =exten       The extension to use in the bootstrap file
+  /checked     The inputs were validated by ccdproc_plan, the image,
+                 header and structure checks are skipped.
   /silent      Don't print anything to the screen.
 
  OUTPUTS:
@@ -25,7 +27,7 @@
 -
 """
 
-def ccdproc_bootstrap(im,head,bootstr,exten=exten,error='',silent=True):
+def ccdproc_bootstrap(im,head,bootstr,exten=exten,checked=False,error='',silent=True):
 
     # Initalizing some variables
     errprefix = 'CCDPROC_BOOTSTRAP: '   # error message prefix
@@ -52,28 +54,29 @@ def ccdproc_bootstrap(im,head,bootstr,exten=exten,error='',silent=True):
         return error
 
     # Check that IM is a data (type=1-5 or 12-15) 2D array
-    if CHECKPAR(im,[1,2,3,4,5,12,13,14,15],[2],caller=errprefix+'Image - ',errstr=error,silent=silent): return error
-    # Check that HEAD is a string array
-    if CHECKPAR(head,7,1,caller=errprefix+'Header - ',errstr=error,silent=silent): return error
+    if not checked:
+        if CHECKPAR(im,[1,2,3,4,5,12,13,14,15],[2],caller=errprefix+'Image - ',errstr=error,silent=silent): return error
+        # Check that HEAD is a string array
+        if CHECKPAR(head,7,1,caller=errprefix+'Header - ',errstr=error,silent=silent): return error
 
     # Have we done this processing step already?
-    btstrp = sxpar(head,'BTSTRP',count=nbtstrp)
-    if nbtstrp>0:
+    if fitshaskey(head,'BTSTRP'):
         error = errprefix+'Bootstrap correction already applied.'
         if not silent: print error
         return error
 
     # Check the bootstrap structure
-    if CHECKPAR(bootstr,8,caller=errprefix+'BOOTSTR - ',errstr=error,silent=silent): return error
-    if tag_exist(bootstr,'EXTEN')==0 or tag_exist(bootstr,'SCALE')==0:
-        error = errprefix+'Bootstrap structure must have EXTEN and SCALE tags.'
-        if not silent: print error
-        return error
-
-    # Check that the BOOTSTRAP EXTEN is int/long
-    if CHECKPAR(bootstr.exten,[2,3],caller=errprefix+'Bootstrap EXTEN - ',silent=silent,errstr=error): return error
-    # Check that the BOOTSTRAP SCALE is float/double
-    if CHECKPAR(bootstr.scale,[4,5],caller=errprefix+'Bootstrap SCALE - ',silent=silent,errstr=error): return error
+    if not checked:
+        if CHECKPAR(bootstr,8,caller=errprefix+'BOOTSTR - ',errstr=error,silent=silent): return error
+        if tag_exist(bootstr,'EXTEN')==0 or tag_exist(bootstr,'SCALE')==0:
+            error = errprefix+'Bootstrap structure must have EXTEN and SCALE tags.'
+            if not silent: print error
+            return error
+
+        # Check that the BOOTSTRAP EXTEN is int/long
+        if CHECKPAR(bootstr.exten,[2,3],caller=errprefix+'Bootstrap EXTEN - ',silent=silent,errstr=error): return error
+        # Check that the BOOTSTRAP SCALE is float/double
+        if CHECKPAR(bootstr.scale,[4,5],caller=errprefix+'Bootstrap SCALE - ',silent=silent,errstr=error): return error
 
     # Find the right extension
     if len(exten)>0:
@@ -105,6 +108,6 @@ def ccdproc_bootstrap(im,head,bootstr,exten=exten,error='',silent=True):
     datearr = strtrim(strsplit(date,' ',/extract),2)
     timarr = strsplit(datearr[3],':',/extract)
     datestr = datearr[1]+' '+datearr[2]+' '+strjoin(timarr[0:1],':')
-    fxaddpar,head,'BTSTRP',datestr+' Bootstrap scale '+strtrim(string(bootstr[ind[0]].scale,format='(G20.2)'),2)
+    fitsaddpar(head,'BTSTRP',datestr+' Bootstrap scale '+strtrim(string(bootstr[ind[0]].scale,format='(G20.2)'),2))
 
     return error
@@ -11,6 +11,13 @@
   bpmfile      The name of the bad pixel mask file.
   =exten       The extension to use for the bpm image file.
   =badpixval   Value to set bad pixels to in input image.  Default is 65535.
+  =cache       CalCache calibration frame cache.  The BPM image is
+                 read from the cache if this is given.
+  =maskstore   MaskStore of the BPM file (see ccdproc_mask).  The
+                 precomputed bad pixel indices are used if this is
+                 given, the BPM image is not read again.
+  /checked     The inputs were validated by ccdproc_plan, the image,
+                 header and BPM file checks are skipped.
   /silent      Don't print anything to the screen.
 
  OUTPUTS:
@@ -26,7 +33,7 @@
 -
 """
 
-def ccdproc_bpm(im,head,bpmfile,exten=exten,badpixval=badpixval,error='',silent=True):
+def ccdproc_bpm(im,head,bpmfile,exten=exten,badpixval=badpixval,cache=None,maskstore=None,checked=False,error='',silent=True):
 
     # Initalizing some variables
     errprefix = 'CCDPROC_BPM: '   # error message prefix
@@ -53,33 +60,50 @@ def ccdproc_bpm(im,head,bpmfile,exten=exten,badpixval=badpixval,error='',silent=
         return error
 
     # Check that IM is a data (type=1-5 or 12-15) 2D array
-    if CHECKPAR(im,[1,2,3,4,5,12,13,14,15],[2],caller=errprefix+'Image - ',errstr=error,silent=silent): return error
-    # Check that HEAD is a string array
-    if CHECKPAR(head,7,1,caller=errprefix+'Header - ',errstr=error,silent=silent): return error
+    if not checked:
+        if CHECKPAR(im,[1,2,3,4,5,12,13,14,15],[2],caller=errprefix+'Image - ',errstr=error,silent=silent): return error
+        # Check that HEAD is a string array
+        if CHECKPAR(head,7,1,caller=errprefix+'Header - ',errstr=error,silent=silent): return error
     imsz = size(im) & imsz=imsz[1:imsz[0]]
 
     # Have we done this processing step already?
-    bpmcor = sxpar(head,'BPM',count=nbpmcor)
-    if nbpmcor>0:
+    if fitshaskey(head,'BPM'):
         error = errprefix+'BPM correction already applied.'
         if not silent: print error
         return error
 
-    # Check BPM file
-    if CCDPROC_CHECKFILE(bpmfile,exten=exten,size=imsz,caller=errprefix,silent=silent,errstr=error): return error
+    # Check BPM file, once per run with ccdproc_plan
+    if not checked and CCDPROC_CHECKFILE(bpmfile,exten=exten,size=imsz,caller=errprefix,silent=silent,errstr=error): return error
 
 
-    # Read in BPM image
+    # Bad pixel indices
     #--------------------
-    FITS_READ(bpmfile,bpmim,bpmhead,exten=exten,no_abort=True,message=message)
-    if message!='':
-        error = errprefix+message
-        if not silent: print error
-        return error
-
-    # Set bad pixels
-    #-----------------
-    bdpix = where(bpmim==1,nbdpix)           # BPM=1 means bad pixels
+    if maskstore is not None:
+        try:
+            bdpix = maskstore.get(exten).indices('bad')
+        except (IOError, ValueError) as e:
+            error = errprefix+str(e)
+            if not silent: print error
+            return error
+        nbdpix = len(bdpix)
+    elif cache is not None:
+        try:
+            bpmim = cache.get(bpmfile,exten)
+        except IOError as e:
+            error = errprefix+str(e)
+            if not silent: print error
+            return error
+        bdpix = where(bpmim==1,nbdpix)       # BPM=1 means bad pixels
+    else:
+        FITS_READ(bpmfile,bpmim,bpmhead,exten=exten,no_abort=True,message=message)
+        if message!='':
+            error = errprefix+message
+            if not silent: print error
+            return error
+        bdpix = where(bpmim==1,nbdpix)       # BPM=1 means bad pixels
+
+    # Set bad pixels, one indexed scatter
+    #-------------------------------------
     if nbdpix>0: im[bdpix] = badpixval       # set to bad pixel value
 
 
@@ -91,6 +115,6 @@ def ccdproc_bpm(im,head,bpmfile,exten=exten,badpixval=badpixval,error='',silent=
     datearr = strtrim(strsplit(date,' ',/extract),2)
     timarr = strsplit(datearr[3],':',/extract)
     datestr = datearr[1]+' '+datearr[2]+' '+strjoin(timarr[0:1],':')
-    fxaddpar,head,'BPM',datestr+' BPM is '+bpmfile+', '+strtrim(nbdpix,2)+' bad pixels'
+    fitsaddpar(head,'BPM',datestr+' BPM is '+bpmfile+', '+strtrim(nbdpix,2)+' bad pixels')
 
     return error
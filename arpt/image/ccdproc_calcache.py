@@ -0,0 +1,165 @@
+"""
++
+
+ CCDPROC_CALCACHE
+
+ This is a cache for calibration frames (zero, flat, illum, bpm)
+ that are shared by all of the files in a ccdproc run.  Frames are
+ keyed by (path, extension, mtime, size) so a changed file is
+ reloaded.  The cache has a memory budget and evicts the least
+ recently used frames.  Derived values, such as the flat median
+ and the cleaned flat, are kept with the frame they come from.
+
+ INPUTS:
+  =maxbytes    The memory budget in bytes.  Default is 2GB.
+  =loader      Function loader(path,exten) that returns the image.
+
+ OUTPUTS:
+  cache        The CalCache object.  The hits, misses and evictions
+                 counters and nbytes give the cache statistics.
+
+ USAGE:
+  cache = CalCache(maxbytes=4*1024**3,loader=loader)
+  zeroim = cache.get(zerofile,exten)
+  cache.preload(flatfile,range(1,63))
+  flatim, medflat = ccdproc_calflat(cache,flatfile,exten)
+
+-
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class CalCache(object):
+
+    def __init__(self, maxbytes=2*1024**3, loader=None):
+        self.maxbytes = int(maxbytes)
+        self.loader = loader
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        # Locks can't be pickled, i.e. for worker processes
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def key(self, path, exten):
+        # Cache key, a changed file gets a new key
+        st = os.stat(path)
+        return (os.path.abspath(path), exten, st.st_mtime, st.st_size)
+
+    def _evict(self, keep):
+        # Drop least recently used entries until we are under budget
+        while self.nbytes>self.maxbytes and len(self._entries)>1:
+            key = next(iter(self._entries))
+            if key==keep:
+                self._entries.move_to_end(key)
+                continue
+            entry = self._entries.pop(key)
+            self.nbytes -= entry['nbytes']
+            self.evictions += 1
+
+    def _entry(self, path, exten, loader=None):
+        # Get the entry for a frame, loading it if needed
+        key = self.key(path, exten)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return key, entry
+            self.misses += 1
+
+        # Load outside of the lock
+        if loader is None: loader = self.loader
+        if loader is None:
+            raise ValueError('No loader for '+path)
+        data = np.asarray(loader(path, exten))
+        data.setflags(write=False)   # shared, must not be modified
+        entry = {'data':data, 'derived':{}, 'nbytes':data.nbytes}
+
+        with self._lock:
+            # Another thread might have loaded it already
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return key, self._entries[key]
+            # Too big for the cache, don't keep it
+            if entry['nbytes']>self.maxbytes:
+                return key, entry
+            # Stale versions of this frame can go
+            for k in [k for k in self._entries if k[0:2]==key[0:2]]:
+                self.nbytes -= self._entries.pop(k)['nbytes']
+            self._entries[key] = entry
+            self.nbytes += entry['nbytes']
+            self._evict(key)
+        return key, entry
+
+    def get(self, path, exten, loader=None):
+        # Return the calibration frame
+        key, entry = self._entry(path, exten, loader=loader)
+        return entry['data']
+
+    def derived(self, path, exten, name, func, loader=None):
+        # Return a value derived from the frame with func(data)
+        key, entry = self._entry(path, exten, loader=loader)
+        with self._lock:
+            if name in entry['derived']:
+                return entry['derived'][name]
+        value = func(entry['data'])
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+            nbytes = value.nbytes
+        else:
+            nbytes = 0
+        with self._lock:
+            if name not in entry['derived']:
+                entry['derived'][name] = value
+                if key in self._entries:
+                    entry['nbytes'] += nbytes
+                    self.nbytes += nbytes
+                    self._evict(key)
+        return entry['derived'][name]
+
+    def preload(self, path, extens, loader=None):
+        # Load frames ahead of time, i.e. in the parent before forking
+        for exten in extens:
+            self.get(path, exten, loader=loader)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        # Summary of the cache usage
+        return {'hits':self.hits, 'misses':self.misses,
+                'evictions':self.evictions, 'nbytes':self.nbytes,
+                'nframes':len(self._entries)}
+
+
+def ccdproc_calflat(cache, flatfile, exten, loader=None):
+    # Cleaned flat and its median
+    #  bad pixels (<0.001) in the flat are set to the median
+    def median(flatim):
+        return float(np.median(flatim))
+    def clean(flatim):
+        medflatim = cache.derived(flatfile, exten, 'median', median, loader=loader)
+        out = np.array(flatim, dtype=np.result_type(flatim.dtype,np.float32))
+        out[out<0.001] = medflatim
+        return out
+    medflatim = cache.derived(flatfile, exten, 'median', median, loader=loader)
+    flatim = cache.derived(flatfile, exten, 'clean', clean, loader=loader)
+    return flatim, medflatim
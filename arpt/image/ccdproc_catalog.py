@@ -0,0 +1,148 @@
+"""
++
+
+ CCDPROC_CATALOG
+
+ This is a persistent on-disk catalog (sqlite) of the per-HDU
+ processing state (XTALKCOR, LINCORR, FIXPIX, TRIM, OVERSCAN,
+ ZEROCOR, FLATCOR, ILLUMCOR, BTSTRP, BPM) and basic metadata
+ (FILTER, DATE-OBS, EXPTIME, NAXIS) of FITS files.  Entries are keyed
+ by the path and are only used while the file's mtime and size are
+ unchanged.  ccdproc updates the catalog as it writes its outputs,
+ so a rerun over a large directory can decide which files still
+ need work from the catalog alone, without opening them.
+
+ INPUTS:
+  dbfile       The name of the catalog file.  It is created if it
+                 does not exist.
+
+ OUTPUTS:
+  catalog      The HeaderCatalog object.
+
+ HeaderCatalog:
+  .lookup(file)        The catalog entry for FILE, or None if it is
+                         missing or stale.  The entry has FILE, MTIME,
+                         SIZE, NEXTEND, FILTER, DATEOBS, EXPTIME and
+                         HDU, a list with EXT, NAXIS, SZ and a 0/1
+                         flag for each processing step.
+  .update(file)        Read the headers of FILE (one open and scan)
+                         and store them.  Returns the entry.
+  .todo(file,steps)    The extensions of FILE that still need any of
+                         STEPS, i.e. ['overscan','trim','zero'].
+                         The file is scanned if the entry is stale.
+
+ USAGE:
+  catalog = HeaderCatalog('ccdproc.db')
+  if len(catalog.todo(file,['overscan','zero']))==0: skip the file
+
+-
+"""
+
+import os
+import json
+import sqlite3
+import threading
+
+from fitsindex import fitsindex, fitskey, fitshaskey
+
+# Processing step flags and the header keywords that set them
+STEPKEYS = [('xtalk',['XTALKCOR']), ('lincor',['LINCORR']),
+            ('fixpix',['FIXPIX']), ('trim',['TRIM']),
+            ('overscan',['OVERSCAN']), ('zero',['ZEROCOR']),
+            ('flat',['FLATCOR']), ('illumcor',['ILLUMCOR']),
+            ('btsrp',['BTSTRP','BTSRP']), ('bpm',['BPM'])]
+STEPS = [s[0] for s in STEPKEYS]
+
+
+def ccdproc_hdustate(head):
+    # Processing state and size of one HDU from its header
+    naxis = fitskey(head, 'NAXIS', 0)
+    state = {'naxis':naxis,
+             'sz':[fitskey(head, 'NAXIS'+str(j+1), 0) for j in range(naxis)]}
+    for step,kwds in STEPKEYS:
+        state[step] = int(any(fitshaskey(head, k) for k in kwds))
+    return state
+
+
+class HeaderCatalog(object):
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self._db = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Worker processes open their own connection
+        return {'dbfile':self.dbfile}
+
+    def __setstate__(self, state):
+        self.__init__(state['dbfile'])
+
+    def _conn(self):
+        # One connection per process
+        if self._db is None or self._pid!=os.getpid():
+            db = sqlite3.connect(self.dbfile, timeout=60, check_same_thread=False)
+            db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, '
+                       'mtime REAL, size INTEGER, nextend INTEGER, filter TEXT, '
+                       'dateobs TEXT, exptime REAL, hdu TEXT)')
+            db.commit()
+            self._db = db
+            self._pid = os.getpid()
+        return self._db
+
+    def lookup(self, file):
+        # Catalog entry, None if missing or stale
+        path = os.path.abspath(file)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            row = self._conn().execute('SELECT mtime,size,nextend,filter,dateobs,'
+                                       'exptime,hdu FROM files WHERE path=?',
+                                       (path,)).fetchone()
+        if row is None or row[0]!=st.st_mtime or row[1]!=st.st_size:
+            return None
+        return {'file':path, 'mtime':row[0], 'size':row[1], 'nextend':row[2],
+                'filter':row[3], 'dateobs':row[4], 'exptime':row[5],
+                'hdu':json.loads(row[6])}
+
+    def update(self, file):
+        # Scan the headers of a file and store them
+        path = os.path.abspath(file)
+        fits, error = fitsindex(path)
+        if error!='': raise IOError(error)
+        head = fits.header(0, shared=True)
+        hdu = []
+        for i in range(fits.nextend+1):
+            state = ccdproc_hdustate(fits.header(i, shared=True))
+            state['ext'] = i
+            hdu.append(state)
+        entry = {'file':path, 'mtime':fits.mtime, 'size':fits.size,
+                 'nextend':fits.nextend, 'filter':str(fitskey(head, 'FILTER', '')),
+                 'dateobs':str(fitskey(head, 'DATE-OBS', '')),
+                 'exptime':float(fitskey(head, 'EXPTIME', 0.0) or 0.0), 'hdu':hdu}
+        with self._lock:
+            db = self._conn()
+            db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?)',
+                       (path, entry['mtime'], entry['size'], entry['nextend'],
+                        entry['filter'], entry['dateobs'], entry['exptime'],
+                        json.dumps(hdu)))
+            db.commit()
+        return entry
+
+    def todo(self, file, steps):
+        # Extensions that still need processing
+        entry = self.lookup(file)
+        if entry is None: entry = self.update(file)
+        hdu = entry['hdu']
+        # Image extensions only, the PDU of a MEF file has no data
+        if entry['nextend']>0: hdu = hdu[1:]
+        return [h['ext'] for h in hdu
+                if h['naxis']>0 and any(h[s]==0 for s in steps)]
+
+    def close(self):
+        if self._db is not None and self._pid==os.getpid():
+            self._db.close()
+        self._db = None
@@ -87,8 +87,15 @@ def ccdproc_checkfile(file,exten=exten,exists=exists,validfits=validfits,data=da
         return errval
 
     # Load the header
+    #  ccdproc_fileinfo already indexed the file, this reuses it
     if validfits or data or len(size)>0:
-        head = headfits(info.file,errmsg=errmsg,exten=exten)
+        fits, errmsg = fitsindex(info.file)
+        if errmsg=='':
+            if len(exten)==0: exten=0
+            if exten>fits.nextend:
+                errmsg = 'Extension '+str(exten)+' not found'
+            else:
+                head = fits.header(exten,shared=True)
         if errmsg!='':
             errstr = info.file+' cannot load FITS Header.'
             errval = 1
@@ -102,9 +109,9 @@ def ccdproc_checkfile(file,exten=exten,exists=exists,validfits=validfits,data=da
         # if NAXIS=0 or XTENSION='BINTABLE' then errval=1
         # Check that it's not a fits binary table
 
-        naxis = sxpar(head,'NAXIS',count=n_naxis)
-        xtension = sxpar(head,'XTENSION',count=n_xtension)
-        if naxis==0 or (n_xtension>0 and xtension.split()=='BINTABLE'):
+        naxis = head.get('NAXIS',0)
+        xtension = head.get('XTENSION')
+        if naxis==0 or (xtension is not None and xtension.split()=='BINTABLE'):
             errstr = info.file+' is not DATA.'
             errval = 1
             bomb(errval,caller,errstr,silent)
@@ -113,12 +120,12 @@ def ccdproc_checkfile(file,exten=exten,exists=exists,validfits=validfits,data=da
     # SIZE
     #------
     if len(size)>0 and info.validfits==1:
-        naxis = sxpar(head,'NAXIS',count=n_naxis)
+        naxis = head.get('NAXIS',0)
         if naxis>0:
             imsize = lonarr(naxis)
             for i in range(0,naxis):
-                naxis1 = sxpar(head,'NAXIS'+str(i+1).split(),count=n_naxis1)
-                if n_naxis1>0: imsize[i]=long(naxis1)
+                naxis1 = head.get('NAXIS'+str(i+1))
+                if naxis1 is not None: imsize[i]=long(naxis1)
         nimdim = len(imsize)
         ndim = len(size)
 
@@ -0,0 +1,333 @@
+"""
++
+
+ CCDPROC_COMBINE
+
+ This builds the master zero (bias) and flat frames for ccdproc
+ (zerocombine and flatcombine).  Every input exposure is run through
+ the ccdproc steps (overscan, trim, zero, see ccdproc_fused) and the
+ stack is combined pixel by pixel with a median or a sigma-clipped
+ mean.  The output is a multi-extension file with one extension per
+ raw extension (same numbers, trimmed size, float32), the layout that
+ ccdproc's ZERO and FLAT inputs expect.
+
+ Memory is bounded: the inputs are memory-mapped (fitsindex) and the
+ stack is built and combined in chunks of rows, so only MAXMEM bytes
+ are used however many frames there are.  The overscan vectors come
+ from the bias pixels only (one pre-pass per input).  For flats each
+ input is divided by its median first (from a subsample of rows of
+ the calibrated frame) so that the stack is normalized, the master
+ then has a median of about 1.  The extensions are combined in
+ parallel on a thread pool and written straight into their place in
+ the output file, which is renamed into place at the end.
+ Tile-compressed inputs work but are decompressed for every chunk,
+ so uncompressed inputs are much faster.
+
+ INPUTS:
+  input        The input exposures (see loadinput: names, wildcards,
+                 comma lists or "@list" files).
+  outfile      The output master file.
+  =type        'zero' or 'flat'.  Default is 'zero'.
+  =combine     'median' (default), 'mean' or 'sigclip' (the mean after
+                 iterative NSIGMA clipping around the mean).
+  =nsigma      The clipping threshold for 'sigclip'.  Default is 3.
+  =niter       The maximum number of clipping iterations.  Default is 3.
+  /overscan    Subtract the overscan (all amplifiers).  Default is True.
+  /trim        Trim to TRIMSEC (or DATASEC).  Default is True.
+  =zero        The master zero to subtract (for flats).
+  /scale       Divide every input by its median.  Default is True for
+                 flats and False for zeros.
+  =ovfunction  The overscan estimator, see ccdproc_overscan.
+  =ovorder     The order of the 'poly' or 'spline' overscan fit.
+  =maxmem      The memory ceiling in bytes.  Default is 512MB.
+  =threads     The number of extensions to combine at once.  Default
+                 is 0, one per CPU.  They share MAXMEM.
+  /silent      Don't print anything to the screen.
+
+ OUTPUTS:
+  error        The error message if one occurred.
+  =stats       Dictionary that is filled with NCOMBINE, the SCALE of
+                 each input (flats, per extension) and NROWS (rows per
+                 chunk).
+
+ ccdproc_combinestack(stack) combines a stack (nframes,ny,nx) along
+ the first axis with the same options.
+
+ USAGE:
+  error = ccdproc_combine('bias*.fits','Zero.fits',type='zero')
+  error = ccdproc_combine('@dflats.lst','Flat.fits',type='flat',zero='Zero.fits',
+                          combine='sigclip')
+
+-
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from fitsindex import BLOCK, fitsindex, fitskey, fitsaddpar
+from fitswrite import fitsheader
+from loadinput import iloadinput
+from ccdproc_splitsec import ccdproc_splitsec
+from ccdproc_overscan import ccdproc_overscangeom, ccdproc_overscanvecs
+from ccdproc_fused import ccdproc_fused
+from ccdproc_strips import ccdproc_stripgeom
+
+COMBINES = ('median','mean','sigclip')
+
+# Pixels in the subsample for the flat scale
+NSCALE = 1 << 20
+
+
+def ccdproc_combinestack(stack, combine='median', nsigma=3.0, niter=3):
+    # Combine a stack of frames along the first axis
+    if combine=='median':
+        return np.median(stack, axis=0)
+    if combine=='mean':
+        return np.mean(stack, axis=0)
+    # Sigma clipping, rejected pixels become NaN
+    data = np.array(stack, dtype=stack.dtype)
+    with np.errstate(all='ignore'):
+        nkeep = np.full(data.shape[1:], data.shape[0])
+        for it in range(niter):
+            mean = np.nanmean(data, axis=0)
+            sigma = np.nanstd(data, axis=0)
+            data[np.abs(data-mean) > nsigma*sigma] = np.nan
+            n = np.sum(~np.isnan(data), axis=0)
+            if np.array_equal(n, nkeep): break
+            nkeep = n
+        out = np.nanmean(data, axis=0)
+    # Everything rejected, use the median
+    bad = nkeep==0
+    if bad.any(): out[bad] = np.median(stack, axis=0)[bad]
+    return out
+
+
+def _datestr():
+    # Oct  7 15:38
+    datearr = time.ctime().split()
+    return datearr[1]+' '+datearr[2]+' '+':'.join(datearr[3].split(':')[0:2])
+
+
+def _trimsec(head):
+    # 0-based TRIMSEC or DATASEC
+    trimsec = ccdproc_splitsec(fitskey(head, 'TRIMSEC'))
+    if trimsec==-1: trimsec = ccdproc_splitsec(fitskey(head, 'DATASEC'))
+    if trimsec==-1: raise ValueError('Header must have TRIMSEC or DATASEC')
+    return [t-1 for t in trimsec]
+
+
+def _extplan(fitslist, exten, overscan, trim, ovfunction, ovorder, zeroim, scale, dtype):
+    # Geometry, overscan vectors and scales of one extension of all inputs
+    head = fitslist[0].header(exten)
+    im0 = fitslist[0].data(exten)
+    ny, nx = im0.shape
+    trimsec = _trimsec(head) if trim else [0, nx-1, 0, ny-1]
+    ovgeom = ccdproc_overscangeom(head, im0.shape) if overscan else None
+    ovvecs, scales, ovsnmean = [], [], []
+    for fits in fitslist:
+        im = fits.data(exten)
+        if im.shape!=im0.shape:
+            raise ValueError(fits.file+' extension '+str(exten)+' has a different size')
+        vecs = None
+        if ovgeom is not None:
+            vecs = [v.astype(dtype) for v in
+                    ccdproc_overscanvecs(im, ovgeom, function=ovfunction, order=ovorder, dtype=dtype)]
+            ovsnmean.append(float(np.mean([np.mean(v) for v in vecs])))
+        ovvecs.append(vecs)
+        s = 1.0
+        if scale:
+            # Median of a subsample of the calibrated rows
+            oy0, oy1 = trimsec[2], trimsec[3]+1
+            step = max(1, (oy1-oy0)*(trimsec[1]-trimsec[0]+1)//NSCALE)
+            rows = np.arange(oy0, oy1, step)
+            vals = []
+            for y in rows:
+                out = _calrows(im, y, y+1, trimsec, ovgeom, vecs,
+                               None if zeroim is None else zeroim[y-oy0:y-oy0+1], dtype)
+                vals.append(out.ravel())
+            s = float(np.median(np.concatenate(vals)))
+            if not np.isfinite(s) or s<=0:
+                raise ValueError(fits.file+' extension '+str(exten)+' has a bad median '+str(s))
+        scales.append(s)
+    return {'head':head, 'shape':(trimsec[3]-trimsec[2]+1, trimsec[1]-trimsec[0]+1),
+            'trimsec':trimsec, 'ovgeom':ovgeom, 'ovvecs':ovvecs, 'scales':scales,
+            'ovsnmean':ovsnmean}
+
+
+def _calrows(im, y0, y1, trimsec, ovgeom, vecs, zeroband, dtype):
+    # The calibrated, trimmed rows Y0:Y1 (raw rows) of one input
+    geom, bvecs = None, None
+    if ovgeom is not None:
+        geom, bvecs = ccdproc_stripgeom(ovgeom, vecs, y0, y1)
+    out, error = ccdproc_fused(im[y0:y1], ovgeom=geom, ovvecs=bvecs,
+                               trimsec=[trimsec[0], trimsec[1], 0, y1-y0-1], trim=True,
+                               zeroim=zeroband, dtype=dtype)
+    if error!='': raise ValueError(error)
+    return out
+
+
+def ccdproc_combine(input, outfile, type='zero', combine='median', nsigma=3.0, niter=3,
+                    overscan=True, trim=True, zero='', scale=None, ovfunction='median',
+                    ovorder=3, maxmem=512*1024**2, threads=0, dtype='float32',
+                    stats=None, silent=False):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'CCDPROC_COMBINE: '   # error message prefix
+    if stats is None: stats = {}
+    tmpfile = outfile+'.tmp'
+
+    try:
+        # Check inputs
+        #-------------
+        if type not in ('zero','flat'):
+            error = errprefix+"TYPE must be 'zero' or 'flat'"
+            if not silent: print(error)
+            return error
+        if combine not in COMBINES:
+            error = errprefix+'COMBINE must be one of '+', '.join(COMBINES)
+            if not silent: print(error)
+            return error
+        if scale is None: scale = type=='flat'
+        dtype = np.dtype(dtype)
+        files = list(iloadinput(input, sort=True))
+        if len(files)==0:
+            error = errprefix+'No files to combine'
+            if not silent: print(error)
+            return error
+        fitslist = []
+        for file in files:
+            fits, error = fitsindex(file)
+            if error!='':
+                error = errprefix+error
+                if not silent: print(error)
+                return error
+            fitslist.append(fits)
+        nextend = fitslist[0].nextend
+        if any(f.nextend!=nextend for f in fitslist):
+            error = errprefix+'The inputs have different numbers of extensions'
+            if not silent: print(error)
+            return error
+        extens = list(range(1, nextend+1)) if nextend>0 else [0]
+        zfits = None
+        if zero!='':
+            zfits, error = fitsindex(zero)
+            if error!='':
+                error = errprefix+error
+                if not silent: print(error)
+                return error
+        nthreads = threads if threads>0 else (os.cpu_count() or 1)
+        nthreads = min(nthreads, len(extens))
+        stats['ncombine'] = len(files)
+        if not silent:
+            print('Combining '+str(len(files))+' '+type+' frames, '+combine)
+
+        # Pre-pass: geometry, overscan vectors and scales
+        #--------------------------------------------------
+        def plan(exten):
+            zeroim = None if zfits is None else zfits.data(exten)
+            p = _extplan(fitslist, exten, overscan, trim, ovfunction, ovorder, zeroim,
+                         scale, dtype)
+            p['zeroim'] = zeroim
+            return p
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            plans = dict(zip(extens, pool.map(plan, extens)))
+        stats['scale'] = dict((e, plans[e]['scales']) for e in extens)
+
+        # Headers and the layout of the output file
+        #-------------------------------------------
+        datestr = _datestr()
+        ohead = [c for c in fitslist[0].header(0) if c[0:8]!='END     ']
+        fitsaddpar(ohead, 'OBSTYPE', type)
+        fitsaddpar(ohead, 'NCOMBINE', len(files))
+        cards = []
+        if nextend>0:
+            cards.append(fitsheader(None, ohead, primary=True, nextend=nextend))
+        for e in extens:
+            p = plans[e]
+            head = [c for c in (p['head'] if nextend>0 else ohead) if c[0:8]!='END     ']
+            if overscan:
+                fitsaddpar(head, 'OVSNMEAN', float(np.mean(p['ovsnmean'])))
+                fitsaddpar(head, 'OVERSCAN', datestr+' Overscan is '+
+                           ','.join([amp['biassec'] for amp in p['ovgeom']])+', '+ovfunction)
+            if trim:
+                fitsaddpar(head, 'TRIM', datestr+' Trim is '+
+                           '[%d:%d,%d:%d]' % tuple([t+1 for t in p['trimsec']]))
+            if zero!='': fitsaddpar(head, 'ZEROCOR', datestr+' Zero is '+zero)
+            fitsaddpar(head, 'OBSTYPE', type)
+            fitsaddpar(head, 'NCOMBINE', len(files))
+            fitsaddpar(head, 'COMBINE', combine+(' %.1f sigma' % nsigma if combine=='sigclip' else ''))
+            for k,file in enumerate(files):
+                fitsaddpar(head, 'IMCMB%03d' % (k+1), os.path.basename(file))
+            if scale:
+                fitsaddpar(head, 'CCDMEAN', 1.0, 'inputs scaled by their medians')
+            cards.append(fitsheader((p['shape'], dtype), head, primary=(nextend==0)))
+        # header offset and data offset of every HDU
+        hdus = [None]+extens if nextend>0 else extens
+        layout = []
+        offsets = {}
+        off = 0
+        for e,c in zip(hdus, cards):
+            raw = ''.join(c).encode('ascii', 'replace')
+            layout.append((off, raw+b' '*(-len(raw) % BLOCK)))
+            off += len(layout[-1][1])
+            if e is None: continue
+            offsets[e] = off
+            ny, nx = plans[e]['shape']
+            off += (ny*nx*dtype.itemsize+BLOCK-1)//BLOCK*BLOCK
+
+        # Preallocate, the extensions are written in place
+        fd = os.open(tmpfile, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, off)
+            for hoff,raw in layout: os.pwrite(fd, raw, hoff)
+
+            # Combine the extensions chunk by chunk
+            #---------------------------------------
+            nfiles = len(files)
+            extmem = maxmem//nthreads
+            outtype = dtype.newbyteorder('>')
+
+            def combineext(e):
+                p = plans[e]
+                ny, nx = p['shape']
+                trimsec = p['trimsec']
+                # The stack, the combine copies and the fused scratch
+                rowbytes = nx*dtype.itemsize*(2*nfiles+8)
+                nrows = max(1, min(ny, extmem//rowbytes))
+                stack = np.empty((nfiles, nrows, nx), dtype=dtype)
+                for r0 in range(0, ny, nrows):
+                    r1 = min(r0+nrows, ny)
+                    y0, y1 = trimsec[2]+r0, trimsec[2]+r1
+                    zeroband = None if p['zeroim'] is None else p['zeroim'][r0:r1]
+                    for k,fits in enumerate(fitslist):
+                        out = _calrows(fits.data(e), y0, y1, trimsec, p['ovgeom'],
+                                       p['ovvecs'][k], zeroband, dtype)
+                        if p['scales'][k]!=1.0: out /= dtype.type(p['scales'][k])
+                        stack[k,0:r1-r0] = out
+                    comb = ccdproc_combinestack(stack[:,0:r1-r0], combine=combine,
+                                                nsigma=nsigma, niter=niter)
+                    os.pwrite(fd, comb.astype(outtype).tobytes(),
+                              offsets[e]+r0*nx*dtype.itemsize)
+                return nrows
+
+            with ThreadPoolExecutor(max_workers=nthreads) as pool:
+                nrows = list(pool.map(combineext, extens))
+            stats['nrows'] = dict(zip(extens, nrows))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmpfile, outfile)
+        if not silent:
+            print(outfile+' written, '+str(len(extens))+' extensions')
+
+    except Exception as e:
+        if os.path.exists(tmpfile): os.remove(tmpfile)
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return error
+
+    return error
@@ -53,32 +53,35 @@ def ccdproc_fileinfo(file, xtrafits=False, silent=False, error=''):
         lastdot = strpos(base,'.',/reverse_search)
         info.base = strmid(base,0,lastdot)
         info.ext = strmid(base,lastdot+1)  # extension without the dot
+        # Tile-compressed files keep EXT='fz', the derived names
+        #  (_temp.fits, _mask.fits.fz) are built without the '.fits'
+        if info.ext=='fz' and strmid(info.base,strlen(info.base)-5)=='.fits':
+            info.base = strmid(info.base,0,strlen(info.base)-5)
     else: info.base=base
 
     # File not found
     if info.exists==0: return info
 
-    # The rest is only for FITS files
-    if info.ext!='fits': return info
+    # The rest is only for FITS files, .fz are tile-compressed FITS files
+    #  whose image HDUs fitsindex reads directly
+    if info.ext!='fits' and info.ext!='fz': return info
 
     # Get fits info
-    fits_open(file[0],fcb,no_abort=True,message=message)
+    #  one open and header scan for all of the HDUs
+    fits, message = fitsindex(file[0])
     if message!='': return info   # not valid fits file, return
-    next = fcb.nextend
-    fits_close(fcb)
+    next = fits.nextend
     info.validfits = 1             # loaded with no error, valid fits file
     info.nextend = long(next)      # number of extensions
 
     # Getting some basic FITS header information
+    #  the headers are the indexed instances of the fitsindex, shared
+    #  with ccdproc_checkfile and the processing steps (read only)
     info = CREATE_STRUCT(info,{filter:'',dateobs:'',exptime:0.0})
-    head = headfits(file[0],exten=0,errmsg=errmsg,/silent)
-    if errmsg!='': return info
-    filter = sxpar(head,'FILTER',count=nfilter)
-    if nfilter>0: info.filter=filter
-    dateobs = sxpar(head,'DATE-OBS',count=ndateobs)
-    if ndateobs>0: info.dateobs=dateobs
-    exptime = sxpar(head,'EXPTIME',count=nexptime)
-    if nexptime>0: info.exptime=exptime
+    head = fits.header(0,shared=True)
+    if head.has('FILTER'): info.filter=head.get('FILTER')
+    if head.has('DATE-OBS'): info.dateobs=head.get('DATE-OBS')
+    if head.has('EXPTIME'): info.exptime=head.get('EXPTIME')
 
     # Extra FITS information
     if info.validfits and xtrafits:
@@ -89,37 +92,26 @@ def ccdproc_fileinfo(file, xtrafits=False, silent=False, error=''):
         # Loop through HDUs
         for i in range(0,nhdu):
             info.hdu[i].ext = i
-            head = headfits(file[0],exten=i,errmsg=errmsg,silent=True)
-            if errmsg!='':
-                return info
-            naxis = sxpar(head,'NAXIS')
+            head = fits.header(i,shared=True)
+            naxis = head.get('NAXIS',0)
             info.hdu[i].naxis = naxis
             sz = lonarr(6)
             sz[0] = naxis
             if naxis>0:
                 for j in range(1,naxis+1):
-                    sz[j]=sxpar(head,'NAXIS'+strtrim(j,2))
+                    sz[j]=head.get('NAXIS'+strtrim(j,2),0)
             info.hdu[i].sz = sz
             info.hdu[i].head = PTR_NEW(head)
 
-            # Check processing steps
-            xtalk = sxpar(head,'XTALKCOR',count=nxtalk)
-            if nxtalk>0: info.hdu[i].xtalk=1
-            lincorr = sxpar(head,'LINCORR',count=nlincorr)
-            if nlincorr>0: info.hdu[i].lincor=1
-            trim = sxpar(head,'TRIM',count=ntrim)
-            if ntrim>0: info.hdu[i].trim=1
-            overscan = sxpar(head,'OVERSCAN',count=noverscan)
-            if noverscan>0: info.hdu[i].overscan=1
-            zerocor = sxpar(head,'ZEROCOR',count=nzerocor)
-            if nzerocor>0: info.hdu[i].zero=1
-            flatcor = sxpar(head,'FLATCOR',count=nflatcor)
-            if nflatcor>0: info.hdu[i].flat=1
-            illumcor = sxpar(head,'ILLUMCOR',count=nillumcor)
-            if nillumcor>0: info.hdu[i].illumcor=1
-            btstrp = sxpar(head,'BTSRP',count=nbtstrp)
-            if nbtstrp>0: info.hdu[i].btsrp=1
-            bpm = sxpar(head,'BPM',count=nbpm)
-            if nbpm>0: info.hdu[i].bpm=1
+            # Check processing steps, keyword index lookups
+            if head.has('XTALKCOR'): info.hdu[i].xtalk=1
+            if head.has('LINCORR'): info.hdu[i].lincor=1
+            if head.has('TRIM'): info.hdu[i].trim=1
+            if head.has('OVERSCAN'): info.hdu[i].overscan=1
+            if head.has('ZEROCOR'): info.hdu[i].zero=1
+            if head.has('FLATCOR'): info.hdu[i].flat=1
+            if head.has('ILLUMCOR'): info.hdu[i].illumcor=1
+            if head.has('BTSRP'): info.hdu[i].btsrp=1
+            if head.has('BPM'): info.hdu[i].bpm=1
 
     return info
@@ -3,105 +3,188 @@
 
  CCDPROC_FIXPIX
 
- This program applies a linearity correction to an image.
+ This program replaces the bad pixel regions of an image by linear
+ interpolation (like IRAF's fixpix).  Each region is interpolated
+ across its narrower dimension: along the lines for regions that are
+ at most as wide as they are tall (i.e. bad columns), along the
+ columns otherwise.  The interpolation is between the nearest good
+ pixels on both sides, at the image edge the one good neighbor is
+ copied.
+
+ The region list is compiled once per detector layout (regions and
+ image size) into a plan: the flat target indices of the bad pixels
+ and, for each of them, two source indices and weights.  Plans are
+ cached, so all files and extensions of a run share them, and
+ applying fixpix is a single gather and scatter.
 
  INPUTS:
-  im           The 2D image array.
+  im           The 2D float image array.  It is modified in place.
   head         The image header string array.
-  linstr       The linearity correction structure.
+  fixstr       The fixpix regions from ccdproc_loadfixpix.
   /silent      Don't print anything to the screen.
 
  OUTPUTS:
-  The input image and header are modified.  The input image is
-  scaled using the linarity correction and processing information
-  is added to the header.
-  =error       The error message if one occurred.
+  error        The error message if one occurred.
+  The bad regions of the input image are replaced and processing
+  information is added to the header.
+
+ ccdproc_fixpixplan(fixstr,shape) returns the plan, a dictionary with
+ TARGET (flat indices of the bad pixels, in increasing order), SRC
+ and W (2 x npix source indices and weights), TY/TX (the target rows
+ and columns), NPIX, NREGION and SHAPE.
+ ccdproc_fixpixvalues(im,plan) returns the interpolated values of the
+ targets, READ(indices) can return the (linearity-corrected) source
+ values instead of the raw ones.
+ ccdproc_fixpixband(plan,vals,y0,y1) returns the targets and values
+ of the rows Y0:Y1 (band coordinates), for the strip mode.
 
  USAGE:
-  IDL>ccdproc_fixpix,im,head,linstr,error=error,silent=silent
+  error = ccdproc_fixpix(im,head,fixstr)
+  plan = ccdproc_fixpixplan(fixstr,im.shape)
 
  By D. Nidever   April 2014
 -
 """
 
-def ccdproc_fixpix(im,head,linstr,error='',silent=True):
+import time
+from functools import lru_cache
+
+import numpy as np
+
+from fitsindex import fitskey, fitsaddpar
+
+
+def _nearest(good):
+    # Nearest good index below and above every position along axis 1,
+    # -1 and n if there is none
+    n = good.shape[1]
+    idx = np.arange(n, dtype=np.int32)
+    below = np.maximum.accumulate(np.where(good, idx, -1), axis=1)
+    above = np.minimum.accumulate(np.where(good, idx, n)[:,::-1], axis=1)[:,::-1]
+    return below, above
+
+
+def _weights(p, a, b, n):
+    # Linear interpolation weights of position P between A and B, one
+    # sided at the edges.  Returns the sources, weights and a flag for
+    # the pixels that have no good neighbor at all.
+    hasa, hasb = a>=0, b<n
+    a2 = np.where(hasa, a, b)
+    b2 = np.where(hasb, b, a2)
+    wa = np.where(hasa & hasb, (b-p)/np.maximum(b-a, 1).astype(np.float64), 1.0)
+    return a2, b2, wa, 1.0-wa, hasa | hasb
+
+
+@lru_cache(maxsize=32)
+def _plan(regions, shape):
+    # The plan for 0-based inclusive regions (x1,x2,y1,y2)
+    ny, nx = shape
+    bad = np.zeros(shape, dtype=bool)
+    alongx = np.zeros(shape, dtype=bool)
+    for x1, x2, y1, y2 in regions:
+        x1, x2, y1, y2 = max(x1,0), min(x2,nx-1), max(y1,0), min(y2,ny-1)
+        if x2<x1 or y2<y1: continue
+        sl = (slice(y1,y2+1), slice(x1,x2+1))
+        # The first region of a pixel sets the direction
+        if x2-x1<=y2-y1: alongx[sl] |= ~bad[sl]
+        bad[sl] = True
+    ty, tx = np.nonzero(bad)
+    dirx = alongx[ty, tx]
+    src = np.zeros((2, len(ty)), dtype=np.int64)
+    w = np.zeros((2, len(ty)), dtype=np.float64)
+    keep = np.zeros(len(ty), dtype=bool)
+
+    # Along the lines, only the rows with such pixels
+    sel = np.flatnonzero(dirx)
+    if len(sel)>0:
+        rows, rind = np.unique(ty[sel], return_inverse=True)
+        below, above = _nearest(~bad[rows])
+        a, b = below[rind, tx[sel]], above[rind, tx[sel]]
+        a, b, wa, wb, ok = _weights(tx[sel], a, b, nx)
+        src[0,sel], src[1,sel] = ty[sel]*nx+a, ty[sel]*nx+b
+        w[0,sel], w[1,sel], keep[sel] = wa, wb, ok
+    # Along the columns
+    sel = np.flatnonzero(~dirx)
+    if len(sel)>0:
+        cols, cind = np.unique(tx[sel], return_inverse=True)
+        below, above = _nearest(~bad[:,cols].T)
+        a, b = below[cind, ty[sel]], above[cind, ty[sel]]
+        a, b, wa, wb, ok = _weights(ty[sel], a, b, ny)
+        src[0,sel], src[1,sel] = a*nx+tx[sel], b*nx+tx[sel]
+        w[0,sel], w[1,sel], keep[sel] = wa, wb, ok
+
+    ty, tx = ty[keep], tx[keep]
+    return {'target':ty.astype(np.int64)*nx+tx, 'ty':ty, 'tx':tx, 'src':src[:,keep],
+            'w':w[:,keep], 'npix':int(keep.sum()), 'nregion':len(regions),
+            'shape':tuple(shape)}
+
+
+def ccdproc_fixpixplan(fixstr, shape):
+    # The cached interpolation plan of the regions for an image size
+    regions = tuple((f['x1']-1, f['x2']-1, f['y1']-1, f['y2']-1) for f in fixstr)
+    return _plan(regions, tuple(int(s) for s in shape))
+
+
+def ccdproc_fixpixvalues(im, plan, read=None, dtype=np.float64):
+    # The interpolated values of the targets
+    if read is None:
+        flat = im.reshape(-1)
+        read = lambda ind: flat[ind]
+    s0 = np.asarray(read(plan['src'][0]), dtype=dtype)
+    s1 = np.asarray(read(plan['src'][1]), dtype=dtype)
+    return (plan['w'][0]*s0+plan['w'][1]*s1).astype(dtype)
+
+
+def ccdproc_fixpixband(plan, vals, y0, y1):
+    # Targets (rows relative to Y0, columns) and values of the rows Y0:Y1
+    i0, i1 = np.searchsorted(plan['ty'], [y0, y1])
+    return plan['ty'][i0:i1]-y0, plan['tx'][i0:i1], vals[i0:i1]
+
+
+def ccdproc_fixpix(im, head, fixstr, silent=True):
 
     # Initalizing some variables
+    error = ''
     errprefix = 'CCDPROC_FIXPIX: '   # error message prefix
 
     # Error Handling
     #------------------
-    # Establish error handler. When errors occur, the index of the  
-    # error is returned in the variable error_status:  
-    CATCH( error_status )
-    #This statement begins the error handler:  
-    if error_status!=0:
-        error = errprefix+!ERROR_STATE.MSG  
-        if not silent: print error
-        CATCH( CANCEL=True )
+    try:
+
+        # Check inputs
+        #-------------
+        if not isinstance(im, np.ndarray) or im.ndim!=2 or im.dtype.kind!='f':
+            error = errprefix+'Image must be a 2D float array'
+            if not silent: print(error)
+            return error
+        if fixstr is None or len(fixstr)==0:
+            error = errprefix+'No fixpix regions'
+            if not silent: print(error)
+            return error
+
+        # Have we done this processing step already?
+        if fitskey(head, 'FIXPIX') is not None:
+            error = errprefix+'Fixpix correction already applied.'
+            if not silent: print(error)
+            return error
+
+        # Interpolate, one gather and one scatter
+        #-----------------------------------------
+        plan = ccdproc_fixpixplan(fixstr, im.shape)
+        im[plan['ty'], plan['tx']] = ccdproc_fixpixvalues(im, plan)
+
+        # Add processing information to header
+        #--------------------------------------
+        #  Current timestamp information
+        #  Sun Oct  7 15:38:23 2012
+        datearr = time.ctime().split()
+        datestr = datearr[1]+' '+datearr[2]+' '+':'.join(datearr[3].split(':')[0:2])
+        fitsaddpar(head, 'FIXPIX', datestr+' Fixpix '+str(plan['npix'])+' pixels in '+
+                   str(plan['nregion'])+' regions')
+
+    except Exception as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
         return error
 
-    # Check inputs
-    #-------------
-    if len(im)==0 or len(head)==0 or len(linstr)==0:
-        if not silent: $
-        print 'Syntax -  ccdproc_fixpix,im,head,linstr,error=error,silent=silent'
-        error = errprefix+'Not Enough Inputs'
-        return error
-
-    # Check that IM is a data (type=1-5 or 12-15) 2D array
-    if CHECKPAR(im,[1,2,3,4,5,12,13,14,15],[2],caller=errprefix+'Image - ',errstr=error,silent=silent): return error
-    # Check that HEAD is a string array
-    if CHECKPAR(head,7,1,caller=errprefix+'Header - ',errstr=error,silent=silent): return error
-
-    # Have we done this processing step already?
-    fixpix = sxpar(head,'FIXPIX',count=nfixpix)
-    if nfixpix>0:
-        error = errprefix+'Linearity correction already applied.'
-        if not silent: print error
-        return error
-
-    # Check the fixpix structure
-    if CHECKPAR(im,[8],caller=errprefix+'LINSTR - ',errstr=error,silent=silent): return error
-    if tag_exist(linstr,'EXTEN')==0 or tag_exist(linstr,'SCALE')==0:
-        error = errprefix+'Linearity structure must have EXTEN and SCALE tags.'
-        if not silent: print error
-        return error
-
-    # Check that the FIXPIX EXTEN is int/long
-    if CHECKPAR(bootstr.exten,[2,3],caller=errprefix+'Fixpix EXTEN - ',silent=silent,errstr=error): return error
-    # Check that the FIXPIX SCALE is float/double
-    if CHECKPAR(bootstr.scale,[4,5],caller=errprefix+'Fixpix SCALE - ',silent=silent,errstr=error): return error
-
-    # Find the right extension
-    if len(exten)>0:
-        ind=where(bootstr.exten==exten,nind)
-    else:
-        ind = where(bootstr.exten==0,nind)
-    if nind==0:
-        error = errprefix+'Right extension NOT FOUND in Fixpix structure.'
-        if not silent: print error
-        return error
-
-    # SCALE cannot be zero
-    if bootstr[ind[0]].scale==0.0:
-        error = errprefix+'Fixpix SCALE but not be zero.'
-        if not silent: print error
-        return error
-
-    # Scale by FIXPIX value
-    #--------------------------
-    im *= bootstr[ind[0]].scale     # scale by Fixpix value
-
-
-    # Add processing information to header
-    #--------------------------------------
-    #  Current timestamp information
-    #  Sun Oct  7 15:38:23 2012
-    date = systime(0)
-    datearr = strtrim(strsplit(date,' ',/extract),2)
-    timarr = strsplit(datearr[3],':',/extract)
-    datestr = datearr[1]+' '+datearr[2]+' '+strjoin(timarr[0:1],':')
-    fxaddpar,head,'FIXPIX',datestr+' Fixpix scale '+strtrim(string(bootstr[ind[0]].scale,format='(G20.2)'),2)
-
     return error
@@ -0,0 +1,303 @@
+"""
++
+
+ CCDPROC_FUSED
+
+ This program applies all of the per-pixel ccdproc steps to one
+ image extension in a single pass.  The raw image is converted
+ into one float32 (or float64) working buffer block by block, and
+ linearity, fixpix, overscan, trim, zero, flat, illum,
+ bootstrap and bpm are all applied to each block while it is still
+ in cache.  No full-frame copies are made besides the working buffer.
+ Cross-talk needs the other extensions and must be applied before.
+
+ INPUTS:
+  im           The 2D raw image array.  This is not modified.
+  =biassec     The 0-based [x1,x2,y1,y2] BIASSEC indices.  Setting this
+                 turns on the overscan correction.
+  =ovgeom      The amplifier geometry from ccdproc_overscangeom, for
+                 detectors with several amplifiers.  This is used
+                 instead of BIASSEC.
+  =ovfunction  The overscan estimator (see ccdproc_overscan).
+                 Default is 'median'.
+  =ovorder     The order of the 'poly' or 'spline' overscan fit.
+  =ovvecs      The overscan vectors of the OVGEOM amplifiers, if they
+                 are already known (ccdproc_strips).  The bias pixels
+                 are then not used.
+  =trimsec     The 0-based [x1,x2,y1,y2] TRIMSEC (or DATASEC) indices.
+                 Needed for overscan.  Used to trim if /trim is set.
+  /trim        Trim the image to TRIMSEC.
+  =linplan     The linearity plan of the raw image (ccdproc_linplan).
+                 Raw integers of up to 16 bits are corrected with the
+                 lookup tables while they are converted to float.
+  =fixplan     The fixpix plan of the raw image (ccdproc_fixpixplan).
+                 The bad pixels are interpolated right after the
+                 linearity correction (the bias pixels are not fixed).
+  =fixvals     The interpolated values of the FIXPLAN targets, if they
+                 are already known (ccdproc_strips).  FIXPLAN then only
+                 needs TY and TX.
+  =zeroim      The zero image (same size as the output image).
+  =flatim      The flat image (same size as the output image).
+  =illumim     The illumination image (same size as the output image).
+  =bootscale   Bootstrap scale.
+  =bpmind      The sorted flat indices of the bad pixels in the output
+                 image (PixMask.indices, see ccdproc_mask).
+  =badpixval   Value to set bad pixels to.  Default is 65535.
+  =medflat     Median of flatim, if it is already known.
+  =medillum    Median of illumim, if it is already known.
+  =dtype       The working buffer type, 'float32' (default) or 'float64'.
+  =nblock      Number of rows to process per block.  Default is 256.
+  /silent      Don't print anything to the screen.
+
+ OUTPUTS:
+  out          The calibrated image in the working buffer.
+  error        The error message if one occurred.
+  =stats       Dictionary that is filled with information on the
+                 processing: ovsnmean, ovsnamp (mean per amplifier), medflat, medillum, nbdpix,
+                 peakmem (bytes allocated by this program) and maxrss
+                 (peak resident set size of the process in bytes).
+
+ USAGE:
+  out, error = ccdproc_fused(im,zeroim=zeroim,flatim=flatim,stats=stats)
+
+-
+"""
+
+import numpy as np
+
+from ccdproc_overscan import ccdproc_overscanvecs
+from ccdproc_fixpix import ccdproc_fixpixvalues
+from ccdproc_lincorr import ccdproc_linconvert, ccdproc_linwindow, ccdproc_linvalues
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def maxrss():
+    # Peak resident set size of the process in bytes
+    if resource is None: return -1
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+def ccdproc_fused(im, biassec=None, trimsec=None, trim=False, ovgeom=None,
+                  ovfunction='median', ovorder=3, ovvecs=None, linplan=None,
+                  fixplan=None, fixvals=None, zeroim=None, flatim=None, illumim=None,
+                  bootscale=None, bpmind=None, badpixval=65535, medflat=None,
+                  medillum=None, dtype='float32', nblock=256, stats=None,
+                  silent=True):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'CCDPROC_FUSED: '   # error message prefix
+    if stats is None: stats = {}
+
+    # Error Handling
+    #------------------
+    try:
+
+        # Check inputs
+        #-------------
+        im = np.asarray(im)
+        if im.ndim!=2 or im.dtype.kind not in 'uif':
+            error = errprefix+'Image must be a 2D data array'
+            if not silent: print(error)
+            return None, error
+        dtype = np.dtype(dtype)
+        if dtype not in (np.dtype('float32'),np.dtype('float64')):
+            error = errprefix+'DTYPE must be float32 or float64'
+            if not silent: print(error)
+            return None, error
+        ny, nx = im.shape
+        peakmem = 0
+
+        # Overscan and trim sections
+        #----------------------------
+        if (biassec is not None or trim) and trimsec is None:
+            error = errprefix+'Need TRIMSEC or DATASEC'
+            if not silent: print(error)
+            return None, error
+        for sec in (biassec,trimsec):
+            if sec is None: continue
+            if sec[1]<sec[0] or sec[3]<sec[2]:
+                error = errprefix+'BIAS/TRIM/DATA section indices are not in INCREASING order'
+                if not silent: print(error)
+                return None, error
+            if sec[0]<0 or sec[1]>nx-1 or sec[2]<0 or sec[3]>ny-1:
+                error = errprefix+'BIAS/TRIM/DATA section indices out of image bounds'
+                if not silent: print(error)
+                return None, error
+
+        # Output region in the raw image
+        if trim:
+            ox0, ox1, oy0, oy1 = trimsec[0], trimsec[1]+1, trimsec[2], trimsec[3]+1
+        else:
+            ox0, ox1, oy0, oy1 = 0, nx, 0, ny
+        onx, ony = ox1-ox0, oy1-oy0
+
+        # Calibration images must match the output image
+        for name,cal in (('Zero',zeroim),('Flat',flatim),('Illum',illumim)):
+            if cal is not None and np.shape(cal)!=(ony,onx):
+                error = errprefix+name+' image has wrong size, must be ['+str(onx)+','+str(ony)+'].'
+                if not silent: print(error)
+                return None, error
+        if bpmind is not None and len(bpmind)>0 and \
+           (bpmind[0]<0 or bpmind[-1]>=ony*onx):
+            error = errprefix+'BPM indices out of image bounds'
+            if not silent: print(error)
+            return None, error
+
+        # Linearity-corrected raw pixels
+        readwin, readval = None, None
+        if linplan is not None:
+            readwin = lambda sl: ccdproc_linwindow(im, sl, linplan, dtype=dtype)
+            readval = lambda ind: ccdproc_linvalues(im, ind, linplan, dtype=dtype)
+
+        # Fixpix values, gathered from the raw image, in output coordinates
+        if fixplan is not None:
+            if fixvals is None:
+                fixvals = ccdproc_fixpixvalues(im, fixplan, read=readval, dtype=dtype)
+            ty, tx = fixplan['ty'], fixplan['tx']
+            inside = (ty>=oy0) & (ty<oy1) & (tx>=ox0) & (tx<ox1)
+            fixy, fixx, fixv = ty[inside]-oy0, tx[inside]-ox0, fixvals[inside].astype(dtype)
+
+        # Overscan vectors
+        #------------------
+        #  This only touches the bias pixels so it is small
+        if biassec is not None and ovgeom is None:
+            nxbias = biassec[1]-biassec[0]+1
+            nybias = biassec[3]-biassec[2]+1
+            # BIAS along columns, collapse in X
+            if nxbias<nybias:
+                if biassec[2]>trimsec[2] or biassec[3]<trimsec[3]:
+                    error = errprefix+'BIASSEC does not cover TRIMSEC in Y'
+                    if not silent: print(error)
+                    return None, error
+                bias = (slice(trimsec[2],trimsec[3]+1), slice(biassec[0],biassec[1]+1))
+                axis = 1
+            # BIAS along rows, collapse in Y
+            else:
+                if biassec[0]>trimsec[0] or biassec[1]<trimsec[1]:
+                    error = errprefix+'BIASSEC does not cover TRIMSEC in X'
+                    if not silent: print(error)
+                    return None, error
+                bias = (slice(biassec[2],biassec[3]+1), slice(trimsec[0],trimsec[1]+1))
+                axis = 0
+            ovgeom = [{'name':'', 'axis':axis, 'bias':bias,
+                       'data':(slice(trimsec[2],trimsec[3]+1),
+                               slice(trimsec[0],trimsec[1]+1))}]
+        amps = []
+        if ovgeom is not None:
+            if ovvecs is None:
+                vecs = ccdproc_overscanvecs(im, ovgeom, function=ovfunction, order=ovorder,
+                                            read=readwin, dtype=dtype)
+            else:
+                vecs = ovvecs
+            for amp,vec in zip(ovgeom, vecs):
+                vec = vec.astype(dtype)
+                if ovvecs is None:
+                    b = amp['bias']
+                    peakmem += 3*(b[0].stop-b[0].start)*(b[1].stop-b[1].start)*dtype.itemsize
+                # Overscan-corrected region in output coordinates, clipped
+                dy, dx = amp['data']
+                ay0, ay1 = max(dy.start,oy0)-oy0, min(dy.stop,oy1)-oy0
+                ax0, ax1 = max(dx.start,ox0)-ox0, min(dx.stop,ox1)-ox0
+                if ay1<=ay0 or ax1<=ax0: continue
+                # Vector positions of the output region
+                if amp['axis']==1:
+                    vec = vec[ay0+oy0-dy.start:ay1+oy0-dy.start]
+                else:
+                    vec = vec[ax0+ox0-dx.start:ax1+ox0-dx.start]
+                amps.append((amp['axis'], ay0, ay1, ax0, ax1, vec))
+            stats['ovsnamp'] = [float(np.mean(v)) for v in vecs]
+            stats['ovsnmean'] = float(np.mean(stats['ovsnamp']))
+
+        # Flat and illum medians, these are global
+        #-------------------------------------------
+        scale = 1.0
+        if flatim is not None:
+            if medflat is None:
+                medflat = float(np.median(flatim))
+                peakmem += np.asarray(flatim).nbytes
+            stats['medflat'] = medflat
+            scale *= medflat
+        if illumim is not None:
+            if medillum is None:
+                medillum = float(np.median(illumim))
+                peakmem += np.asarray(illumim).nbytes
+            stats['medillum'] = medillum
+            scale *= medillum
+        if bootscale is not None:
+            scale *= bootscale
+
+        # The single working buffer and block scratch space
+        out = np.empty((ony,onx), dtype=dtype)
+        nblock = max(1, min(int(nblock), ony))
+        tmp = np.empty((nblock,onx), dtype=dtype)
+        mask = np.empty((nblock,onx), dtype=bool)
+        peakmem += out.nbytes + tmp.nbytes + mask.nbytes
+        nbdpix = 0
+
+        # Loop over the row blocks
+        #--------------------------
+        for r0 in range(0, ony, nblock):
+            r1 = min(r0+nblock, ony)
+            blk = out[r0:r1]
+            t = tmp[0:r1-r0]
+            m = mask[0:r1-r0]
+
+            # Convert to float, with the linearity correction
+            if linplan is not None:
+                ccdproc_linconvert(im[oy0+r0:oy0+r1,ox0:ox1], blk, linplan, oy0+r0, ox0)
+            else:
+                blk[...] = im[oy0+r0:oy0+r1,ox0:ox1]
+
+            # Fixpix
+            if fixplan is not None:
+                i0, i1 = np.searchsorted(fixy, [r0, r1])
+                blk[fixy[i0:i1]-r0, fixx[i0:i1]] = fixv[i0:i1]
+
+            # Overscan
+            for axis,ay0,ay1,ax0,ax1,vec in amps:
+                s0, s1 = max(r0,ay0), min(r1,ay1)
+                if s1<=s0: continue
+                sub = blk[s0-r0:s1-r0,ax0:ax1]
+                if axis==1:
+                    sub -= vec[s0-ay0:s1-ay0,np.newaxis]
+                else:
+                    sub -= vec[np.newaxis,:]
+
+            # Zero, im should be LONG, need to round ZERO if non-integer
+            if zeroim is not None:
+                np.round(zeroim[r0:r1], out=t)
+                blk -= t
+
+            # Flat and illum, bad pixels are set to the median
+            for cal,med in ((flatim,medflat),(illumim,medillum)):
+                if cal is None: continue
+                t[...] = cal[r0:r1]
+                np.less(t, 0.001, out=m)
+                np.copyto(t, med, where=m)
+                blk /= t
+
+            # Flat/illum normalization and bootstrap scale
+            if scale!=1.0:
+                blk *= scale
+
+            # Bad pixels, the indices of this block
+            if bpmind is not None:
+                i0, i1 = np.searchsorted(bpmind, [r0*onx, r1*onx])
+                blk.reshape(-1)[bpmind[i0:i1]-r0*onx] = badpixval
+                nbdpix += int(i1-i0)
+
+        if bpmind is not None: stats['nbdpix'] = nbdpix
+        stats['peakmem'] = peakmem
+        stats['maxrss'] = maxrss()
+
+    except Exception as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return None, error
+
+    return out, error
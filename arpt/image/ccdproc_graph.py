@@ -0,0 +1,207 @@
+"""
++
+
+ CCDPROC_GRAPH
+
+ The ccdproc pipeline as a declared list of stages.  Each stage has
+ the run option that turns it on, the inputs it uses, the header
+ keyword it sets, its name in the header catalog, the coordinates it
+ works in ('raw' before trimming, 'out' after it), its place in
+ the fused kernel (ccdproc_fused), if it has one, and whether it can
+ be broadcast over a stack of exposures (ccdproc_stack).
+
+ A run compiles the graph once: inactive stages are dropped, the
+ order is checked (cross-talk first, raw-coordinate stages before
+ the trim, output-coordinate stages after it) and, in the fused mode,
+ adjacent stages that the fused kernel runs in the same order are
+ merged into one 'fused' node.  In the batch mode the adjacent
+ stackable stages (zero, flat, illum, bootstrap) become one 'stack'
+ node instead, that is applied to the exposures of a batch at once.
+ The same compiled graph drives the serial, threaded, process-pool
+ and batch execution (ccdproc_ext walks its nodes).
+
+ The default order is STAGEORDER.  Other orders can be given per
+ instrument, either as a comma list of stage names (for all files)
+ or as a file with lines
+
+   INSTRUME   stage1,stage2,...
+
+ where INSTRUME is matched against the primary header keyword and
+ '*' is the default.  Blank lines and lines starting with # are
+ skipped.  Active stages that an order leaves out are an error.
+
+ INPUTS:
+  active       Dictionary of run options (i.e. ccdproc's opts), a stage
+                 is active if its option is set.
+  =order       The order: '' (default), a comma list or an order file.
+  /fused       Merge the fusable stages.
+  /single      All of the stages after cross-talk must fuse into one
+                 node (the strip mode and the pixel masks need this).
+  /batch       Merge the stackable stages into 'stack' nodes.
+
+ OUTPUTS:
+  graphs       The StepGraphs object.
+  error        The error message if one occurred.
+
+ StepGraphs:
+  .get(file)   The compiled StepGraph for a file (by its INSTRUME).
+  .default     The StepGraph of the default order.
+
+ StepGraph:
+  .nodes       The list of nodes, dictionaries with NAME (the stage
+                 name, 'fused' or 'stack') and STEPS (the stage names).
+  .steps       The active stage names in order.
+  .catalog     The header catalog names of the active stages.
+  .describe()  The graph as text, i.e. 'xtalk -> fused(overscan,trim,zero)'.
+
+ USAGE:
+  graphs, error = ccdproc_graph(opts,order='orders.txt',fused=True)
+  for node in graphs.get(file).nodes: ...
+
+-
+"""
+
+import os
+from collections import OrderedDict
+
+from fitsindex import fitsindex, fitskey
+
+# The stages: run option, inputs, header keyword, catalog step,
+#  coordinates, the rank in the fused kernel (None if not fusable)
+#  and if it is broadcast over a stack of exposures
+STAGES = OrderedDict([
+    ('xtalk',     {'option':'xTalk', 'inputs':['xTalk','xstr','xmat'], 'key':'XTALKCOR',
+                   'catalog':'xtalk', 'coords':'raw', 'kernel':None, 'stack':False}),
+    ('lincorr',   {'option':'linCorr', 'inputs':['linstr'], 'key':'LINCORR',
+                   'catalog':'lincor', 'coords':'raw', 'kernel':0, 'stack':False}),
+    ('fixpix',    {'option':'fixPix', 'inputs':['fixstr'], 'key':'FIXPIX',
+                   'catalog':'fixpix', 'coords':'raw', 'kernel':1, 'stack':False}),
+    ('overscan',  {'option':'overscan', 'inputs':['ovfunction','ovorder'], 'key':'OVERSCAN',
+                   'catalog':'overscan', 'coords':'raw', 'kernel':2, 'stack':False}),
+    ('trim',      {'option':'trim', 'inputs':[], 'key':'TRIM',
+                   'catalog':'trim', 'coords':None, 'kernel':3, 'stack':False}),
+    ('zero',      {'option':'zero', 'inputs':['zero','cache'], 'key':'ZEROCOR',
+                   'catalog':'zero', 'coords':'out', 'kernel':4, 'stack':True}),
+    ('flat',      {'option':'flat', 'inputs':['flat','cache'], 'key':'FLATCOR',
+                   'catalog':'flat', 'coords':'out', 'kernel':5, 'stack':True}),
+    ('illum',     {'option':'illum', 'inputs':['illum','cache'], 'key':'ILLUMCOR',
+                   'catalog':'illumcor', 'coords':'out', 'kernel':6, 'stack':True}),
+    ('bootstrap', {'option':'bootstrap', 'inputs':['bootstr'], 'key':'BTSTRP',
+                   'catalog':'btsrp', 'coords':None, 'kernel':7, 'stack':True}),
+    ('bpm',       {'option':'bpm', 'inputs':['bpm','maskstore'], 'key':'BPM',
+                   'catalog':'bpm', 'coords':'out', 'kernel':8, 'stack':False}),
+])
+STAGEORDER = list(STAGES)
+
+
+class StepGraph(object):
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.steps = [s for node in nodes for s in node['steps']]
+        self.catalog = [STAGES[s]['catalog'] for s in self.steps]
+
+    def describe(self):
+        return ' -> '.join(n['name'] if n['name'] not in ('fused','stack') else
+                           n['name']+'('+','.join(n['steps'])+')' for n in self.nodes)
+
+
+def _compile(order, active, fused, single, batch=False):
+    # Compile one order, raises ValueError if it is not valid
+    for name in order:
+        if name not in STAGES:
+            raise ValueError('Unknown stage '+name+', must be one of '+', '.join(STAGEORDER))
+    if len(set(order))!=len(order):
+        raise ValueError('Stage order '+','.join(order)+' has duplicates')
+    missing = [s for s in STAGEORDER if active[s] and s not in order]
+    if len(missing)>0:
+        raise ValueError('Stage order '+','.join(order)+' is missing '+','.join(missing))
+    steps = [s for s in order if active[s]]
+
+    # Static checks of the order
+    if 'xtalk' in steps and steps[0]!='xtalk':
+        raise ValueError('xtalk must be the first stage, it works on the raw exposure')
+    if 'trim' in steps:
+        itrim = steps.index('trim')
+        for i,s in enumerate(steps):
+            if STAGES[s]['coords']=='raw' and i>itrim:
+                raise ValueError(s+' works on the untrimmed image, it must come before trim')
+            if STAGES[s]['coords']=='out' and i<itrim:
+                raise ValueError(s+' works on the trimmed image, it must come after trim')
+
+    # Merge adjacent stages that the fused or stack kernels run in
+    #  this order, the batch mode stacks before it fuses
+    nodes = []
+    for s in steps:
+        rank = STAGES[s]['kernel']
+        last = nodes[-1] if len(nodes)>0 else None
+        kind = 'stack' if batch and STAGES[s]['stack'] else ('fused' if fused else None)
+        if kind is not None and rank is not None and last is not None and \
+                last['name']==kind and STAGES[last['steps'][-1]]['kernel']<rank:
+            last['steps'].append(s)
+        elif kind is not None and rank is not None:
+            nodes.append({'name':kind, 'steps':[s]})
+        else:
+            nodes.append({'name':s, 'steps':[s]})
+    if single and len([n for n in nodes if n['name']!='xtalk'])>1:
+        raise ValueError('Stage order '+','.join(steps)+' does not fuse into one pass')
+    return StepGraph(nodes)
+
+
+def _orders(order):
+    # The orders by instrument of an order string or file
+    if order=='': return {}
+    if not os.path.exists(order):
+        return {'*':[s.strip().lower() for s in order.split(',') if s.strip()!='']}
+    out = {}
+    with open(order) as fh:
+        for line in fh:
+            arr = line.split(None, 1)
+            if len(arr)==0 or arr[0].startswith('#'): continue
+            if len(arr)<2:
+                raise ValueError(order+': no stages for '+arr[0])
+            out[arr[0]] = [s.strip().lower() for s in arr[1].split(',') if s.strip()!='']
+    return out
+
+
+class StepGraphs(object):
+
+    def __init__(self, graphs, default):
+        self.graphs = graphs
+        self.default = default
+
+    def get(self, file=''):
+        # The graph of a file, by the INSTRUME of its primary header
+        if len(self.graphs)==0 or file=='': return self.default
+        fits, error = fitsindex(file)
+        if error!='': return self.default
+        instrume = str(fitskey(fits.header(0, shared=True), 'INSTRUME', '')).strip()
+        return self.graphs.get(instrume, self.default)
+
+
+def ccdproc_graph(active, order='', fused=False, single=False, batch=False, silent=True):
+
+    # Initalizing some variables
+    graphs = None
+    error = ''
+    errprefix = 'CCDPROC_GRAPH: '   # error message prefix
+
+    try:
+        # Active stages of the run options
+        act = {}
+        for name,stage in STAGES.items():
+            val = active.get(stage['option'])
+            act[name] = (len(val)>0) if isinstance(val, str) else bool(val)
+
+        # Every order is compiled now, so a bad one fails before any file
+        orders = _orders(order)
+        default = _compile(orders.pop('*', STAGEORDER), act, fused, single, batch)
+        graphs = StepGraphs(dict((k, _compile(o, act, fused, single, batch))
+                                 for k,o in orders.items()), default)
+
+    except (IOError, OSError, ValueError) as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return None, error
+
+    return graphs, error
@@ -0,0 +1,205 @@
+"""
++
+
+ CCDPROC_JOURNAL
+
+ This is a persistent on-disk journal (sqlite) of the ccdproc runs
+ that makes interrupted runs resumable.  For every input file it
+ records a content hash of the input, the key of the calibration
+ files (content hashes) and the step configuration, the output
+ (temporary) file and the content hash of the output, and the state
+ of the work: STARTED, MOVING (the output is about to replace the
+ input) or DONE.
+
+ A rerun decides per file (begin):
+  - DONE with the same key and the file is (still) the recorded
+    output: skip it.
+  - DONE with another key (i.e. a new flat): redo it if the recorded
+    input is still there (out-of-place runs), otherwise the raw data
+    was overwritten and the file is reported as STALE.
+  - STARTED (the run died): the orphaned temporary file is deleted
+    and the file is processed again.
+  - MOVING (the run died around the rename): a complete temporary
+    file (its hash matches) is moved into place and the file is DONE,
+    a partial one is deleted and the file is processed again.
+  - Unknown or changed input: process it.
+
+ The content hashes (BLAKE2b) are cached by path, mtime and size so
+ unchanged files, in particular the calibration files that every key
+ uses, are only read once.
+
+ INPUTS:
+  dbfile       The name of the journal file.  It is created if it
+                 does not exist.
+
+ OUTPUTS:
+  journal      The ProcJournal object.
+
+ ProcJournal:
+  .hash(file)              The content hash of FILE.
+  .key(calfiles,config)    The key of a calibration setup, from the
+                             content hashes of CALFILES (names, '' for
+                             none) and the CONFIG dictionary.
+  .begin(file,key,outfile,inplace=True)
+                           The action for FILE: 'run', 'skip' or
+                             'stale'.  With 'run' the file is
+                             journaled as STARTED.
+  .moving(file)            The output is complete and is about to
+                             replace the input.
+  .done(file)              The output is in place.
+  .lookup(file)            The journal entry of FILE or None.
+
+ USAGE:
+  journal = ProcJournal('ccdproc.jnl')
+  key = journal.key([zero,flat],{'steps':['zero','flat']})
+  if journal.begin(file,key,outfile)=='run':
+      ... process, write outfile
+      journal.moving(file)
+      os.replace(outfile,file)
+      journal.done(file)
+
+-
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Bytes per read when hashing
+HASHCHUNK = 4*1024*1024
+
+
+class ProcJournal(object):
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self._db = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Worker processes open their own connection
+        return {'dbfile':self.dbfile}
+
+    def __setstate__(self, state):
+        self.__init__(state['dbfile'])
+
+    def _conn(self):
+        # One connection per process
+        if self._db is None or self._pid!=os.getpid():
+            db = sqlite3.connect(self.dbfile, timeout=60, check_same_thread=False)
+            db.execute('CREATE TABLE IF NOT EXISTS journal (path TEXT PRIMARY KEY, '
+                       'inhash TEXT, key TEXT, outfile TEXT, outhash TEXT, '
+                       'inplace INTEGER, status TEXT, time REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, '
+                       'mtime REAL, size INTEGER, hash TEXT)')
+            db.commit()
+            self._db = db
+            self._pid = os.getpid()
+        return self._db
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            db = self._conn()
+            rows = db.execute(sql, args).fetchall()
+            db.commit()
+        return rows
+
+    def hash(self, file):
+        # Content hash, cached while the mtime and size are unchanged
+        path = os.path.abspath(file)
+        st = os.stat(path)
+        rows = self._execute('SELECT mtime,size,hash FROM hashes WHERE path=?', (path,))
+        if len(rows)>0 and rows[0][0]==st.st_mtime and rows[0][1]==st.st_size:
+            return rows[0][2]
+        h = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as fh:
+            while True:
+                buf = fh.read(HASHCHUNK)
+                if not buf: break
+                h.update(buf)
+        digest = h.hexdigest()
+        self._execute('INSERT OR REPLACE INTO hashes VALUES (?,?,?,?)',
+                      (path, st.st_mtime, st.st_size, digest))
+        return digest
+
+    def key(self, calfiles, config=None):
+        # Key of the calibration files and the step configuration
+        h = hashlib.blake2b(digest_size=20)
+        for file in calfiles:
+            h.update((self.hash(file) if file!='' else '-').encode())
+        h.update(json.dumps(config, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def lookup(self, file):
+        path = os.path.abspath(file)
+        rows = self._execute('SELECT inhash,key,outfile,outhash,inplace,status,time '
+                             'FROM journal WHERE path=?', (path,))
+        if len(rows)==0: return None
+        r = rows[0]
+        return {'file':path, 'inhash':r[0], 'key':r[1], 'outfile':r[2], 'outhash':r[3],
+                'inplace':bool(r[4]), 'status':r[5], 'time':r[6]}
+
+    def _set(self, file, **kw):
+        self._execute('UPDATE journal SET '+', '.join(k+'=?' for k in kw)+' WHERE path=?',
+                      tuple(kw.values())+(os.path.abspath(file),))
+
+    def _recover(self, entry):
+        # Clean up after a run that died with this file, returns the entry
+        path, outfile = entry['file'], entry['outfile']
+        if entry['status']=='MOVING' and entry['inplace']:
+            if os.path.exists(outfile) and self.hash(outfile)==entry['outhash']:
+                # The output is complete, finish the rename
+                os.replace(outfile, path)
+                self._set(path, status='DONE', time=time.time())
+                return self.lookup(path)
+            if not os.path.exists(outfile) and os.path.exists(path) and \
+               self.hash(path)==entry['outhash']:
+                self._set(path, status='DONE', time=time.time())
+                return self.lookup(path)
+        if entry['status']!='DONE' and os.path.exists(outfile):
+            # Orphaned temporary file
+            os.remove(outfile)
+        return entry
+
+    def begin(self, file, key, outfile, inplace=True):
+        # What to do with FILE
+        path = os.path.abspath(file)
+        entry = self.lookup(path)
+        if entry is not None:
+            entry = self._recover(entry)
+        h = self.hash(path)
+        if entry is not None and entry['status']=='DONE':
+            if entry['inplace'] and h==entry['outhash']:
+                return 'skip' if entry['key']==key else 'stale'
+            if not entry['inplace'] and h==entry['inhash'] and entry['key']==key and \
+               os.path.exists(entry['outfile']) and self.hash(entry['outfile'])==entry['outhash']:
+                return 'skip'
+        self._execute('INSERT OR REPLACE INTO journal VALUES (?,?,?,?,?,?,?,?)',
+                      (path, h, key, os.path.abspath(outfile), None, int(inplace),
+                       'STARTED', time.time()))
+        return 'run'
+
+    def moving(self, file):
+        # The output is complete
+        entry = self.lookup(file)
+        self._set(file, outhash=self.hash(entry['outfile']), status='MOVING', time=time.time())
+
+    def done(self, file):
+        entry = self.lookup(file)
+        if entry['outhash'] is None:
+            self._set(file, outhash=self.hash(entry['outfile']))
+        elif entry['inplace']:
+            # The file is the output now, no need to read it again
+            st = os.stat(entry['file'])
+            self._execute('INSERT OR REPLACE INTO hashes VALUES (?,?,?,?)',
+                          (entry['file'], st.st_mtime, st.st_size, entry['outhash']))
+        self._set(file, status='DONE', time=time.time())
+
+    def close(self):
+        if self._db is not None and self._pid==os.getpid():
+            self._db.close()
+        self._db = None
@@ -0,0 +1,364 @@
+"""
++
+
+ CCDPROC_LINCORR
+
+ This program applies the linearity correction to an image.  The
+ correction of every extension, or of every amplifier of an
+ extension, is a polynomial in the raw value or a tabulated
+ correction.
+
+ Raw integer data with up to 16 bits can only have 65536 (256)
+ values, so the correction is compiled into a lookup table over all
+ of the raw values (cached per polynomial, raw type and float type)
+ and applied with a single indexed gather on the raw integer pixels
+ while they are converted to float.  Other data (float or 32-bit
+ raw images) use the polynomial, or linear interpolation in the
+ table, as before.
+
+ The linearity file is either:
+  - A text file with lines "EXTEN C0 C1 C2 ..." (the polynomial
+    coefficients, constant first) for a whole extension, or
+    "EXTEN AMP C0 C1 ..." for the amplifier AMP (the A of
+    BIASSECA/DATASECA).  Blank lines and lines starting with # are
+    skipped.
+  - A FITS file with the tabulated corrections.  Extension EXTEN has
+    the corrected values of the raw values LINMIN, LINMIN+1, ...
+    (header keyword, default 0), other values are interpolated and
+    values outside of the table get the end values.  A 1D table is
+    for the whole extension, a 2D table has one row per amplifier
+    (the names are in LINAMP1, LINAMP2, ..., default A, B, ...).
+
+ INPUTS:
+  im           The 2D float image array.  It is modified in place.
+  head         The image header string array.
+  exten        The extension number.
+  linstr       The linearity corrections from ccdproc_loadlincorr.
+  /silent      Don't print anything to the screen.
+
+ OUTPUTS:
+  error        The error message if one occurred.
+  The input image is corrected and processing information is added
+  to the header.
+
+ ccdproc_loadlincorr(file) returns linstr, a list of dictionaries
+ with EXTEN, AMP ('' for the whole extension), COEF or TABLE (the
+ other one is None), TMIN (the raw value of the first table entry)
+ and KEY (identifies the correction for the table cache).
+ ccdproc_linplan(linstr,exten,head,shape,rawdtype) returns the plan of
+ one extension, the regions (whole image, or the data and bias
+ sections of an amplifier) with their lookup tables, or None if the
+ extension has no correction.
+ ccdproc_linconvert(raw,out,plan,y0,x0) converts the raw pixels of a
+ window that starts at Y0,X0 into OUT and corrects them.
+ ccdproc_linwindow(raw,slices,plan) returns a corrected float window,
+ ccdproc_linvalues(raw,ind,plan) the corrected values at flat indices
+ and ccdproc_linshift(plan,y0,y1) the plan of the rows Y0:Y1.
+
+ USAGE:
+  linstr, error = ccdproc_loadlincorr('lincorr.txt')
+  error = ccdproc_lincorr(im,head,5,linstr)
+
+ By D. Nidever   April 2014
+-
+"""
+
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from fitsindex import fitsindex, fitskey, fitsaddpar
+from ccdproc_overscan import ccdproc_overscangeom
+
+# Lookup tables by correction, raw type and float type
+_LUTS = OrderedDict()
+_LUTLOCK = threading.Lock()
+MAXLUTS = 256
+
+
+def ccdproc_loadlincorr(file, silent=True):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'CCDPROC_LOADLINCORR: '   # error message prefix
+
+    try:
+        if not os.path.exists(file):
+            error = errprefix+file+' NOT FOUND'
+            if not silent: print(error)
+            return None, error
+
+        linstr = []
+        # Tabulated corrections
+        if file.endswith('.fits') or file.endswith('.fits.fz'):
+            fits, error = fitsindex(file)
+            if error!='':
+                error = errprefix+error
+                if not silent: print(error)
+                return None, error
+            for exten in range(1, fits.nextend+1):
+                table = np.asarray(fits.data(exten), dtype=np.float64)
+                if table.size==0: continue
+                head = fits.header(exten)
+                tmin = int(fitskey(head, 'LINMIN', 0))
+                if table.ndim==1: table = table.reshape(1, -1)
+                for k,row in enumerate(table):
+                    amp = '' if len(table)==1 else \
+                        str(fitskey(head, 'LINAMP'+str(k+1), 'ABCDEFGH'[k])).strip()
+                    linstr.append({'exten':exten, 'amp':amp, 'coef':None,
+                                   'table':np.array(row), 'tmin':tmin,
+                                   'key':_tablekey(row, tmin)})
+
+        # Polynomial coefficients
+        else:
+            with open(file) as fh:
+                for line in fh:
+                    arr = line.split()
+                    if len(arr)==0 or arr[0].startswith('#'): continue
+                    try:
+                        exten = int(arr[0])
+                        amp = ''
+                        try:
+                            float(arr[1])
+                        except ValueError:
+                            amp = arr[1]
+                            arr = arr[1:]
+                        coef = np.array([float(a) for a in arr[1:]])
+                    except (ValueError, IndexError):
+                        error = errprefix+'The linearity lines must be "EXTEN [AMP] C0 C1 ..."'
+                        if not silent: print(error)
+                        return None, error
+                    if len(coef)==0:
+                        error = errprefix+'No coefficients for extension '+str(exten)
+                        if not silent: print(error)
+                        return None, error
+                    linstr.append({'exten':exten, 'amp':amp, 'coef':coef, 'table':None,
+                                   'tmin':0, 'key':('poly',)+tuple(coef)})
+
+        if len(linstr)==0:
+            error = errprefix+'No linearity corrections in '+file
+            if not silent: print(error)
+            return None, error
+
+    except (IOError, OSError, ValueError) as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return None, error
+
+    return linstr, error
+
+
+def _lutok(rawdtype):
+    # Can the raw values be looked up, integers of up to 16 bits
+    rawdtype = np.dtype(rawdtype)
+    return rawdtype.kind in 'iu' and rawdtype.itemsize<=2
+
+
+def _unsigned(raw):
+    # The raw integers as table indices, same byte order
+    if raw.dtype.kind=='u': return raw
+    return raw.view(raw.dtype.str.replace('i','u'))
+
+
+def _tablekey(table, tmin):
+    h = hashlib.blake2b(np.ascontiguousarray(table, dtype=np.float64).tobytes(), digest_size=16)
+    return ('table', int(tmin), h.hexdigest())
+
+
+def _tablevals(vals, l):
+    # Tabulated correction of VALS, interpolated and clipped to the ends
+    table = l['table']
+    return np.interp(vals, l.get('tmin', 0)+np.arange(len(table)), table)
+
+
+def _lut(l, rawdtype, dtype):
+    # The corrected values of all raw values, in the order of the
+    #  unsigned view of the raw data.  Cached.
+    key = l.get('key')
+    if key is None:
+        key = ('poly',)+tuple(l['coef']) if l['coef'] is not None else \
+            _tablekey(l['table'], l.get('tmin', 0))
+    key = (key, rawdtype.kind, rawdtype.itemsize, dtype.str)
+    with _LUTLOCK:
+        if key in _LUTS:
+            _LUTS.move_to_end(key)
+            return _LUTS[key]
+    nval = 2**(8*rawdtype.itemsize)
+    vals = np.arange(nval, dtype='u'+str(rawdtype.itemsize))
+    if rawdtype.kind=='i': vals = vals.view('i'+str(rawdtype.itemsize))
+    vals = vals.astype(np.float64)
+    if l['coef'] is not None:
+        lut = ccdproc_linpoly(vals, l['coef'])
+    else:
+        lut = _tablevals(vals, l)
+    lut = lut.astype(dtype)
+    lut.setflags(write=False)
+    with _LUTLOCK:
+        _LUTS[key] = lut
+        while len(_LUTS)>MAXLUTS: _LUTS.popitem(last=False)
+    return lut
+
+
+def ccdproc_linpoly(arr, coef, tmp=None):
+    # Polynomial (constant first) in place with Horner's rule, TMP is
+    #  scratch space like ARR
+    if tmp is None: tmp = np.empty_like(arr)
+    tmp[...] = coef[-1]
+    for c in coef[-2::-1]:
+        tmp *= arr
+        tmp += c
+    arr[...] = tmp
+    return arr
+
+
+def ccdproc_linplan(linstr, exten, head, shape, rawdtype, dtype='float32'):
+    # The linearity plan of one extension, None if there is nothing to do
+    if linstr is None: return None
+    entries = [l for l in linstr if l['exten']==exten]
+    if len(entries)==0: return None
+    lutok = _lutok(rawdtype)
+    dtype = np.dtype(dtype)
+
+    def piece(region, l):
+        lut = None
+        if lutok: lut = _lut(l, np.dtype(rawdtype), dtype)
+        return {'region':region, 'lut':lut, 'lin':l}
+
+    # The whole extension first, the amplifiers override it
+    pieces = [piece(None, l) for l in entries if l['amp'] in ('','*')]
+    amps = [l for l in entries if l['amp'] not in ('','*')]
+    if len(amps)>0:
+        geom = {amp['name']:amp for amp in ccdproc_overscangeom(head, shape)}
+        for l in amps:
+            if l['amp'] not in geom:
+                raise ValueError('No amplifier '+l['amp']+' in extension '+str(exten))
+            amp = geom[l['amp']]
+            for region in (amp['data'], amp['bias']):
+                pieces.append(piece(region, l))
+    return {'pieces':pieces, 'rawdtype':np.dtype(rawdtype).str, 'dtype':dtype.str,
+            'lut':lutok}
+
+
+def _correct(raw, out, p, rawok):
+    # Convert and correct the pixels of one piece
+    if rawok and p['lut'] is not None:
+        np.take(p['lut'], _unsigned(raw), out=out, mode='clip')
+        return
+    out[...] = raw
+    if p['lin']['coef'] is not None:
+        ccdproc_linpoly(out, p['lin']['coef'])
+    else:
+        out[...] = _tablevals(out, p['lin'])
+
+
+def ccdproc_linconvert(raw, out, plan, y0=0, x0=0):
+    # Convert a raw window starting at Y0,X0 into OUT with the correction
+    ny, nx = raw.shape
+    rawok = np.dtype(raw.dtype).str[1:]==plan['rawdtype'][1:] and plan['lut']
+    pieces = plan['pieces']
+    if len(pieces)==0 or pieces[0]['region'] is not None:
+        out[...] = raw
+    for p in pieces:
+        if p['region'] is None:
+            _correct(raw, out, p, rawok)
+            continue
+        ys, xs = p['region']
+        a0, a1 = max(ys.start-y0,0), min(ys.stop-y0,ny)
+        b0, b1 = max(xs.start-x0,0), min(xs.stop-x0,nx)
+        if a1<=a0 or b1<=b0: continue
+        _correct(raw[a0:a1,b0:b1], out[a0:a1,b0:b1], p, rawok)
+    return out
+
+
+def ccdproc_linwindow(raw, slices, plan, dtype=None):
+    # The corrected float pixels of a window of the raw image
+    ys, xs = slices
+    win = raw[ys, xs]
+    out = np.empty(win.shape, dtype=plan['dtype'] if dtype is None else dtype)
+    return ccdproc_linconvert(win, out, plan, ys.start or 0, xs.start or 0)
+
+
+def ccdproc_linvalues(raw, ind, plan, dtype=None):
+    # The corrected values of the raw pixels at flat indices IND
+    nx = raw.shape[1]
+    vals = raw.reshape(-1)[ind]
+    out = np.empty(len(vals), dtype=plan['dtype'] if dtype is None else dtype)
+    rawok = np.dtype(raw.dtype).str[1:]==plan['rawdtype'][1:] and plan['lut']
+    pieces = plan['pieces']
+    if len(pieces)==0 or pieces[0]['region'] is not None:
+        out[...] = vals
+    rows = cols = None
+    for p in pieces:
+        if p['region'] is None:
+            _correct(vals, out, p, rawok)
+            continue
+        if rows is None: rows, cols = np.divmod(ind, nx)
+        ys, xs = p['region']
+        sel = np.flatnonzero((rows>=ys.start) & (rows<ys.stop) & (cols>=xs.start) & (cols<xs.stop))
+        if len(sel)==0: continue
+        sub = np.empty(len(sel), dtype=out.dtype)
+        _correct(vals[sel], sub, p, rawok)
+        out[sel] = sub
+    return out
+
+
+def ccdproc_linshift(plan, y0, y1):
+    # The plan of the raw rows Y0:Y1, in band coordinates
+    if plan is None: return None
+    pieces = []
+    for p in plan['pieces']:
+        if p['region'] is not None:
+            ys, xs = p['region']
+            a0, a1 = max(ys.start,y0)-y0, min(ys.stop,y1)-y0
+            if a1<=a0: continue
+            p = dict(p, region=(slice(a0,a1), xs))
+        pieces.append(p)
+    return dict(plan, pieces=pieces)
+
+
+def ccdproc_lincorr(im, head, exten, linstr, silent=True):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'CCDPROC_LINCORR: '   # error message prefix
+
+    # Error Handling
+    #------------------
+    try:
+
+        # Check inputs
+        #-------------
+        if not isinstance(im, np.ndarray) or im.ndim!=2 or im.dtype.kind!='f':
+            error = errprefix+'Image must be a 2D float array'
+            if not silent: print(error)
+            return error
+
+        # Have we done this processing step already?
+        if fitskey(head, 'LINCORR') is not None:
+            error = errprefix+'Linearity correction already applied.'
+            if not silent: print(error)
+            return error
+
+        plan = ccdproc_linplan(linstr, exten, head, im.shape, im.dtype, dtype=im.dtype)
+        if plan is None:
+            return error
+        ccdproc_linconvert(im.copy(), im, plan)
+
+        # Add processing information to header
+        #--------------------------------------
+        #  Current timestamp information
+        #  Sun Oct  7 15:38:23 2012
+        datearr = time.ctime().split()
+        datestr = datearr[1]+' '+datearr[2]+' '+':'.join(datearr[3].split(':')[0:2])
+        fitsaddpar(head, 'LINCORR', datestr+' Lincorr applied')
+
+    except Exception as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return error
+
+    return error
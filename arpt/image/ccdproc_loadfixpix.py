@@ -0,0 +1,96 @@
+"""
++
+
+ CCDPROC_LOADFIXPIX
+
+ This program loads the fixpix file.
+
+ A  text  file  with lines giving the integer coordinates of a single
+ pixel or a rectangular region.  A single pixel is specified by a
+ column and line number ("X Y").  A region is specified by a starting
+ column, an ending column, a starting line, and an ending line
+ ("X1 X2 Y1 Y2").  The coordinates are 1-based raw image pixels.
+ Blank lines and lines starting with # are skipped.
+
+ INPUTS:
+  file         The fixpix filename.
+  /silent      Don't print anything to the screen.
+
+ OUTPUTS:
+  fixstr       The list of regions, dictionaries with X1, X2, Y1, Y2,
+                 NX and NY.
+  error        The error message if one occurred.
+
+ USAGE:
+  fixstr, error = ccdproc_loadfixpix('fixpix.txt')
+
+ By D. Nidever   April 2014
+-
+"""
+
+import os
+
+
+def ccdproc_loadfixpix(file, silent=True):
+
+    # Initalizing some variables
+    fixstr = None
+    error = ''                          # initialize error variable
+    errprefix = 'CCDPROC_LOADFIXPIX: '  # error message prefix
+
+    try:
+        # Check file
+        if not os.path.exists(file):
+            error = errprefix+file+' NOT FOUND'
+            if not silent: print(error)
+            return None, error
+
+        # Read the file
+        #--------------
+        fixstr = []
+        with open(file) as fh:
+            for line in fh:
+                arr = line.split()
+                if len(arr)==0 or arr[0].startswith('#'): continue
+
+                # Check that the numbers are integers
+                try:
+                    vals = [int(a) for a in arr]
+                except ValueError:
+                    error = errprefix+'The fixpix lines must all be integers'
+                    if not silent: print(error)
+                    return None, error
+                # Check that the numbers are positive
+                if min(vals)<=0:
+                    error = errprefix+'The fixpix pixel numbers mast be >=1'
+                    if not silent: print(error)
+                    return None, error
+
+                if len(vals)==2:
+                    x1, x2, y1, y2 = vals[0], vals[0], vals[1], vals[1]
+                elif len(vals)==4:
+                    x1, x2, y1, y2 = vals
+                else:
+                    error = errprefix+'The fixpix lines must have "X Y" or "X1 X2 Y1 Y2"'
+                    if not silent: print(error)
+                    return None, error
+
+                # Check that X2>=X1 and Y2>=Y1
+                if x2<x1 or y2<y1:
+                    error = errprefix+'The fixpix pixel numbers must have X2>=X1 and Y2>=Y1'
+                    if not silent: print(error)
+                    return None, error
+                fixstr.append({'x1':x1, 'x2':x2, 'y1':y1, 'y2':y2,
+                               'nx':x2-x1+1, 'ny':y2-y1+1})
+
+        if len(fixstr)==0:
+            error = errprefix+'No good lines in '+file+' fixpix file'
+            if not silent: print(error)
+            return None, error
+
+    except (IOError, OSError) as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return None, error
+
+    return fixstr, error
@@ -0,0 +1,252 @@
+"""
++
+
+ CCDPROC_MASK
+
+ This is a compact store for the pixel masks of a ccdproc run.  A
+ mask has one bit-packed plane (np.packbits, 1 bit per pixel) per
+ flag:
+
+   bad      1   bad pixel (BPM)
+   sat      2   saturated
+   bleed    4   bleed trail
+   fixpix   8   interpolated by fixpix
+   cr      16   cosmic ray
+
+ The flat (row-major) indices of the flagged pixels are computed
+ once per mask and flag combination and kept with the planes, so
+ applying the mask to an image is a single indexed scatter.
+
+ The BPM file is read as a bit mask with these values, i.e. a plain
+ 0/1 BPM only has bad pixels.  MaskStore loads the BPM of every
+ extension once per run, only the packed planes are kept.
+
+ INPUTS:
+  bpmfile      The name of the bad pixel mask file, '' for none.
+  =loader      Function loader(path,exten) that returns the BPM image.
+  =shapes      Dictionary of extension shapes, used for the empty
+                 masks when there is no BPM file.
+
+ OUTPUTS:
+  store        The MaskStore object.
+
+ MaskStore:
+  .get(exten,shape=None)   The PixMask of an extension (shared, copy
+                             it before changing it).
+  .preload(extens)         Load the masks ahead of time.
+
+ PixMask(shape):
+  .set(flag,pix)           Flag pixels, PIX is a boolean image or flat
+                             indices.
+  .plane(flag)             The boolean image of a flag.
+  .indices(flags='bad')    The sorted flat indices of the pixels with
+                             any of FLAGS (a name or list of names).
+  .count(flags='bad')      The number of these pixels.
+  .image()                 The uint8 bit-mask image.
+  .copy()                  A copy that can be changed.
+  PixMask.frombpm(bpmim)   The mask of a bit-mask BPM image.
+
+ ccdproc_writemask(file,masks,heads) writes the masks (a list of
+ PixMask) as RICE tile-compressed uint8 extensions.
+
+ USAGE:
+  store = MaskStore(bpmfile,loader=calload)
+  ind = store.get(exten).indices()
+  im.reshape(-1)[ind] = 65535
+  error = ccdproc_writemask('image_mask.fits.fz',[mask1,mask2],heads=[head1,head2])
+
+-
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from fitsindex import fitscard, fitskey
+from fitswrite import fitswrite
+
+# Mask flags and their bits
+MASKFLAGS = OrderedDict([('bad',1), ('sat',2), ('bleed',4), ('fixpix',8), ('cr',16)])
+
+
+def _flaglist(flags):
+    # Flag names as a tuple, checked
+    if isinstance(flags, str): flags = [flags]
+    flags = tuple(flags)
+    for f in flags:
+        if f not in MASKFLAGS:
+            raise ValueError('Unknown mask flag '+str(f)+', must be one of '+
+                             ', '.join(MASKFLAGS))
+    return flags
+
+
+class PixMask(object):
+
+    def __init__(self, shape):
+        self.shape = tuple(int(s) for s in shape)
+        self.npix = int(np.prod(self.shape))
+        self._planes = {}
+        self._indices = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def frombpm(cls, bpmim):
+        # The mask of a bit-mask BPM image
+        bpmim = np.asarray(bpmim)
+        mask = cls(bpmim.shape)
+        vals = bpmim.astype(np.int64) if bpmim.dtype.kind=='f' else bpmim
+        for flag,bit in MASKFLAGS.items():
+            on = (vals & bit)!=0
+            if on.any(): mask.set(flag, on)
+        return mask
+
+    @property
+    def nbytes(self):
+        return sum(p.nbytes for p in self._planes.values()) + \
+            sum(i.nbytes for i in self._indices.values())
+
+    def set(self, flag, pix):
+        # Flag pixels, a boolean image or flat indices
+        flag, = _flaglist(flag)
+        pix = np.asarray(pix)
+        if pix.dtype==bool:
+            if pix.shape!=self.shape:
+                raise ValueError('Mask plane has wrong size, must be '+str(self.shape))
+            on = pix.reshape(-1)
+        else:
+            on = np.zeros(self.npix, dtype=bool)
+            on[pix.reshape(-1)] = True
+        with self._lock:
+            if flag in self._planes:
+                on = on | np.unpackbits(self._planes[flag], count=self.npix).view(bool)
+            self._planes[flag] = np.packbits(on)
+            # The index lists with this flag are out of date
+            for k in [k for k in self._indices if flag in k]:
+                del self._indices[k]
+
+    def plane(self, flag):
+        # The boolean image of a flag
+        flag, = _flaglist(flag)
+        if flag not in self._planes:
+            return np.zeros(self.shape, dtype=bool)
+        return np.unpackbits(self._planes[flag], count=self.npix).view(bool).reshape(self.shape)
+
+    def indices(self, flags='bad'):
+        # Sorted flat indices of the pixels with any of the flags
+        flags = _flaglist(flags)
+        key = tuple(sorted(flags))
+        with self._lock:
+            if key in self._indices:
+                return self._indices[key]
+            packed = [self._planes[f] for f in key if f in self._planes]
+        if len(packed)==0:
+            ind = np.zeros(0, dtype=np.int64)
+        else:
+            on = packed[0]
+            for p in packed[1:]: on = on | p
+            ind = np.flatnonzero(np.unpackbits(on, count=self.npix)).astype(np.int64)
+        ind.setflags(write=False)
+        with self._lock:
+            self._indices.setdefault(key, ind)
+            return self._indices[key]
+
+    def count(self, flags='bad'):
+        return len(self.indices(flags))
+
+    def image(self):
+        # The uint8 bit-mask image
+        out = np.zeros(self.npix, dtype=np.uint8)
+        for flag,packed in self._planes.items():
+            out[np.flatnonzero(np.unpackbits(packed, count=self.npix))] |= MASKFLAGS[flag]
+        return out.reshape(self.shape)
+
+    def copy(self):
+        new = PixMask(self.shape)
+        with self._lock:
+            new._planes = dict(self._planes)
+            new._indices = dict(self._indices)
+        return new
+
+
+class MaskStore(object):
+
+    def __init__(self, bpmfile='', loader=None, shapes=None):
+        self.bpmfile = bpmfile
+        self.loader = loader
+        self.shapes = {} if shapes is None else dict(shapes)
+        self._masks = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can't be pickled, i.e. for worker processes
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, exten, shape=None):
+        # The mask of an extension, the BPM is only read once
+        with self._lock:
+            if exten in self._masks:
+                return self._masks[exten]
+        if self.bpmfile!='':
+            if self.loader is None:
+                raise ValueError('No loader for '+self.bpmfile)
+            mask = PixMask.frombpm(self.loader(self.bpmfile, exten))
+        else:
+            if shape is None: shape = self.shapes.get(exten)
+            if shape is None:
+                raise ValueError('No BPM file and no shape for extension '+str(exten))
+            mask = PixMask(shape)
+        with self._lock:
+            return self._masks.setdefault(exten, mask)
+
+    def preload(self, extens):
+        # Load the masks ahead of time, i.e. in the parent before forking
+        for exten in extens:
+            self.get(exten)
+
+
+def ccdproc_writemask(file, masks, heads=None, silent=True):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'CCDPROC_WRITEMASK: '   # error message prefix
+
+    try:
+        if heads is None: heads = [None]*len(masks)
+        # The flag bits are documented in every extension
+        bitcards = [fitscard('MASKB'+str(i+1), bit, 'mask bit of '+flag)
+                    for i,(flag,bit) in enumerate(MASKFLAGS.items())] + \
+                   [fitscard('MASKF'+str(i+1), flag, 'mask flag name')
+                    for i,flag in enumerate(MASKFLAGS)]
+        mheads = []
+        for head in heads:
+            cards = []
+            if head is not None:
+                for key in ('EXTNAME','EXTVER','CCDNAME','DETSEC','DATASEC'):
+                    val = fitskey(head, key)
+                    if val is not None: cards.append(fitscard(key, val))
+            mheads.append(cards+bitcards)
+        error = fitswrite(file, [None]+[m.image() for m in masks],
+                          heads=[None]+mheads, compress='RICE_1')
+        if error!='': error = errprefix+error
+
+    except (IOError, OSError, ValueError) as e:
+        error = errprefix+str(e)
+
+    if error!='' and not silent: print(error)
+    return error
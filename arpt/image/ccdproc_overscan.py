@@ -0,0 +1,278 @@
+"""
++
+
+ CCDPROC_OVERSCAN
+
+ This program subtracts the overscan (bias) level from an image.
+ Every amplifier section is handled: BIASSECA/DATASECA,
+ BIASSECB/DATASECB, ... or the single BIASSEC with TRIMSEC (or
+ DATASEC).  The bias section of each amplifier is collapsed along its
+ short dimension, the resulting vector along the readout direction
+ is optionally fit, and it is subtracted from the amplifier's data
+ section.  Amplifiers with the same layout are stacked and done in
+ one vectorized operation.
+
+ The parsed section geometry is cached per detector layout (section
+ strings and image size) and the fit matrices per vector length, so
+ they are only computed once per run.
+
+ INPUTS:
+  im           The 2D image array.  It is modified in place, so it
+                 should be float.
+  head         The image header string array.
+  =function    The overscan estimator:
+                 'median'  median per line (default)
+                 'mean'    mean per line
+                 'sigclip' sigma-clipped mean per line
+                 'poly'    Legendre polynomial fit to the line medians
+                 'spline'  cubic spline fit to the line medians
+  =order       The polynomial order for 'poly' or the number of
+                 spline pieces for 'spline'.  Default is 3.
+  =nsigma      The clipping threshold for 'sigclip'.  Default is 3.
+  =niter       The number of clipping iterations.  Default is 3.
+  /silent      Don't print anything to the screen.
+
+ OUTPUTS:
+  The input image and header are modified.  The overscan is
+  subtracted from the data sections and OVSNMEAN and OVERSCAN
+  are added to the header.
+  error        The error message if one occurred.
+
+ Lower level:
+  ccdproc_overscangeom(head,shape)       Cached amplifier geometry.
+  ccdproc_overscanvec(biasim,axis,...)   Collapse and fit bias images,
+                                           biasim can be a stack.
+  ccdproc_overscanvecs(im,geom,...)      The vector of every amplifier.
+  ccdproc_overscancor(im,geom,...)       Subtract using the geometry,
+                                           returns the mean per amp.
+
+ USAGE:
+  error = ccdproc_overscan(im,head,function='sigclip')
+
+-
+"""
+
+import time
+from functools import lru_cache
+
+import numpy as np
+
+from ccdproc_splitsec import ccdproc_splitsec
+from fitsindex import fitskey, fitsaddpar
+
+FUNCTIONS = ('median','mean','sigclip','poly','spline')
+
+
+@lru_cache(maxsize=256)
+def _geometry(secs, shape):
+    # Parse the sections of one detector layout
+    ny, nx = shape
+    geom = []
+    for name,bstr,dstr in secs:
+        biassec = ccdproc_splitsec(bstr)
+        datasec = ccdproc_splitsec(dstr)
+        if biassec==-1 or datasec==-1:
+            raise ValueError('Bad BIASSEC'+name+' or DATASEC'+name)
+        # 0-based, and allow flipped (readout order) sections
+        bx0, bx1 = sorted([biassec[0]-1, biassec[1]-1])
+        by0, by1 = sorted([biassec[2]-1, biassec[3]-1])
+        dx0, dx1 = sorted([datasec[0]-1, datasec[1]-1])
+        dy0, dy1 = sorted([datasec[2]-1, datasec[3]-1])
+        if min(bx0,by0,dx0,dy0)<0 or max(bx1,dx1)>nx-1 or max(by1,dy1)>ny-1:
+            raise ValueError('BIAS/TRIM/DATA section indices out of image bounds')
+        # BIAS along columns, collapse in X
+        if bx1-bx0<by1-by0:
+            if by0>dy0 or by1<dy1:
+                raise ValueError('BIASSEC'+name+' does not cover the data in Y')
+            axis = 1
+            bias = (slice(dy0,dy1+1), slice(bx0,bx1+1))
+        # BIAS along rows, collapse in Y
+        else:
+            if bx0>dx0 or bx1<dx1:
+                raise ValueError('BIASSEC'+name+' does not cover the data in X')
+            axis = 0
+            bias = (slice(by0,by1+1), slice(dx0,dx1+1))
+        geom.append({'name':name, 'axis':axis, 'bias':bias,
+                     'data':(slice(dy0,dy1+1), slice(dx0,dx1+1)),
+                     'biassec':bstr.strip().strip("'").strip()})
+    return tuple(geom)
+
+
+def ccdproc_overscangeom(head, shape):
+    # Amplifier geometry from the header, cached per layout
+    secs = []
+    for amp in 'ABCDEFGH':
+        bstr = fitskey(head, 'BIASSEC'+amp)
+        if bstr is None: break
+        dstr = fitskey(head, 'TRIMSEC'+amp)
+        if dstr is None: dstr = fitskey(head, 'DATASEC'+amp)
+        if dstr is None:
+            raise ValueError('Header must have TRIMSEC'+amp+' or DATASEC'+amp)
+        secs.append((amp, bstr, dstr))
+    if len(secs)==0:
+        bstr = fitskey(head, 'BIASSEC')
+        if bstr is None: raise ValueError('Header must have BIASSEC')
+        dstr = fitskey(head, 'TRIMSEC')
+        if dstr is None: dstr = fitskey(head, 'DATASEC')
+        if dstr is None: raise ValueError('Header must have TRIMSEC or DATASEC')
+        secs.append(('', bstr, dstr))
+    return _geometry(tuple(secs), tuple(shape))
+
+
+@lru_cache(maxsize=64)
+def _fitmatrix(n, function, order):
+    # Basis and pseudo-inverse of the least-squares fit to a vector of length n
+    x = np.linspace(-1.0, 1.0, n)
+    if function=='poly':
+        basis = np.polynomial.legendre.legvander(x, min(order, n-1))
+    else:
+        # Cubic B-spline basis with ORDER equal pieces
+        npiece = max(1, min(order, n//4))
+        knots = np.concatenate([[-1.0]*3, np.linspace(-1.0, 1.0, npiece+1), [1.0]*3])
+        basis = _bspline(x, knots, 3)
+    return basis, np.linalg.pinv(basis)
+
+
+def _bspline(x, t, k):
+    # B-spline basis functions (Cox-de Boor) at x
+    nb = len(t)-k-1
+    b = np.zeros((len(x), len(t)-1))
+    for i in range(len(t)-1):
+        if t[i]<t[i+1]:
+            b[:,i] = (x>=t[i]) & (x<t[i+1])
+    # Include the right end
+    last = np.where(t[:-1]<t[1:])[0][-1]
+    b[x==t[-1], last] = 1.0
+    for d in range(1, k+1):
+        nb2 = len(t)-d-1
+        b2 = np.zeros((len(x), nb2))
+        for i in range(nb2):
+            if t[i+d]>t[i]:
+                b2[:,i] += (x-t[i])/(t[i+d]-t[i])*b[:,i]
+            if t[i+d+1]>t[i+1]:
+                b2[:,i] += (t[i+d+1]-x)/(t[i+d+1]-t[i+1])*b[:,i+1]
+        b = b2
+    return b[:,0:nb]
+
+
+def ccdproc_overscanvec(biasim, axis, function='median', order=3, nsigma=3.0, niter=3):
+    # Collapse bias images along AXIS (of the 2D image) and fit them
+    #  biasim can be a 3D stack of amplifiers, the output is then 2D
+    biasim = np.asarray(biasim)
+    if biasim.ndim==3: axis += 1
+    if function=='mean':
+        return biasim.mean(axis=axis)
+    if function=='sigclip':
+        vec = np.median(biasim, axis=axis)
+        data = biasim.astype(np.float64)
+        for it in range(niter):
+            resid = data-np.expand_dims(vec, axis)
+            sig = np.sqrt(np.nanmean(resid**2, axis=axis))
+            clip = np.abs(resid)>nsigma*np.expand_dims(sig, axis)
+            if it>0 and not clip.any(): break
+            data[clip] = np.nan
+            vec = np.nanmean(data, axis=axis)
+        return vec
+    vec = np.median(biasim, axis=axis)
+    if function in ('poly','spline'):
+        n = vec.shape[-1]
+        if n>1:
+            basis, pinv = _fitmatrix(n, function, order)
+            vec = vec.dot(pinv.T).dot(basis.T)
+    return vec
+
+
+def ccdproc_overscanvecs(im, geom, function='median', order=3, nsigma=3.0, niter=3,
+                         prep=None, dtype=None, read=None):
+    # The overscan vector of every amplifier
+    #  The bias images are converted to DTYPE and prep(biasim) is
+    #  applied to them first, read(slices) replaces im[slices] (i.e.
+    #  the linearity-corrected pixels)
+    if function not in FUNCTIONS:
+        raise ValueError('FUNCTION must be one of '+', '.join(FUNCTIONS))
+
+    # Group the amplifiers with the same bias shape and direction
+    groups = {}
+    for k,amp in enumerate(geom):
+        b = amp['bias']
+        key = (amp['axis'], b[0].stop-b[0].start, b[1].stop-b[1].start)
+        groups.setdefault(key, []).append(k)
+
+    vecs = [None]*len(geom)
+    for key,ks in groups.items():
+        if read is None:
+            stack = np.stack([im[geom[k]['bias']] for k in ks])
+        else:
+            stack = np.stack([read(geom[k]['bias']) for k in ks])
+        if dtype is not None: stack = stack.astype(dtype, copy=False)
+        if prep is not None: prep(stack)
+        out = ccdproc_overscanvec(stack, key[0], function=function, order=order,
+                                  nsigma=nsigma, niter=niter)
+        for k,v in zip(ks, out): vecs[k] = v
+    return vecs
+
+
+def ccdproc_overscancor(im, geom, function='median', order=3, nsigma=3.0, niter=3):
+    # Subtract the overscan for every amplifier, returns the mean per amp
+    #  All vectors are measured before anything is subtracted
+    vecs = ccdproc_overscanvecs(im, geom, function=function, order=order,
+                                nsigma=nsigma, niter=niter)
+    ovsnmean = []
+    for amp,vec in zip(geom, vecs):
+        if amp['axis']==1:
+            im[amp['data']] -= vec[:,np.newaxis]
+        else:
+            im[amp['data']] -= vec[np.newaxis,:]
+        ovsnmean.append(float(np.mean(vec)))
+    return ovsnmean
+
+
+def ccdproc_overscan(im, head, function='median', order=3, nsigma=3.0, niter=3, silent=True):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'CCDPROC_OVERSCAN: '   # error message prefix
+
+    # Error Handling
+    #------------------
+    try:
+
+        # Check inputs
+        #-------------
+        if not isinstance(im, np.ndarray) or im.ndim!=2 or im.dtype.kind!='f':
+            error = errprefix+'Image must be a 2D float array'
+            if not silent: print(error)
+            return error
+
+        # Have we done this processing step already?
+        if fitskey(head, 'OVERSCAN') is not None:
+            error = errprefix+'Overscan correction already applied.'
+            if not silent: print(error)
+            return error
+
+        # Subtract the overscan
+        #-----------------------
+        geom = ccdproc_overscangeom(head, im.shape)
+        ovsnmean = ccdproc_overscancor(im, geom, function=function, order=order,
+                                       nsigma=nsigma, niter=niter)
+
+        # Add processing information to header
+        #--------------------------------------
+        #  Current timestamp information
+        #  Sun Oct  7 15:38:23 2012
+        datearr = time.ctime().split()
+        datestr = datearr[1]+' '+datearr[2]+' '+':'.join(datearr[3].split(':')[0:2])
+        mean = float(np.mean(ovsnmean))
+        fitsaddpar(head, 'OVSNMEAN', mean)
+        for amp,m in zip(geom, ovsnmean):
+            if amp['name']!='': fitsaddpar(head, 'OVSNMN'+amp['name'], m)
+        fitsaddpar(head, 'OVERSCAN', datestr+' Overscan is '+
+                   ','.join([amp['biassec'] for amp in geom])+', '+function+
+                   ' mean '+('%.7G' % mean))
+
+    except Exception as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return error
+
+    return error
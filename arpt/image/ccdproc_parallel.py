@@ -0,0 +1,122 @@
+"""
++
+
+ CCDPROC_PARALLEL
+
+ Parallel execution helpers for ccdproc.
+
+ ccdproc_pool runs func(item,shared) for every item on a pool of
+ worker processes and returns the results in input order.  The
+ read-only SHARED data (calibration structures, calibration frame
+ cache, run options) is handed to each worker once when it starts
+ and not with every task.  With the "fork" start method it is not
+ pickled at all, the workers share the parent's pages copy-on-write.
+
+ INPUTS:
+  func         The function to run, func(item,shared).  It must be
+                 defined at the top level of a module.
+  items        The list (or iterator) of items, i.e. the input files.
+                 Iterators are consumed as the workers need more work.
+  =shared      Read-only data passed to every call of func.
+  =workers     The number of worker processes.  The default (0) is to
+                 use the number of CPUs.
+
+ OUTPUTS:
+  The list of func return values in the same order as ITEMS.  If
+  func raised an exception, the item's value is the error message.
+
+ USAGE:
+  error = ccdproc_pool(ccdproc_file,files,shared=opts,workers=16)
+
+ ccdproc_threadmap runs func(*args) for every tuple in ARGLIST on a
+ pool of threads.  This is for the extensions of one file, the numpy
+ work releases the GIL.  It yields (result,error) pairs in input
+ order as soon as each one (and all before it) is done, so the
+ caller can write the output in order while later ones still run.
+ An exception only sets the error of its own item.
+
+ INPUTS:
+  func         The function to run, func(*args).
+  arglist      The list of argument tuples.
+  =threads     The number of threads.  The default (0) is to use the
+                 number of CPUs.
+
+ OUTPUTS:
+  A generator of (result,error) pairs.  ERROR is '' if func returned
+  normally and the exception message otherwise.
+
+ USAGE:
+  for result,error in ccdproc_threadmap(ccdproc_ext,args,threads=8): ...
+
+-
+"""
+
+import os
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+# Set in each worker process by _poolinit
+_poolfunc = None
+_poolshared = None
+
+
+def _poolinit(func, shared):
+    # Store the function and shared data in the worker
+    global _poolfunc, _poolshared
+    _poolfunc = func
+    _poolshared = shared
+
+
+def _poolcall(item):
+    # Run one task in a worker
+    try:
+        return _poolfunc(item, _poolshared)
+    except Exception as e:
+        return str(item)+' '+str(e)
+
+
+def ccdproc_pool(func, items, shared=None, workers=0):
+
+    if workers is None or workers<=0:
+        workers = os.cpu_count() or 1
+    if hasattr(items, '__len__'): workers = min(workers, len(items))
+
+    # Nothing to parallelize
+    if workers<=1:
+        _poolinit(func, shared)
+        return [_poolcall(item) for item in items]
+
+    # Fork shares the parent's memory with the workers
+    if 'fork' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('fork')
+    else:
+        ctx = multiprocessing.get_context()
+    pool = ctx.Pool(workers, initializer=_poolinit, initargs=(func,shared))
+    try:
+        # imap keeps the input order
+        out = list(pool.imap(_poolcall, items, chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+
+    return out
+
+
+def ccdproc_threadmap(func, arglist, threads=0):
+
+    arglist = list(arglist)
+    if threads is None or threads<=0:
+        threads = os.cpu_count() or 1
+    threads = max(1, min(threads, len(arglist)))
+
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        futures = [executor.submit(func, *args) for args in arglist]
+        # Hand them back in order
+        for future in futures:
+            try:
+                yield future.result(), ''
+            except Exception as e:
+                yield None, str(e)
+    finally:
+        executor.shutdown(wait=True)
@@ -0,0 +1,239 @@
+"""
++
+
+ CCDPROC_PLAN
+
+ This validates the inputs of a ccdproc run once, when the run is
+ set up, and returns the plan that the extensions are processed
+ with.  The calibration files (zero, flat, illum, bpm) are checked
+ to be FITS images with the extensions that are needed, their sizes
+ and types come from the headers (no pixels are read), the bootstrap
+ structure is turned into a scale per extension and the trim and
+ overscan sections are parsed once per detector layout.  Flats and
+ illumination frames must be floating point (BITPIX -32 or -64).
+
+ With reference science files the calibration frames are checked
+ against their (trimmed) extensions, once per distinct layout (number
+ of extensions and image sizes), so that a bad calibration input
+ fails before any science file is touched.  Files that come later
+ (streamed inputs) are checked with .checklayout, which again only
+ looks at new layouts.  Per extension only cheap guards are left
+ (.guard): a 2D numeric image whose output size matches the
+ calibration frames.
+
+ INPUTS:
+  =zero        The zero file name.
+  =flat        The flat file name.
+  =illum       The illumination file name.
+  =bpm         The bad pixel mask file name.
+  =bootstr     The bootstrap structure (EXTEN and SCALE).
+  /trim        The images are trimmed (TRIMSEC, or DATASEC).
+  /overscan    The images are overscan corrected, the sections of
+                 the reference file are checked.
+  =ref         The science files (a name or a list) to check the
+                 calibrations against.
+  /silent      Don't print anything to the screen.
+
+ OUTPUTS:
+  plan         The ProcPlan object.
+  error        The error message if one occurred.
+
+ ProcPlan:
+  .cal[name][exten]        (shape,bitpix) of the calibration frames,
+                             NAME is 'zero', 'flat', 'illum' or 'bpm'.
+  .bootscale(exten)        The bootstrap scale of an extension, None
+                             without bootstrap.
+  .trimsec(head)           The 0-based [x1,x2,y1,y2] trim section,
+                             cached per layout.
+  .outshape(head,shape)    The output size of an extension.
+  .guard(exten,im,head)    The per-extension checks, '' if they pass.
+  .checkfile(file)         Check a science file against the
+                             calibrations, '' if it passes.
+  .checklayout(file)       The same, only for the first file of
+                             every layout.
+
+ USAGE:
+  plan, error = ccdproc_plan(zero='zero.fits',flat='flat.fits',trim=True,ref=files[0])
+  error = plan.guard(exten,im,head)
+
+-
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+from fitsindex import fitsindex, fitskey
+from ccdproc_splitsec import ccdproc_splitsec
+from ccdproc_overscan import ccdproc_overscangeom
+
+CALNAMES = ('zero', 'flat', 'illum', 'bpm')
+
+# Calibrations that are divided by, they must be floating point
+FLOATCALS = ('flat', 'illum')
+
+
+@lru_cache(maxsize=256)
+def _trimsec(trimsec, datasec):
+    # 0-based trim section of a layout, -1 if there is none
+    sec = ccdproc_splitsec(trimsec)
+    if sec==-1: sec = ccdproc_splitsec(datasec)
+    if sec==-1: return -1
+    return tuple(s-1 for s in sec)
+
+
+def _bootscales(bootstr):
+    # Extension -> scale of the bootstrap structure
+    if hasattr(bootstr, 'exten'):
+        extens, scales = np.atleast_1d(bootstr.exten), np.atleast_1d(bootstr.scale)
+    else:
+        extens = [b['exten'] for b in bootstr]
+        scales = [b['scale'] for b in bootstr]
+    if len(extens)!=len(scales) or len(extens)==0:
+        raise ValueError('Bootstrap structure must have EXTEN and SCALE tags.')
+    out = {}
+    for exten,scale in zip(extens, scales):
+        if not isinstance(exten, (int, np.integer)):
+            raise ValueError('Bootstrap EXTEN must be an integer')
+        if not isinstance(scale, (float, np.floating, int, np.integer)):
+            raise ValueError('Bootstrap SCALE must be a number')
+        if scale==0.0:
+            raise ValueError('Bootstrap SCALE must not be zero.')
+        out.setdefault(int(exten), float(scale))
+    return out
+
+
+def _calinfo(file, name):
+    # Sizes and types of the image HDUs of a calibration file
+    fits, error = fitsindex(file)
+    if error!='':
+        raise ValueError(name.upper()+' file '+file+' is NOT a valid FITS file.')
+    out = {}
+    for exten,hdu in enumerate(fits.hdu):
+        if len(hdu['naxis'])==0: continue
+        if hdu['xtension'].strip() not in ('','IMAGE'):
+            raise ValueError(name.upper()+' file '+file+' HDU '+str(exten)+' is not DATA.')
+        if len(hdu['naxis'])!=2:
+            raise ValueError(name.upper()+' file '+file+' HDU '+str(exten)+' is not a 2D image.')
+        if name in FLOATCALS and hdu['bitpix'] not in (-32, -64):
+            raise ValueError(name.upper()+' file '+file+' HDU '+str(exten)+' has BITPIX='+
+                             str(hdu['bitpix'])+', must be floating point (-32 or -64).')
+        out[exten] = (tuple(reversed(hdu['naxis'])), hdu['bitpix'])
+    if len(out)==0:
+        raise ValueError(name.upper()+' file '+file+' has no image data.')
+    return out
+
+
+class ProcPlan(object):
+
+    def __init__(self, cal=None, bootscales=None, trim=False, overscan=False):
+        self.cal = {} if cal is None else cal
+        self.bootscales = bootscales
+        self.trim = trim
+        self.overscan = overscan
+        self._layouts = {}
+
+    def bootscale(self, exten):
+        if self.bootscales is None: return None
+        return self.bootscales.get(exten)
+
+    def trimsec(self, head):
+        return _trimsec(str(fitskey(head, 'TRIMSEC', '')), str(fitskey(head, 'DATASEC', '')))
+
+    def outshape(self, head, shape):
+        if not self.trim: return tuple(shape)
+        sec = self.trimsec(head)
+        if sec==-1: raise ValueError('Header must have TRIMSEC or DATASEC')
+        return (sec[3]-sec[2]+1, sec[1]-sec[0]+1)
+
+    def guard(self, exten, im, head):
+        # Cheap per-extension checks, the inputs were validated already
+        if not hasattr(im, 'ndim') or im.ndim!=2 or im.dtype.kind not in 'uif':
+            return 'Image must be a 2D numeric array'
+        try:
+            shape = self.outshape(head, im.shape)
+        except ValueError as e:
+            return str(e)
+        for name in CALNAMES:
+            if name not in self.cal: continue
+            cal = self.cal[name].get(exten)
+            if cal is None:
+                return name.upper()+' file has no extension '+str(exten)
+            if cal[0]!=shape:
+                return name.upper()+' image has wrong size, must be ['+ \
+                    str(shape[1])+','+str(shape[0])+'].'
+        if self.bootscales is not None and exten not in self.bootscales:
+            return 'Right extension NOT FOUND in Bootstrap structure.'
+        return ''
+
+    def checkfile(self, file):
+        # Check the extensions of a science file, only the headers are read
+        fits, error = fitsindex(file)
+        if error!='': return error
+        extens = range(1, fits.nextend+1) if fits.nextend>0 else [0]
+        for exten in extens:
+            hdu = fits.hdu[exten]
+            if len(hdu['naxis'])!=2:
+                return file+' HDU '+str(exten)+' is not a 2D image.'
+            head = fits.header(exten, shared=True)
+            shape = tuple(reversed(hdu['naxis']))
+            if self.overscan:
+                try:
+                    ccdproc_overscangeom(head, shape)
+                except ValueError as e:
+                    return file+' HDU '+str(exten)+': '+str(e)
+            error = self.guard(exten, _Shape(shape), head)
+            if error!='': return file+' HDU '+str(exten)+': '+error
+        return ''
+
+
+    def checklayout(self, file):
+        # Check the first file of every layout, '' if it passes
+        fits, error = fitsindex(file)
+        if error!='': return ''   # reported when the file is processed
+        layout = (fits.nextend, tuple(tuple(hdu['naxis']) for hdu in fits.hdu))
+        if layout not in self._layouts:
+            self._layouts[layout] = self.checkfile(file)
+        return self._layouts[layout]
+
+
+class _Shape(object):
+    # The shape and type of an image that is not read
+    def __init__(self, shape):
+        self.shape = shape
+        self.ndim = len(shape)
+        self.dtype = np.dtype(np.float32)
+
+
+def ccdproc_plan(zero='', flat='', illum='', bpm='', bootstr=None, trim=False,
+                 overscan=False, ref='', silent=True):
+
+    # Initalizing some variables
+    plan = None
+    error = ''
+    errprefix = 'CCDPROC_PLAN: '   # error message prefix
+
+    try:
+        cal = {}
+        for name,file in zip(CALNAMES, (zero, flat, illum, bpm)):
+            if file!='': cal[name] = _calinfo(file, name)
+        bootscales = None
+        if bootstr is not None: bootscales = _bootscales(bootstr)
+        plan = ProcPlan(cal=cal, bootscales=bootscales, trim=trim, overscan=overscan)
+
+        # The calibrations against every layout of the science files, a
+        #  file that is not valid FITS is reported when it is processed
+        if isinstance(ref, str): ref = [ref] if ref!='' else []
+        for file in ref:
+            error = plan.checklayout(file)
+            if error!='':
+                error = errprefix+error
+                break
+
+    except (IOError, OSError, ValueError) as e:
+        error = errprefix+str(e)
+
+    if error!='':
+        if not silent: print(error)
+        return None, error
+    return plan, error
@@ -0,0 +1,270 @@
+"""
++
+
+ CCDPROC_PROFILE
+
+ Timing and performance counters for a ccdproc run.  Every step of
+ every extension is timed (reading, the processing steps, header
+ updates, writing), and bytes read and written, calibration cache
+ hits and misses and the peak memory are counted per file.  When a
+ file is done its record is appended to a JSON lines file, one line
+ per file, so that the records of all worker processes end up in one
+ place.  The summary table has the time per step over the run.
+
+ Timing uses lap timers: lap('name') charges the time since the
+ previous lap to step NAME, so a step costs one clock read and one
+ dictionary update.  lap.peak(name,n) and lap.count(name,n) update
+ the counters of the file.  A disabled profile hands out a lap timer
+ (NOLAPS) that does nothing, the instrumented code runs unchanged.
+
+ INPUTS:
+  =file        The JSON lines file for the per-file records.  Default
+                 is '', the records are only kept in memory.
+  =enabled     Profile or not.  Default is True.
+
+ OUTPUTS:
+  prof         The ProcProfile object.
+
+ ProcProfile:
+  .begin(file)             Start the record of a file.
+  .laps(file,exten=None)   A lap timer for FILE (and an extension).
+  .step(name,file,exten)   A context manager that times a step.
+  .add(file,name,sec,exten=None)  Charge SEC seconds to a step.
+  .count(file,name,n)      Add N to a counter, i.e. 'bytes_read'.
+  .peak(file,name,n)       Keep the maximum of a counter, i.e. 'peakmem'.
+  .done(file,error='')     Finish the record of a file and write it.
+  .records()               The records of the finished files, also
+                             those written by other processes to FILE.
+  .summary(records=None)   The totals per step and counter.
+  .table(records=None)     The summary as a text table.
+
+ A record looks like:
+  {"file": "obj1.fits", "pid": 1234, "wall": 2.31, "error": "",
+   "steps": {"read": 0.41, "overscan": 0.22, ...},
+   "extens": {"1": {"overscan": 0.004, ...}, ...},
+   "bytes_read": 134438400, "bytes_written": 268876800,
+   "cache_hits": 62, "cache_misses": 0, "peakmem": 18874368,
+   "maxrss": 912261120}
+
+ USAGE:
+  prof = ProcProfile(file='run.prof.jsonl')
+  prof.begin(file)
+  lap = prof.laps(file,exten)
+  ... read ...
+  lap('read')
+  ... overscan ...
+  lap('overscan')
+  prof.done(file)
+  print(prof.table())
+
+-
+"""
+
+import os
+import json
+import time
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _maxrss():
+    # Peak resident set size of the process in bytes
+    if resource is None: return -1
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+class _NoLaps(object):
+    # The lap timer of a disabled profile
+
+    def __call__(self, name):
+        pass
+
+    def peak(self, name, n):
+        pass
+
+    def count(self, name, n):
+        pass
+
+NOLAPS = _NoLaps()
+
+
+class _Laps(object):
+
+    def __init__(self, prof, file, exten):
+        self.prof, self.file, self.exten = prof, file, exten
+        self.last = time.time()
+
+    def __call__(self, name):
+        # Charge the time since the last lap to step NAME
+        t = time.time()
+        self.prof.add(self.file, name, t-self.last, exten=self.exten)
+        self.last = t
+
+    def peak(self, name, n):
+        self.prof.peak(self.file, name, n)
+
+    def count(self, name, n):
+        self.prof.count(self.file, name, n)
+
+
+class _NoStep(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NOSTEP = _NoStep()
+
+
+class _Step(object):
+
+    def __init__(self, prof, name, file, exten):
+        self.prof, self.name, self.file, self.exten = prof, name, file, exten
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.prof.add(self.file, self.name, time.time()-self.t0, exten=self.exten)
+        return False
+
+
+class ProcProfile(object):
+
+    def __init__(self, file='', enabled=True):
+        self.file = file
+        self.enabled = enabled
+        self._open = {}
+        self._done = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can't be pickled, i.e. for worker processes
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _record(self, file):
+        # The open record of a file, started if needed
+        rec = self._open.get(file)
+        if rec is None:
+            rec = {'file':file, 'pid':os.getpid(), 't0':time.time(),
+                   'steps':{}, 'extens':{}, 'counts':{}}
+            self._open[file] = rec
+        return rec
+
+    def begin(self, file):
+        if not self.enabled: return
+        with self._lock:
+            self._record(file)['t0'] = time.time()
+
+    def add(self, file, name, sec, exten=None):
+        if not self.enabled: return
+        with self._lock:
+            rec = self._record(file)
+            rec['steps'][name] = rec['steps'].get(name, 0.0)+sec
+            if exten is not None:
+                ext = rec['extens'].setdefault(str(exten), {})
+                ext[name] = ext.get(name, 0.0)+sec
+
+    def count(self, file, name, n):
+        if not self.enabled: return
+        with self._lock:
+            counts = self._record(file)['counts']
+            counts[name] = counts.get(name, 0)+n
+
+    def peak(self, file, name, n):
+        if not self.enabled: return
+        with self._lock:
+            counts = self._record(file)['counts']
+            counts[name] = max(counts.get(name, 0), n)
+
+    def laps(self, file, exten=None):
+        # A lap timer, each call charges the time since the last one
+        if not self.enabled: return NOLAPS
+        return _Laps(self, file, exten)
+
+    def step(self, name, file, exten=None):
+        if not self.enabled: return _NOSTEP
+        return _Step(self, name, file, exten)
+
+    def done(self, file, error=''):
+        # Finish the record of a file and append it to the JSON lines file
+        if not self.enabled: return None
+        with self._lock:
+            rec = self._record(file)
+            del self._open[file]
+        out = {'file':file, 'pid':rec['pid'], 'wall':time.time()-rec['t0'],
+               'error':error, 'steps':rec['steps'], 'extens':rec['extens']}
+        out.update(rec['counts'])
+        out['maxrss'] = _maxrss()
+        if self.file!='':
+            # One write per record, records of parallel workers don't mix
+            line = (json.dumps(out, sort_keys=True)+'\n').encode('utf-8')
+            fd = os.open(self.file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        with self._lock:
+            self._done.append(out)
+        return out
+
+    def records(self):
+        # The finished records, from the file if there is one
+        if self.file=='' or not os.path.exists(self.file):
+            with self._lock:
+                return list(self._done)
+        out = []
+        with open(self.file) as fh:
+            for line in fh:
+                if line.strip()!='': out.append(json.loads(line))
+        return out
+
+    def summary(self, records=None):
+        # Totals per step (seconds and calls) and of the counters
+        if records is None: records = self.records()
+        steps = {}
+        counts = {}
+        wall = 0.0
+        for rec in records:
+            wall += rec['wall']
+            for name,sec in rec['steps'].items():
+                tot = steps.setdefault(name, [0.0, 0])
+                tot[0] += sec
+                tot[1] += 1
+            for name,val in rec.items():
+                if name in ('file','pid','wall','error','steps','extens'): continue
+                if name in ('peakmem','maxrss'):
+                    counts[name] = max(counts.get(name, 0), val)
+                else:
+                    counts[name] = counts.get(name, 0)+val
+        return {'nfiles':len(records), 'wall':wall, 'steps':steps, 'counts':counts}
+
+    def table(self, records=None):
+        # The summary as a text table, the slowest steps first
+        summ = self.summary(records)
+        total = sum(s[0] for s in summ['steps'].values())
+        lines = ['%-12s %10s %7s %6s' % ('Step', 'Time (s)', 'Files', '%')]
+        for name,(sec,n) in sorted(summ['steps'].items(), key=lambda s: -s[1][0]):
+            lines.append('%-12s %10.3f %7d %6.1f' % (name, sec, n, 100.0*sec/max(total,1e-9)))
+        lines.append('%-12s %10.3f %7d' % ('total', total, summ['nfiles']))
+        counts = summ['counts']
+        for name in sorted(counts):
+            val = counts[name]
+            if name.startswith('bytes') or name in ('peakmem','maxrss'):
+                lines.append('%-12s %10.1f MB' % (name, val/1048576.))
+            else:
+                lines.append('%-12s %10d' % (name, val))
+        return '\n'.join(lines)
@@ -0,0 +1,341 @@
+"""
++
+
+ CCDPROC_QUEUE
+
+ A shared work queue for reducing whole nights or surveys with
+ ccdproc on many hosts.  The input list is split into work units, a
+ whole file or (with /byext) one extension of a file, and workers
+ lease units from the queue, process them and mark them done.
+
+ A lease lasts LEASE seconds and is renewed while the unit is worked
+ on (.held).  A unit whose lease runs out (the worker died or hung)
+ goes back to the queue the next time any worker leases, a unit that
+ fails goes back too, and after MAXTRIES failed attempts it is
+ FAILED with the last error.  Adding units is idempotent (the unit
+ id is the absolute file name and the extension), so every host can
+ add the same input and a rerun only adds the new files.
+
+ With /byext every multi-extension file gets one unit per extension
+ and a MERGE unit.  The merge unit is only handed out when all of
+ the extensions of its file are DONE (and FAILS when one of them
+ failed), it assembles the output of the extension parts.
+
+ The backends are looked up by the scheme of the queue name,
+ 'sqlite:run.queue' or just 'run.queue' is the SQLite backend.  The
+ database file has to be on a filesystem with working locks when
+ the workers run on several hosts.  Other backends (i.e. a server
+ queue) are added to QUEUES, they implement the methods below.
+
+ INPUTS:
+  name         The queue, 'scheme:location' or a SQLite file name.
+  =lease       The lease time in seconds.  Default is 600.
+  =maxtries    The number of attempts of a unit.  Default is 3.
+  /silent      Don't print anything to the screen.
+
+ OUTPUTS:
+  queue        The queue object.
+  error        The error message if one occurred.
+
+ Queue:
+  .put(units)              Add units (dictionaries from queueunits),
+                             returns the number that were new.
+  .lease(worker,n=1)       Lease up to N units, after reclaiming the
+                             expired leases.  A unit is a dictionary
+                             with ID, FILE, KIND ('file', 'ext' or
+                             'merge'), EXTEN and TRIES.
+  .renew(unit,worker)      Extend the lease, False if it was lost.
+  .done(unit,worker)       The unit is done, False if the lease was lost.
+  .fail(unit,worker,error) The attempt failed, the unit is retried or
+                             FAILED.
+  .held(unit,worker)       A context manager that renews the lease
+                             in the background while the unit runs.
+  .active()                The number of PENDING and LEASED units.
+  .wait()                  Sleep a poll interval, when nothing could
+                             be leased but other workers are busy.
+  .requeue(states)         Put units back to PENDING, i.e. ('FAILED',).
+  .failed()                The FAILED units and their last errors.
+  .stats()                 The progress of the whole campaign.
+  .progress()              The progress as one line of text.
+  .worker(tag='')          A worker name, host:pid (and TAG).
+
+ USAGE:
+  queue, error = ccdproc_queue('sqlite:/survey/season1.queue')
+  queue.put(queueunits(iloadinput('@season1.lst')))
+  for unit in queue.lease(worker):
+      with queue.held(unit, worker):
+          ... process unit['file']
+      queue.done(unit, worker)
+
+-
+"""
+
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+from fitsindex import fitsindex
+
+STATES = ('PENDING', 'LEASED', 'DONE', 'FAILED')
+
+# Window of the current throughput in seconds
+RATEWINDOW = 600.0
+
+
+def queueunits(files, byext=False):
+    # The work units of the input files, a generator
+    for file in files:
+        path = os.path.abspath(file)
+        nextend = 0
+        if byext:
+            fits, error = fitsindex(path)
+            if error=='': nextend = fits.nextend
+        if nextend==0:
+            yield {'id':path, 'file':path, 'kind':'file', 'exten':None}
+            continue
+        for exten in range(1, nextend+1):
+            yield {'id':path+'['+str(exten)+']', 'file':path, 'kind':'ext', 'exten':exten}
+        yield {'id':path+'[merge]', 'file':path, 'kind':'merge', 'exten':None}
+
+
+class _Keeper(object):
+    # Renews a lease in a background thread
+
+    def __init__(self, queue, unit, worker):
+        self.queue, self.unit, self.worker = queue, unit, worker
+        self._stop = threading.Event()
+        self.lost = False
+
+    def _run(self):
+        while not self._stop.wait(self.queue.leasetime/3.0):
+            if not self.queue.renew(self.unit, self.worker):
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+class SqliteQueue(object):
+
+    def __init__(self, dbfile, lease=600, maxtries=3):
+        self.dbfile = dbfile
+        self.leasetime = float(lease)
+        self.maxtries = int(maxtries)
+        self._db = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Worker processes open their own connection
+        return {'dbfile':self.dbfile, 'lease':self.leasetime, 'maxtries':self.maxtries}
+
+    def __setstate__(self, state):
+        self.__init__(state['dbfile'], lease=state['lease'], maxtries=state['maxtries'])
+
+    def _conn(self):
+        # One connection per process, transactions are explicit
+        if self._db is None or self._pid!=os.getpid():
+            db = sqlite3.connect(self.dbfile, timeout=60, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute('CREATE TABLE IF NOT EXISTS units (id TEXT PRIMARY KEY, '
+                       'file TEXT, kind TEXT, exten INTEGER, state TEXT, tries INTEGER, '
+                       'worker TEXT, expires REAL, leased REAL, done REAL, error TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS units_state ON units (state)')
+            db.execute('CREATE INDEX IF NOT EXISTS units_file ON units (file)')
+            self._db = db
+            self._pid = os.getpid()
+        return self._db
+
+    def _transaction(self, func):
+        # Run func(db) in one write transaction
+        with self._lock:
+            db = self._conn()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                out = func(db)
+            except:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        return out
+
+    def worker(self, tag=''):
+        name = socket.gethostname()+':'+str(os.getpid())
+        if tag!='': name += ':'+str(tag)
+        return name
+
+    def put(self, units, batch=1000):
+        # Add the units that are not in the queue yet, in batches
+        def insert(rows):
+            def func(db):
+                before = db.total_changes
+                db.executemany('INSERT OR IGNORE INTO units VALUES '
+                               '(?,?,?,?,\'PENDING\',0,NULL,NULL,NULL,NULL,NULL)', rows)
+                return db.total_changes-before
+            return self._transaction(func)
+        nnew = 0
+        rows = []
+        for unit in units:
+            rows.append((unit['id'], unit['file'], unit['kind'], unit['exten']))
+            if len(rows)>=batch:
+                nnew += insert(rows)
+                rows = []
+        if len(rows)>0: nnew += insert(rows)
+        return nnew
+
+    def _reclaim(self, db, now):
+        # Expired leases count as a failed attempt
+        db.execute('UPDATE units SET tries=tries+1, error=\'lease of \'||worker||\' expired\', '
+                   'state=CASE WHEN tries+1>=? THEN \'FAILED\' ELSE \'PENDING\' END, '
+                   'worker=NULL, expires=NULL WHERE state=\'LEASED\' AND expires<?',
+                   (self.maxtries, now))
+        # Merges of files with a failed extension can't be done
+        db.execute('UPDATE units SET state=\'FAILED\', error=\'an extension failed\' '
+                   'WHERE kind=\'merge\' AND state=\'PENDING\' AND file IN '
+                   '(SELECT file FROM units WHERE kind=\'ext\' AND state=\'FAILED\')')
+
+    def lease(self, worker, n=1):
+        # Lease up to N units, merges only when their extensions are done
+        def func(db):
+            now = time.time()
+            self._reclaim(db, now)
+            rows = db.execute('SELECT id,file,kind,exten,tries FROM units u '
+                              'WHERE state=\'PENDING\' AND (kind!=\'merge\' OR NOT EXISTS '
+                              '(SELECT 1 FROM units v WHERE v.file=u.file AND v.kind=\'ext\' '
+                              'AND v.state!=\'DONE\')) ORDER BY rowid LIMIT ?', (n,)).fetchall()
+            db.executemany('UPDATE units SET state=\'LEASED\', worker=?, expires=?, leased=? '
+                           'WHERE id=?', [(worker, now+self.leasetime, now, r[0]) for r in rows])
+            return rows
+        return [{'id':r[0], 'file':r[1], 'kind':r[2], 'exten':r[3], 'tries':r[4]}
+                for r in self._transaction(func)]
+
+    def _update(self, sql, args, unit, worker):
+        # Update a unit that WORKER still holds, True if it did
+        def func(db):
+            cur = db.execute(sql+' WHERE id=? AND worker=? AND state=\'LEASED\'',
+                             tuple(args)+(unit['id'], worker))
+            return cur.rowcount>0
+        return self._transaction(func)
+
+    def renew(self, unit, worker):
+        return self._update('UPDATE units SET expires=?', (time.time()+self.leasetime,),
+                            unit, worker)
+
+    def done(self, unit, worker):
+        return self._update('UPDATE units SET state=\'DONE\', done=?, expires=NULL, error=NULL',
+                            (time.time(),), unit, worker)
+
+    def fail(self, unit, worker, error=''):
+        return self._update('UPDATE units SET tries=tries+1, error=?, worker=NULL, '
+                            'expires=NULL, state=CASE WHEN tries+1>=? THEN \'FAILED\' '
+                            'ELSE \'PENDING\' END', (error, self.maxtries), unit, worker)
+
+    def held(self, unit, worker):
+        return _Keeper(self, unit, worker)
+
+    def active(self):
+        rows = self._conn().execute('SELECT COUNT(*) FROM units WHERE state IN '
+                                    '(\'PENDING\',\'LEASED\')').fetchall()
+        return rows[0][0]
+
+    def wait(self):
+        time.sleep(min(5.0, self.leasetime/10.0))
+
+    def requeue(self, states=('FAILED',)):
+        # Put units back, i.e. the failed ones after a fix
+        def func(db):
+            cur = db.execute('UPDATE units SET state=\'PENDING\', tries=0, worker=NULL, '
+                             'expires=NULL WHERE state IN ('+','.join('?'*len(states))+')',
+                             tuple(states))
+            return cur.rowcount
+        return self._transaction(func)
+
+    def failed(self):
+        # The failed units and their last errors
+        rows = self._conn().execute('SELECT id,error FROM units WHERE state=\'FAILED\' '
+                                    'ORDER BY rowid').fetchall()
+        return [{'id':r[0], 'error':r[1]} for r in rows]
+
+    def stats(self):
+        # Counts, throughput (units/s) and the time left of the campaign
+        db = self._conn()
+        now = time.time()
+        counts = dict((s, 0) for s in STATES)
+        for state,n in db.execute('SELECT state,COUNT(*) FROM units GROUP BY state'):
+            counts[state] = n
+        t0, t1, files = db.execute('SELECT MIN(leased),MAX(done),COUNT(DISTINCT file) '
+                                   'FROM units WHERE state=\'DONE\'').fetchone()
+        recent = db.execute('SELECT COUNT(*) FROM units WHERE state=\'DONE\' AND done>?',
+                            (now-RATEWINDOW,)).fetchone()[0]
+        workers = db.execute('SELECT COUNT(DISTINCT worker) FROM units '
+                             'WHERE state=\'LEASED\'').fetchone()[0]
+        retries = db.execute('SELECT COUNT(*) FROM units WHERE tries>0').fetchone()[0]
+        rate = 0.0
+        if t0 is not None and t1>t0: rate = counts['DONE']/(t1-t0)
+        window = min(RATEWINDOW, now-t0) if t0 is not None else 0.0
+        current = recent/window if window>0 else 0.0
+        left = counts['PENDING']+counts['LEASED']
+        eta = left/current if current>0 else (left/rate if rate>0 else None)
+        return {'counts':counts, 'total':sum(counts.values()), 'files':files,
+                'workers':workers, 'retried':retries, 'rate':rate,
+                'current':current, 'eta':eta}
+
+    def progress(self):
+        s = self.stats()
+        c = s['counts']
+        done = 100.0*c['DONE']/max(s['total'], 1)
+        line = '%d/%d units done (%.1f%%), %d leased, %d failed, %d workers, ' \
+               '%.2f units/s (%.2f overall)' % (c['DONE'], s['total'], done, c['LEASED'],
+                                                 c['FAILED'], s['workers'], s['current'],
+                                                 s['rate'])
+        if s['eta'] is not None: line += ', %.1f h left' % (s['eta']/3600.)
+        return line
+
+    def close(self):
+        if self._db is not None and self._pid==os.getpid():
+            self._db.close()
+        self._db = None
+
+
+# The queue backends by scheme
+QUEUES = {'sqlite':SqliteQueue}
+
+
+def ccdproc_queue(name, lease=600, maxtries=3, silent=True):
+
+    # Initalizing some variables
+    queue = None
+    error = ''
+    errprefix = 'CCDPROC_QUEUE: '   # error message prefix
+
+    scheme, location = 'sqlite', name
+    if ':' in name and name.split(':', 1)[0] in QUEUES:
+        scheme, location = name.split(':', 1)
+
+    if location=='':
+        error = errprefix+'No queue location in '+name
+    elif lease<=0 or maxtries<1:
+        error = errprefix+'LEASE must be positive and MAXTRIES at least 1'
+    else:
+        try:
+            queue = QUEUES[scheme](location, lease=lease, maxtries=maxtries)
+            queue.active()
+        except (IOError, OSError, sqlite3.Error) as e:
+            queue = None
+            error = errprefix+name+' '+str(e)
+
+    if error!='':
+        if not silent: print(error)
+        return None, error
+    return queue, error
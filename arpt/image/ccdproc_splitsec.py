@@ -0,0 +1,42 @@
+"""
++
+
+ CCDPROC_SPLITSEC
+
+ This function splits an IRAF section string like [1:1024,1:4096]
+ into a 4-element integer array [x1,x2,y1,y2].  The values are
+ 1-based like the IRAF string.
+
+ INPUTS:
+  sec          The IRAF section string.
+
+ OUTPUTS:
+  A 4-element integer list [x1,x2,y1,y2], or -1 if the string
+  could not be parsed.
+
+ USAGE:
+  sec = ccdproc_splitsec('[1:1024,1:4096]')
+
+-
+"""
+
+def ccdproc_splitsec(sec):
+
+    # Need a single string
+    if not hasattr(sec, 'strip'): return -1
+
+    sec = sec.strip().strip("'").strip()
+    if len(sec)<2: return -1
+    sec2 = sec[1:len(sec)-1]
+    dum = sec2.split(',')
+    if len(dum)!=2: return -1
+    str_x = dum[0].split(':')
+    str_y = dum[1].split(':')
+    out = str_x + str_y
+    if len(out)!=4: return -1
+    try:
+        out = [int(o) for o in out]
+    except ValueError:
+        return -1
+
+    return out
@@ -0,0 +1,119 @@
+"""
++
+
+ CCDPROC_STACK
+
+ This program applies the zero, flat, illum and bootstrap corrections
+ to a stack of exposures of one CCD (the same extension of several
+ files) at once.  The exposures are a 3D cube and every calibration
+ frame is broadcast over the whole stack one block of rows at a time,
+ so a block of the zero and flat frames is read once and applied to
+ all of the exposures while it is still in cache.  The arithmetic is
+ that of ccdproc_fused (the zero is rounded, flat and illum pixels
+ below 0.001 are set to the median, the median and bootstrap scales
+ come last), the results are the same as one exposure at a time.
+
+ INPUTS:
+  cube         The 3D float array (nexp, ny, nx) of the (trimmed)
+                 exposures.  It is calibrated in place.
+  =zeroim      The zero image (ny, nx).
+  =flatim      The flat image (ny, nx).
+  =illumim     The illumination image (ny, nx).
+  =bootscale   Bootstrap scale.
+  =medflat     Median of flatim, if it is already known.
+  =medillum    Median of illumim, if it is already known.
+  =nblock      Number of rows to process per block.  Default is 64.
+  /silent      Don't print anything to the screen.
+
+ OUTPUTS:
+  cube         The calibrated cube (the input array).
+  error        The error message if one occurred.
+  =stats       Dictionary that is filled with information on the
+                 processing: nexp, medflat, medillum.
+
+ USAGE:
+  cube, error = ccdproc_stack(cube,zeroim=zeroim,flatim=flatim,stats=stats)
+
+-
+"""
+
+import numpy as np
+
+
+def ccdproc_stack(cube, zeroim=None, flatim=None, illumim=None, bootscale=None,
+                  medflat=None, medillum=None, nblock=64, stats=None, silent=True):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'CCDPROC_STACK: '   # error message prefix
+    if stats is None: stats = {}
+
+    # Error Handling
+    #------------------
+    try:
+
+        # Check inputs
+        #-------------
+        if not isinstance(cube, np.ndarray) or cube.ndim!=3 or cube.dtype.kind!='f':
+            error = errprefix+'Stack must be a 3D float array'
+            if not silent: print(error)
+            return None, error
+        nexp, ny, nx = cube.shape
+        for name,cal in (('Zero',zeroim),('Flat',flatim),('Illum',illumim)):
+            if cal is not None and np.shape(cal)!=(ny,nx):
+                error = errprefix+name+' image has wrong size, must be ['+str(nx)+','+str(ny)+'].'
+                if not silent: print(error)
+                return None, error
+
+        # Flat and illum medians, these are global
+        scale = 1.0
+        if flatim is not None:
+            if medflat is None: medflat = float(np.median(flatim))
+            stats['medflat'] = medflat
+            scale *= medflat
+        if illumim is not None:
+            if medillum is None: medillum = float(np.median(illumim))
+            stats['medillum'] = medillum
+            scale *= medillum
+        if bootscale is not None:
+            scale *= bootscale
+
+        # Block scratch space for the calibration rows
+        nblock = max(1, min(int(nblock), ny))
+        tmp = np.empty((nblock,nx), dtype=cube.dtype)
+        mask = np.empty((nblock,nx), dtype=bool)
+
+        # Loop over the row blocks, each calibration block is
+        #  broadcast over all of the exposures
+        #------------------------------------------------------
+        for r0 in range(0, ny, nblock):
+            r1 = min(r0+nblock, ny)
+            blk = cube[:,r0:r1]
+            t = tmp[0:r1-r0]
+            m = mask[0:r1-r0]
+
+            # Zero, rounded like in ccdproc_fused
+            if zeroim is not None:
+                np.round(zeroim[r0:r1], out=t)
+                blk -= t
+
+            # Flat and illum, bad pixels are set to the median
+            for cal,med in ((flatim,medflat),(illumim,medillum)):
+                if cal is None: continue
+                t[...] = cal[r0:r1]
+                np.less(t, 0.001, out=m)
+                np.copyto(t, med, where=m)
+                blk /= t
+
+            # Flat/illum normalization and bootstrap scale
+            if scale!=1.0:
+                blk *= scale
+
+        stats['nexp'] = nexp
+
+    except Exception as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return None, error
+
+    return cube, error
@@ -0,0 +1,166 @@
+"""
++
+
+ CCDPROC_STREAM
+
+ This runs ccdproc as a three stage streaming pipeline so that
+ reading, calibrating and writing overlap.  A reader thread reads
+ ahead the next extensions (and files) into a bounded queue, the
+ calling thread calibrates, and a writer thread writes completed
+ HDUs from a second bounded queue in the background.  The bounded
+ queues limit the number of images in memory.
+
+ INPUTS:
+  tasks        Iterable of tasks, i.e. (file,exten,...) tuples, in the
+                 order they should be written.
+  readfunc     readfunc(task) returns the data for the task.
+  procfunc     procfunc(task,data) returns the calibrated result.
+  writefunc    writefunc(task,result,error) writes the result.  It is
+                 called for every task, also when an earlier stage
+                 failed (RESULT is None and ERROR is set) so that it
+                 can clean up.  It is not called for a failure of
+                 TASKS itself.
+  =readahead   The depth of the read queue.  Default is 4.
+  =writebehind The depth of the write queue.  Default is 4.
+  =stats       StreamStats object that is updated with the queue
+                 depths and wait times.
+
+ OUTPUTS:
+  The list of (task,error) for every task.  ERROR is '' if all
+  stages succeeded.  If iterating over TASKS raised an exception
+  the list ends with a (None,error) entry for it.
+
+ StreamStats:
+  .depth(name)   Current depth of the 'read' or 'write' queue.
+  .maxdepth      Maximum depth seen for each queue.
+  .meandepth()   Mean depth of each queue (sampled at each get).
+  .wait          Time (s) spent waiting: 'calib' for data from the
+                   reader (I/O bound), 'write' for room in the write
+                   queue (writer bound).
+
+ USAGE:
+  errors = ccdproc_stream(tasks,readfunc,procfunc,writefunc,readahead=8)
+
+-
+"""
+
+import time
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# End of the stream
+_DONE = object()
+
+
+class StreamStats(object):
+
+    def __init__(self):
+        self.queues = {}
+        self.maxdepth = {'read':0, 'write':0}
+        self.sumdepth = {'read':0, 'write':0}
+        self.nsample = {'read':0, 'write':0}
+        self.wait = {'calib':0.0, 'write':0.0}
+        self.ntasks = 0
+
+    def depth(self, name):
+        # Current depth of a queue
+        q = self.queues.get(name)
+        return 0 if q is None else q.qsize()
+
+    def sample(self, name):
+        d = self.depth(name)
+        self.maxdepth[name] = max(self.maxdepth[name], d)
+        self.sumdepth[name] += d
+        self.nsample[name] += 1
+
+    def meandepth(self):
+        return dict((k, self.sumdepth[k]/float(max(self.nsample[k],1)))
+                    for k in self.sumdepth)
+
+
+def ccdproc_stream(tasks, readfunc, procfunc, writefunc, readahead=4,
+                   writebehind=4, stats=None):
+
+    if stats is None: stats = StreamStats()
+    readq = queue.Queue(maxsize=max(int(readahead),1))
+    writeq = queue.Queue(maxsize=max(int(writebehind),1))
+    stats.queues = {'read':readq, 'write':writeq}
+    results = []
+    stop = threading.Event()
+
+    # Reader, reads ahead of the calibration
+    def reader():
+        try:
+            for task in tasks:
+                if stop.is_set(): break
+                try:
+                    data, error = readfunc(task), ''
+                except Exception as e:
+                    data, error = None, str(e)
+                readq.put((task, data, error))
+                stats.sample('read')
+        except Exception as e:
+            # The task generator itself failed
+            readq.put((None, None, str(e)))
+        finally:
+            readq.put(_DONE)
+
+    # Writer, writes behind the calibration
+    def writer():
+        while True:
+            item = writeq.get()
+            if item is _DONE: break
+            task, result, error = item
+            # The task generator failed, nothing to write
+            if task is None:
+                results.append((task, error))
+                continue
+            try:
+                writefunc(task, result, error)
+            except Exception as e:
+                error = str(e)
+            results.append((task, error))
+
+    rthread = threading.Thread(target=reader, name='ccdproc_stream_reader')
+    wthread = threading.Thread(target=writer, name='ccdproc_stream_writer')
+    rthread.daemon = True
+    wthread.daemon = True
+    rthread.start()
+    wthread.start()
+
+    # Calibrate in this thread
+    try:
+        while True:
+            t0 = time.time()
+            item = readq.get()
+            stats.wait['calib'] += time.time()-t0
+            if item is _DONE: break
+            stats.sample('read')
+            task, data, error = item
+            result = None
+            if error=='' and task is not None:
+                try:
+                    result = procfunc(task, data)
+                except Exception as e:
+                    error = str(e)
+            data = None
+            t0 = time.time()
+            writeq.put((task, result, error))
+            stats.wait['write'] += time.time()-t0
+            stats.sample('write')
+            stats.ntasks += 1
+    finally:
+        stop.set()
+        # Let a blocked reader finish
+        while rthread.is_alive():
+            try:
+                readq.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        writeq.put(_DONE)
+        wthread.join()
+
+    return results
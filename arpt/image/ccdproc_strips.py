@@ -0,0 +1,295 @@
+"""
++
+
+ CCDPROC_STRIPS
+
+ This is the bounded-memory (strip) mode of the per-pixel ccdproc
+ steps for frames that are larger than the memory of the machine.
+ The raw image and the calibration images are memory-mapped
+ (fitsindex) and only touched one horizontal band of rows at a
+ time.  Each band is calibrated with ccdproc_fused and handed to
+ WRITEFUNC, so reading, calibration and writing all happen band by
+ band.  The number of rows per band follows from the memory ceiling.
+
+ The global statistics are computed first in a pre-pass that also
+ works band by band (ccdproc_stripstats): the overscan vectors (from
+ the bias pixels only), the flat and illum medians (exact, see
+ ccdproc_stripmedian), the number of bad pixels and the fixpix values
+ (only the source pixels of the fixpix plan are read).  The output is
+ therefore identical to whole-frame processing, and the header can
+ be completed before any data is written.
+
+ INPUTS:
+  im           The 2D raw image array, normally a memory map.
+  writefunc    writefunc(row0,strip) is called for every calibrated band
+                 in order.  ROW0 is the first output row of the band.
+  =prestats    The output of ccdproc_stripstats.  It is computed if
+                 it is not given.
+  =maxmem      The memory ceiling in bytes.  Default is 256MB.
+  The other keywords are the same as for ccdproc_fused (ovgeom,
+  ovfunction, ovorder, trimsec, trim, linplan, fixplan, zeroim,
+  flatim, illumim, bootscale, bpmind, badpixval, medflat, medillum,
+  dtype).  The calibration images can be memory maps too.
+  /silent      Don't print anything to the screen.
+
+ OUTPUTS:
+  error        The error message if one occurred.
+  =stats       Dictionary that is filled with the global statistics
+                 (ovsnmean, ovsnamp, medflat, medillum, nbdpix), nrows
+                 (rows per band), nstrips and peakmem (the largest
+                 band allocation in bytes).
+
+ ccdproc_stripgeom(ovgeom,ovvecs,y0,y1) returns the amplifiers and
+ overscan vectors of the raw rows Y0:Y1 in band coordinates.
+
+ ccdproc_stripmedian(im) returns the exact median (same as np.median)
+ reading IM band by band.  It uses a radix selection on the sortable
+ integer keys of the values, two passes for 32-bit data.
+
+ USAGE:
+  prestats, error = ccdproc_stripstats(im,ovgeom=ovgeom,flatim=flatim)
+  error = ccdproc_strips(im,writefunc,ovgeom=ovgeom,flatim=flatim,
+                         prestats=prestats,maxmem=512*1024**2)
+
+-
+"""
+
+import numpy as np
+
+from ccdproc_fused import ccdproc_fused
+from ccdproc_overscan import ccdproc_overscanvecs
+from ccdproc_fixpix import ccdproc_fixpixvalues, ccdproc_fixpixband
+from ccdproc_lincorr import ccdproc_linwindow, ccdproc_linvalues, ccdproc_linshift
+
+
+def _bands(im, nrows):
+    # Native-order copies of the bands of rows of IM
+    nrows = max(1, int(nrows))
+    arr = im.reshape(im.shape[0], -1) if im.ndim>1 else im.reshape(1, -1)
+    native = arr.dtype.newbyteorder('=')
+    for r0 in range(0, arr.shape[0], nrows):
+        yield np.ascontiguousarray(arr[r0:r0+nrows], dtype=native).ravel()
+
+
+def _sortkey(x):
+    # Unsigned integer keys that sort like the values
+    nbits = 8*x.dtype.itemsize
+    utype = np.dtype('u'+str(x.dtype.itemsize))
+    u = x.view(utype)
+    sign = utype.type(1 << (nbits-1))
+    if x.dtype.kind=='f':
+        return np.where(u & sign, ~u, u | sign)
+    if x.dtype.kind=='i':
+        return u ^ sign
+    return u
+
+
+def _fromkey(key, dtype):
+    # The value of a sort key
+    nbits = 8*dtype.itemsize
+    utype = np.dtype('u'+str(dtype.itemsize))
+    key = utype.type(key)
+    sign = utype.type(1 << (nbits-1))
+    if dtype.kind=='f':
+        u = key ^ sign if key & sign else ~key
+    elif dtype.kind=='i':
+        u = key ^ sign
+    else:
+        u = key
+    return np.array([u], dtype=utype).view(dtype)[0]
+
+
+def ccdproc_stripmedian(im, nrows=1024):
+    # Exact median reading IM band by band
+    dtype = np.dtype(im.dtype).newbyteorder('=')
+    if dtype.kind=='b': dtype = np.dtype('u1')
+    n = int(np.prod(im.shape))
+    if n==0: return np.nan
+    if dtype.kind=='f':
+        for band in _bands(im, nrows):
+            if np.isnan(band).any(): return dtype.type(np.nan)
+    nbits = 8*dtype.itemsize
+    width = min(16, nbits)
+    # The two middle ranks, the same for odd N
+    ranks = [(n-1)//2, n//2]
+    prefix = [0, 0]
+    for shift in range(nbits-width, -1, -width):
+        # Histogram of the next digit of the keys that match the prefix
+        todo = sorted(set(prefix))
+        counts = dict((p, np.zeros(1 << width, dtype=np.int64)) for p in todo)
+        for band in _bands(im, nrows):
+            key = _sortkey(band.view(dtype))
+            digit = ((key >> shift) & ((1 << width)-1)).astype(np.intp)
+            high = key >> (shift+width) if shift+width<nbits else np.zeros_like(key)
+            for p in todo:
+                counts[p] += np.bincount(digit[high==p], minlength=1 << width)
+        for k in range(2):
+            cum = np.cumsum(counts[prefix[k]])
+            d = int(np.searchsorted(cum, ranks[k], side='right'))
+            if d>0: ranks[k] -= int(cum[d-1])
+            prefix[k] = (prefix[k] << width) | d
+    vals = np.array([_fromkey(p, dtype) for p in prefix], dtype=dtype)
+    # Same arithmetic as np.median
+    return np.mean(vals) if n%2==0 else vals[0]
+
+
+def ccdproc_stripgeom(ovgeom, ovvecs, y0, y1):
+    # The amplifiers and overscan vectors of the raw rows Y0:Y1, in band
+    # coordinates
+    geom, vecs = [], []
+    for amp,vec in zip(ovgeom, ovvecs):
+        dy, dx = amp['data']
+        a0, a1 = max(dy.start,y0), min(dy.stop,y1)
+        if a1<=a0: continue
+        if amp['axis']==1: vec = vec[a0-dy.start:a1-dy.start]
+        geom.append({'name':amp['name'], 'axis':amp['axis'], 'bias':amp['bias'],
+                     'data':(slice(a0-y0,a1-y0), dx)})
+        vecs.append(vec)
+    return geom, vecs
+
+
+def ccdproc_striprows(maxmem, nx, dtype='float32', ncal=0, nin=1):
+    # Rows per band that fit in MAXMEM bytes
+    #  output band, fused scratch (tmp and mask), the converted raw band,
+    #  the big-endian output copy and the calibration bands
+    itemsize = np.dtype(dtype).itemsize
+    rowbytes = nx*(itemsize*(3+nin) + 1 + ncal*itemsize)
+    return max(1, int(maxmem)//rowbytes)
+
+
+def ccdproc_stripstats(im, ovgeom=None, ovfunction='median', ovorder=3, linplan=None,
+                       fixplan=None, flatim=None, illumim=None,
+                       bpmind=None, medflat=None, medillum=None, dtype='float32',
+                       nrows=1024, silent=True):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'CCDPROC_STRIPSTATS: '   # error message prefix
+    stats = {}
+
+    try:
+        dtype = np.dtype(dtype)
+        # Linearity-corrected raw pixels
+        readwin, readval = None, None
+        if linplan is not None:
+            readwin = lambda sl: ccdproc_linwindow(im, sl, linplan, dtype=dtype)
+            readval = lambda ind: ccdproc_linvalues(im, ind, linplan, dtype=dtype)
+        # Overscan vectors, only the bias pixels are read
+        if ovgeom is not None:
+            vecs = ccdproc_overscanvecs(im, ovgeom, function=ovfunction, order=ovorder,
+                                        read=readwin, dtype=dtype)
+            stats['ovvecs'] = [v.astype(dtype) for v in vecs]
+            stats['ovsnamp'] = [float(np.mean(v)) for v in vecs]
+            stats['ovsnmean'] = float(np.mean(stats['ovsnamp']))
+        # Fixpix values, only the source pixels are read
+        if fixplan is not None:
+            stats['fixvals'] = ccdproc_fixpixvalues(im, fixplan, read=readval, dtype=dtype)
+        # Flat and illum medians
+        if flatim is not None:
+            stats['medflat'] = float(ccdproc_stripmedian(flatim, nrows)) if medflat is None else medflat
+        if illumim is not None:
+            stats['medillum'] = float(ccdproc_stripmedian(illumim, nrows)) if medillum is None else medillum
+        # Bad pixels
+        if bpmind is not None:
+            stats['nbdpix'] = len(bpmind)
+
+    except Exception as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return None, error
+
+    return stats, error
+
+
+def ccdproc_strips(im, writefunc, ovgeom=None, ovfunction='median', ovorder=3,
+                   trimsec=None, trim=False, linplan=None, fixplan=None, zeroim=None,
+                   flatim=None, illumim=None, bootscale=None, bpmind=None, badpixval=65535,
+                   medflat=None, medillum=None, dtype='float32', prestats=None,
+                   maxmem=256*1024**2, stats=None, silent=True):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'CCDPROC_STRIPS: '   # error message prefix
+    if stats is None: stats = {}
+
+    try:
+        ny, nx = im.shape
+        if trim and trimsec is None:
+            error = errprefix+'Need TRIMSEC or DATASEC'
+            if not silent: print(error)
+            return error
+
+        # Output region in the raw image
+        if trim:
+            ox0, ox1, oy0, oy1 = trimsec[0], trimsec[1]+1, trimsec[2], trimsec[3]+1
+        else:
+            ox0, ox1, oy0, oy1 = 0, nx, 0, ny
+        ony = oy1-oy0
+
+        # Global statistics
+        if prestats is None:
+            prestats, error = ccdproc_stripstats(im, ovgeom=ovgeom, ovfunction=ovfunction,
+                                                 ovorder=ovorder, linplan=linplan,
+                                                 fixplan=fixplan, flatim=flatim,
+                                                 illumim=illumim, bpmind=bpmind,
+                                                 medflat=medflat, medillum=medillum,
+                                                 dtype=dtype, silent=silent)
+            if error!='': return error
+        for k in ('ovsnmean','ovsnamp','medflat','medillum','nbdpix'):
+            if k in prestats: stats[k] = prestats[k]
+
+        # Rows per band
+        ncal = sum(c is not None for c in (zeroim, flatim, illumim))
+        nrows = min(ccdproc_striprows(maxmem, nx, dtype=dtype, ncal=ncal), ony)
+        stats['nrows'] = nrows
+        stats['nstrips'] = 0
+        stats['peakmem'] = 0
+
+        # Loop over the bands
+        #---------------------
+        for r0 in range(0, ony, nrows):
+            r1 = min(r0+nrows, ony)
+            y0, y1 = oy0+r0, oy0+r1   # raw rows
+
+            # Amplifiers of this band, in band coordinates
+            geom, vecs = None, None
+            if ovgeom is not None:
+                geom, vecs = ccdproc_stripgeom(ovgeom, prestats['ovvecs'], y0, y1)
+
+            # Bad pixels of this band
+            bfixplan, bfixvals = None, None
+            if fixplan is not None:
+                fy, fx, bfixvals = ccdproc_fixpixband(fixplan, prestats['fixvals'], y0, y1)
+                bfixplan = {'ty':fy, 'tx':fx}
+            bbpmind = None
+            if bpmind is not None:
+                onx = ox1-ox0
+                i0, i1 = np.searchsorted(bpmind, [r0*onx, r1*onx])
+                bbpmind = bpmind[i0:i1]-r0*onx
+
+            bstats = {}
+            band = im[y0:y1]
+            out, error = ccdproc_fused(band, ovgeom=geom, ovvecs=vecs,
+                                       trimsec=[ox0, ox1-1, 0, y1-y0-1], trim=True,
+                                       linplan=ccdproc_linshift(linplan, y0, y1),
+                                       fixplan=bfixplan, fixvals=bfixvals,
+                                       zeroim=None if zeroim is None else zeroim[r0:r1],
+                                       flatim=None if flatim is None else flatim[r0:r1],
+                                       illumim=None if illumim is None else illumim[r0:r1],
+                                       bootscale=bootscale,
+                                       bpmind=bbpmind,
+                                       badpixval=badpixval, medflat=prestats.get('medflat'),
+                                       medillum=prestats.get('medillum'), dtype=dtype,
+                                       stats=bstats, silent=silent)
+            if error!='': return error
+            stats['peakmem'] = max(stats['peakmem'], bstats['peakmem'])
+            writefunc(r0, out)
+            out = None
+            stats['nstrips'] += 1
+
+    except Exception as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return error
+
+    return error
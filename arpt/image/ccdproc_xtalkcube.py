@@ -0,0 +1,176 @@
+"""
++
+
+ CCDPROC_XTALKCUBE
+
+ This program applies the cross-talk correction to all extensions of
+ an exposure at once.  The cross-talk structure (from
+ ccdproc_loadxtalk) is compiled once per run into a sparse victim x
+ source matrix.  The extensions that take part are read once into a
+ stacked cube and all coefficients are applied in one pass using the
+ original (uncorrected) source pixels:
+
+    out[victim] = round( cube[victim] - sum scale*cube[source] )
+
+ This replaces reading every source extension from disk again for
+ every (victim,source) entry.
+
+ ccdproc_xtalkmatrix(xstr)
+  INPUTS:
+   xstr        The xtalk structure with VICTIM, SOURCE and SCALE.  A
+                 list of (victim,source,scale) tuples also works.
+  OUTPUTS:
+   xmat        The compiled matrix (dictionary): VICTIMS, EXTENS (all
+                 extensions used), INDPTR/SOURCE/SCALE (CSR rows, one
+                 per victim) and TEXT (header text per victim).
+   error       The error message if one occurred.
+
+ ccdproc_xtalkcube(cube,xmat)
+  INPUTS:
+   cube        The 3D cube (or list of 2D images) in the order of
+                 xmat['extens'].  This is not modified.
+   xmat        The compiled matrix.
+   =dtype      The output type.  Default is float32.
+  OUTPUTS:
+   out         Dictionary of corrected victim images keyed by extension.
+   error       The error message if one occurred.
+
+ ccdproc_xtalkfile(file,xmat)
+  Reads the extensions of FILE in xmat['extens'] and returns
+  ccdproc_xtalkcube(cube,xmat).
+
+ USAGE:
+  xmat, error = ccdproc_xtalkmatrix(xstr)
+  xcor, error = ccdproc_xtalkfile(file,xmat)
+  im = xcor[5]
+
+-
+"""
+
+import numpy as np
+
+from fitsindex import fitsindex
+
+
+def ccdproc_xtalkmatrix(xstr, silent=True):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'CCDPROC_XTALKMATRIX: '   # error message prefix
+
+    try:
+        # Structure or list of tuples
+        if hasattr(xstr, 'dtype') and xstr.dtype.names is not None:
+            names = [n.lower() for n in xstr.dtype.names]
+            if 'victim' not in names or 'source' not in names or 'scale' not in names:
+                error = errprefix+'Cross-talk structure must have VICTIM, SOURCE and SCALE tags'
+                if not silent: print(error)
+                return None, error
+            fields = dict((n.lower(),n) for n in xstr.dtype.names)
+            victim = np.asarray(xstr[fields['victim']], dtype=int)
+            source = np.asarray(xstr[fields['source']], dtype=int)
+            scale = np.asarray(xstr[fields['scale']], dtype=float)
+        else:
+            arr = list(xstr)
+            victim = np.array([a[0] for a in arr], dtype=int)
+            source = np.array([a[1] for a in arr], dtype=int)
+            scale = np.array([a[2] for a in arr], dtype=float)
+
+        if len(victim)==0:
+            error = errprefix+'No cross-talk entries'
+            if not silent: print(error)
+            return None, error
+        if np.any(victim==source):
+            error = errprefix+'An extension cannot be its own cross-talk source'
+            if not silent: print(error)
+            return None, error
+
+        # CSR rows, one per victim
+        victims = np.unique(victim)
+        indptr = [0]
+        src = []
+        scl = []
+        text = {}
+        for v in victims:
+            ind = np.where(victim==v)[0]
+            src.extend(source[ind])
+            scl.extend(scale[ind])
+            indptr.append(len(src))
+            text[int(v)] = '+'.join(['im'+str(source[k])+'*'+('%.3G' % scale[k])
+                                     for k in ind])
+        extens = sorted(set(victims.tolist()) | set(source.tolist()))
+
+        xmat = {'victims':[int(v) for v in victims], 'extens':extens,
+                'indptr':np.array(indptr), 'source':np.array(src,dtype=int),
+                'scale':np.array(scl), 'text':text}
+
+    except Exception as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return None, error
+
+    return xmat, error
+
+
+def ccdproc_xtalkcube(cube, xmat, dtype='float32', silent=True):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'CCDPROC_XTALKCUBE: '   # error message prefix
+
+    try:
+        extens = xmat['extens']
+        if len(cube)!=len(extens):
+            error = errprefix+'Cube must have '+str(len(extens))+' images'
+            if not silent: print(error)
+            return None, error
+        pos = dict((e,k) for k,e in enumerate(extens))
+        shape = np.shape(cube[0])
+        for im in cube:
+            if np.shape(im)!=shape:
+                error = errprefix+'Source image not same size as victim image.'
+                if not silent: print(error)
+                return None, error
+
+        # One pass over the victims, sources are read from the
+        # original cube so the order of the victims does not matter
+        out = {}
+        acc = np.empty(shape, dtype=dtype)
+        tmp = np.empty(shape, dtype=dtype)
+        for k,v in enumerate(xmat['victims']):
+            lo, hi = xmat['indptr'][k], xmat['indptr'][k+1]
+            acc[...] = 0
+            for s,scale in zip(xmat['source'][lo:hi], xmat['scale'][lo:hi]):
+                np.multiply(cube[pos[s]], scale, out=tmp)
+                acc += tmp
+            vim = np.array(cube[pos[v]], dtype=dtype)
+            vim -= acc
+            np.round(vim, out=vim)   # round the final image
+            out[v] = vim
+
+    except Exception as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return None, error
+
+    return out, error
+
+
+def ccdproc_xtalkfile(file, xmat, dtype='float32', silent=True):
+
+    # Initalizing some variables
+    errprefix = 'CCDPROC_XTALKFILE: '   # error message prefix
+
+    fits, error = fitsindex(file)
+    if error!='':
+        if not silent: print(error)
+        return None, error
+    if max(xmat['extens'])>fits.nextend:
+        error = errprefix+file+' does not have extension '+str(max(xmat['extens']))
+        if not silent: print(error)
+        return None, error
+
+    # Read each extension once into the cube
+    cube = np.stack([fits.data(e) for e in xmat['extens']])
+
+    return ccdproc_xtalkcube(cube, xmat, dtype=dtype, silent=silent)
@@ -0,0 +1,683 @@
+"""
++
+
+ FITSCOMP
+
+ Tile-compressed FITS images (the fpack/funpack convention).  The
+ image is split into tiles (one row each by default) that are
+ compressed separately and stored in the heap of a binary table with
+ ZIMAGE=T.  This reads and writes the RICE_1, GZIP_1, GZIP_2 and
+ NOCOMPRESS compression types.  Floating point images are quantized
+ to integers first (ZQUANTIZ = NO_DITHER, SUBTRACTIVE_DITHER_1 or
+ SUBTRACTIVE_DITHER_2), with the quantization step set to the tile's
+ noise divided by the quantization level (ZVAL NOISEBIT).
+
+ fitsindex uses this to read compressed HDUs directly, fitswrite to
+ write them.  The tiles are compressed and decompressed on a thread
+ pool: gzip (zlib) runs in parallel, Rice tiles are decoded with
+ numpy across all tiles of a batch at once.
+
+ fitstiledata(head,buf,offset)
+  INPUTS:
+   head         The header cards of the compressed (BINTABLE) HDU.
+   buf          The buffer (memory map) with the file.
+   offset       The byte offset of the HDU's data in BUF.
+   =threads     The number of threads.  Default is 0, one per CPU.
+  OUTPUTS:
+   im           The image, with the ZBITPIX type (BZERO/BSCALE of
+                  integer images are not applied).
+
+ fitsimagehead(head)
+  The image header of a compressed HDU (ZBITPIX, ZNAXISn, ... become
+  BITPIX, NAXISn, ... and the table keywords are removed).
+
+ fitscompress(im,head)
+  INPUTS:
+   im           The image.
+   head         The image header cards, the non-structural ones are
+                  copied.
+   =cmptype     RICE_1 (default), GZIP_1, GZIP_2 or NOCOMPRESS.
+   =quantize    The quantization level for floating point images.
+                  The step is the noise/QUANTIZE, a negative value is
+                  used as the step itself.  0 means lossless (not
+                  possible with RICE_1).  Default is 4.
+   =dither      NO_DITHER, SUBTRACTIVE_DITHER_1 (default) or
+                  SUBTRACTIVE_DITHER_2 (exact zeros).
+   =zdither0    The dither seed (1-10000).  Default is from the data.
+   =threads     The number of threads.  Default is 0, one per CPU.
+   =intscale    (BSCALE, BZERO, BLANK) of a scaled integer image, BLANK
+                  can be None.
+  OUTPUTS:
+   cards        The header cards of the compressed HDU.
+   payload      The table and heap bytes (not padded).
+
+ USAGE:
+  cards, payload = fitscompress(im,head,cmptype='RICE_1',quantize=8)
+
+-
+"""
+
+import os
+import re
+import zlib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from fitsindex import BITPIX2DTYPE, fitskey, fitscard
+
+# Rice parameters per BYTEPIX: (FSBITS, FSMAX, BBITS)
+RICEPARS = {1:(3,6,8), 2:(4,14,16), 4:(5,25,32)}
+
+# Quantization
+N_RANDOM = 10000
+NULL_VALUE = -2147483647
+ZERO_VALUE = -2147483646
+DITHERS = ('NO_DITHER','SUBTRACTIVE_DITHER_1','SUBTRACTIVE_DITHER_2')
+CMPTYPES = ('RICE_1','GZIP_1','GZIP_2','NOCOMPRESS')
+
+# Binary table column sizes
+TFORMSIZE = {'L':1, 'B':1, 'I':2, 'J':4, 'K':8, 'A':1, 'E':4, 'D':8, 'C':8,
+             'M':16, 'P':8, 'Q':16}
+
+# Keywords of the compressed HDU that are not part of the image header
+_TABLEKEYS = set(['XTENSION','BITPIX','NAXIS','PCOUNT','GCOUNT','TFIELDS','THEAP',
+                  'ZIMAGE','ZCMPTYPE','ZQUANTIZ','ZDITHER0','ZMASKCMP','ZBLANK',
+                  'CHECKSUM','DATASUM','END'])
+_TABLEPATS = re.compile(r'^(NAXIS\d+|TTYPE\d+|TFORM\d+|TUNIT\d+|TDIM\d+|TNULL\d+|'
+                        r'TSCAL\d+|TZERO\d+|ZTILE\d+|ZNAME\d+|ZVAL\d+)$')
+_ZMAP = [('ZSIMPLE','SIMPLE'), ('ZTENSION','XTENSION'), ('ZBITPIX','BITPIX'),
+         ('ZNAXIS','NAXIS'), ('ZPCOUNT','PCOUNT'), ('ZGCOUNT','GCOUNT'),
+         ('ZEXTEND','EXTEND'), ('ZHECKSUM','CHECKSUM'), ('ZDATASUM','DATASUM')]
+
+
+def _nthreads(threads):
+    return threads if threads>0 else (os.cpu_count() or 1)
+
+
+@lru_cache(maxsize=1)
+def _randoms():
+    # The standard sequence of random numbers for dithering
+    a, m, seed = 16807.0, 2147483647.0, 1.0
+    rnd = np.empty(N_RANDOM)
+    for i in range(N_RANDOM):
+        temp = a*seed
+        seed = temp-m*int(temp/m)
+        rnd[i] = seed/m
+    # Single precision like the reference implementation
+    return rnd.astype(np.float32).astype(np.float64)
+
+
+def _dither(itile, zdither0, npix):
+    # The dither offsets of the pixels of tile ITILE (0-based)
+    rnd = _randoms()
+    iseed = (itile+zdither0-1) % N_RANDOM
+    out = np.empty(npix)
+    k = 0
+    while k<npix:
+        nextrand = int(rnd[iseed]*500)
+        n = min(npix-k, N_RANDOM-nextrand)
+        out[k:k+n] = rnd[nextrand:nextrand+n]
+        k += n
+        iseed = (iseed+1) % N_RANDOM
+    return out
+
+
+def _bitlen(x):
+    # Number of bits of nonnegative integers below 2**53
+    return np.frexp(np.asarray(x, dtype=np.float64))[1].astype(np.int64)
+
+
+#----------
+#  Rice
+#----------
+
+def _slowcode(buf, p, fs):
+    # Decode one unary+FS code at bit P the slow way, returns (diff, nbits)
+    byte, bit = p >> 3, p & 7
+    b = int(buf[byte]) & (0xFF >> bit)
+    if b!=0:
+        nz = (8-int(b).bit_length())-bit
+    else:
+        q = byte+1
+        while True:
+            nzi = np.flatnonzero(buf[q:q+256])
+            if len(nzi)>0: break
+            q += 256
+        first = q+int(nzi[0])
+        nz = (8-bit)+(first-byte-1)*8+(8-int(buf[first]).bit_length())
+    x = p+nz+1
+    low = 0
+    if fs>0:
+        word = int.from_bytes(bytes(buf[(x >> 3):(x >> 3)+8]), 'big')
+        low = ((word << (x & 7)) & 0xFFFFFFFFFFFFFFFF) >> (64-fs)
+    return (nz << fs) | low, nz+1+fs
+
+
+def _ricedecode(buf, starts, npix, bytepix, blocksize=32):
+    # Decode NTILE Rice tiles of NPIX pixels each that start at the
+    # byte offsets STARTS of BUF, all tiles are done together
+    fsbits, fsmax, bbits = RICEPARS[bytepix]
+    ntile = len(starts)
+    buf = np.concatenate([np.asarray(buf, dtype=np.uint8), np.zeros(16, np.uint8)])
+    win = as_strided(buf, shape=(len(buf)-7, 8), strides=(1, 1))
+    one, u63 = np.uint64(1), np.uint64(63)
+
+    def window(pos):
+        # The 64 bits at the bit positions POS
+        w = win[pos >> 3].copy().view('>u8').ravel().astype(np.uint64)
+        return w << (pos & 7).astype(np.uint64)
+
+    def top(w, n):
+        # The top N bits of the windows, N can be 0
+        return (w >> one) >> (u63-np.asarray(n, dtype=np.uint64))
+
+    mask = np.int64((1 << bbits)-1)
+    out = np.empty((ntile, npix), dtype=np.int64)
+    pos = np.asarray(starts, dtype=np.int64)*8
+    last = top(window(pos), bbits).astype(np.int64)
+    pos += bbits
+    for b0 in range(0, npix, blocksize):
+        fs = top(window(pos), fsbits).astype(np.int64)-1
+        pos += fsbits
+        low = fs<0
+        high = fs==fsmax
+        normal = ~low & ~high
+        fsn = np.where(normal, fs, 0)
+        fsu = fsn.astype(np.uint64)
+        for k in range(b0, min(b0+blocksize, npix)):
+            w = window(pos)
+            # Unary zeros, a one, then FS bits
+            hi = w >> np.uint64(32)
+            nz = 32-_bitlen(hi)
+            slow = normal & ((hi==0) | (nz+1+fsn>57))
+            lowbits = top(w << (np.minimum(nz, 32)+1).astype(np.uint64), fsu).astype(np.int64)
+            diff = np.where(normal, (np.minimum(nz, 32) << fsn) | lowbits,
+                            np.where(high, top(w, bbits).astype(np.int64), 0))
+            adv = np.where(normal, nz+1+fsn, np.where(high, bbits, 0))
+            for t in np.flatnonzero(slow):
+                diff[t], adv[t] = _slowcode(buf, int(pos[t]), int(fsn[t]))
+            pos += adv
+            # Undo the mapping to nonnegative differences
+            d = np.where(diff & 1, ~(diff >> 1), diff >> 1)
+            last = (last+d) & mask
+            out[:,k] = last
+    # Signed values, bytes are unsigned
+    if bytepix>1:
+        out -= (out >> (bbits-1)) << bbits
+    return out
+
+
+def _riceencode(vals, bytepix, blocksize=32):
+    # Encode the rows of VALS (NTILE x NPIX integers) as Rice tiles,
+    # returns the list of tile bytes
+    fsbits, fsmax, bbits = RICEPARS[bytepix]
+    ntile, npix = vals.shape
+    mask = (1 << bbits)-1
+    v = vals.astype(np.int64) & mask
+    # Differences wrapped to BBITS and mapped to nonnegative values
+    pdiff = np.empty_like(v)
+    pdiff[:,0] = 0
+    pdiff[:,1:] = (v[:,1:]-v[:,:-1]) & mask
+    pdiff -= (pdiff >> (bbits-1)) << bbits
+    m = np.where(pdiff<0, ~(pdiff << 1), pdiff << 1)
+
+    # FS of each block
+    nblk = (npix+blocksize-1)//blocksize
+    mb = np.zeros((ntile, nblk*blocksize), dtype=np.int64)
+    mb[:,0:npix] = m
+    mb = mb.reshape(ntile, nblk, blocksize)
+    thisblock = np.full(nblk, blocksize, dtype=np.int64)
+    thisblock[-1] = npix-(nblk-1)*blocksize
+    pixelsum = mb.sum(axis=2)
+    dpsum = np.maximum((pixelsum-thisblock//2-1)/thisblock.astype(np.float64), 0.0)
+    fs = _bitlen(dpsum.astype(np.int64) >> 1)
+    high = fs>=fsmax
+    low = (fs==0) & (pixelsum==0)
+    normal = ~high & ~low
+    code = np.where(high, fsmax+1, np.where(low, 0, fs+1))
+    fsp = np.where(normal, fs, 0)[:,:,np.newaxis]
+
+    # Bit lengths of the block codes and the pixels
+    valid = (np.arange(nblk*blocksize) < npix).reshape(nblk, blocksize)
+    top = mb >> fsp
+    plen = np.where(normal[:,:,np.newaxis], top+1+fsp,
+                    np.where(high[:,:,np.newaxis], bbits, 0))*valid
+    lens = np.empty((ntile, 1+nblk*(1+blocksize)), dtype=np.int64)
+    lens[:,0] = bbits
+    lb = lens[:,1:].reshape(ntile, nblk, 1+blocksize)
+    lb[:,:,0] = fsbits
+    lb[:,:,1:] = plen
+    ends = np.cumsum(lens, axis=1)
+    starts = ends-lens
+    nbytes = (ends[:,-1]+7)//8
+    tstart = np.concatenate([[0], np.cumsum(nbytes)[:-1]])*8
+    starts += tstart[:,np.newaxis]
+    sb = starts[:,1:].reshape(ntile, nblk, 1+blocksize)
+
+    # Fixed width fields: first pixel, block codes, raw (high entropy)
+    # pixels and the low FS bits of the normal pixels
+    isnorm = np.broadcast_to(normal[:,:,np.newaxis], mb.shape) & valid
+    ishigh = np.broadcast_to(high[:,:,np.newaxis], mb.shape) & valid
+    fsfull = np.broadcast_to(fsp, mb.shape)
+    fstart = np.concatenate([starts[:,0], sb[:,:,0].ravel(), sb[:,:,1:][ishigh],
+                             (sb[:,:,1:]+top+1)[isnorm]])
+    fwidth = np.concatenate([np.full(ntile, bbits), np.full(ntile*nblk, fsbits),
+                             np.full(int(ishigh.sum()), bbits), fsfull[isnorm]])
+    fvalue = np.concatenate([v[:,0], code.ravel(), mb[ishigh],
+                             (mb & ((1 << fsfull)-1))[isnorm]])
+    bits = np.zeros(int(nbytes.sum())*8, dtype=np.uint8)
+    for k in range(int(fwidth.max())):
+        sel = fwidth>k
+        bits[fstart[sel]+k] = (fvalue[sel] >> (fwidth[sel]-1-k)) & 1
+    # The ones that end the unary codes
+    bits[(sb[:,:,1:]+top)[isnorm]] = 1
+
+    packed = np.packbits(bits).tobytes()
+    offs = np.concatenate([[0], np.cumsum(nbytes)])
+    return [packed[offs[i]:offs[i+1]] for i in range(ntile)]
+
+
+#----------
+#  Gzip
+#----------
+
+def _shuffle(raw, elsize):
+    # GZIP_2 byte shuffling: all first bytes, then all second bytes, ...
+    return np.frombuffer(raw, dtype=np.uint8).reshape(-1, elsize).T.tobytes()
+
+
+def _unshuffle(raw, elsize):
+    return np.frombuffer(raw, dtype=np.uint8).reshape(elsize, -1).T.tobytes()
+
+
+def _gzip(raw):
+    c = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return c.compress(raw)+c.flush()
+
+
+#--------------------------------
+#  Tile geometry and the table
+#--------------------------------
+
+def _tiles(dims, tile):
+    # (y0, y1, x0, x1) of every tile, in storage order
+    nx, ny = dims[0], (dims[1] if len(dims)>1 else 1)
+    t1, t2 = tile[0], (tile[1] if len(tile)>1 else 1)
+    out = []
+    for y0 in range(0, ny, t2):
+        for x0 in range(0, nx, t1):
+            out.append((y0, min(y0+t2, ny), x0, min(x0+t1, nx)))
+    return out
+
+
+def _columns(head):
+    # Offsets and types of the table columns
+    cols = {}
+    off = 0
+    for i in range(1, fitskey(head, 'TFIELDS', 0)+1):
+        name = str(fitskey(head, 'TTYPE'+str(i), '')).strip().upper()
+        form = str(fitskey(head, 'TFORM'+str(i), '')).strip().upper()
+        m = re.match(r'^(\d*)([LXBIJKAEDCMPQ])([LXBIJKAEDCMPQ]?)', form)
+        if m is None: raise IOError('Bad TFORM'+str(i)+' '+form)
+        rep = int(m.group(1) or 1)
+        code = m.group(2)
+        size = (rep+7)//8 if code=='X' else TFORMSIZE[code]*rep
+        cols[name] = (off, code, m.group(3), rep)
+        off += size
+    return cols, off
+
+
+def _column(table, cols, name):
+    # Values of a column, descriptors are (count, offset) pairs
+    if name not in cols: return None
+    off, code, elcode, rep = cols[name]
+    if code in ('P','Q'):
+        n = 8 if code=='P' else 16
+        t = '>i4' if code=='P' else '>i8'
+        return np.ascontiguousarray(table[:,off:off+n]).view(t).reshape(-1, 2).astype(np.int64)
+    t = {'D':'>f8', 'E':'>f4', 'J':'>i4', 'K':'>i8', 'I':'>i2', 'B':'u1'}[code]
+    n = TFORMSIZE[code]
+    return np.ascontiguousarray(table[:,off:off+n]).view(t).ravel()
+
+
+def _zvals(head):
+    # ZNAMEi/ZVALi parameters
+    out = {}
+    i = 1
+    while True:
+        name = fitskey(head, 'ZNAME'+str(i))
+        if name is None: break
+        out[str(name).strip().upper()] = fitskey(head, 'ZVAL'+str(i))
+        i += 1
+    return out
+
+
+def fitsimagehead(head):
+    # The image header of a compressed HDU
+    zkeys = dict(_ZMAP)
+    out = {}
+    rest = []
+    for card in head:
+        name = card[0:8].rstrip()
+        if name=='END': break
+        if name in zkeys or (name.startswith('ZNAXIS') and name[6:].isdigit()):
+            out[zkeys.get(name, name[1:])] = card
+            continue
+        if name in _TABLEKEYS or _TABLEPATS.match(name): continue
+        if name=='EXTNAME' and str(fitskey([card], 'EXTNAME')).strip()=='COMPRESSED_IMAGE':
+            continue
+        rest.append(card)
+    cards = []
+    if 'SIMPLE' in out:
+        cards.append(fitscard('SIMPLE', True, 'file does conform to FITS standard'))
+    else:
+        cards.append(fitscard('XTENSION', 'IMAGE', 'Image extension'))
+    for key in ['BITPIX','NAXIS']+['NAXIS'+str(i+1) for i in range(fitskey(head, 'ZNAXIS', 0))]:
+        cards.append(('%-8s' % key)+out[key][8:])
+    if 'SIMPLE' in out:
+        if 'EXTEND' in out: cards.append('EXTEND  '+out['EXTEND'][8:])
+    else:
+        cards.append(fitscard('PCOUNT', fitskey(head, 'ZPCOUNT', 0)))
+        cards.append(fitscard('GCOUNT', fitskey(head, 'ZGCOUNT', 1)))
+    for key in ('CHECKSUM','DATASUM'):
+        if key in out: cards.append(('%-8s' % key)+out[key][8:])
+    cards.extend(rest)
+    cards.append('%-80s' % 'END')
+    return cards
+
+
+def fitstiledata(head, buf, offset, threads=0):
+    # Decompress the image of a tile-compressed HDU
+    cmptype = str(fitskey(head, 'ZCMPTYPE', '')).strip().upper()
+    if cmptype not in CMPTYPES:
+        raise IOError('Compression type '+cmptype+' is not supported')
+    zbitpix = fitskey(head, 'ZBITPIX')
+    znaxis = fitskey(head, 'ZNAXIS', 0)
+    if znaxis<1 or znaxis>2:
+        raise IOError('Only 1D and 2D compressed images are supported')
+    dims = [fitskey(head, 'ZNAXIS'+str(i+1)) for i in range(znaxis)]
+    tile = [fitskey(head, 'ZTILE1', dims[0])]+[fitskey(head, 'ZTILE2', 1)]*(znaxis-1)
+    zvals = _zvals(head)
+    nrows = fitskey(head, 'NAXIS2')
+    rowlen = fitskey(head, 'NAXIS1')
+    heap = offset+fitskey(head, 'THEAP', nrows*rowlen)
+    cols, _ = _columns(head)
+    table = np.frombuffer(buf, dtype=np.uint8, count=nrows*rowlen, offset=offset).reshape(nrows, rowlen)
+    cdata = _column(table, cols, 'COMPRESSED_DATA')
+    gdata = _column(table, cols, 'GZIP_COMPRESSED_DATA')
+    udata = _column(table, cols, 'UNCOMPRESSED_DATA')
+    zscale = _column(table, cols, 'ZSCALE')
+    zzero = _column(table, cols, 'ZZERO')
+    zblank = _column(table, cols, 'ZBLANK')
+    if zscale is None and fitskey(head, 'ZSCALE') is not None:
+        zscale = np.full(nrows, float(fitskey(head, 'ZSCALE')))
+        zzero = np.full(nrows, float(fitskey(head, 'ZZERO', 0.0)))
+    if zblank is None and fitskey(head, 'ZBLANK') is not None:
+        zblank = np.full(nrows, int(fitskey(head, 'ZBLANK')))
+    quantized = zscale is not None
+    dither = str(fitskey(head, 'ZQUANTIZ', 'NO_DITHER')).strip().upper()
+    zdither0 = fitskey(head, 'ZDITHER0', 1)
+
+    tiles = _tiles(dims, tile)
+    if len(tiles)!=nrows:
+        raise IOError('Number of tiles does not match the table')
+    ny = dims[1] if znaxis>1 else 1
+    outtype = np.dtype({8:'u1', 16:'i2', 32:'i4', 64:'i8', -32:'f4', -64:'f8'}[zbitpix])
+    out = np.empty((ny, dims[0]), dtype=outtype)
+    # The tile values type in the table
+    rawtype = np.dtype('>i4') if quantized else np.dtype(BITPIX2DTYPE[zbitpix])
+    bytepix = zvals.get('BYTEPIX', 4 if quantized else abs(zbitpix)//8)
+    blocksize = zvals.get('BLOCKSIZE', 32)
+    nthreads = _nthreads(threads)
+
+    def store(k, vals):
+        # Put the values of tile K into the image
+        y0, y1, x0, x1 = tiles[k]
+        vals = vals.reshape(y1-y0, x1-x0)
+        if quantized and np.dtype(vals.dtype).kind in 'iu':
+            vals = _dequantize(vals.astype(np.int64), k, zscale[k], zzero[k],
+                               None if zblank is None else zblank[k], dither, zdither0)
+        out[y0:y1,x0:x1] = vals
+
+    def rawtile(k):
+        # Tiles that are gzipped or stored raw
+        if gdata is not None and gdata[k,0]>0:
+            raw = zlib.decompress(bytes(buf[heap+gdata[k,1]:heap+gdata[k,1]+gdata[k,0]]), 47)
+            return np.frombuffer(raw, dtype=BITPIX2DTYPE[zbitpix]).astype(outtype)
+        if udata is not None and udata[k,0]>0:
+            t = np.dtype(BITPIX2DTYPE[zbitpix])
+            return np.frombuffer(bytes(buf[heap+udata[k,1]:heap+udata[k,1]+udata[k,0]*t.itemsize]),
+                                 dtype=t).astype(outtype)
+        return None
+
+    def gziptile(k):
+        vals = rawtile(k)
+        if vals is None:
+            raw = bytes(buf[heap+cdata[k,1]:heap+cdata[k,1]+cdata[k,0]])
+            if cmptype!='NOCOMPRESS': raw = zlib.decompress(raw, 47)
+            if cmptype=='GZIP_2': raw = _unshuffle(raw, rawtype.itemsize)
+            vals = np.frombuffer(raw, dtype=rawtype)
+        store(k, vals)
+
+    if cmptype!='RICE_1':
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            list(pool.map(gziptile, range(nrows)))
+        return out if znaxis>1 else out[0]
+
+    # Rice, tiles of the same size are decoded together
+    heapbuf = np.frombuffer(buf, dtype=np.uint8)
+    groups = {}
+    for k in range(nrows):
+        if cdata[k,0]==0:
+            vals = rawtile(k)
+            if vals is None: raise IOError('Tile '+str(k)+' has no data')
+            store(k, vals)
+            continue
+        y0, y1, x0, x1 = tiles[k]
+        groups.setdefault((y1-y0)*(x1-x0), []).append(k)
+
+    def ricebatch(args):
+        npix, ks = args
+        vals = _ricedecode(heapbuf, heap+cdata[ks,1], npix, bytepix, blocksize)
+        for k,v in zip(ks, vals): store(k, v)
+
+    batches = []
+    for npix,ks in groups.items():
+        ks = np.array(ks)
+        for part in np.array_split(ks, min(nthreads, len(ks))):
+            batches.append((npix, part))
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        list(pool.map(ricebatch, batches))
+    return out if znaxis>1 else out[0]
+
+
+#------------------
+#  Quantization
+#------------------
+
+def _dequantize(ivals, itile, scale, zero, blank, dither, zdither0):
+    # Quantized integers of one tile back to floats
+    if dither.startswith('SUBTRACTIVE_DITHER'):
+        shape = ivals.shape
+        r = _dither(itile, zdither0, ivals.size).reshape(shape)
+        out = (ivals-r+0.5)*scale+zero
+        if dither=='SUBTRACTIVE_DITHER_2': out[ivals==ZERO_VALUE] = 0.0
+    else:
+        out = ivals*scale+zero
+    if blank is not None: out[ivals==blank] = np.nan
+    return out
+
+
+def _noise(vals):
+    # Noise of the rows of VALS from the median of the third order
+    # differences (the 'noise3' estimate)
+    if vals.shape[1]<5: return np.zeros(vals.shape[0])
+    d = np.abs(2*vals[:,2:-2]-vals[:,:-4]-vals[:,4:])
+    with np.errstate(all='ignore'):
+        noise = 0.6052697*np.nanmedian(d, axis=1)
+    return np.nan_to_num(noise)
+
+
+def _quantize(vals, itiles, quantize, dither, zdither0):
+    # Quantize the tile rows VALS, returns the integers, scales and zeros
+    vals = vals.astype(np.float64)
+    bad = ~np.isfinite(vals)
+    with np.errstate(all='ignore'):
+        vmin = np.nan_to_num(np.nanmin(np.where(bad, np.nan, vals), axis=1))
+        vmax = np.nan_to_num(np.nanmax(np.where(bad, np.nan, vals), axis=1))
+    if quantize>0:
+        scale = _noise(np.where(bad, np.nan, vals))/quantize
+    else:
+        scale = np.full(len(vals), -float(quantize))
+    # Noiseless tiles, a step below the float precision
+    flat = scale<=0
+    scale[flat] = np.maximum(np.maximum(np.abs(vmin[flat]), np.abs(vmax[flat]))*2.0**-26, 1e-30)
+    # The integers must stay clear of the null values
+    scale = np.maximum(scale, (vmax-vmin)/(2.0**31-10))
+    zero = vmin
+    x = (vals-zero[:,np.newaxis])/scale[:,np.newaxis]
+    if dither.startswith('SUBTRACTIVE_DITHER'):
+        r = np.vstack([_dither(int(t), zdither0, vals.shape[1]) for t in itiles])
+        x += r-0.5
+    ivals = np.round(np.where(bad, 0, x)).astype(np.int64)
+    if dither=='SUBTRACTIVE_DITHER_2': ivals[vals==0.0] = ZERO_VALUE
+    ivals[bad] = NULL_VALUE
+    return ivals, scale, zero
+
+
+def fitscompress(im, head=None, cmptype='RICE_1', quantize=4.0,
+                 dither='SUBTRACTIVE_DITHER_1', zdither0=None, threads=0, intscale=None):
+    # Compress an image into a tile-compressed HDU, one tile per row
+    cmptype = cmptype.upper()
+    dither = dither.upper()
+    if cmptype not in CMPTYPES:
+        raise ValueError('CMPTYPE must be one of '+', '.join(CMPTYPES))
+    if dither not in DITHERS:
+        raise ValueError('DITHER must be one of '+', '.join(DITHERS))
+    im = np.asarray(im)
+    if im.ndim==1: im = im.reshape(1, -1)
+    if im.ndim!=2: raise ValueError('Only 1D and 2D images can be compressed')
+    ny, nx = im.shape
+    nthreads = _nthreads(threads)
+
+    # Data type of the image and the tile values
+    unsigned = 0
+    kind, size = im.dtype.kind, im.dtype.itemsize
+    if kind=='f':
+        zbitpix = -8*size
+        quantized = quantize!=0
+        if not quantized and cmptype=='RICE_1':
+            raise ValueError('Floating point images must be quantized for RICE_1')
+    elif kind in 'iu':
+        zbitpix = 8*size
+        quantized = False
+        if kind=='u' and size>1: unsigned = 1 << (8*size-1)
+        if size==8 and cmptype=='RICE_1':
+            raise ValueError('64-bit integers cannot be compressed with RICE_1')
+    else:
+        raise ValueError('Cannot compress data of type '+str(im.dtype))
+    if zdither0 is None:
+        zdither0 = 1+zlib.crc32(np.ascontiguousarray(im[0]).tobytes()) % N_RANDOM
+
+    # Tile values
+    scale = zero = None
+    if quantized:
+        vals, scale, zero = _quantize(im, range(ny), quantize, dither, zdither0)
+        rawtype = np.dtype('>i4')
+        bytepix = 4
+    elif unsigned:
+        vals = im.astype(np.int64)-unsigned
+        rawtype = np.dtype(BITPIX2DTYPE[zbitpix])
+        bytepix = size
+    else:
+        vals = im
+        rawtype = np.dtype(BITPIX2DTYPE[zbitpix])
+        bytepix = size
+
+    # Compress the tiles
+    if cmptype=='RICE_1':
+        nbatch = max(1, min(nthreads, ny))
+        rows = np.array_split(np.arange(ny), nbatch)
+        # Bound the temporary memory of the encoder
+        rows = [r[i:i+max(1, 2**20//nx)] for r in rows for i in range(0, len(r), max(1, 2**20//nx))]
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            parts = pool.map(lambda r: _riceencode(np.asarray(vals[r[0]:r[-1]+1]), bytepix), rows)
+            blobs = [b for part in parts for b in part]
+    else:
+        def gziptile(y):
+            raw = np.ascontiguousarray(vals[y], dtype=rawtype).tobytes()
+            if cmptype=='GZIP_2': raw = _shuffle(raw, rawtype.itemsize)
+            return raw if cmptype=='NOCOMPRESS' else _gzip(raw)
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            blobs = list(pool.map(gziptile, range(ny)))
+
+    # The table: descriptors (and scale/zero) then the heap
+    heapsize = sum(len(b) for b in blobs)
+    pcode = 'P' if heapsize<2**31 else 'Q'
+    dtype = [('desc', '>i4' if pcode=='P' else '>i8', (2,))]
+    if quantized: dtype += [('zscale', '>f8'), ('zzero', '>f8')]
+    table = np.zeros(ny, dtype=dtype)
+    lens = np.array([len(b) for b in blobs], dtype=np.int64)
+    table['desc'][:,0] = lens
+    table['desc'][:,1] = np.concatenate([[0], np.cumsum(lens)[:-1]])
+    if quantized:
+        table['zscale'] = scale
+        table['zzero'] = zero
+    payload = table.tobytes()+b''.join(blobs)
+
+    # The header
+    cards = [fitscard('XTENSION', 'BINTABLE', 'binary table extension'),
+             fitscard('BITPIX', 8, 'array data type'),
+             fitscard('NAXIS', 2, 'number of array dimensions'),
+             fitscard('NAXIS1', table.dtype.itemsize, 'width of table in bytes'),
+             fitscard('NAXIS2', ny, 'number of rows in table'),
+             fitscard('PCOUNT', heapsize, 'number of group parameters'),
+             fitscard('GCOUNT', 1, 'number of groups'),
+             fitscard('TFIELDS', 3 if quantized else 1, 'number of fields in each row'),
+             fitscard('TTYPE1', 'COMPRESSED_DATA'),
+             fitscard('TFORM1', '1'+pcode+'B('+str(int(lens.max()) if len(lens)>0 else 0)+')')]
+    if quantized:
+        cards += [fitscard('TTYPE2', 'ZSCALE'), fitscard('TFORM2', '1D'),
+                  fitscard('TTYPE3', 'ZZERO'), fitscard('TFORM3', '1D')]
+    cards += [fitscard('ZIMAGE', True, 'extension contains compressed image'),
+              fitscard('ZTENSION', 'IMAGE', 'Image extension'),
+              fitscard('ZBITPIX', zbitpix, 'array data type'),
+              fitscard('ZNAXIS', 2, 'number of array dimensions'),
+              fitscard('ZNAXIS1', nx), fitscard('ZNAXIS2', ny),
+              fitscard('ZPCOUNT', 0, 'number of parameters'),
+              fitscard('ZGCOUNT', 1, 'number of groups'),
+              fitscard('ZTILE1', nx, 'size of tiles to be compressed'),
+              fitscard('ZTILE2', 1, 'size of tiles to be compressed'),
+              fitscard('ZCMPTYPE', cmptype, 'compression algorithm')]
+    zvals = []
+    if cmptype=='RICE_1':
+        zvals += [('BLOCKSIZE', 32, 'pixels per block'), ('BYTEPIX', bytepix, 'bytes per pixel')]
+    if quantized:
+        zvals += [('NOISEBIT', quantize, 'floating point quantization level')]
+    for i,(name,val,comment) in enumerate(zvals):
+        cards += [fitscard('ZNAME'+str(i+1), name), fitscard('ZVAL'+str(i+1), val, comment)]
+    if quantized:
+        cards.append(fitscard('ZQUANTIZ', dither, 'Pixel Quantization Algorithm'))
+        if dither!='NO_DITHER':
+            cards.append(fitscard('ZDITHER0', int(zdither0), 'dithering offset when quantizing floats'))
+        cards.append(fitscard('ZBLANK', NULL_VALUE, 'null value in the quantized data'))
+    if unsigned:
+        cards += [fitscard('BZERO', unsigned), fitscard('BSCALE', 1)]
+    elif intscale is not None:
+        # Scaled integers (BSCALE, BZERO, BLANK)
+        cards += [fitscard('BSCALE', intscale[0], 'data scaling factor'),
+                  fitscard('BZERO', intscale[1], 'data offset')]
+        if intscale[2] is not None: cards.append(fitscard('BLANK', intscale[2], 'undefined value'))
+    if head is not None:
+        for card in head:
+            name = card[0:8].rstrip()
+            if name=='END': break
+            if name in ('SIMPLE','XTENSION','BITPIX','NAXIS','EXTEND','PCOUNT','GCOUNT',
+                        'BZERO','BSCALE') or (name.startswith('NAXIS') and name[5:].isdigit()):
+                continue
+            cards.append(('%-80s' % card)[0:80])
+    cards.append('%-80s' % 'END')
+    return cards, payload
@@ -0,0 +1,497 @@
+"""
++
+
+ FITSINDEX
+
+ This is a memory-mapped FITS file reader.  The file is opened and
+ mapped once and its 2880-byte blocks are scanned once to build an
+ index of the header and data offsets of every HDU.  Headers are
+ served as string arrays (one 80-character card per element, like
+ headfits) and data as zero-copy arrays on the memory map.
+
+ Indexes of recently used files are kept open, so ccdproc_fileinfo,
+ ccdproc_checkfile and the processing steps share one open and one
+ header scan of a file.  A changed file (mtime/size) is rescanned.
+
+ INPUTS:
+  file         The name of the FITS file.
+
+ OUTPUTS:
+  fits         The FitsIndex object, or None if the file is not a
+                 valid FITS file.
+  error        The error message if one occurred.
+
+ FitsIndex:
+  .nextend     The number of extensions.
+  .hdu         List of dictionaries with HOFFSET, HSIZE, DOFFSET,
+                 DSIZE, BITPIX, NAXIS (list of NAXISn) and XTENSION.
+  .header(i)   The header of HDU i as a list of cards.
+  .data(i)     The data of HDU i.  This is a read-only view on the
+                 memory map unless BSCALE/BZERO have to be applied
+                 (scale=False returns the raw values).
+
+ Tile-compressed image HDUs (ZIMAGE=T binary tables, see fitscomp)
+ look like ordinary image HDUs: their BITPIX/NAXIS entries and the
+ header are those of the image (ZBITPIX, ZNAXISn, ...), ZIMAGE is
+ set in .hdu and .data(i,threads=) decompresses the tiles on a
+ thread pool.
+
+ fitskey(head,name) returns the value of a keyword in a header list
+ (None if it is missing), fitshaskey(head,name) says if it is there
+ and fitsaddpar(head,name,value) adds or replaces a keyword in place.
+
+ Headers are FitsHeader objects, card lists with a keyword index.
+ The index (keyword -> first card) is built on the first lookup and
+ values are parsed on first use and kept, so fitskey is O(1) per
+ keyword.  Updates (fitsaddpar, .set, .update) are batched and only
+ turned into cards when the header is used as a list (iterated,
+ indexed, written by fitsheader) or .flush() is called.  .header(i)
+ returns a copy that shares the index and parsed values of the HDU,
+ .header(i,shared=True) the HDU's own instance for read-only use,
+ e.g. by ccdproc_fileinfo, ccdproc_checkfile and the catalog.
+
+ FitsHeader:
+  .get(name,default=None)   The value of a keyword.
+  .has(name)                Is the keyword there?
+  .set(name,value,comment)  Add or replace a keyword (batched).
+  .update(cards)            Many (name,value[,comment]) at once.
+  .keys()                   The keywords, in header order.
+  .flush()                  Apply the batched updates to the cards.
+  .copy()                   A copy with the same index and values.
+
+ USAGE:
+  fits, error = fitsindex('image.fits')
+  head = fits.header(5)
+  im = fits.data(5)
+  fitsaddpar(head,'ZEROCOR','Zero is zero.fits')
+  naxis1 = fits.header(5,shared=True).get('NAXIS1')
+
+-
+"""
+
+import os
+import mmap
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+BLOCK = 2880
+CARD = 80
+
+# FITS BITPIX to numpy type
+BITPIX2DTYPE = {8:'u1', 16:'>i2', 32:'>i4', 64:'>i8', -32:'>f4', -64:'>f8'}
+
+
+def fitskey(head, name, default=None):
+    # Value of keyword NAME in a header list, the first one is used
+    if isinstance(head, FitsHeader): return head.get(name, default)
+    name = name.upper()
+    for card in head:
+        if card[0:8].rstrip()==name:
+            return fitsvalue(card)
+        if card[0:8]=='END     ': break
+    return default
+
+
+def fitshaskey(head, name):
+    # Is keyword NAME in a header list?
+    if isinstance(head, FitsHeader): return head.has(name)
+    name = name.upper()
+    for card in head:
+        if card[0:8]=='END     ': break
+        if card[0:8].rstrip()==name: return True
+    return False
+
+
+def fitsvalue(card):
+    # Parse the value of an 80-character card
+    if card[8:10]!='= ':
+        return card[8:].rstrip()
+    val = card[10:]
+    sval = val.lstrip()
+    # String, '' is an escaped quote
+    if sval[0:1]=="'":
+        out = ''
+        i = 1
+        while i<len(sval):
+            if sval[i]=="'":
+                if sval[i+1:i+2]=="'":
+                    out += "'"
+                    i += 2
+                    continue
+                break
+            out += sval[i]
+            i += 1
+        return out.rstrip()
+    sval = sval.split('/')[0].strip()
+    if sval=='': return None
+    if sval=='T': return True
+    if sval=='F': return False
+    try:
+        return int(sval)
+    except ValueError:
+        pass
+    try:
+        return float(sval.replace('D','E'))
+    except ValueError:
+        return sval
+
+
+def fitscard(name, value, comment=''):
+    # Format an 80-character card
+    name = name.upper()
+    if isinstance(value, bool):
+        val = '%20s' % ('T' if value else 'F')
+    elif isinstance(value, (int, np.integer)):
+        val = '%20d' % value
+    elif isinstance(value, (float, np.floating)):
+        val = repr(float(value)).upper()
+        if '.' not in val and 'E' not in val: val += '.'
+        val = '%20s' % val
+    else:
+        # The closing quote must fit in the card, long strings are cut
+        #  to 68 characters (without splitting a doubled quote)
+        sval = str(value).replace("'", "''")
+        if len(sval)>68:
+            sval = sval[0:68]
+            nquote = len(sval)-len(sval.rstrip("'"))
+            if nquote % 2==1: sval = sval[0:-1]
+        val = "'%-8s'" % sval
+    card = '%-8s= %s' % (name, val)
+    # Only as much of the comment as fits
+    if comment!='' and len(card)+4<=80: card += ' / '+comment
+    return ('%-80s' % card)[0:80]
+
+
+def fitsaddpar(head, name, value, comment=''):
+    # Add or replace a keyword in a header list, in place
+    if isinstance(head, FitsHeader):
+        head.set(name, value, comment)
+        return head
+    card = fitscard(name, value, comment)
+    name = name.upper()
+    for i,c in enumerate(head):
+        if c[0:8].rstrip()==name:
+            head[i] = card
+            return head
+    # Before END
+    for i,c in enumerate(head):
+        if c[0:8]=='END     ':
+            head.insert(i, card)
+            return head
+    head.append(card)
+    return head
+
+
+class FitsHeader(list):
+
+    def __init__(self, cards=()):
+        list.__init__(self, cards)
+        self._index = None             # keyword -> position of its first card
+        self._values = {}              # parsed values
+        self._pending = OrderedDict()  # batched updates, keyword -> card
+
+    def _changed(self):
+        # The cards were changed as a list, index again
+        self._index = None
+        self._values = {}
+
+    def _getindex(self):
+        # One pass over the cards, up to END
+        index = self._index
+        if index is None:
+            index = {}
+            for i,card in enumerate(list.__iter__(self)):
+                name = card[0:8].rstrip()
+                if name not in index: index[name] = i
+                if name=='END': break
+            self._index = index
+        return index
+
+    def get(self, name, default=None):
+        name = name.upper()
+        if name in self._values: return self._values[name]
+        card = self._pending.get(name)
+        if card is None:
+            i = self._getindex().get(name)
+            if i is None or name=='END': return default
+            card = list.__getitem__(self, i)
+        val = fitsvalue(card)
+        self._values[name] = val
+        return val
+
+    def has(self, name):
+        name = name.upper()
+        return name in self._pending or (name!='END' and name in self._getindex())
+
+    def set(self, name, value, comment=''):
+        name = name.upper()
+        self._pending[name] = fitscard(name, value, comment)
+        self._values.pop(name, None)
+
+    def update(self, cards):
+        for card in cards: self.set(*card)
+
+    def keys(self):
+        self.flush()
+        index = self._getindex()
+        return [k for k,i in sorted(index.items(), key=lambda k: k[1]) if k!='END']
+
+    def flush(self):
+        # Replace the cards in place, new ones go before END in one insert
+        if len(self._pending)==0: return self
+        index = self._getindex()
+        new = []
+        for name,card in self._pending.items():
+            i = index.get(name)
+            if i is not None and name!='END':
+                list.__setitem__(self, i, card)
+            else:
+                new.append((name, card))
+        self._pending = OrderedDict()
+        if len(new)>0:
+            pos = index.get('END', list.__len__(self))
+            list.__setitem__(self, slice(pos,pos), [c for n,c in new])
+            for k,(name,card) in enumerate(new): index[name] = pos+k
+            if 'END' in index: index['END'] = pos+len(new)
+        return self
+
+    def copy(self):
+        self.flush()
+        new = FitsHeader(list.__iter__(self))
+        if self._index is not None: new._index = dict(self._index)
+        new._values = dict(self._values)
+        return new
+
+    # List access sees the batched updates
+    def __iter__(self):
+        return list.__iter__(self.flush())
+
+    def __len__(self):
+        return list.__len__(self.flush())
+
+    def __getitem__(self, i):
+        return list.__getitem__(self.flush(), i)
+
+    def __reduce__(self):
+        return (FitsHeader, (list(list.__iter__(self.flush())),))
+
+    # Changes as a list
+    def __setitem__(self, i, card):
+        list.__setitem__(self.flush(), i, card)
+        self._changed()
+
+    def __delitem__(self, i):
+        list.__delitem__(self.flush(), i)
+        self._changed()
+
+    def __iadd__(self, cards):
+        list.extend(self.flush(), cards)
+        self._changed()
+        return self
+
+    def append(self, card):
+        list.append(self.flush(), card)
+        self._changed()
+
+    def extend(self, cards):
+        list.extend(self.flush(), cards)
+        self._changed()
+
+    def insert(self, i, card):
+        list.insert(self.flush(), i, card)
+        self._changed()
+
+    def pop(self, i=-1):
+        card = list.pop(self.flush(), i)
+        self._changed()
+        return card
+
+    def remove(self, card):
+        list.remove(self.flush(), card)
+        self._changed()
+
+
+class FitsIndex(object):
+
+    def __init__(self, file):
+        self.file = file
+        self.hdu = []
+        # Indexes are shared between threads, see header()
+        self._lock = threading.Lock()
+        self._fh = open(file, 'rb')
+        st = os.fstat(self._fh.fileno())
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        if self.size==0:
+            self._fh.close()
+            raise IOError(file+' is empty')
+        self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._scan()
+        except Exception:
+            self.close()
+            raise
+
+    def _scan(self):
+        # Walk the file once, HDU by HDU
+        mm = self._mm
+        off = 0
+        while off+BLOCK<=self.size:
+            # Junk after the last HDU is allowed
+            if len(self.hdu)>0 and mm[off:off+9]!=b'XTENSION=':
+                break
+            # Find the END card
+            hoff = off
+            end = -1
+            while end<0:
+                if off+BLOCK>self.size:
+                    raise IOError(self.file+' has a truncated header')
+                block = mm[off:off+BLOCK]
+                if len(self.hdu)==0 and off==0 and block[0:9]!=b'SIMPLE  =':
+                    raise IOError(self.file+' is not a FITS file')
+                for c in range(0, BLOCK, CARD):
+                    if block[c:c+8]==b'END     ':
+                        end = off+c
+                        break
+                off += BLOCK
+
+            head = FitsHeader(self._cards(hoff, end+CARD))
+            bitpix = fitskey(head, 'BITPIX')
+            naxis = fitskey(head, 'NAXIS', 0)
+            dims = [fitskey(head, 'NAXIS'+str(i+1), 0) for i in range(naxis)]
+            pcount = fitskey(head, 'PCOUNT', 0)
+            gcount = fitskey(head, 'GCOUNT', 1)
+            if bitpix not in BITPIX2DTYPE:
+                raise IOError(self.file+' has bad BITPIX in HDU '+str(len(self.hdu)))
+            npix = int(np.prod(dims)) if naxis>0 else 0
+            dsize = abs(bitpix)//8*gcount*(pcount+npix) if naxis>0 else 0
+            xtension = fitskey(head, 'XTENSION', '')
+            zimage = fitskey(head, 'ZIMAGE')==True
+            if zimage:
+                # Tile-compressed image, described by the image keywords
+                bitpix = fitskey(head, 'ZBITPIX')
+                dims = [fitskey(head, 'ZNAXIS'+str(i+1), 0) for i in range(fitskey(head, 'ZNAXIS', 0))]
+                xtension = 'IMAGE'
+            self.hdu.append({'hoffset':hoff, 'hsize':off-hoff, 'doffset':off,
+                             'dsize':dsize, 'bitpix':bitpix, 'naxis':dims,
+                             'xtension':xtension, 'zimage':zimage,
+                             'head':None, 'scanhead':head})
+            if off+dsize>self.size:
+                raise IOError(self.file+' is truncated')
+            off += (dsize+BLOCK-1)//BLOCK*BLOCK
+
+        if len(self.hdu)==0:
+            raise IOError(self.file+' is not a FITS file')
+
+    def _cards(self, start, stop):
+        # Split the header bytes into cards
+        raw = self._mm[start:stop].decode('ascii', 'replace')
+        return [raw[i:i+CARD] for i in range(0, len(raw), CARD)]
+
+    @property
+    def nextend(self):
+        return len(self.hdu)-1
+
+    def header(self, exten=0, shared=False):
+        # The header of an HDU, parsed once
+        #  SHARED returns the HDU's own instance, it must not be changed
+        hdu = self.hdu[exten]
+        if hdu['head'] is None:
+            with self._lock:
+                # Another thread may have parsed it in the meantime
+                if hdu['head'] is None:
+                    # The scan already split the cards up to END
+                    head = hdu['scanhead']
+                    if hdu['zimage']:
+                        from fitscomp import fitsimagehead
+                        hdu['tablehead'] = head
+                        head = FitsHeader(fitsimagehead(head))
+                    # Set last, data() needs TABLEHEAD once HEAD is set
+                    hdu['head'] = head
+                    del hdu['scanhead']
+        if shared: return hdu['head']
+        return hdu['head'].copy()
+
+    def data(self, exten=0, scale=True, threads=0):
+        # The data of an image HDU
+        hdu = self.hdu[exten]
+        if len(hdu['naxis'])==0: return None
+        if hdu['xtension'].strip() not in ('','IMAGE'):
+            raise IOError(self.file+' HDU '+str(exten)+' is not an image')
+        shape = tuple(reversed(hdu['naxis']))
+        if hdu['zimage']:
+            # Decompressed into a new (native byte order) array
+            from fitscomp import fitstiledata
+            self.header(exten, shared=True)
+            im = fitstiledata(hdu['tablehead'], self._mm, hdu['doffset'], threads=threads)
+            im = im.reshape(shape)
+        else:
+            im = np.ndarray(shape, dtype=BITPIX2DTYPE[hdu['bitpix']],
+                            buffer=self._mm, offset=hdu['doffset'])
+        if not scale: return im
+        head = self.header(exten, shared=True)
+        bscale = fitskey(head, 'BSCALE', 1)
+        bzero = fitskey(head, 'BZERO', 0)
+        if bscale==1 and bzero==0: return im
+        # Unsigned integers
+        if bscale==1 and hdu['bitpix']==16 and bzero==32768:
+            return (im.view(im.dtype.str.replace('i','u')) ^ np.uint16(0x8000)).astype(np.uint16)
+        if bscale==1 and hdu['bitpix']==32 and bzero==2147483648:
+            return (im.view(im.dtype.str.replace('i','u')) ^ np.uint32(0x80000000)).astype(np.uint32)
+        dtype = np.float64 if hdu['bitpix'] in (32,64,-64) else np.float32
+        out = im*dtype(bscale)+dtype(bzero)
+        # Undefined integers
+        blank = fitskey(head, 'BLANK')
+        if blank is not None and hdu['bitpix']>0:
+            out[im==blank] = np.nan
+        return out
+
+    def close(self):
+        try:
+            self._mm.close()
+        except (BufferError, AttributeError):
+            # Arrays still use the memory map, let them own it
+            pass
+        self._fh.close()
+
+
+# Recently used indexes
+_cache = OrderedDict()
+_cachelock = threading.Lock()
+_cachesize = 64
+
+
+def fitsindex(file, silent=True):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'FITSINDEX: '   # error message prefix
+
+    try:
+        st = os.stat(file)
+        key = os.path.abspath(file)
+        with _cachelock:
+            fits = _cache.get(key)
+            if fits is not None and fits.mtime==st.st_mtime and fits.size==st.st_size:
+                _cache.move_to_end(key)
+                return fits, error
+
+        # Open and scan the file
+        fits = FitsIndex(file)
+
+        with _cachelock:
+            old = _cache.pop(key, None)
+            if old is not None: old.close()
+            _cache[key] = fits
+            _cache.move_to_end(key)
+            while len(_cache)>_cachesize:
+                _cache.popitem(last=False)[1].close()
+
+    except (IOError, OSError, ValueError) as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return None, error
+
+    return fits, error
@@ -0,0 +1,453 @@
+"""
++
+
+ FITSWRITE
+
+ This writes a FITS file with a primary HDU and any number of image
+ extensions in one pass.  It is the counterpart of fitsindex and
+ uses the same header string arrays (one 80-character card per
+ element).  The structural keywords (SIMPLE, XTENSION, BITPIX, NAXIS,
+ EXTEND, PCOUNT, GCOUNT, BZERO, BSCALE) are generated from the data,
+ all other cards of the input headers are copied.  Unsigned 16 and
+ 32-bit data are written with the standard BZERO offset.
+
+ INPUTS:
+  file         The name of the output FITS file.
+  data         List of the data arrays of each HDU.  The first one is
+                 the primary HDU, use None for no primary data.
+  =heads       List of the header string arrays of each HDU.
+  =compress    Write the image extensions tile-compressed with this
+                 compression type (RICE_1, GZIP_1, GZIP_2, see fitscomp).
+                 The primary HDU is never compressed.  Default is no
+                 compression.
+  =quantize    The quantization level for compressed floating point
+                 images (noise/QUANTIZE is the step), 0 for lossless
+                 (GZIP only).  Default is 4.
+  =dither      The quantization dithering.  Default is
+                 SUBTRACTIVE_DITHER_1.
+  =threads     The number of compression threads.  Default is 0, one
+                 per CPU.
+  /silent      Don't print anything to the screen.
+
+ OUTPUTS:
+  error        The error message if one occurred.
+
+ fitsheader(im,head,primary) returns the header cards for one HDU.
+ An HDU can also be written in pieces (e.g. band by band) with
+ fitsstarthdu(fh,cards), fitswriterows(fh,rows) for each block of
+ rows and fitsendhdu(fh,nbytes).  fitsheader accepts a (shape,dtype)
+ tuple instead of the image for this.  fitsappend(file,im,head)
+ appends one image extension to an existing file.
+
+ FitsWriter(file) writes a whole file in one open: the HDUs go to a
+ temporary file next to FILE (preallocated to SIZE bytes if that is
+ given), .close() truncates it to the written size (.nbytes) and
+ .commit() renames it to FILE atomically.  OUTTYPE is the output policy for
+ float images: '' (as they are), 'float32', 'int16' (scaled with
+ BSCALE/BZERO from the range of each image, NaNs become BLANK) or
+ 'quantized' (RICE_1 tile compression of the quantized floats).
+ The FsyncPolicy says when the data is forced to disk: 'none' (left
+ to the OS), 'file' (every file before its rename) or 'batch:N'
+ (every N committed files, and at .flush()).  fitsscale16(im)
+ returns the int16 image, BSCALE, BZERO and BLANK.  fitsoutsize(hdus,
+ bitpix) is the size of a file with the HDUs of a fitsindex and
+ BITPIX data.
+
+ USAGE:
+  error = fitswrite('image.fits',[None,im1,im2],heads=[head0,head1,head2])
+  sync = FsyncPolicy('batch:64')
+  w = FitsWriter('image.fits',outtype='int16',sync=sync)
+  w.primary(head0,nextend=2)
+  w.append(im1,head1)
+  w.append(im2,head2)
+  w.close()
+  w.commit()
+
+-
+"""
+
+import os
+import threading
+
+import numpy as np
+
+from fitsindex import BLOCK, BITPIX2DTYPE, fitscard
+from fitscomp import fitscompress
+
+# numpy kind/size to BITPIX, BZERO
+DTYPE2BITPIX = {('u',1):(8,0), ('i',2):(16,0), ('u',2):(16,32768),
+                ('i',4):(32,0), ('u',4):(32,2147483648), ('i',8):(64,0),
+                ('f',4):(-32,0), ('f',8):(-64,0)}
+
+# Structural keywords that are generated from the data
+STRUCTKEYS = set(['SIMPLE','XTENSION','BITPIX','NAXIS','EXTEND','PCOUNT',
+                  'GCOUNT','BZERO','BSCALE','END'])
+
+
+def _isstruct(name):
+    return name in STRUCTKEYS or (name.startswith('NAXIS') and name[5:].isdigit())
+
+
+# Output policies for float images
+OUTTYPES = ('', 'float32', 'int16', 'quantized')
+
+
+def fitsheader(im, head=None, primary=True, nextend=0, intscale=None):
+    # The header cards for one HDU
+    #  INTSCALE is (BSCALE, BZERO, BLANK) of scaled integer data
+    if im is None:
+        bitpix, bzero, shape = 8, 0, ()
+    elif isinstance(im, tuple):
+        # (shape, dtype) of data that is written in pieces
+        shape, dtype = im[0], np.dtype(im[1])
+        bitpix, bzero = DTYPE2BITPIX[(dtype.kind, dtype.itemsize)]
+    else:
+        key = (im.dtype.kind, im.dtype.itemsize)
+        if key not in DTYPE2BITPIX:
+            raise ValueError('Cannot write data of type '+str(im.dtype))
+        (bitpix, bzero), shape = DTYPE2BITPIX[key], im.shape
+    if primary:
+        cards = [fitscard('SIMPLE', True, 'file does conform to FITS standard')]
+    else:
+        cards = [fitscard('XTENSION', 'IMAGE', 'Image extension')]
+    cards.append(fitscard('BITPIX', bitpix, 'number of bits per data pixel'))
+    cards.append(fitscard('NAXIS', len(shape), 'number of data axes'))
+    for i,n in enumerate(reversed(shape)):
+        cards.append(fitscard('NAXIS'+str(i+1), int(n), 'length of data axis '+str(i+1)))
+    if primary:
+        if nextend>0:
+            cards.append(fitscard('EXTEND', True, 'FITS dataset may contain extensions'))
+    else:
+        cards.append(fitscard('PCOUNT', 0, 'required keyword; must = 0'))
+        cards.append(fitscard('GCOUNT', 1, 'required keyword; must = 1'))
+    if bzero!=0:
+        cards.append(fitscard('BZERO', bzero, 'offset data range to that of unsigned'))
+        cards.append(fitscard('BSCALE', 1, 'default scaling factor'))
+    elif intscale is not None:
+        cards.append(fitscard('BSCALE', intscale[0], 'data scaling factor'))
+        cards.append(fitscard('BZERO', intscale[1], 'data offset'))
+        if intscale[2] is not None:
+            cards.append(fitscard('BLANK', intscale[2], 'undefined value'))
+    if head is not None:
+        # the batched updates of a FitsHeader are applied here
+        for card in head:
+            if card[0:8]=='END     ': break
+            if _isstruct(card[0:8].rstrip()) or card[0:8]=='BLANK   ': continue
+            cards.append(('%-80s' % card)[0:80])
+    cards.append('%-80s' % 'END')
+    return cards
+
+
+def fitsstarthdu(fh, cards):
+    # Write the header of an HDU, the data follows with fitswriterows
+    raw = ''.join(cards).encode('ascii', 'replace')
+    fh.write(raw)
+    fh.write(b' '*(-len(raw) % BLOCK))
+
+
+def fitswriterows(fh, blk, dtype=None):
+    # Write a block of rows of the data in the FITS byte order
+    #  DTYPE is the type of the whole image (default is the block's)
+    dtype = blk.dtype if dtype is None else np.dtype(dtype)
+    bitpix, bzero = DTYPE2BITPIX[(dtype.kind, dtype.itemsize)]
+    outtype = np.dtype(BITPIX2DTYPE[bitpix])
+    blk = np.asarray(blk, dtype=dtype)
+    # Unsigned integers, flip the sign bit (same as subtracting BZERO)
+    if bzero!=0:
+        blk = (blk ^ np.array(1 << (8*dtype.itemsize-1), dtype=dtype)).view(outtype.newbyteorder('='))
+    fh.write(blk.astype(outtype, copy=False).tobytes())
+    return blk.size*abs(bitpix)//8
+
+
+def fitsendhdu(fh, nbytes):
+    # Pad the data of an HDU with NBYTES to full blocks
+    fh.write(b'\0'*(-nbytes % BLOCK))
+
+
+def _writehdu(fh, im, cards, nblock=1024):
+    # Write the header and the data of one HDU, padded to full blocks
+    fitsstarthdu(fh, cards)
+    if im is None or im.size==0: return
+    # Converted block by block, no full-frame copy
+    arr = im.reshape(im.shape[0], -1) if im.ndim>1 else im.reshape(1, -1)
+    nbytes = 0
+    for r0 in range(0, arr.shape[0], nblock):
+        nbytes += fitswriterows(fh, arr[r0:r0+nblock])
+    fitsendhdu(fh, nbytes)
+
+
+def _writecomp(fh, im, head, compress, quantize, dither, threads, intscale=None):
+    # Write one tile-compressed image HDU
+    cards, payload = fitscompress(im, head, cmptype=compress, quantize=quantize,
+                                  dither=dither, threads=threads, intscale=intscale)
+    fitsstarthdu(fh, cards)
+    fh.write(payload)
+    fitsendhdu(fh, len(payload))
+
+
+def fitsappend(file, im, head=None, compress='', quantize=4.0,
+               dither='SUBTRACTIVE_DITHER_1', threads=0, silent=True):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'FITSAPPEND: '   # error message prefix
+
+    try:
+        im = np.asarray(im)
+        with open(file, 'ab') as fh:
+            if compress!='' and im.size>0:
+                _writecomp(fh, im, head, compress, quantize, dither, threads)
+            else:
+                _writehdu(fh, im, fitsheader(im, head, primary=False))
+
+    except (IOError, OSError, ValueError) as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return error
+
+    return error
+
+
+def fitswrite(file, data, heads=None, compress='', quantize=4.0,
+              dither='SUBTRACTIVE_DITHER_1', threads=0, silent=True):
+
+    # Initalizing some variables
+    error = ''
+    errprefix = 'FITSWRITE: '   # error message prefix
+
+    try:
+        if len(data)==0:
+            error = errprefix+'No HDUs to write'
+            if not silent: print(error)
+            return error
+        if heads is None: heads = [None]*len(data)
+        if len(heads)!=len(data):
+            error = errprefix+'Need one header per HDU'
+            if not silent: print(error)
+            return error
+        data = [None if d is None else np.asarray(d) for d in data]
+        with open(file, 'wb') as fh:
+            for i,(im,head) in enumerate(zip(data, heads)):
+                if i>0 and compress!='' and im is not None and im.size>0:
+                    _writecomp(fh, im, head, compress, quantize, dither, threads)
+                    continue
+                cards = fitsheader(im, head, primary=(i==0), nextend=len(data)-1)
+                _writehdu(fh, im, cards)
+
+    except (IOError, OSError, ValueError) as e:
+        error = errprefix+str(e)
+        if not silent: print(error)
+        return error
+
+    return error
+
+
+def fitsscale16(im):
+    # Scale a float image to int16 with BSCALE/BZERO from its range
+    #  -32768 is kept for the undefined (not finite) pixels
+    im = np.asarray(im)
+    good = np.isfinite(im)
+    allgood = bool(good.all())
+    vals = im if allgood else im[good]
+    if vals.size==0:
+        vmin = vmax = 0.0
+    else:
+        vmin, vmax = float(vals.min()), float(vals.max())
+    bzero = (vmax+vmin)/2.0
+    bscale = (vmax-vmin)/65534.0 if vmax>vmin else 1.0
+    out = np.empty(im.shape, dtype=np.int16)
+    scaled = (im-bzero)/bscale
+    if not allgood: scaled[~good] = 0
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, -32767, 32767, out=scaled)
+    out[...] = scaled
+    blank = None
+    if not allgood:
+        out[~good] = -32768
+        blank = -32768
+    return out, bscale, bzero, blank
+
+
+def fitsoutsize(hdus, bitpix):
+    # Size of a file with the HDUs of a fitsindex and BITPIX data
+    size = 0
+    for hdu in hdus:
+        npix = int(np.prod(hdu['naxis'])) if len(hdu['naxis'])>0 else 0
+        size += (hdu['hsize']+BLOCK-1)//BLOCK*BLOCK
+        size += (npix*abs(bitpix)//8+BLOCK-1)//BLOCK*BLOCK
+    return size
+
+
+class FsyncPolicy(object):
+
+    def __init__(self, mode='none'):
+        mode = str(mode).lower()
+        self.nbatch = 0
+        if mode.startswith('batch'):
+            self.nbatch = int(mode.split(':')[1]) if ':' in mode else 64
+            mode = 'batch'
+        if mode not in ('none','file','batch'):
+            raise ValueError("FSYNC must be 'none', 'file' or 'batch:N'")
+        self.mode = mode
+        self.pending = []
+        self.nsync = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can't be pickled, i.e. for worker processes
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['pending'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def closing(self, fh):
+        # The data of a file is complete, before it is closed
+        if self.mode=='file':
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def committed(self, file):
+        # A file was renamed into place
+        if self.mode=='file':
+            _syncdir(file)
+        elif self.mode=='batch':
+            with self._lock:
+                self.pending.append(file)
+                full = len(self.pending)>=self.nbatch
+            if full: self.flush()
+
+    def flush(self):
+        # Force the pending files to disk
+        with self._lock:
+            pending, self.pending = self.pending, []
+        if self.mode!='batch': return
+        if hasattr(os, 'sync'):
+            os.sync()
+        else:
+            for file in pending:
+                try:
+                    fd = os.open(file, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError:
+                    pass
+            for d in set(os.path.dirname(os.path.abspath(f)) for f in pending):
+                _syncdir(os.path.join(d, ''))
+        self.nsync += 1
+
+
+def _syncdir(file):
+    # Make a rename in the directory of FILE durable
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(file)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class FitsWriter(object):
+
+    def __init__(self, file, tmpfile=None, size=0, outtype='', compress='',
+                 quantize=4.0, dither='SUBTRACTIVE_DITHER_1', threads=0, sync=None):
+        if outtype not in OUTTYPES:
+            raise ValueError('OUTTYPE must be one of '+', '.join(repr(o) for o in OUTTYPES))
+        self.file = file
+        self.tmpfile = file+'.tmp' if tmpfile is None else tmpfile
+        self.outtype = outtype
+        self.compress = compress.upper()
+        if outtype=='quantized' and self.compress=='': self.compress = 'RICE_1'
+        self.quantize = quantize
+        self.dither = dither
+        self.threads = threads
+        self.sync = FsyncPolicy('none') if sync is None else sync
+        self._nbytes = 0
+        self.nbytes = 0
+        self.fh = open(self.tmpfile, 'wb')
+        if size>0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fh.fileno(), 0, int(size))
+            except OSError:
+                pass
+
+    def _outdata(self, im):
+        # The data and integer scaling of an image under the output policy
+        if im is None or im.dtype.kind!='f': return im, None
+        if self.outtype=='float32':
+            return im.astype(np.float32, copy=False), None
+        if self.outtype=='int16':
+            out, bscale, bzero, blank = fitsscale16(im)
+            return out, (bscale, bzero, blank)
+        return im, None
+
+    def primary(self, head=None, nextend=0, im=None):
+        # The primary HDU, normally without data
+        im, intscale = self._outdata(None if im is None else np.asarray(im))
+        _writehdu(self.fh, im, fitsheader(im, head, primary=True, nextend=nextend,
+                                          intscale=intscale))
+
+    def append(self, im, head=None):
+        # An image extension
+        im, intscale = self._outdata(np.asarray(im))
+        if self.compress!='' and im.size>0:
+            _writecomp(self.fh, im, head, self.compress, self.quantize, self.dither,
+                       self.threads, intscale=intscale)
+        else:
+            _writehdu(self.fh, im, fitsheader(im, head, primary=False, intscale=intscale))
+
+    def starthdu(self, shape, dtype, head=None, primary=False, nextend=0):
+        # An HDU that is written in pieces with writerows, not compressed
+        if self.compress!='' or self.outtype=='int16':
+            raise ValueError('HDUs written in pieces must be float32 or float64')
+        if self.outtype=='float32': dtype = np.float32
+        self._dtype = np.dtype(dtype)
+        self._nbytes = 0
+        fitsstarthdu(self.fh, fitsheader((shape, self._dtype), head, primary=primary,
+                                         nextend=nextend))
+
+    def writerows(self, blk):
+        self._nbytes += fitswriterows(self.fh, np.asarray(blk, dtype=self._dtype))
+
+    def endhdu(self):
+        fitsendhdu(self.fh, self._nbytes)
+
+    def close(self):
+        # The data is complete, drop the unused preallocated space
+        if self.fh is None: return
+        self.fh.flush()
+        self.nbytes = self.fh.tell()
+        self.fh.truncate(self.nbytes)
+        self.sync.closing(self.fh)
+        self.fh.close()
+        self.fh = None
+
+    def commit(self, file=None):
+        # Rename the temporary file to FILE (default is the writer's)
+        self.close()
+        if file is None: file = self.file
+        if file is not None and file!=self.tmpfile:
+            os.replace(self.tmpfile, file)
+        else:
+            file = self.tmpfile
+        self.sync.committed(file)
+        return file
+
+    def abort(self):
+        # Throw the output away
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+        try:
+            os.remove(self.tmpfile)
+        except OSError:
+            pass
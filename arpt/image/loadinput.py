@@ -6,105 +6,179 @@
   This program can be used to load command-line inputs.
   The input can be:
    (1) an array list of files, i.e. ['one.txt','two.txt']
-   (2) a globbed list, i.e. "*.txt"
+   (2) a globbed list, i.e. "*.txt", "night*/**/*.fits"
    (3) a comma separated list, i.e.  'one.txt,two.txt'
-   (4) the name of a file that contains a list, i.e. "list.txt"
-         This can NOT be used in combination with any of the other three options.
+   (4) the name of a file that contains a list, i.e. "@list.txt"
+  These can be combined.
+
+  iloadinput is the streaming version.  It is a generator that yields
+  the files as they are found: list files are read line by line and
+  every directory is scanned once (os.scandir) and matched against
+  all of the wildcard components that need it.  "**" matches any
+  number of directories (including none).  Files are only yielded
+  once.  The matches of a directory are in sorted order, the whole
+  list is only sorted with /sort (which has to read all of the input
+  first).  Names without wildcards are yielded as they are, even if
+  they don't exist.  Wildcards that match nothing yield nothing.
 
  INPUTS:
-  input    The input list.  There are three possibilities
-            (1) an array list of files
-            (2) a globbed list, i.e. "*.txt"
-            (3) a comma separated list, i.e.  'one.txt,two.txt'
-            (4) the name of a file that contains a list, i.e. "@list.txt"
-                  This can NOT be used in combination with any of the other three options.
+  input    The input list.  A string or a list of strings, see above.
   =comment Comment string to use when loading a list file. By default comment='#'
+  /sort    Sort the whole list.
+  /unique  Drop duplicate files (the same normalized path).  Default is True.
   /stp     Stop at the end of the program
 
  OUTPUTS:
   list     The list of files
-  =count   The number of elements in list
+  count    The number of elements in list
 
  USAGE:
-  loadinput('*.fits', list, count=count)
+  list, count = loadinput('*.fits')
+  for file in iloadinput(['@night1.lst','raw/**/*.fits.fz']): ...
 
  By D.Nidever   April 2007
 -
 """
-def loadinput(input0, comment='#', stp=False):
 
-# KENZA Q: undefine,list -> is None close enough?
-    list = None
-    count = 0
+import os
+import re
+import sys
+import fnmatch
+
+_WILD = re.compile(r'[*?\[]')
+
+
+def _iswild(s):
+    return _WILD.search(s) is not None
+
+
+def _readlist(file, comment='#'):
+    # The entries of a list file, one line at a time
+    with open(file) as fh:
+        for line in fh:
+            line = line.strip()
+            if line=='' or (comment!='' and line.startswith(comment)): continue
+            yield line
+
+
+class _Scanner(object):
+    # Directory listings, each directory is scanned once per input
+
+    def __init__(self):
+        self._dirs = {}
+
+    def entries(self, dir):
+        # Sorted (name, isdir) pairs of a directory
+        if dir not in self._dirs:
+            out = []
+            try:
+                with os.scandir(dir if dir!='' else '.') as it:
+                    for e in it:
+                        try:
+                            isdir = e.is_dir()
+                        except OSError:
+                            isdir = False
+                        out.append((e.name, isdir))
+            except OSError:
+                pass
+            out.sort()
+            self._dirs[dir] = out
+        return self._dirs[dir]
+
+    def expand(self, dir, parts):
+        # Paths below DIR that match the pattern components PARTS
+        if len(parts)==0:
+            yield dir
+            return
+        part, rest = parts[0], parts[1:]
+        if part=='**':
+            # Zero directories, then one more level
+            for path in self.expand(dir, rest): yield path
+            for name,isdir in self.entries(dir):
+                if isdir and not name.startswith('.'):
+                    for path in self.expand(os.path.join(dir, name), parts): yield path
+            return
+        if not _iswild(part):
+            path = os.path.join(dir, part)
+            if len(rest)==0:
+                if os.path.lexists(path): yield path
+            elif os.path.isdir(path):
+                for p in self.expand(path, rest): yield p
+            return
+        match = re.compile(fnmatch.translate(part)).match
+        # Hidden files only match explicit dots
+        hidden = part.startswith('.')
+        for name,isdir in self.entries(dir):
+            if name.startswith('.') and not hidden: continue
+            if not match(name): continue
+            if len(rest)==0:
+                yield os.path.join(dir, name)
+            elif isdir:
+                for path in self.expand(os.path.join(dir, name), rest): yield path
+
+
+def _glob(pattern, scanner):
+    # Expand one wildcard pattern
+    drive, path = os.path.splitdrive(pattern)
+    if path.startswith(os.sep):
+        root = drive+os.sep
+        path = path.lstrip(os.sep)
+    else:
+        root = drive
+    parts = [p for p in path.split(os.sep) if p not in ('','.')]
+    # Start at the last directory without wildcards
+    n = 0
+    while n<len(parts)-1 and not _iswild(parts[n]): n += 1
+    start = os.path.join(root, *parts[0:n]) if n>0 else root
+    if n>0 and not os.path.isdir(start): return
+    for path in scanner.expand(start, parts[n:]): yield path
+
+
+def iloadinput(input, comment='#', sort=False, unique=True):
+
+    if sort:
+        for file in sorted(iloadinput(input, comment=comment, unique=unique)): yield file
+        return
+
+    if isinstance(input, str): input = [input]
+    scanner = _Scanner()
+    seen = set()
+
+    def entries():
+        for inp in input:
+            if inp is None: continue
+            inp = inp.strip()
+            if inp=='': continue
+            # A list file
+            if inp.startswith('@'):
+                for line in _readlist(inp[1:], comment=comment): yield line, False
+                continue
+            # Break up comma lists
+            for name in inp.split(','):
+                name = name.strip()
+                if name!='': yield name, _iswild(name)
+
+    for name,wild in entries():
+        files = _glob(name, scanner) if wild else [name]
+        for file in files:
+            if unique:
+                key = os.path.normpath(file)
+                if key in seen: continue
+                seen.add(key)
+            yield file
+
+
+def loadinput(input0, comment='#', sort=False, unique=True, stp=False):
 
     # Not enough inputs
-    if len(input0)==0:
-        print 'Syntax - loadinput(input, comment=comment, stp=stp)'
-        return list, count
-    input = input0
-
-    # Empty string input
-    if input[0].split()=='':
-        list = None
-        count = 0
-        return list, count
-
-    # A list file was input
-    if input[0][0:1]=='@':
-        inp = input[0][1:]
-        # Loading the files
-# KENZA - change this function
-        readline(inp, list, comment=comment, noblank=True)
-        nlist = len(list)
-    else:
-        # Break up comma lists
-        ninput = len(input)
-        temp = None
-
-        for i in range(0,ninput):
-            dum = input[i].split(',')
-            push(temp,dum)
-
-        input = temp
-        temp = None
-        if len(input)==1: input=input[0]
-
-        # Probably an array of filenames
-        if len(input)>1:
-            # Try to expand as wildcards
-# KENZA - change this function
-            wildind = where(strpos(input,'*')!=-1 or strpos(input,'?')!=-1, nwild)
-            normind = where(strpos(input,'*')!=-1 and strpos(input,'?')!=-1,nnorm)
-
-            # Some wildcards
-            if nwild>0:
-                list = None
-# KENZA - change this function
-                if nnorm>0: push(list,input[normind])
-                wild = input[wildind]
-
-                # Loop through the wildcards
-                for i in range(0,nwild):
-# KENZA - change this function
-                    wfiles = file_search(wild[i],count=nwfiles)
-# KENZA - change this function
-                    if nwfiles>0: push(list,wfiles)
-      
-                nlist = len(list)
-
-            # No wildcards
-            else:
-                list = input
-                nlist = len(list)
-            
-        # A globbed list or only one file
-        else:
-# KENZA - change this function
-            list = file_search(input, count=nlist)
-            if nlist==0: list=input    # Maybe just one filename
-            #nlist = len(list)
+    if input0 is None or len(input0)==0:
+        print('Syntax - list, count = loadinput(input, comment=comment, stp=stp)')
+        return None, 0
 
+    list = [f for f in iloadinput(input0, comment=comment, sort=sort, unique=unique)]
     count = len(list)
-    if count==1: list=list[0]
-    if stp: exit()
+    if count==0: list = None
+    elif count==1: list = list[0]
+
+    if stp: sys.exit()
     return list, count
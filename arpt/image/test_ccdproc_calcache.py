@@ -0,0 +1,99 @@
+"""
+ The calibration frame cache (ccdproc_calcache).
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from ccdproc_calcache import CalCache, ccdproc_calflat
+
+
+@pytest.fixture
+def calfile(tmp_path):
+    file = tmp_path/'zero.fits'
+    file.write_bytes(b'x'*10)
+    return str(file)
+
+
+class Loader(object):
+    # Frames of 10x10 float64 (800 bytes), counting the loads
+    def __init__(self):
+        self.calls = []
+    def __call__(self, path, exten):
+        self.calls.append((path, exten))
+        return np.full((10, 10), float(exten))
+
+
+def test_hits_and_misses(calfile):
+    loader = Loader()
+    cache = CalCache(loader=loader)
+    im = cache.get(calfile, 1)
+    assert im[0, 0]==1.0
+    assert cache.get(calfile, 1) is im
+    cache.get(calfile, 2)
+    assert (cache.hits, cache.misses)==(1, 2)
+    assert len(loader.calls)==2
+    assert cache.stats()=={'hits':1, 'misses':2, 'evictions':0, 'nbytes':1600, 'nframes':2}
+    # Shared frames are read-only
+    with pytest.raises(ValueError):
+        im[0, 0] = 5.0
+
+
+def test_lru_eviction(calfile):
+    loader = Loader()
+    cache = CalCache(maxbytes=2000, loader=loader)
+    cache.get(calfile, 1)
+    cache.get(calfile, 2)
+    cache.get(calfile, 1)      # 2 is now the least recently used
+    cache.get(calfile, 3)
+    assert cache.evictions==1
+    assert cache.nbytes==1600 and cache.nbytes<=cache.maxbytes
+    cache.get(calfile, 1)
+    cache.get(calfile, 3)
+    assert len(loader.calls)==3
+    cache.get(calfile, 2)
+    assert len(loader.calls)==4
+
+
+def test_too_big_not_kept(calfile):
+    cache = CalCache(maxbytes=500, loader=Loader())
+    cache.get(calfile, 1)
+    cache.get(calfile, 1)
+    assert cache.misses==2 and cache.nbytes==0
+
+
+def test_invalidation(calfile):
+    loader = Loader()
+    cache = CalCache(loader=loader)
+    cache.get(calfile, 1)
+    # A new mtime
+    st = os.stat(calfile)
+    os.utime(calfile, (st.st_atime, st.st_mtime+10))
+    cache.get(calfile, 1)
+    assert len(loader.calls)==2
+    # A new size
+    with open(calfile, 'ab') as fh: fh.write(b'more')
+    cache.get(calfile, 1)
+    assert len(loader.calls)==3
+    # The stale versions are dropped
+    assert cache.stats()['nframes']==1 and cache.nbytes==800
+
+
+def test_derived(calfile):
+    flat = np.ones((10, 10))
+    flat[2, 3] = 0.0
+    flat[0, 0:10] = 3.0
+    cache = CalCache(loader=lambda path, exten: flat)
+    calls = []
+    def median(im):
+        calls.append(1)
+        return float(np.median(im))
+    assert cache.derived(calfile, 1, 'median', median)==1.0
+    assert cache.derived(calfile, 1, 'median', median)==1.0
+    assert len(calls)==1
+    flatim, medflat = ccdproc_calflat(cache, calfile, 1)
+    assert medflat==1.0 and flatim[2, 3]==1.0 and flatim[0, 0]==3.0
+    # The cleaned flat counts against the budget
+    assert cache.nbytes>flat.nbytes
@@ -0,0 +1,119 @@
+"""
+ The persistent header catalog (ccdproc_catalog).
+"""
+
+import os
+import pickle
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from fitsindex import fitscard
+from fitswrite import fitswrite
+from ccdproc_catalog import HeaderCatalog, ccdproc_hdustate
+
+
+def _writemef(file, done=()):
+    # Two image extensions, DONE are the (extension, keyword) already applied
+    im = np.zeros((4, 6), dtype=np.float32)
+    heads = [[fitscard('FILTER', 'g'), fitscard('EXPTIME', 90.0),
+              fitscard('DATE-OBS', '2014-04-01T03:04:05')], [], []]
+    for ext,key in done: heads[ext].append(fitscard(key, 'applied'))
+    assert fitswrite(file, [None, im, im], heads=heads)==''
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    cat = HeaderCatalog(str(tmp_path/'ccdproc.db'))
+    yield cat
+    cat.close()
+
+
+def test_hdustate():
+    head = [fitscard('NAXIS', 2), fitscard('NAXIS1', 6), fitscard('NAXIS2', 4),
+            fitscard('ZEROCOR', 'done'), fitscard('BTSRP', 'done')]
+    state = ccdproc_hdustate(head)
+    assert state['naxis']==2 and state['sz']==[6, 4]
+    assert state['zero']==1 and state['btsrp']==1 and state['flat']==0
+
+
+def test_todo(tmp_path, catalog):
+    file = str(tmp_path/'a.fits')
+    _writemef(file, done=[(1, 'ZEROCOR'), (1, 'FLATCOR'), (2, 'ZEROCOR')])
+    assert catalog.lookup(file) is None
+    # The file is scanned on the first query
+    assert catalog.todo(file, ['zero'])==[]
+    assert catalog.todo(file, ['zero', 'flat'])==[2]
+    assert catalog.todo(file, ['overscan'])==[1, 2]
+    entry = catalog.lookup(file)
+    assert entry['nextend']==2 and entry['filter']=='g' and entry['exptime']==90.0
+    assert entry['dateobs']=='2014-04-01T03:04:05'
+    assert [h['ext'] for h in entry['hdu']]==[0, 1, 2]
+
+
+def test_update(tmp_path, catalog):
+    file = str(tmp_path/'a.fits')
+    _writemef(file)
+    assert catalog.todo(file, ['zero'])==[1, 2]
+    # The file is processed, the old entry is stale
+    _writemef(file, done=[(1, 'ZEROCOR'), (2, 'ZEROCOR'), (2, 'OVERSCAN')])
+    os.utime(file, (1e9, 1e9))
+    assert catalog.lookup(file) is None
+    entry = catalog.update(file)
+    assert [h['zero'] for h in entry['hdu']]==[0, 1, 1]
+    assert [h['overscan'] for h in entry['hdu']]==[0, 0, 1]
+    assert catalog.lookup(file)['hdu']==entry['hdu']
+    assert catalog.todo(file, ['zero'])==[]
+    # A reopened catalog has the same entry
+    other = HeaderCatalog(catalog.dbfile)
+    assert other.lookup(file)==catalog.lookup(file)
+    other.close()
+
+
+def test_missing_file(tmp_path, catalog):
+    file = str(tmp_path/'missing.fits')
+    assert catalog.lookup(file) is None
+    with pytest.raises(IOError):
+        catalog.update(file)
+
+
+def _childtodo(catalog, file, out):
+    # In a forked worker, with the parent's catalog object
+    try:
+        catalog.update(file)
+        out.put((os.getpid(), catalog._pid, catalog.todo(file, ['zero'])))
+    except Exception as e:
+        out.put(str(e))
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(),
+                    reason='needs fork')
+def test_fork_reopens(tmp_path, catalog):
+    file = str(tmp_path/'a.fits')
+    _writemef(file, done=[(1, 'ZEROCOR')])
+    assert catalog.todo(file, ['zero'])==[2]
+    parentdb = catalog._db
+    ctx = multiprocessing.get_context('fork')
+    out = ctx.Queue()
+    proc = ctx.Process(target=_childtodo, args=(catalog, file, out))
+    proc.start()
+    result = out.get(timeout=60)
+    proc.join()
+    # The child opened its own connection
+    pid, dbpid, todo = result
+    assert dbpid==pid and pid!=os.getpid()
+    assert todo==[2]
+    # The parent's connection still works
+    assert catalog._db is parentdb
+    assert catalog.todo(file, ['zero'])==[2]
+
+
+def test_pickle(tmp_path, catalog):
+    file = str(tmp_path/'a.fits')
+    _writemef(file)
+    catalog.update(file)
+    new = pickle.loads(pickle.dumps(catalog))
+    assert new._db is None
+    assert new.lookup(file)==catalog.lookup(file)
+    new.close()
@@ -0,0 +1,137 @@
+"""
+ The master zero and flat builder (ccdproc_combine) against an
+ in-memory stack.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from fitsindex import fitsindex, fitscard, fitskey
+from fitswrite import fitswrite
+from ccdproc_overscan import ccdproc_overscangeom
+from ccdproc_fused import ccdproc_fused
+from ccdproc_combine import ccdproc_combine, ccdproc_combinestack
+
+NY, NX = 60, 48
+NFILES = 5
+
+
+def _head():
+    return [fitscard('BIASSEC', '[41:48,1:60]'), fitscard('TRIMSEC', '[1:40,1:60]')]
+
+
+def _writeraw(tmp_path, prefix, levels, seed):
+    # Raw exposures with 2 extensions, LEVELS are the sky levels
+    rng = np.random.default_rng(seed)
+    files = []
+    for k,level in enumerate(levels):
+        ims = []
+        for e in range(2):
+            im = rng.normal(level*(1.0+0.05*e), 5.0, (NY, NX))
+            im[:, 40:] = 0.0
+            im += 400.0+rng.normal(0.0, 3.0, (NY, 1))
+            # A cosmic ray
+            im[10+k, 7+k] += 30000.0
+            ims.append(np.round(im).astype(np.uint16))
+        file = str(tmp_path/('%s%d.fits' % (prefix, k)))
+        assert fitswrite(file, [None]+ims, heads=[[fitscard('OBSTYPE', prefix)], _head(), _head()])==''
+        files.append(file)
+    return files
+
+
+def _stack(files, exten, zeroim=None, scale=False):
+    # The calibrated frames of one extension in memory
+    frames = []
+    for file in files:
+        fits = fitsindex(file)[0]
+        raw = fits.data(exten)
+        out, error = ccdproc_fused(raw, ovgeom=ccdproc_overscangeom(_head(), raw.shape),
+                                   trimsec=[0, 39, 0, 59], trim=True, zeroim=zeroim)
+        assert error==''
+        if scale: out /= np.float32(np.median(out))
+        frames.append(out)
+    return np.array(frames)
+
+
+@pytest.mark.parametrize('combine', ['median', 'mean', 'sigclip'])
+def test_zero_matches_stack(tmp_path, combine):
+    files = _writeraw(tmp_path, 'zero', [0.0]*NFILES, 1)
+    outfile = str(tmp_path/'Zero.fits')
+    stats = {}
+    assert ccdproc_combine(str(tmp_path/'zero*.fits'), outfile, combine=combine, stats=stats,
+                           silent=True)==''
+    assert stats['ncombine']==NFILES and stats['scale'][1]==[1.0]*NFILES
+    fits = fitsindex(outfile)[0]
+    assert fits.nextend==2
+    for e in (1, 2):
+        ref = ccdproc_combinestack(_stack(files, e), combine=combine)
+        np.testing.assert_allclose(fits.data(e), ref, rtol=1e-6, atol=1e-4)
+        head = fits.header(e)
+        assert fitskey(head, 'NCOMBINE')==NFILES
+        assert fitskey(head, 'IMCMB001')=='zero0.fits'
+        assert fitskey(head, 'COMBINE').startswith(combine)
+        assert fitskey(head, 'TRIM').endswith('[1:40,1:60]')
+    if combine=='median':
+        # The cosmic rays are rejected
+        assert np.abs(fits.data(1)).max()<100
+
+
+def test_sigclip_stack():
+    stack = np.zeros((7, 2, 2), dtype=np.float32)
+    stack[:, 0, 0] = [10, 11, 9, 10, 11, 9, 500]
+    stack[:, 1, 1] = [1, 2, 3, 4, 5, 6, 7]
+    out = ccdproc_combinestack(stack, combine='sigclip', nsigma=2.0)
+    assert out[0, 0]==10.0
+    assert out[1, 1]==4.0
+    assert out[0, 1]==0.0
+
+
+def test_chunks(tmp_path):
+    # A small memory ceiling, many chunks of rows, the same output
+    _writeraw(tmp_path, 'zero', [0.0]*NFILES, 2)
+    outfile = str(tmp_path/'Zero.fits')
+    assert ccdproc_combine(str(tmp_path/'zero*.fits'), outfile, silent=True)==''
+    ref = [fitsindex(outfile)[0].data(e).copy() for e in (1, 2)]
+    stats = {}
+    chunked = str(tmp_path/'Zero_chunked.fits')
+    assert ccdproc_combine(str(tmp_path/'zero*.fits'), chunked, maxmem=10000, threads=1,
+                           stats=stats, silent=True)==''
+    assert stats['nrows'][1]<NY//4
+    for e in (1, 2):
+        np.testing.assert_array_equal(fitsindex(chunked)[0].data(e), ref[e-1])
+
+
+def test_flat(tmp_path):
+    zfiles = _writeraw(tmp_path, 'zero', [0.0]*NFILES, 3)
+    zero = str(tmp_path/'Zero.fits')
+    assert ccdproc_combine(zfiles, zero, silent=True)==''
+    levels = [1000.0, 2000.0, 1500.0, 3000.0, 2500.0]
+    files = _writeraw(tmp_path, 'dflat', levels, 4)
+    outfile = str(tmp_path/'Flat.fits')
+    stats = {}
+    assert ccdproc_combine(files, outfile, type='flat', zero=zero, stats=stats, silent=True)==''
+    # Every input is normalized, the master is about 1
+    np.testing.assert_allclose(stats['scale'][1], levels, rtol=0.01)
+    fits = fitsindex(outfile)[0]
+    zfits = fitsindex(zero)[0]
+    for e in (1, 2):
+        flat = fits.data(e)
+        assert abs(np.median(flat)-1.0)<0.01
+        ref = np.median(_stack(files, e, zeroim=zfits.data(e), scale=True), axis=0)
+        np.testing.assert_allclose(flat, ref, rtol=1e-4)
+        assert fitskey(fits.header(e), 'CCDMEAN')==1.0
+        assert fitskey(fits.header(e), 'OBSTYPE')=='flat'
+
+
+def test_errors(tmp_path):
+    files = _writeraw(tmp_path, 'zero', [0.0]*2, 5)
+    outfile = str(tmp_path/'Zero.fits')
+    assert 'TYPE must be' in ccdproc_combine(files, outfile, type='dark', silent=True)
+    assert 'COMBINE must be' in ccdproc_combine(files, outfile, combine='mode', silent=True)
+    assert 'No files' in ccdproc_combine(str(tmp_path/'none*.fits'), outfile, silent=True)
+    single = str(tmp_path/'single.fits')
+    assert fitswrite(single, [None, np.zeros((NY, NX), dtype=np.uint16)], heads=[None, _head()])==''
+    assert 'different numbers of extensions' in ccdproc_combine(files+[single], outfile, silent=True)
+    assert not os.path.exists(outfile) and not os.path.exists(outfile+'.tmp')
@@ -0,0 +1,132 @@
+"""
+ The fixpix interpolation plan (ccdproc_fixpix) against a loop over the
+ regions.
+"""
+
+import numpy as np
+import pytest
+
+from fitsindex import fitscard, fitskey
+from ccdproc_loadfixpix import ccdproc_loadfixpix
+from ccdproc_fixpix import ccdproc_fixpix, ccdproc_fixpixplan, ccdproc_fixpixvalues, \
+    ccdproc_fixpixband
+
+NY, NX = 40, 30
+
+
+def _regions(lines):
+    # 1-based "X1 X2 Y1 Y2" tuples to ccdproc_loadfixpix regions
+    return [{'x1':x1, 'x2':x2, 'y1':y1, 'y2':y2, 'nx':x2-x1+1, 'ny':y2-y1+1}
+            for x1,x2,y1,y2 in lines]
+
+
+def _regionloop(im, fixstr):
+    # One region and one pixel at a time, walking out to the nearest
+    #  good pixels on both sides
+    ny, nx = im.shape
+    bad = np.zeros(im.shape, dtype=bool)
+    alongx = {}
+    for f in fixstr:
+        x1, x2, y1, y2 = max(f['x1']-1,0), min(f['x2']-1,nx-1), max(f['y1']-1,0), min(f['y2']-1,ny-1)
+        for y in range(y1, y2+1):
+            for x in range(x1, x2+1):
+                # The first region of a pixel sets the direction
+                if (y, x) not in alongx: alongx[(y, x)] = x2-x1<=y2-y1
+                bad[y, x] = True
+    out = im.copy()
+    for (y, x),dirx in alongx.items():
+        line = im[y] if dirx else im[:, x]
+        good = ~bad[y] if dirx else ~bad[:, x]
+        p = x if dirx else y
+        a = p-1
+        while a>=0 and not good[a]: a -= 1
+        b = p+1
+        while b<len(line) and not good[b]: b += 1
+        if a>=0 and b<len(line):
+            val = line[a]+(line[b]-line[a])*(p-a)/float(b-a)
+        elif a>=0:
+            val = line[a]
+        elif b<len(line):
+            val = line[b]
+        else:
+            continue
+        out[y, x] = val
+    return out
+
+
+REGIONS = {
+    'columns':[(5, 5, 1, 40), (10, 11, 3, 20)],
+    'rows':[(1, 30, 7, 7), (3, 20, 15, 16)],
+    'pixels':[(12, 12, 30, 30), (13, 13, 30, 30), (20, 20, 2, 2)],
+    # At the image edges, one sided
+    'edges':[(1, 2, 5, 30), (30, 30, 1, 40), (4, 25, 1, 1), (4, 25, 39, 40)],
+    # Overlapping regions of both directions, the first one wins
+    'overlap':[(8, 9, 5, 35), (2, 25, 20, 21), (8, 20, 10, 10), (15, 16, 8, 12)],
+    # Partly outside of the image
+    'outside':[(25, 40, 33, 34), (14, 14, 35, 60)],
+}
+
+
+@pytest.mark.parametrize('name', sorted(REGIONS))
+def test_plan_matches_loop(name):
+    rng = np.random.default_rng(7)
+    im = rng.normal(1000.0, 50.0, (NY, NX))
+    fixstr = _regions(REGIONS[name])
+    ref = _regionloop(im, fixstr)
+    head = [fitscard('OBJECT', 'test')]
+    out = im.copy()
+    assert ccdproc_fixpix(out, head, fixstr)==''
+    np.testing.assert_allclose(out, ref, rtol=1e-12)
+    plan = ccdproc_fixpixplan(fixstr, im.shape)
+    assert plan['npix']==np.sum(out!=im)
+    assert 'Fixpix '+str(plan['npix'])+' pixels in '+str(len(fixstr))+' regions' in fitskey(head, 'FIXPIX')
+
+
+def test_whole_lines():
+    im = np.arange(NY*NX, dtype=np.float64).reshape(NY, NX)
+    # A bad row is interpolated along the columns
+    out = im.copy()
+    assert ccdproc_fixpix(out, [], _regions([(1, 30, 5, 5)]))==''
+    np.testing.assert_array_equal(out[4], (im[3]+im[5])/2)
+    assert ccdproc_fixpixplan(_regions([(4, 4, 1, 40)]), im.shape)['npix']==NY
+    # No good neighbor at all, the pixels are left alone
+    assert ccdproc_fixpixplan(_regions([(1, 30, 1, 40)]), im.shape)['npix']==0
+
+
+def test_plan_cache_and_band():
+    fixstr = _regions(REGIONS['overlap'])
+    plan = ccdproc_fixpixplan(fixstr, (NY, NX))
+    assert ccdproc_fixpixplan(_regions(REGIONS['overlap']), (NY, NX)) is plan
+    assert np.all(np.diff(plan['target'])>0)
+    im = np.random.default_rng(1).normal(0.0, 1.0, (NY, NX))
+    vals = ccdproc_fixpixvalues(im, plan)
+    # The band pieces make up the whole plan
+    pieces = [ccdproc_fixpixband(plan, vals, y0, min(y0+7, NY)) for y0 in range(0, NY, 7)]
+    assert sum(len(p[0]) for p in pieces)==plan['npix']
+    out = im.copy()
+    for y0,(ty,tx,v) in zip(range(0, NY, 7), pieces):
+        out[y0+ty, tx] = v
+    np.testing.assert_allclose(out, _regionloop(im, fixstr), rtol=1e-12)
+
+
+def test_loadfixpix(tmp_path):
+    file = tmp_path/'fixpix.txt'
+    file.write_text('# bad columns\n10 12 20 40\n\n50 60\n')
+    fixstr, error = ccdproc_loadfixpix(str(file))
+    assert error==''
+    assert fixstr==_regions([(10, 12, 20, 40), (50, 50, 60, 60)])
+    for text,msg in (('10 x\n', 'must all be integers'), ('0 5\n', 'be >=1'),
+                     ('1 2 3\n', '"X Y" or "X1 X2 Y1 Y2"'), ('5 4 1 2\n', 'X2>=X1'),
+                     ('# nothing\n', 'No good lines')):
+        file.write_text(text)
+        fixstr, error = ccdproc_loadfixpix(str(file))
+        assert fixstr is None and msg in error
+    assert 'NOT FOUND' in ccdproc_loadfixpix(str(tmp_path/'missing.txt'))[1]
+
+
+def test_errors():
+    fixstr = _regions([(5, 5, 1, 40)])
+    assert 'float array' in ccdproc_fixpix(np.zeros((NY, NX), dtype=np.int16), [], fixstr)
+    assert 'No fixpix regions' in ccdproc_fixpix(np.zeros((NY, NX)), [], [])
+    head = [fitscard('FIXPIX', 'done')]
+    assert 'already applied' in ccdproc_fixpix(np.zeros((NY, NX)), head, fixstr)
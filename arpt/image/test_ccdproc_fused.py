@@ -0,0 +1,118 @@
+"""
+ The fused kernel (ccdproc_fused) against the separate steps.
+"""
+
+import numpy as np
+import pytest
+
+from fitsindex import fitscard, fitskey
+from ccdproc_fused import ccdproc_fused
+from ccdproc_lincorr import ccdproc_loadlincorr, ccdproc_linplan, ccdproc_lincorr
+from ccdproc_loadfixpix import ccdproc_loadfixpix
+from ccdproc_fixpix import ccdproc_fixpix, ccdproc_fixpixplan
+from ccdproc_overscan import ccdproc_overscan, ccdproc_overscangeom
+from ccdproc_splitsec import ccdproc_splitsec
+from ccdproc_mask import PixMask
+
+NY, NX = 300, 220
+EXTEN = 1
+
+
+def _header(twoamp=False):
+    if twoamp:
+        cards = [fitscard('BIASSECA', '[201:210,1:150]'), fitscard('TRIMSECA', '[1:200,1:150]'),
+                 fitscard('BIASSECB', '[201:210,151:300]'), fitscard('TRIMSECB', '[1:200,151:300]'),
+                 fitscard('TRIMSEC', '[1:200,1:300]')]
+    else:
+        cards = [fitscard('BIASSEC', '[201:220,1:300]'), fitscard('TRIMSEC', '[1:200,1:300]')]
+    return cards+['%-80s' % 'END']
+
+
+@pytest.fixture
+def frame(tmp_path):
+    # A raw frame with all of its calibrations
+    rng = np.random.default_rng(3)
+    raw = rng.integers(1000, 5000, (NY, NX)).astype(np.uint16)
+    raw[:, 200:] = rng.integers(300, 340, (NY, 20))
+    linfile = tmp_path/'lincorr.txt'
+    linfile.write_text('# exten c0 c1 c2\n%d 0.0 1.0 1e-6\n' % EXTEN)
+    linstr, error = ccdproc_loadlincorr(str(linfile))
+    assert error==''
+    fixfile = tmp_path/'fixpix.txt'
+    fixfile.write_text('10 12 20 40\n50 60\n1 3 100 101\n')
+    fixstr, error = ccdproc_loadfixpix(str(fixfile))
+    assert error==''
+    flat = rng.normal(1.0, 0.1, (NY, 200))
+    flat[5, 5] = 0.0
+    bpm = np.zeros((NY, 200), dtype=np.int16)
+    bpm[rng.random((NY, 200))<0.01] = 1
+    bpm[7, 0:10] = 2   # saturated, not bad
+    return {'raw':raw, 'linstr':linstr, 'fixstr':fixstr, 'flat':flat, 'bpm':bpm,
+            'zero':rng.normal(100.0, 5.0, (NY, 200)),
+            'illum':rng.normal(2.0, 0.1, (NY, 200)), 'bootscale':0.9}
+
+
+def _stepbystep(frame, head, dtype):
+    # The separate steps in the order of ccdproc_ext
+    im = frame['raw'].astype(dtype)
+    head = list(head)
+    assert ccdproc_lincorr(im, head, EXTEN, frame['linstr'])==''
+    assert ccdproc_fixpix(im, head, frame['fixstr'])==''
+    assert ccdproc_overscan(im, head)==''
+    x1, x2, y1, y2 = [t-1 for t in ccdproc_splitsec(fitskey(head, 'TRIMSEC'))]
+    im = im[y1:y2+1, x1:x2+1].copy()
+    im -= np.round(frame['zero'])
+    for cal in (frame['flat'], frame['illum']):
+        med = np.median(cal)
+        cal = np.where(cal<0.001, med, cal)
+        im /= (cal/med).astype(dtype)
+    im *= frame['bootscale']
+    im[(frame['bpm'] & 1)!=0] = 65535
+    return im
+
+
+def _fusedkw(frame, head, dtype):
+    raw = frame['raw']
+    trimsec = [t-1 for t in ccdproc_splitsec(fitskey(head, 'TRIMSEC'))]
+    return dict(ovgeom=ccdproc_overscangeom(head, raw.shape), trimsec=trimsec, trim=True,
+                linplan=ccdproc_linplan(frame['linstr'], EXTEN, head, raw.shape, raw.dtype,
+                                        dtype=dtype),
+                fixplan=ccdproc_fixpixplan(frame['fixstr'], raw.shape),
+                zeroim=frame['zero'], flatim=frame['flat'], illumim=frame['illum'],
+                bootscale=frame['bootscale'],
+                bpmind=PixMask.frombpm(frame['bpm']).indices(), dtype=dtype)
+
+
+@pytest.mark.parametrize('twoamp', [False, True])
+def test_fused_equals_steps(frame, twoamp):
+    head = _header(twoamp)
+    ref = _stepbystep(frame, head, np.float64)
+    raw = frame['raw'].copy()
+    stats = {}
+    out, error = ccdproc_fused(frame['raw'], nblock=37, stats=stats,
+                               **_fusedkw(frame, head, 'float64'))
+    assert error==''
+    assert out.shape==ref.shape
+    np.testing.assert_allclose(out, ref, rtol=1e-9, atol=1e-9)
+    assert stats['nbdpix']==int(((frame['bpm'] & 1)!=0).sum())
+    # The raw image is not modified
+    np.testing.assert_array_equal(frame['raw'], raw)
+
+
+def test_fused_float32(frame):
+    head = _header()
+    ref = _stepbystep(frame, head, np.float64)
+    out, error = ccdproc_fused(frame['raw'], **_fusedkw(frame, head, 'float32'))
+    assert error==''
+    assert out.dtype==np.float32
+    np.testing.assert_allclose(out, ref, rtol=1e-5, atol=1e-3)
+
+
+def test_fused_errors(frame):
+    head = _header()
+    kw = _fusedkw(frame, head, 'float32')
+    kw['zeroim'] = frame['zero'][0:10]
+    out, error = ccdproc_fused(frame['raw'], **kw)
+    assert out is None and 'Zero image has wrong size' in error
+    out, error = ccdproc_fused(frame['raw'], dtype='int16')
+    assert out is None and error.startswith('CCDPROC_FUSED: ')
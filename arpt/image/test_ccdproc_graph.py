@@ -0,0 +1,121 @@
+"""
+ The stage graph (ccdproc_graph): orders per instrument, their checks
+ and the fused and stack nodes.
+"""
+
+import numpy as np
+import pytest
+
+from fitsindex import fitscard
+from fitswrite import fitswrite
+from ccdproc_graph import ccdproc_graph, STAGES, STAGEORDER
+
+# Every stage turned on, the cross-talk by its file name
+ALL = {'xTalk':'xtalk.txt', 'linCorr':True, 'fixPix':True, 'overscan':True, 'trim':True,
+       'zero':'zero.fits', 'flat':'flat.fits', 'illum':'illum.fits', 'bootstrap':True,
+       'bpm':'bpm.fits'}
+
+
+def _active(*names):
+    return dict((STAGES[s]['option'], True) for s in names)
+
+
+def _instfile(file, instrume):
+    head = [fitscard('INSTRUME', instrume)] if instrume is not None else []
+    assert fitswrite(str(file), [None, np.zeros((2, 2), dtype=np.int16)], heads=[head, None])==''
+    return str(file)
+
+
+def test_default():
+    graphs, error = ccdproc_graph(ALL)
+    assert error==''
+    graph = graphs.default
+    assert graph.steps==STAGEORDER
+    assert [n['name'] for n in graph.nodes]==STAGEORDER
+    assert graph.catalog==[STAGES[s]['catalog'] for s in STAGEORDER]
+    # Inactive stages are dropped, empty strings are off
+    graph = ccdproc_graph(dict(ALL, xTalk='', illum='', bootstrap=False))[0].default
+    assert graph.steps==['lincorr', 'fixpix', 'overscan', 'trim', 'zero', 'flat', 'bpm']
+    assert graphs.get() is graphs.default
+
+
+def test_fused():
+    graph = ccdproc_graph(ALL, fused=True)[0].default
+    assert graph.describe()=='xtalk -> fused('+','.join(STAGEORDER[1:])+')'
+    assert graph.steps==STAGEORDER
+    # Single pass is fine in the default order
+    assert ccdproc_graph(ALL, fused=True, single=True)[1]==''
+    # A stage out of the kernel's order starts a new fused node
+    act = _active('overscan', 'trim', 'zero', 'flat')
+    graph = ccdproc_graph(act, order='overscan,trim,flat,zero', fused=True)[0].default
+    assert graph.describe()=='fused(overscan,trim,flat) -> fused(zero)'
+    graphs, error = ccdproc_graph(act, order='overscan,trim,flat,zero', fused=True, single=True)
+    assert graphs is None and 'does not fuse into one pass' in error
+
+
+def test_batch():
+    # The stackable stages are one stack node, the others are fused
+    graph = ccdproc_graph(ALL, fused=True, batch=True)[0].default
+    assert graph.describe()=='xtalk -> fused(lincorr,fixpix,overscan,trim) -> '\
+        'stack(zero,flat,illum,bootstrap) -> fused(bpm)'
+    graph = ccdproc_graph(ALL, batch=True)[0].default
+    assert [n['name'] for n in graph.nodes]==['xtalk', 'lincorr', 'fixpix', 'overscan', 'trim',
+                                              'stack', 'bpm']
+    assert graph.nodes[5]['steps']==['zero', 'flat', 'illum', 'bootstrap']
+    assert graph.steps==STAGEORDER
+    # Only the stages marked for stacks
+    assert [s for s in STAGEORDER if STAGES[s]['stack']]==graph.nodes[5]['steps']
+    # The kernel ranks follow the default order, xtalk has none
+    ranks = [STAGES[s]['kernel'] for s in STAGEORDER]
+    assert ranks[0] is None and ranks[1:]==sorted(ranks[1:])
+
+
+def test_order_file(tmp_path):
+    act = _active('overscan', 'trim', 'zero', 'flat', 'bpm')
+    orders = tmp_path/'orders.txt'
+    orders.write_text('# Per instrument\n\n'
+                      '*        overscan,trim,zero,flat,bpm\n'
+                      'DECam    overscan, trim, flat, zero, bpm\n'
+                      'Mosaic3  OVERSCAN,TRIM,BPM,ZERO,FLAT\n')
+    graphs, error = ccdproc_graph(act, order=str(orders))
+    assert error==''
+    assert graphs.default.steps==['overscan', 'trim', 'zero', 'flat', 'bpm']
+    decam = graphs.get(_instfile(tmp_path/'decam.fits', 'DECam'))
+    assert decam.steps==['overscan', 'trim', 'flat', 'zero', 'bpm']
+    mosaic = graphs.get(_instfile(tmp_path/'mosaic.fits', 'Mosaic3'))
+    assert mosaic.steps==['overscan', 'trim', 'bpm', 'zero', 'flat']
+    # Other instruments, no INSTRUME and files that are not FITS
+    assert graphs.get(_instfile(tmp_path/'other.fits', '90Prime')) is graphs.default
+    assert graphs.get(_instfile(tmp_path/'none.fits', None)) is graphs.default
+    bad = tmp_path/'bad.fits'
+    bad.write_bytes(b'x'*2880)
+    assert graphs.get(str(bad)) is graphs.default
+    # The same order as a comma list is the default for every file
+    graphs = ccdproc_graph(act, order='overscan,trim,flat,zero,bpm')[0]
+    assert graphs.get(_instfile(tmp_path/'decam.fits', 'DECam')).steps==decam.steps
+
+
+@pytest.mark.parametrize('order,message', [
+    ('overscan,trim,zero,dark', 'Unknown stage dark'),
+    ('overscan,trim,zero,trim', 'has duplicates'),
+    ('overscan,trim', 'is missing zero'),
+    ('trim,overscan,zero', 'overscan works on the untrimmed image, it must come before trim'),
+    ('overscan,zero,trim', 'zero works on the trimmed image, it must come after trim'),
+])
+def test_invalid_order(order, message):
+    graphs, error = ccdproc_graph(_active('overscan', 'trim', 'zero'), order=order)
+    assert graphs is None
+    assert error.startswith('CCDPROC_GRAPH: ') and message in error
+
+
+def test_invalid_order_file(tmp_path):
+    # A bad order of any instrument fails before any file is processed
+    act = _active('xtalk', 'overscan', 'trim')
+    orders = tmp_path/'orders.txt'
+    orders.write_text('*      xtalk,overscan,trim\nDECam  overscan,xtalk,trim\n')
+    graphs, error = ccdproc_graph(act, order=str(orders))
+    assert graphs is None and 'xtalk must be the first stage' in error
+    orders.write_text('*      xtalk,overscan,trim\nDECam\n')
+    assert 'no stages for DECam' in ccdproc_graph(act, order=str(orders))[1]
+    # Stages that are not active can be anywhere
+    assert ccdproc_graph(act, order='xtalk,bpm,overscan,zero,trim,flat')[1]==''
@@ -0,0 +1,142 @@
+"""
+ The resumable run journal (ccdproc_journal).
+"""
+
+import os
+import pickle
+
+import pytest
+
+from ccdproc_journal import ProcJournal
+
+
+@pytest.fixture
+def setup(tmp_path):
+    raw = tmp_path/'raw.fits'
+    raw.write_bytes(b'raw data')
+    flat1 = tmp_path/'flat1.fits'
+    flat1.write_bytes(b'flat one')
+    flat2 = tmp_path/'flat2.fits'
+    flat2.write_bytes(b'flat two')
+    jrn = ProcJournal(str(tmp_path/'ccdproc.jnl'))
+    yield jrn, str(raw), str(tmp_path/'raw_temp.fits'), str(flat1), str(flat2)
+    jrn.close()
+
+
+def _process(jrn, file, outfile, content=b'calibrated'):
+    # What ccdproc does for an in-place run
+    with open(outfile, 'wb') as fh: fh.write(content)
+    jrn.moving(file)
+    os.replace(outfile, file)
+    jrn.done(file)
+
+
+def test_skip_finished(setup):
+    jrn, raw, outfile, flat1, flat2 = setup
+    key = jrn.key(['', flat1], {'steps':['flat']})
+    assert jrn.begin(raw, key, outfile)=='run'
+    assert jrn.lookup(raw)['status']=='STARTED'
+    _process(jrn, raw, outfile)
+    entry = jrn.lookup(raw)
+    assert entry['status']=='DONE' and entry['outhash']==jrn.hash(raw)
+    assert jrn.begin(raw, key, outfile)=='skip'
+    # The key only depends on the contents and the configuration
+    assert jrn.key(['', flat1], {'steps':['flat']})==key
+    assert jrn.key(['', flat1], {'steps':['zero']})!=key
+
+
+def test_stale(setup):
+    jrn, raw, outfile, flat1, flat2 = setup
+    assert jrn.begin(raw, jrn.key([flat1]), outfile)=='run'
+    _process(jrn, raw, outfile)
+    # Another flat, the raw data was overwritten
+    assert jrn.begin(raw, jrn.key([flat2]), outfile)=='stale'
+    # A new version of the same flat file is another key too
+    with open(flat1, 'ab') as fh: fh.write(b' changed')
+    assert jrn.begin(raw, jrn.key([flat1]), outfile)=='stale'
+    # A new raw file is processed again
+    with open(raw, 'wb') as fh: fh.write(b'new raw data')
+    assert jrn.begin(raw, jrn.key([flat2]), outfile)=='run'
+
+
+def test_out_of_place(setup, tmp_path):
+    jrn, raw, outfile, flat1, flat2 = setup
+    outfile = str(tmp_path/'raw_cal.fits')
+    key = jrn.key([flat1])
+    assert jrn.begin(raw, key, outfile, inplace=False)=='run'
+    with open(outfile, 'wb') as fh: fh.write(b'calibrated')
+    jrn.done(raw)
+    assert jrn.begin(raw, key, outfile, inplace=False)=='skip'
+    # The raw data is still there, a new flat is a rerun
+    assert jrn.begin(raw, jrn.key([flat2]), outfile, inplace=False)=='run'
+
+
+def test_interrupted_started(setup):
+    jrn, raw, outfile, flat1, flat2 = setup
+    key = jrn.key([flat1])
+    assert jrn.begin(raw, key, outfile)=='run'
+    # The run died while writing
+    with open(outfile, 'wb') as fh: fh.write(b'calib')
+    assert jrn.begin(raw, key, outfile)=='run'
+    assert not os.path.exists(outfile)
+    assert open(raw, 'rb').read()==b'raw data'
+
+
+def test_interrupted_moving(setup):
+    jrn, raw, outfile, flat1, flat2 = setup
+    key = jrn.key([flat1])
+    assert jrn.begin(raw, key, outfile)=='run'
+    with open(outfile, 'wb') as fh: fh.write(b'calibrated')
+    jrn.moving(raw)
+    # The run died before the rename, the complete output is moved in
+    assert jrn.begin(raw, key, outfile)=='skip'
+    assert not os.path.exists(outfile)
+    assert open(raw, 'rb').read()==b'calibrated'
+    assert jrn.lookup(raw)['status']=='DONE'
+
+
+def test_interrupted_moving_renamed(setup):
+    jrn, raw, outfile, flat1, flat2 = setup
+    key = jrn.key([flat1])
+    assert jrn.begin(raw, key, outfile)=='run'
+    with open(outfile, 'wb') as fh: fh.write(b'calibrated')
+    jrn.moving(raw)
+    # The run died after the rename
+    os.replace(outfile, raw)
+    assert jrn.begin(raw, key, outfile)=='skip'
+    assert jrn.lookup(raw)['status']=='DONE'
+
+
+def test_interrupted_moving_partial(setup):
+    jrn, raw, outfile, flat1, flat2 = setup
+    key = jrn.key([flat1])
+    assert jrn.begin(raw, key, outfile)=='run'
+    with open(outfile, 'wb') as fh: fh.write(b'calibrated')
+    jrn.moving(raw)
+    # The output on disk is not the recorded one
+    with open(outfile, 'wb') as fh: fh.write(b'calib')
+    assert jrn.begin(raw, key, outfile)=='run'
+    assert not os.path.exists(outfile)
+    assert open(raw, 'rb').read()==b'raw data'
+
+
+def test_hash_cache(setup):
+    jrn, raw, outfile, flat1, flat2 = setup
+    h = jrn.hash(raw)
+    assert jrn.hash(raw)==h
+    with open(raw, 'wb') as fh: fh.write(b'raw dat2')
+    st = os.stat(raw)
+    os.utime(raw, (st.st_atime, st.st_mtime+10))
+    assert jrn.hash(raw)!=h
+
+
+def test_pickle_reopen(setup):
+    jrn, raw, outfile, flat1, flat2 = setup
+    key = jrn.key([flat1])
+    assert jrn.begin(raw, key, outfile)=='run'
+    _process(jrn, raw, outfile)
+    # A worker's copy opens its own connection to the same journal
+    new = pickle.loads(pickle.dumps(jrn))
+    assert new._db is None
+    assert new.begin(raw, key, outfile)=='skip'
+    new.close()
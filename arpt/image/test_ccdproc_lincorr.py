@@ -0,0 +1,137 @@
+"""
+ The linearity correction (ccdproc_lincorr), the lookup tables against
+ the polynomial and the tabulated corrections.
+"""
+
+import numpy as np
+import pytest
+
+from fitsindex import fitscard, fitskey
+from fitswrite import fitswrite
+from ccdproc_lincorr import ccdproc_loadlincorr, ccdproc_linplan, ccdproc_linpoly, \
+    ccdproc_linwindow, ccdproc_linvalues, ccdproc_linshift, ccdproc_lincorr
+
+COEF = [3.0, 0.98, 2.5e-6, -1.0e-11]
+
+
+def _linstr(tmp_path, text):
+    file = tmp_path/'lincorr.txt'
+    file.write_text(text)
+    linstr, error = ccdproc_loadlincorr(str(file))
+    assert error==''
+    return linstr
+
+
+def _allvalues(dtype):
+    # Every 16-bit raw value once
+    vals = np.arange(65536, dtype=np.uint16).view(np.dtype(dtype).newbyteorder('='))
+    return vals.astype(dtype).reshape(256, 256)
+
+
+@pytest.mark.parametrize('dtype', ['<i2', '>i2', '<u2', '>u2'])
+def test_lut_matches_poly(tmp_path, dtype):
+    linstr = _linstr(tmp_path, '# exten c0 c1 c2 c3\n1 '+' '.join(repr(c) for c in COEF)+'\n')
+    raw = _allvalues(dtype)
+    plan = ccdproc_linplan(linstr, 1, [], raw.shape, raw.dtype)
+    assert plan['lut'] and plan['pieces'][0]['lut'].dtype==np.float32
+    ref = ccdproc_linpoly(raw.astype(np.float64), COEF).astype(np.float32)
+    out = ccdproc_linwindow(raw, (slice(0, 256), slice(0, 256)), plan)
+    np.testing.assert_array_equal(out, ref)
+    # A window and single pixels
+    np.testing.assert_array_equal(ccdproc_linwindow(raw, (slice(10, 30), slice(5, 7)), plan),
+                                  ref[10:30, 5:7])
+    ind = np.random.default_rng(2).integers(0, 65536, 500)
+    np.testing.assert_array_equal(ccdproc_linvalues(raw, ind, plan), ref.reshape(-1)[ind])
+    # The tables are cached
+    assert ccdproc_linplan(linstr, 1, [], raw.shape, raw.dtype)['pieces'][0]['lut'] is \
+        plan['pieces'][0]['lut']
+
+
+def test_float_poly(tmp_path):
+    # Float images use the polynomial
+    linstr = _linstr(tmp_path, '2 '+' '.join(repr(c) for c in COEF)+'\n')
+    im = np.random.default_rng(3).uniform(0, 60000, (20, 30))
+    ref = ccdproc_linpoly(im.copy(), COEF)
+    head = [fitscard('OBJECT', 'x')]
+    out = im.copy()
+    assert ccdproc_lincorr(out, head, 2, linstr)==''
+    np.testing.assert_allclose(out, ref, rtol=1e-14)
+    assert 'Lincorr applied' in fitskey(head, 'LINCORR')
+    # No correction for this extension
+    out = im.copy()
+    assert ccdproc_lincorr(out, [], 1, linstr)==''
+    np.testing.assert_array_equal(out, im)
+    assert ccdproc_linplan(linstr, 1, [], im.shape, im.dtype) is None
+
+
+def _amphead():
+    # Two amplifiers, the last 4 columns belong to neither
+    return [fitscard('DATASECA', '[1:10,1:20]'), fitscard('BIASSECA', '[11:13,1:20]'),
+            fitscard('DATASECB', '[14:23,1:20]'), fitscard('BIASSECB', '[24:26,1:20]')]
+
+
+@pytest.mark.parametrize('dtype', ['>u2', 'float32'])
+def test_amplifiers(tmp_path, dtype):
+    linstr = _linstr(tmp_path, '1 0.0 2.0\n1 A 1.0 1.0\n1 B 0.0 1.0 1e-4\n')
+    assert [l['amp'] for l in linstr]==['', 'A', 'B']
+    raw = np.random.default_rng(4).integers(0, 3000, (20, 30)).astype(dtype)
+    plan = ccdproc_linplan(linstr, 1, _amphead(), raw.shape, raw.dtype)
+    out = ccdproc_linwindow(raw, (slice(0, 20), slice(0, 30)), plan)
+    r = raw.astype(np.float64)
+    np.testing.assert_allclose(out[:, 0:13], r[:, 0:13]+1.0, rtol=1e-6)
+    np.testing.assert_allclose(out[:, 13:26], r[:, 13:26]+1e-4*r[:, 13:26]**2, rtol=1e-6)
+    np.testing.assert_allclose(out[:, 26:], 2.0*r[:, 26:], rtol=1e-6)
+    # The rows of a band
+    band = ccdproc_linshift(plan, 5, 12)
+    np.testing.assert_array_equal(ccdproc_linwindow(raw[5:12], (slice(0, 7), slice(0, 30)), band),
+                                  out[5:12])
+    # Pixels anywhere in the image
+    ind = np.arange(0, 600, 7)
+    np.testing.assert_array_equal(ccdproc_linvalues(raw, ind, plan), out.reshape(-1)[ind])
+
+
+def test_table(tmp_path):
+    # Extension 1 for the whole image, extension 2 per amplifier
+    table1 = 100.0+1.01*np.arange(1000)+1e-5*np.arange(1000)**2
+    table2 = np.array([np.arange(500)*1.1, np.arange(500)*0.9])
+    file = str(tmp_path/'lincorr.fits')
+    assert fitswrite(file, [None, table1, table2],
+                     heads=[None, [fitscard('LINMIN', 100)],
+                            [fitscard('LINAMP1', 'B'), fitscard('LINAMP2', 'A')]])==''
+    linstr, error = ccdproc_loadlincorr(file)
+    assert error==''
+    assert [(l['exten'], l['amp'], l['tmin']) for l in linstr]==[(1, '', 100), (2, 'B', 0), (2, 'A', 0)]
+    assert all(l['coef'] is None for l in linstr)
+    for dtype in ('>i2', 'float64'):
+        raw = np.random.default_rng(5).integers(0, 1300, (20, 30)).astype(dtype)
+        raw[0, 0:3] = [0, 100, 1200]
+        plan = ccdproc_linplan(linstr, 1, [], raw.shape, raw.dtype, dtype='float64')
+        out = ccdproc_linwindow(raw, (slice(0, 20), slice(0, 30)), plan)
+        # Interpolated, the values outside the table get the end values
+        ref = np.interp(raw.astype(np.float64), 100+np.arange(1000), table1)
+        np.testing.assert_allclose(out, ref, rtol=1e-12)
+        assert out[0, 0]==table1[0] and out[0, 2]==table1[-1]
+        raw = raw % 600
+        plan = ccdproc_linplan(linstr, 2, _amphead(), raw.shape, raw.dtype, dtype='float64')
+        out = ccdproc_linwindow(raw, (slice(0, 20), slice(0, 30)), plan)
+        r = np.minimum(raw.astype(np.float64), 499)
+        np.testing.assert_allclose(out[:, 0:13], 0.9*r[:, 0:13], rtol=1e-12)
+        np.testing.assert_allclose(out[:, 13:26], 1.1*r[:, 13:26], rtol=1e-12)
+        np.testing.assert_array_equal(out[:, 26:], raw[:, 26:])
+
+
+def test_errors(tmp_path):
+    assert 'NOT FOUND' in ccdproc_loadlincorr(str(tmp_path/'missing.txt'))[1]
+    file = tmp_path/'bad.txt'
+    for text,msg in (('x 1.0\n', 'EXTEN [AMP] C0 C1'), ('1\n', 'EXTEN [AMP] C0 C1'),
+                     ('1 A\n', 'No coefficients'), ('# none\n', 'No linearity corrections')):
+        file.write_text(text)
+        linstr, error = ccdproc_loadlincorr(str(file))
+        assert linstr is None and msg in error
+    linstr = _linstr(tmp_path, '1 C 0.0 1.0\n')
+    with pytest.raises(ValueError):
+        ccdproc_linplan(linstr, 1, _amphead(), (20, 30), np.uint16)
+    assert 'No amplifier C' in ccdproc_lincorr(np.zeros((20, 30)), _amphead(), 1, linstr)
+    assert 'float array' in ccdproc_lincorr(np.zeros((20, 30), dtype=np.int16), [], 1, linstr)
+    assert 'already applied' in ccdproc_lincorr(np.zeros((20, 30)), [fitscard('LINCORR', 'x')],
+                                                1, linstr)
@@ -0,0 +1,124 @@
+"""
+ The bit-packed pixel masks (ccdproc_mask).
+"""
+
+import pickle
+
+import numpy as np
+import pytest
+
+from fitsindex import fitsindex, fitscard, fitskey
+from ccdproc_mask import MASKFLAGS, PixMask, MaskStore, ccdproc_writemask
+
+SHAPE = (13, 21)
+
+
+def test_set_and_indices():
+    mask = PixMask(SHAPE)
+    assert mask.count()==0 and mask.indices().dtype==np.int64
+    # Flat indices and boolean images
+    mask.set('bad', [5, 200, 7])
+    sat = np.zeros(SHAPE, dtype=bool)
+    sat[2, 3:6] = True
+    sat[0, 7] = True
+    mask.set('sat', sat)
+    assert list(mask.indices())==[5, 7, 200]
+    assert list(mask.indices('sat'))==[7, 2*21+3, 2*21+4, 2*21+5]
+    assert list(mask.indices(['bad', 'sat']))==[5, 7, 45, 46, 47, 200]
+    assert mask.count(('sat', 'bad'))==6
+    np.testing.assert_array_equal(mask.plane('sat'), sat)
+    assert not mask.plane('cr').any()
+    # The packed planes are 1 bit per pixel
+    assert mask._planes['bad'].nbytes==(SHAPE[0]*SHAPE[1]+7)//8
+
+
+def test_image_roundtrip():
+    rng = np.random.default_rng(3)
+    bpm = np.zeros(SHAPE, dtype=np.int16)
+    for bit in MASKFLAGS.values():
+        bpm[rng.random(SHAPE)<0.1] |= bit
+    mask = PixMask.frombpm(bpm)
+    np.testing.assert_array_equal(mask.image(), bpm)
+    for flag,bit in MASKFLAGS.items():
+        np.testing.assert_array_equal(mask.plane(flag), (bpm & bit)!=0)
+    # Float BPMs and plain 0/1 BPMs
+    np.testing.assert_array_equal(PixMask.frombpm(bpm.astype(np.float32)).image(), bpm)
+    plain = (bpm>0).astype(np.uint8)
+    mask = PixMask.frombpm(plain)
+    assert mask.count()==plain.sum() and mask.count(['sat', 'bleed', 'fixpix', 'cr'])==0
+    # Bits above the flags are ignored
+    assert PixMask.frombpm(np.full(SHAPE, 32)).count(list(MASKFLAGS))==0
+
+
+def test_index_cache():
+    mask = PixMask(SHAPE)
+    mask.set('bad', [1, 2])
+    ind = mask.indices()
+    both = mask.indices(['bad', 'cr'])
+    assert mask.indices() is ind and mask.indices(['cr', 'bad']) is both
+    assert not ind.flags.writeable
+    # Setting a flag drops the index lists with it
+    mask.set('cr', [3])
+    assert mask.indices() is ind
+    assert list(mask.indices(['bad', 'cr']))==[1, 2, 3]
+    mask.set('bad', [0])
+    assert list(mask.indices())==[0, 1, 2]
+    # Copies are independent
+    new = mask.copy()
+    new.set('bad', [10])
+    assert mask.count()==3 and new.count()==4
+
+
+def test_errors():
+    mask = PixMask(SHAPE)
+    with pytest.raises(ValueError):
+        mask.set('hot', [1])
+    with pytest.raises(ValueError):
+        mask.indices(['bad', 'hot'])
+    with pytest.raises(ValueError):
+        mask.set('bad', np.zeros((3, 3), dtype=bool))
+
+
+class Loader(object):
+    # BPM extensions, counting the loads
+    def __init__(self):
+        self.calls = []
+    def __call__(self, path, exten):
+        self.calls.append((path, exten))
+        return {1:np.eye(4, dtype=np.int16), 2:np.zeros((4, 4), dtype=np.int16)}[exten]
+
+
+def test_maskstore():
+    loader = Loader()
+    calls = loader.calls
+    store = MaskStore('bpm.fits', loader=loader)
+    store.preload([1, 2])
+    m1 = store.get(1)
+    assert store.get(1) is m1 and store.get(2).count()==0
+    assert list(m1.indices())==[0, 5, 10, 15]
+    # Each BPM extension is only read once
+    assert calls==[('bpm.fits', 1), ('bpm.fits', 2)]
+    # Worker copies keep the loaded masks
+    new = pickle.loads(pickle.dumps(store))
+    assert list(new.get(1).indices())==[0, 5, 10, 15] and new.loader.calls==calls
+    # No BPM file, empty masks of the given shapes
+    store = MaskStore(shapes={1:(4, 5)})
+    assert store.get(1).shape==(4, 5) and store.get(2, shape=(2, 2)).count()==0
+    with pytest.raises(ValueError):
+        store.get(3)
+
+
+def test_writemask(tmp_path):
+    mask = PixMask(SHAPE)
+    mask.set('bad', [0, 5])
+    mask.set('fixpix', [5, 6])
+    file = str(tmp_path/'im_mask.fits.fz')
+    head = [fitscard('EXTNAME', 'S1'), fitscard('OBJECT', 'M31')]
+    assert ccdproc_writemask(file, [mask, PixMask(SHAPE)], heads=[head, None])==''
+    fits = fitsindex(file)[0]
+    assert fits.nextend==2
+    np.testing.assert_array_equal(fits.data(1), mask.image())
+    assert fits.data(1)[0, 5]==1+8
+    mhead = fits.header(1)
+    assert fitskey(mhead, 'EXTNAME')=='S1' and fitskey(mhead, 'OBJECT') is None
+    assert fitskey(mhead, 'MASKB4')==8 and fitskey(mhead, 'MASKF4')=='fixpix'
@@ -0,0 +1,124 @@
+"""
+ The overscan engine (ccdproc_overscan) with every estimator on a
+ multi-amplifier layout.
+"""
+
+import numpy as np
+import pytest
+
+from fitsindex import fitscard, fitskey
+from ccdproc_overscan import ccdproc_overscan, ccdproc_overscangeom, ccdproc_overscanvec
+
+NY, NX = 120, 110
+NOISE = 2.0
+
+
+def _header():
+    # Two amplifiers side by side, each with its bias strip on the right,
+    #  B is read out from the other side (flipped sections)
+    return [fitscard('BIASSECA', '[101:105,1:120]'), fitscard('DATASECA', '[1:50,1:120]'),
+            fitscard('BIASSECB', '[110:106,120:1]'), fitscard('DATASECB', '[100:51,120:1]'),
+            '%-80s' % 'END']
+
+
+def _levels():
+    # The true bias level of each row, smooth (cubic) for both amplifiers
+    y = np.linspace(-1.0, 1.0, NY)
+    return 300.0+4.0*y+1.5*y**2, 500.0-3.0*y+2.0*y**3
+
+
+def _image(noise=NOISE, seed=2):
+    rng = np.random.default_rng(seed)
+    lev_a, lev_b = _levels()
+    im = rng.normal(0.0, noise, (NY, NX))+1000.0
+    im[:, 0:50] += lev_a[:, None]
+    im[:, 100:105] += lev_a[:, None]-1000.0
+    im[:, 50:100] += lev_b[:, None]
+    im[:, 105:110] += lev_b[:, None]-1000.0
+    return im
+
+
+def test_geometry():
+    geom = ccdproc_overscangeom(_header(), (NY, NX))
+    assert [g['name'] for g in geom]==['A', 'B']
+    assert all(g['axis']==1 for g in geom)
+    assert geom[1]['bias']==(slice(0, 120), slice(105, 110))
+    assert geom[1]['data']==(slice(0, 120), slice(50, 100))
+    # Cached per layout
+    assert ccdproc_overscangeom(_header(), (NY, NX)) is geom
+
+
+@pytest.mark.parametrize('function', ['median', 'mean', 'sigclip'])
+def test_line_estimators(function):
+    im = _image()
+    raw = im.copy()
+    head = list(_header())
+    assert ccdproc_overscan(im, head, function=function)==''
+    est = {'median':np.median, 'mean':np.mean}.get(function)
+    for cols,bias in ((slice(0, 50), slice(100, 105)), (slice(50, 100), slice(105, 110))):
+        if est is not None:
+            vec = est(raw[:, bias], axis=1)
+            np.testing.assert_allclose(im[:, cols], raw[:, cols]-vec[:, None], rtol=1e-12)
+        # Close to the true level either way
+        resid = raw[:, cols]-im[:, cols]
+        assert np.abs(resid[:, 0]-raw[:, cols][:, 0]+1000.0).max()<5*NOISE
+    # The bias pixels themselves are not changed
+    np.testing.assert_array_equal(im[:, 100:], raw[:, 100:])
+    lev_a, lev_b = _levels()
+    assert abs(fitskey(head, 'OVSNMNA')-lev_a.mean())<1.0
+    assert abs(fitskey(head, 'OVSNMNB')-lev_b.mean())<1.0
+    assert abs(fitskey(head, 'OVSNMEAN')-(lev_a.mean()+lev_b.mean())/2)<1.0
+    assert 'Overscan is [101:105,1:120],[110:106,120:1], '+function in fitskey(head, 'OVERSCAN')
+
+
+def test_sigclip_rejects_outliers():
+    rng = np.random.default_rng(4)
+    bias = rng.normal(100.0, 1.0, (200, 20))
+    # A cosmic ray in every other line
+    bias[np.arange(0, 200, 2), rng.integers(0, 20, 100)] = 5000.0
+    clipped = ccdproc_overscanvec(bias, 1, function='sigclip')
+    mean = ccdproc_overscanvec(bias, 1, function='mean')
+    assert np.abs(clipped-100.0).max()<1.5
+    assert np.abs(mean-100.0).max()>100.0
+
+
+@pytest.mark.parametrize('function', ['poly', 'spline'])
+def test_fit_estimators(function):
+    # A cubic level is fit exactly without noise
+    im = _image(noise=0.0)
+    raw = im.copy()
+    assert ccdproc_overscan(im, list(_header()), function=function, order=3)==''
+    np.testing.assert_allclose(im[:, 0:100], raw[:, 0:100]*0+1000.0, atol=1e-8)
+    # and smooths the noise of the line medians
+    noisy = _image()
+    bias = noisy[:, 100:105]
+    lev_a = _levels()[0]
+    fit = ccdproc_overscanvec(bias, 1, function=function, order=3)
+    med = ccdproc_overscanvec(bias, 1, function='median')
+    assert np.std(fit-lev_a)<0.5*np.std(med-lev_a)
+
+
+def test_rows_bias():
+    # The bias strip below the data, collapsed in Y
+    rng = np.random.default_rng(6)
+    lev = np.linspace(200.0, 220.0, 60)
+    im = rng.normal(0.0, 1.0, (50, 60))+lev[None, :]
+    head = [fitscard('BIASSEC', '[1:60,41:50]'), fitscard('TRIMSEC', '[1:60,1:40]')]
+    raw = im.copy()
+    assert ccdproc_overscan(im, head)==''
+    vec = np.median(raw[40:50, :], axis=0)
+    np.testing.assert_allclose(im[0:40], raw[0:40]-vec[None, :])
+
+
+def test_errors():
+    head = list(_header())
+    assert 'float array' in ccdproc_overscan(np.zeros((NY, NX), dtype=np.int16), head)
+    im = _image()
+    assert 'FUNCTION must be one of' in ccdproc_overscan(im, head, function='mode')
+    assert ccdproc_overscan(im, head)==''
+    assert 'already applied' in ccdproc_overscan(im, head)
+    head = [fitscard('BIASSEC', '[101:120,1:120]'), fitscard('TRIMSEC', '[1:100,1:120]')]
+    assert 'out of image bounds' in ccdproc_overscan(_image(), head)
+    head = [fitscard('BIASSEC', '[101:105,1:60]'), fitscard('TRIMSEC', '[1:100,1:120]')]
+    assert 'does not cover' in ccdproc_overscan(_image(), head)
+    assert 'must have BIASSEC' in ccdproc_overscan(_image(), [])
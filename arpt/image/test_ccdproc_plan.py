@@ -0,0 +1,134 @@
+"""
+ The up-front validation of a run (ccdproc_plan).
+"""
+
+import numpy as np
+import pytest
+
+from fitsindex import fitscard
+from fitswrite import fitswrite
+from ccdproc_plan import ccdproc_plan, ProcPlan
+
+
+def _head(ny=20, nx=30):
+    # Raw images of NY x NX+4 with the bias on the right
+    return [fitscard('BIASSEC', '[%d:%d,1:%d]' % (nx+1, nx+4, ny)),
+            fitscard('TRIMSEC', '[1:%d,1:%d]' % (nx, ny))]
+
+
+def _science(file, shapes):
+    ims = [np.zeros((ny, nx+4), dtype=np.uint16) for ny,nx in shapes]
+    assert fitswrite(str(file), [None]+ims, heads=[None]+[_head(*s) for s in shapes])==''
+    return str(file)
+
+
+def _cal(file, shapes, dtype=np.float32):
+    ims = [np.ones(s, dtype=dtype) for s in shapes]
+    assert fitswrite(str(file), [None]+ims)==''
+    return str(file)
+
+
+@pytest.fixture
+def files(tmp_path):
+    return {'sci':_science(tmp_path/'sci.fits', [(20, 30), (20, 30)]),
+            'flat':_cal(tmp_path/'flat.fits', [(20, 30), (20, 30)]),
+            'zero':_cal(tmp_path/'zero.fits', [(20, 30), (20, 30)], np.int16),
+            'bpm':_cal(tmp_path/'bpm.fits', [(20, 30), (20, 30)], np.uint8),
+            'tmp':tmp_path}
+
+
+def test_plan(files):
+    plan, error = ccdproc_plan(zero=files['zero'], flat=files['flat'], bpm=files['bpm'],
+                               bootstr=[{'exten':1, 'scale':0.9}, {'exten':2, 'scale':1.1}],
+                               trim=True, overscan=True, ref=files['sci'])
+    assert error==''
+    assert plan.cal['flat'][1]==((20, 30), -32) and plan.cal['zero'][2]==((20, 30), 16)
+    assert plan.bootscale(2)==1.1 and plan.bootscale(3) is None
+    assert plan.trimsec(_head())==(0, 29, 0, 19)
+    assert plan.outshape(_head(), (20, 34))==(20, 30)
+    assert plan.guard(1, np.zeros((20, 34), dtype=np.uint16), _head())==''
+    assert 'wrong size' in plan.guard(1, np.zeros((20, 34)), _head(10, 30))
+    assert 'no extension 3' in plan.guard(3, np.zeros((20, 34)), _head())
+    assert '2D numeric' in plan.guard(1, np.zeros(5), _head())
+    assert ProcPlan().bootscale(1) is None
+
+
+@pytest.mark.parametrize('name', ['flat', 'illum'])
+@pytest.mark.parametrize('dtype', [np.int16, np.uint16, np.int32])
+def test_integer_flat(files, name, dtype):
+    cal = _cal(files['tmp']/'int.fits', [(20, 30), (20, 30)], dtype)
+    plan, error = ccdproc_plan(**{name:cal, 'trim':True, 'ref':files['sci']})
+    assert plan is None
+    assert error.startswith('CCDPROC_PLAN: '+name.upper()+' file '+cal+' HDU 1 has BITPIX=')
+    assert 'must be floating point' in error
+    # Without any science file too
+    assert 'must be floating point' in ccdproc_plan(**{name:cal})[1]
+    # Float64 is fine
+    cal = _cal(files['tmp']/'dbl.fits', [(20, 30), (20, 30)], np.float64)
+    assert ccdproc_plan(**{name:cal, 'trim':True, 'ref':files['sci']})[1]==''
+
+
+def test_wrong_size_once(files, monkeypatch):
+    # A flat of the wrong size fails at plan time, the first layout is
+    #  checked once however many files have it
+    flat = _cal(files['tmp']/'small.fits', [(20, 30), (10, 30)])
+    sci = [_science(files['tmp']/('sci%d.fits' % k), [(20, 30), (20, 30)]) for k in range(4)]
+    calls = []
+    checkfile = ProcPlan.checkfile
+    def counted(self, file):
+        calls.append(file)
+        return checkfile(self, file)
+    monkeypatch.setattr(ProcPlan, 'checkfile', counted)
+    plan, error = ccdproc_plan(flat=flat, trim=True, ref=sci)
+    assert plan is None
+    assert error=='CCDPROC_PLAN: '+sci[0]+' HDU 2: FLAT image has wrong size, must be [30,20].'
+    assert calls==[sci[0]]
+
+
+def test_layouts(files, monkeypatch):
+    # Every distinct layout of the inputs is checked
+    other = _science(files['tmp']/'other.fits', [(20, 30), (16, 30)])
+    three = _science(files['tmp']/'three.fits', [(20, 30), (20, 30), (20, 30)])
+    sci = [files['sci'], _science(files['tmp']/'same.fits', [(20, 30), (20, 30)])]
+    calls = []
+    checkfile = ProcPlan.checkfile
+    def counted(self, file):
+        calls.append(file)
+        return checkfile(self, file)
+    monkeypatch.setattr(ProcPlan, 'checkfile', counted)
+    plan, error = ccdproc_plan(flat=files['flat'], trim=True, ref=sci)
+    assert error=='' and calls==[files['sci']]
+    plan, error = ccdproc_plan(flat=files['flat'], trim=True, ref=sci+[other])
+    assert error=='CCDPROC_PLAN: '+other+' HDU 2: FLAT image has wrong size, must be [30,16].'
+    plan, error = ccdproc_plan(flat=files['flat'], trim=True, ref=[three]+sci)
+    assert error=='CCDPROC_PLAN: '+three+' HDU 3: FLAT file has no extension 3'
+    # Streamed files, a new layout is checked when it comes
+    plan, error = ccdproc_plan(flat=files['flat'], trim=True, ref=files['sci'])
+    del calls[:]
+    assert plan.checklayout(sci[1])=='' and calls==[]
+    assert 'wrong size' in plan.checklayout(other)
+    assert 'wrong size' in plan.checklayout(other) and calls==[other]
+    # Files that are not FITS are reported when they are processed
+    bad = files['tmp']/'bad.fits'
+    bad.write_bytes(b'x'*2880)
+    assert plan.checklayout(str(bad))==''
+
+
+def test_errors(files):
+    notfits = files['tmp']/'notfits.fits'
+    notfits.write_bytes(b'x'*2880)
+    assert 'ZERO file '+str(notfits)+' is NOT a valid FITS file.' in ccdproc_plan(zero=str(notfits))[1]
+    empty = files['tmp']/'empty.fits'
+    assert fitswrite(str(empty), [None])==''
+    assert 'has no image data' in ccdproc_plan(bpm=str(empty))[1]
+    cube = files['tmp']/'cube.fits'
+    assert fitswrite(str(cube), [None, np.zeros((2, 3, 4), dtype=np.float32)])==''
+    assert 'is not a 2D image' in ccdproc_plan(flat=str(cube))[1]
+    assert 'must not be zero' in ccdproc_plan(bootstr=[{'exten':1, 'scale':0.0}])[1]
+    assert 'EXTEN must be an integer' in ccdproc_plan(bootstr=[{'exten':1.5, 'scale':1.0}])[1]
+    assert 'EXTEN and SCALE' in ccdproc_plan(bootstr=[])[1]
+    # Sections of the science file
+    sci = files['tmp']/'nosec.fits'
+    assert fitswrite(str(sci), [None, np.zeros((20, 34), dtype=np.uint16)])==''
+    assert 'TRIMSEC or DATASEC' in ccdproc_plan(flat=files['flat'], trim=True, ref=str(sci))[1]
+    assert 'BIASSEC' in ccdproc_plan(overscan=True, ref=str(sci))[1]
@@ -0,0 +1,105 @@
+"""
+ The run profile (ccdproc_profile), the per-file records and the
+ summary table.
+"""
+
+import os
+import json
+import time
+import pickle
+
+import pytest
+
+from ccdproc_profile import ProcProfile, NOLAPS
+
+FIELDS = set(['file', 'pid', 'wall', 'error', 'steps', 'extens', 'maxrss'])
+
+
+def _fill(prof, file, scale=1.0):
+    prof.begin(file)
+    prof.add(file, 'read', 0.5*scale, exten=1)
+    prof.add(file, 'read', 0.25*scale, exten=2)
+    prof.add(file, 'overscan', 1.0*scale, exten=1)
+    prof.add(file, 'write', 0.125*scale)
+    prof.count(file, 'bytes_read', 1048576)
+    prof.count(file, 'cache_hits', 3)
+    prof.count(file, 'cache_hits', 2)
+    prof.peak(file, 'peakmem', 100)
+    prof.peak(file, 'peakmem', 50)
+
+
+def test_record(tmp_path):
+    pfile = str(tmp_path/'run.prof.jsonl')
+    prof = ProcProfile(file=pfile)
+    _fill(prof, 'obj1.fits')
+    rec = prof.done('obj1.fits', error='')
+    assert set(rec)==FIELDS|set(['bytes_read', 'cache_hits', 'peakmem'])
+    assert rec['file']=='obj1.fits' and rec['pid']==os.getpid() and rec['error']==''
+    assert rec['steps']=={'read':0.75, 'overscan':1.0, 'write':0.125}
+    assert rec['extens']=={'1':{'read':0.5, 'overscan':1.0}, '2':{'read':0.25}}
+    assert rec['cache_hits']==5 and rec['peakmem']==100 and rec['bytes_read']==1048576
+    assert rec['wall']>=0
+    # One JSON line per file
+    lines = open(pfile).read().splitlines()
+    assert len(lines)==1 and json.loads(lines[0])==rec
+    prof.done('obj2.fits', error='CCDPROC: bad')
+    assert [r['file'] for r in prof.records()]==['obj1.fits', 'obj2.fits']
+    assert prof.records()[1]['error']=='CCDPROC: bad' and prof.records()[1]['steps']=={}
+
+
+def test_laps():
+    prof = ProcProfile()
+    lap = prof.laps('a.fits', 3)
+    time.sleep(0.02)
+    lap('read')
+    lap('overscan')
+    lap.count('bytes_written', 10)
+    lap.peak('peakmem', 7)
+    with prof.step('write', 'a.fits'):
+        time.sleep(0.01)
+    rec = prof.done('a.fits')
+    assert rec['steps']['read']>=0.015 and rec['steps']['overscan']<rec['steps']['read']
+    assert rec['steps']['write']>=0.005 and 'write' not in rec['extens']['3']
+    assert set(rec['extens']['3'])==set(['read', 'overscan'])
+    assert rec['bytes_written']==10 and rec['peakmem']==7
+
+
+def test_workers_summary(tmp_path):
+    # Worker processes have their own copy, the records meet in the file
+    pfile = str(tmp_path/'run.prof.jsonl')
+    prof = ProcProfile(file=pfile)
+    workers = [pickle.loads(pickle.dumps(prof)) for k in range(2)]
+    _fill(workers[0], 'obj1.fits')
+    _fill(workers[1], 'obj2.fits', scale=2.0)
+    workers[1].peak('obj2.fits', 'peakmem', 300)
+    workers[0].done('obj1.fits')
+    workers[1].done('obj2.fits')
+    assert prof._done==[]
+    summ = prof.summary()
+    assert summ['nfiles']==2
+    assert summ['steps']['read']==[2.25, 2] and summ['steps']['write']==[0.375, 2]
+    # Counters are summed, the peaks are the maximum
+    assert summ['counts']['cache_hits']==10 and summ['counts']['bytes_read']==2*1048576
+    assert summ['counts']['peakmem']==300
+    assert summ['wall']==sum(r['wall'] for r in prof.records())
+    table = prof.table().splitlines()
+    assert table[0].split()==['Step', 'Time', '(s)', 'Files', '%']
+    # The slowest step first
+    assert table[1].split()==['overscan', '3.000', '2', '53.3']
+    assert table[2].split()==['read', '2.250', '2', '40.0']
+    assert table[4].split()==['total', '5.625', '2']
+    assert table[5].split()==['bytes_read', '2.0', 'MB']
+    assert table[6].split()==['cache_hits', '10']
+
+
+def test_disabled(tmp_path):
+    pfile = str(tmp_path/'run.prof.jsonl')
+    prof = ProcProfile(file=pfile, enabled=False)
+    assert prof.laps('a.fits', 1) is NOLAPS
+    NOLAPS('read')
+    with prof.step('write', 'a.fits'):
+        pass
+    _fill(prof, 'a.fits')
+    assert prof.done('a.fits') is None
+    assert not os.path.exists(pfile) and prof.records()==[]
+    assert prof.summary()=={'nfiles':0, 'wall':0.0, 'steps':{}, 'counts':{}}
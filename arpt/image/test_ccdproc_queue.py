@@ -0,0 +1,142 @@
+"""
+ The shared work queue (ccdproc_queue): leases, their expiry and the
+ gating of the /byext merge units.
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from fitswrite import fitswrite
+from ccdproc_queue import ccdproc_queue, queueunits
+
+
+@pytest.fixture
+def files(tmp_path):
+    # A single-image file and a file with two extensions
+    single = str(tmp_path/'single.fits')
+    mef = str(tmp_path/'mef.fits')
+    im = np.zeros((4, 4), dtype=np.float32)
+    assert fitswrite(single, [im])==''
+    assert fitswrite(mef, [None, im, im])==''
+    return single, mef
+
+
+def _queue(tmp_path, lease=600, maxtries=3):
+    queue, error = ccdproc_queue('sqlite:'+str(tmp_path/'run.queue'), lease=lease,
+                                 maxtries=maxtries)
+    assert error==''
+    return queue
+
+
+def test_queueunits(files):
+    single, mef = files
+    units = list(queueunits(files, byext=True))
+    assert [u['kind'] for u in units]==['file', 'ext', 'ext', 'merge']
+    assert [u['exten'] for u in units]==[None, 1, 2, None]
+    assert units[1]['id']==mef+'[1]'
+    assert [u['kind'] for u in queueunits(files)]==['file', 'file']
+
+
+def test_put_idempotent(tmp_path, files):
+    queue = _queue(tmp_path)
+    assert queue.put(queueunits(files, byext=True))==4
+    assert queue.put(queueunits(files, byext=True))==0
+    assert queue.stats()['counts']['PENDING']==4
+
+
+def test_merge_gating(tmp_path, files):
+    queue = _queue(tmp_path)
+    queue.put(queueunits(files, byext=True))
+    worker = queue.worker('a')
+    # The merge is held back while its extensions are not done
+    units = queue.lease(worker, n=10)
+    assert sorted(u['kind'] for u in units)==['ext', 'ext', 'file']
+    assert queue.lease(worker, n=10)==[]
+    exts = [u for u in units if u['kind']=='ext']
+    assert queue.done(exts[0], worker)
+    assert queue.lease(worker, n=10)==[]
+    assert queue.done(exts[1], worker)
+    merge = queue.lease(worker, n=10)
+    assert [u['kind'] for u in merge]==['merge']
+    assert queue.done(merge[0], worker)
+    assert queue.active()==1   # the single file is still leased
+
+
+def test_merge_fails_with_extension(tmp_path, files):
+    queue = _queue(tmp_path, maxtries=1)
+    queue.put(queueunits(files[1:], byext=True))
+    worker = queue.worker('a')
+    exts = queue.lease(worker, n=10)
+    assert queue.done(exts[0], worker)
+    assert queue.fail(exts[1], worker, 'boom')
+    # The merge can never run
+    assert queue.lease(worker, n=10)==[]
+    assert queue.active()==0
+    failed = dict((f['id'], f['error']) for f in queue.failed())
+    assert failed[exts[1]['id']]=='boom'
+    assert failed[files[1]+'[merge]']=='an extension failed'
+
+
+def test_fail_retries(tmp_path, files):
+    queue = _queue(tmp_path, maxtries=2)
+    queue.put(queueunits(files[0:1]))
+    worker = queue.worker('a')
+    unit, = queue.lease(worker)
+    assert queue.fail(unit, worker, 'first')
+    unit, = queue.lease(worker)
+    assert unit['tries']==1
+    assert queue.fail(unit, worker, 'second')
+    assert queue.lease(worker)==[]
+    assert queue.failed()==[{'id':unit['id'], 'error':'second'}]
+    assert queue.requeue()==1
+    unit, = queue.lease(worker)
+    assert unit['tries']==0
+
+
+def test_lease_expiry(tmp_path, files):
+    queue = _queue(tmp_path, lease=0.5, maxtries=3)
+    queue.put(queueunits(files[0:1]))
+    unit, = queue.lease('a')
+    assert queue.lease('b')==[]
+    time.sleep(0.7)
+    # The expired lease goes to the next worker and counts as a try
+    again, = queue.lease('b')
+    assert again['id']==unit['id'] and again['tries']==1
+    # The first worker can't renew or finish it anymore
+    assert not queue.renew(unit, 'a')
+    assert not queue.done(unit, 'a')
+    assert queue.done(again, 'b')
+    assert queue.stats()['counts']['DONE']==1
+
+
+def test_held_renews(tmp_path, files):
+    queue = _queue(tmp_path, lease=0.6)
+    queue.put(queueunits(files[0:1]))
+    unit, = queue.lease('a')
+    with queue.held(unit, 'a') as keeper:
+        time.sleep(1.5)
+    assert not keeper.lost
+    assert queue.lease('b')==[]
+    assert queue.done(unit, 'a')
+
+
+def test_held_lost(tmp_path, files):
+    queue = _queue(tmp_path, lease=0.6)
+    queue.put(queueunits(files[0:1]))
+    unit, = queue.lease('a')
+    with queue.held(unit, 'a') as keeper:
+        # Another worker takes the unit over
+        queue.fail(unit, 'a', 'stolen')
+        queue.lease('b')
+        time.sleep(0.5)
+    assert keeper.lost
+    assert not queue.done(unit, 'a')
+
+
+def test_queue_errors(tmp_path):
+    queue, error = ccdproc_queue('sqlite:')
+    assert queue is None and error.startswith('CCDPROC_QUEUE: ')
+    queue, error = ccdproc_queue(str(tmp_path/'q.db'), lease=0)
+    assert queue is None and 'LEASE' in error
@@ -0,0 +1,66 @@
+"""
+ The stacked calibration (ccdproc_stack) against ccdproc_fused one
+ exposure at a time.
+"""
+
+import numpy as np
+import pytest
+
+from ccdproc_fused import ccdproc_fused
+from ccdproc_stack import ccdproc_stack
+
+NEXP, NY, NX = 5, 70, 45
+
+
+def _cals(seed=8):
+    rng = np.random.default_rng(seed)
+    zeroim = rng.normal(300.0, 3.0, (NY, NX))
+    flatim = rng.normal(1.0, 0.05, (NY, NX))
+    illumim = rng.normal(1.0, 0.01, (NY, NX))
+    # Bad flat pixels are set to the median
+    flatim[10, 20] = 0.0
+    flatim[NY-1, 0] = -3.0
+    cube = rng.integers(0, 30000, (NEXP, NY, NX)).astype(np.float64)
+    return cube, zeroim, flatim, illumim
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+@pytest.mark.parametrize('nblock', [64, 7, 1000])
+def test_stack_equals_fused(dtype, nblock):
+    cube, zeroim, flatim, illumim = _cals()
+    kw = {'zeroim':zeroim.astype(dtype), 'flatim':flatim.astype(dtype),
+          'illumim':illumim.astype(dtype), 'bootscale':1.07}
+    stack = cube.astype(dtype)
+    stats = {}
+    out, error = ccdproc_stack(stack, nblock=nblock, stats=stats, **kw)
+    assert error=='' and out is stack
+    assert stats['nexp']==NEXP
+    for k in range(NEXP):
+        fused, error = ccdproc_fused(cube[k].astype(dtype), dtype=dtype, **kw)
+        assert error==''
+        assert np.abs(out[k]-fused).max()==0
+    # The bad flat pixels were divided by the median
+    medflat = float(np.median(kw['flatim']))
+    assert stats['medflat']==medflat
+    expect = (cube[:, 10, 20]-np.round(zeroim[10, 20]))/illumim[10, 20]*stats['medillum']*1.07
+    np.testing.assert_allclose(out[:, 10, 20], expect, rtol=1e-5)
+    assert np.isfinite(out).all()
+
+
+def test_stack_subsets():
+    # Any of the calibrations alone, and known medians
+    cube, zeroim, flatim, illumim = _cals(9)
+    for kw in ({'zeroim':zeroim}, {'flatim':flatim}, {'illumim':illumim, 'medillum':1.02},
+               {'bootscale':0.9}, {}):
+        out = ccdproc_stack(cube.copy(), **kw)[0]
+        for k in range(NEXP):
+            fused = ccdproc_fused(cube[k].copy(), dtype='float64', **kw)[0]
+            assert np.abs(out[k]-fused).max()==0
+
+
+def test_stack_errors():
+    cube, zeroim, flatim, illumim = _cals()
+    assert '3D float array' in ccdproc_stack(cube[0])[1]
+    assert '3D float array' in ccdproc_stack(cube.astype(np.int32))[1]
+    out, error = ccdproc_stack(cube, flatim=flatim[0:10])
+    assert out is None and error=='CCDPROC_STACK: Flat image has wrong size, must be [45,70].'
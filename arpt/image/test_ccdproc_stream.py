@@ -0,0 +1,47 @@
+"""
+ The read/calibrate/write pipeline (ccdproc_stream).
+"""
+
+from ccdproc_stream import ccdproc_stream, StreamStats
+
+
+def test_stream_order():
+    written = []
+    stats = StreamStats()
+    results = ccdproc_stream(range(20), lambda t: t, lambda t,d: d*2,
+                             lambda t,r,e: written.append(r), readahead=2,
+                             writebehind=2, stats=stats)
+    assert written==[2*t for t in range(20)]
+    assert results==[(t, '') for t in range(20)]
+    assert stats.ntasks==20
+    assert stats.maxdepth['read']<=2
+
+
+def test_stream_stage_errors():
+    def readfunc(t):
+        if t==1: raise IOError('unreadable')
+        return t
+    def procfunc(t, d):
+        if t==2: raise ValueError('bad data')
+        return d
+    def writefunc(t, r, e):
+        if t==3: raise OSError('disk full')
+        calls.append((t, r, e))
+    calls = []
+    results = ccdproc_stream(range(5), readfunc, procfunc, writefunc)
+    # The writer still sees the failed tasks, to clean up
+    assert calls==[(0, 0, ''), (1, None, 'unreadable'), (2, None, 'bad data'), (4, 4, '')]
+    assert results==[(0, ''), (1, 'unreadable'), (2, 'bad data'), (3, 'disk full'), (4, '')]
+
+
+def test_stream_task_generator_fails():
+    def tasks():
+        yield 0
+        yield 1
+        raise RuntimeError('no more files')
+    calls = []
+    results = ccdproc_stream(tasks(), lambda t: t, lambda t,d: d,
+                             lambda t,r,e: calls.append(t))
+    # Not passed to the writer, but returned
+    assert calls==[0, 1]
+    assert results==[(0, ''), (1, ''), (None, 'no more files')]
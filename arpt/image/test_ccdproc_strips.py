@@ -0,0 +1,62 @@
+"""
+ The bounded-memory strip mode (ccdproc_strips) against whole-frame
+ processing.
+"""
+
+import numpy as np
+import pytest
+
+from ccdproc_fused import ccdproc_fused
+from ccdproc_strips import ccdproc_strips, ccdproc_stripmedian, ccdproc_striprows
+from test_ccdproc_fused import frame, _header, _fusedkw
+
+
+@pytest.mark.parametrize('twoamp', [False, True])
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+def test_strips_equal_wholeframe(frame, twoamp, dtype):
+    head = _header(twoamp)
+    kw = _fusedkw(frame, head, dtype)
+    ref, error = ccdproc_fused(frame['raw'], **kw)
+    assert error==''
+    out = np.zeros_like(ref)
+    rows = []
+    def writefunc(row0, strip):
+        out[row0:row0+len(strip)] = strip
+        rows.append(row0)
+    # Small enough for several bands
+    stats = {}
+    error = ccdproc_strips(frame['raw'], writefunc, maxmem=64*1024, stats=stats, **kw)
+    assert error==''
+    assert stats['nstrips']>2
+    assert rows==sorted(rows) and rows[0]==0
+    np.testing.assert_array_equal(out, ref)
+    assert stats['nbdpix']==len(kw['bpmind'])
+
+
+@pytest.mark.parametrize('dtype', ['float32', '>f4', 'float64', 'int16', '>i2', 'uint16', 'int32'])
+@pytest.mark.parametrize('n', [1, 2, 999, 1000])
+def test_stripmedian(dtype, n):
+    rng = np.random.default_rng(n)
+    im = rng.normal(0.0, 300.0, n)
+    if np.dtype(dtype).kind=='u': im = np.abs(im)
+    im = im.astype(dtype)
+    # Few rows per band, ties and negative values
+    im[0:n//3] = im[-1]
+    im = im.reshape(-1, 1) if n%2==1 else im.reshape(-1, 2)
+    med = ccdproc_stripmedian(im, nrows=7)
+    assert med==np.median(im.astype(np.dtype(dtype).newbyteorder('=')))
+
+
+def test_stripmedian_special():
+    im = np.arange(12.0, dtype=np.float32).reshape(3, 4)
+    im[1, 1] = np.nan
+    assert np.isnan(ccdproc_stripmedian(im))
+    assert np.isnan(ccdproc_stripmedian(np.zeros((0, 4))))
+    assert ccdproc_stripmedian(np.array([[-0.0, 0.0, -1.0]]))==0.0
+
+
+def test_striprows():
+    nrows = ccdproc_striprows(1024**2, 2048, ncal=3)
+    assert nrows==1024**2//(2048*(4*4+1+3*4))
+    # At least one row
+    assert ccdproc_striprows(10, 2048)==1
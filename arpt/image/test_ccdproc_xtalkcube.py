@@ -0,0 +1,87 @@
+"""
+ The cross-talk matrix (ccdproc_xtalkcube) against the per-victim loop.
+"""
+
+import numpy as np
+import pytest
+
+from fitsindex import fitsindex
+from fitswrite import fitswrite
+from ccdproc_xtalkcube import ccdproc_xtalkmatrix, ccdproc_xtalkcube, ccdproc_xtalkfile
+
+# Several sources per victim, a source that is also a victim and an
+#  extension (5) that is only a source
+XTALK = [(1, 2, 1.2e-3), (1, 3, -4.0e-4), (1, 5, 2.5e-4), (2, 1, 9.0e-4),
+         (3, 4, 3.3e-3), (3, 2, -1.1e-3), (4, 3, 7.0e-4)]
+
+
+@pytest.fixture
+def rawfile(tmp_path):
+    rng = np.random.default_rng(11)
+    ims = [rng.integers(0, 60000, (50, 40)).astype(np.uint16) for e in range(6)]
+    file = str(tmp_path/'raw.fits')
+    assert fitswrite(file, [None]+ims)==''
+    return file
+
+
+def _xstr(entries):
+    xstr = np.zeros(len(entries), dtype=[('VICTIM', int), ('SOURCE', int), ('SCALE', float)])
+    for k,e in enumerate(entries): xstr[k] = e
+    return xstr
+
+
+def _victimloop(file, entries):
+    # One victim at a time, every source read again from the file
+    out = {}
+    for v in sorted(set(e[0] for e in entries)):
+        im = fitsindex(file)[0].data(v).astype(np.float64)
+        for victim,source,scale in entries:
+            if victim!=v: continue
+            im -= scale*fitsindex(file)[0].data(source).astype(np.float64)
+        out[v] = np.round(im)
+    return out
+
+
+def test_matrix():
+    xmat, error = ccdproc_xtalkmatrix(_xstr(XTALK))
+    assert error==''
+    assert xmat['victims']==[1, 2, 3, 4]
+    assert xmat['extens']==[1, 2, 3, 4, 5]
+    assert list(xmat['indptr'])==[0, 3, 4, 6, 7]
+    assert list(xmat['source'][0:3])==[2, 3, 5]
+    assert xmat['text'][1]=='im2*0.0012+im3*-0.0004+im5*0.00025'
+    # A list of tuples is the same
+    xmat2, error = ccdproc_xtalkmatrix(XTALK)
+    assert error=='' and list(xmat2['source'])==list(xmat['source'])
+
+
+@pytest.mark.parametrize('dtype', ['float64', 'float32'])
+def test_file_matches_loop(rawfile, dtype):
+    xmat, error = ccdproc_xtalkmatrix(_xstr(XTALK))
+    xcor, error = ccdproc_xtalkfile(rawfile, xmat, dtype=dtype)
+    assert error==''
+    ref = _victimloop(rawfile, XTALK)
+    assert sorted(xcor)==sorted(ref)
+    for v in ref:
+        assert xcor[v].dtype==np.dtype(dtype)
+        if dtype=='float64':
+            np.testing.assert_array_equal(xcor[v], ref[v])
+        else:
+            # Rounding of float32 sums can differ by one
+            assert np.abs(xcor[v]-ref[v]).max()<=1
+    # The sources are the uncorrected pixels, the order doesn't matter
+    rev, error = ccdproc_xtalkfile(rawfile, ccdproc_xtalkmatrix(XTALK[::-1])[0], dtype=dtype)
+    for v in ref: np.testing.assert_array_equal(rev[v], xcor[v])
+
+
+def test_errors(rawfile):
+    assert 'own cross-talk source' in ccdproc_xtalkmatrix([(1, 1, 0.1)])[1]
+    assert 'No cross-talk entries' in ccdproc_xtalkmatrix([])[1]
+    bad = np.zeros(1, dtype=[('VICTIM', int), ('SCALE', float)])
+    assert 'VICTIM, SOURCE and SCALE' in ccdproc_xtalkmatrix(bad)[1]
+    xmat = ccdproc_xtalkmatrix([(1, 9, 0.1)])[0]
+    assert 'does not have extension 9' in ccdproc_xtalkfile(rawfile, xmat)[1]
+    xmat = ccdproc_xtalkmatrix(XTALK)[0]
+    cube = [np.zeros((5, 5))]*4+[np.zeros((5, 6))]
+    assert 'not same size' in ccdproc_xtalkcube(cube, xmat)[1]
+    assert 'must have 5 images' in ccdproc_xtalkcube(cube[0:2], xmat)[1]
@@ -0,0 +1,90 @@
+"""
+ The tile-compressed FITS codecs (fitscomp), checked against astropy.
+"""
+
+import numpy as np
+import pytest
+
+fits = pytest.importorskip('astropy.io.fits')
+
+from fitsindex import fitsindex, fitscard, fitskey
+from fitswrite import fitswrite
+from fitscomp import fitscompress, fitsimagehead
+
+
+def _images():
+    rng = np.random.default_rng(5)
+    return [rng.integers(-3000, 3000, (40, 30)).astype(np.int16),
+            rng.integers(0, 65535, (40, 30)).astype(np.uint16),
+            rng.integers(-10**6, 10**6, (20, 50)).astype(np.int32),
+            rng.normal(100.0, 10.0, (40, 30)).astype(np.float32)]
+
+
+def _head():
+    return [fitscard('OBJECT', "M31 'core'", 'target'), fitscard('EXPTIME', 30.5)]
+
+
+@pytest.mark.parametrize('cmptype', ['RICE_1', 'GZIP_1', 'GZIP_2'])
+def test_int_astropy(tmp_path, cmptype):
+    # Integers are compressed losslessly both ways
+    ims = [im for im in _images() if im.dtype.kind in 'iu']
+    file = str(tmp_path/'ours.fits.fz')
+    assert fitswrite(file, [None]+ims, heads=[None]+[_head() for im in ims],
+                     compress=cmptype)==''
+    with fits.open(file) as hdul:
+        for im,hdu in zip(ims, hdul[1:]):
+            assert isinstance(hdu, fits.CompImageHDU)
+            assert hdu.compression_type==cmptype
+            np.testing.assert_array_equal(hdu.data, im)
+            assert hdu.header['OBJECT']=="M31 'core'"
+    afile = str(tmp_path/'astropy.fits.fz')
+    fits.HDUList([fits.PrimaryHDU()]+[fits.CompImageHDU(im, compression_type=cmptype)
+                                      for im in ims]).writeto(afile)
+    idx, error = fitsindex(afile)
+    assert error==''
+    for i,im in enumerate(ims):
+        np.testing.assert_array_equal(idx.data(i+1), im)
+        # The threaded tile decoding gives the same
+        np.testing.assert_array_equal(idx.data(i+1, threads=4), im)
+        # The image header, not the binary table's
+        head = idx.header(i+1)
+        assert fitskey(head, 'NAXIS2')==im.shape[0]
+        assert fitskey(head, 'XTENSION')=='IMAGE'
+
+
+def test_float_astropy(tmp_path):
+    # Quantized floats decompress to the same values in both readers
+    im = _images()[3]
+    file = str(tmp_path/'float.fits.fz')
+    assert fitswrite(file, [None, im], compress='RICE_1', quantize=16)==''
+    ours = fitsindex(file)[0].data(1)
+    with fits.open(file) as hdul:
+        np.testing.assert_allclose(ours, hdul[1].data, rtol=0, atol=1e-5)
+    assert np.abs(ours-im).max()<np.std(im)/16
+    # astropy's quantized floats too
+    afile = str(tmp_path/'astropy.fits.fz')
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(im, quantize_level=16)]).writeto(afile)
+    with fits.open(afile) as hdul:
+        np.testing.assert_allclose(fitsindex(afile)[0].data(1), hdul[1].data, rtol=0, atol=1e-5)
+
+
+def test_float_lossless(tmp_path):
+    # GZIP with QUANTIZE=0 is lossless
+    im = _images()[3]
+    file = str(tmp_path/'lossless.fits.fz')
+    assert fitswrite(file, [None, im], compress='GZIP_2', quantize=0)==''
+    np.testing.assert_array_equal(fitsindex(file)[0].data(1), im)
+    with fits.open(file) as hdul:
+        np.testing.assert_array_equal(hdul[1].data, im)
+
+
+def test_fitscompress():
+    im = _images()[0]
+    cards, payload = fitscompress(im, _head(), cmptype='GZIP_1', quantize=0)
+    assert fitskey(cards, 'ZIMAGE') is True
+    assert fitskey(cards, 'ZCMPTYPE')=='GZIP_1'
+    assert len(payload)>0
+    # The image header of the table header
+    head = fitsimagehead(cards)
+    assert fitskey(head, 'BITPIX')==16 and fitskey(head, 'NAXIS1')==30
+    assert fitskey(head, 'OBJECT')=="M31 'core'"
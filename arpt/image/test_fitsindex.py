@@ -0,0 +1,213 @@
+"""
+ The memory-mapped FITS reader (fitsindex), checked against astropy.
+"""
+
+import sys
+import pickle
+import threading
+
+import numpy as np
+import pytest
+
+fits = pytest.importorskip('astropy.io.fits')
+
+from fitsindex import fitsindex, fitskey, fitscard, fitsaddpar, FitsIndex, FitsHeader
+from fitswrite import fitswrite
+
+
+def _images():
+    rng = np.random.default_rng(5)
+    return [rng.integers(-3000, 3000, (40, 30)).astype(np.int16),
+            rng.integers(0, 65535, (40, 30)).astype(np.uint16),
+            rng.integers(-10**6, 10**6, (20, 50)).astype(np.int32),
+            rng.normal(100.0, 10.0, (40, 30)).astype(np.float32),
+            rng.normal(0.0, 1.0, (7, 11)).astype(np.float64)]
+
+
+@pytest.fixture
+def mef(tmp_path):
+    # A multi-extension file written by astropy
+    file = str(tmp_path/'astropy.fits')
+    ims = _images()
+    hdus = [fits.PrimaryHDU()]
+    hdus[0].header['OBSERVAT'] = 'CTIO'
+    for k,im in enumerate(ims):
+        hdu = fits.ImageHDU(im)
+        hdu.header['EXTNAME'] = 'IM%d' % (k+1)
+        hdu.header['LONGSTR'] = 'A string value with trailing blanks     '
+        hdus.append(hdu)
+    # Scaled integers
+    scaled = fits.ImageHDU(ims[3].copy())
+    scaled.scale('int16', bscale=0.01, bzero=100.0)
+    hdus.append(scaled)
+    fits.HDUList(hdus).writeto(file)
+    return file, ims
+
+
+def test_fitsindex_astropy(mef):
+    file, ims = mef
+    idx, error = fitsindex(file)
+    assert error==''
+    assert idx.nextend==len(ims)+1
+    with fits.open(file) as hdul:
+        for i in range(1, len(hdul)):
+            hdu = hdul[i]
+            np.testing.assert_array_equal(idx.data(i), hdu.data)
+            assert idx.hdu[i]['hoffset']==hdu.fileinfo()['hdrLoc']
+            assert idx.hdu[i]['doffset']==hdu.fileinfo()['datLoc']
+            assert idx.hdu[i]['naxis']==[hdu.header['NAXIS1'], hdu.header['NAXIS2']]
+            head = idx.header(i)
+            assert isinstance(head, FitsHeader)
+            assert fitskey(head, 'EXTNAME')==hdu.header.get('EXTNAME')
+    assert fitskey(idx.header(0), 'OBSERVAT')=='CTIO'
+    # Trailing blanks of strings are not significant
+    assert fitskey(idx.header(1), 'LONGSTR')=='A string value with trailing blanks'
+    # The raw values without BSCALE/BZERO
+    assert idx.data(len(ims)+1, scale=False).dtype==np.dtype('>i2')
+
+
+def test_fitsindex_cache(mef):
+    file, ims = mef
+    idx = fitsindex(file)[0]
+    # The cache returns the same index until the file changes
+    assert fitsindex(file)[0] is idx
+    fits.writeto(file, ims[0], overwrite=True)
+    new = fitsindex(file)[0]
+    assert new is not idx
+    assert new.nextend==0
+    np.testing.assert_array_equal(new.data(0), ims[0])
+
+
+def test_fitsindex_errors(tmp_path):
+    fits_, error = fitsindex(str(tmp_path/'missing.fits'))
+    assert fits_ is None and error.startswith('FITSINDEX: ')
+    bad = tmp_path/'bad.fits'
+    bad.write_bytes(b'x'*2880)
+    assert 'not a FITS file' in fitsindex(str(bad))[1]
+    empty = tmp_path/'empty.fits'
+    empty.write_bytes(b'')
+    assert 'is empty' in fitsindex(str(empty))[1]
+    # Truncated data
+    file = str(tmp_path/'trunc.fits')
+    fits.writeto(file, np.zeros((100, 100), dtype=np.float32))
+    with open(file, 'r+b') as fh: fh.truncate(2880*3)
+    assert 'truncated' in fitsindex(file)[1]
+
+
+def test_header_copies(mef):
+    file, ims = mef
+    idx = fitsindex(file)[0]
+    head = idx.header(1)
+    head.set('NEWKEY', 5)
+    assert fitskey(head, 'NEWKEY')==5
+    # The HDU's own header is not changed
+    assert fitskey(idx.header(1, shared=True), 'NEWKEY') is None
+    assert idx.header(1, shared=True) is idx.header(1, shared=True)
+
+
+def test_header_threads(mef):
+    # Every thread parses the headers of a shared index at once, with
+    #  frequent thread switches
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        _headerthreads(mef)
+    finally:
+        sys.setswitchinterval(interval)
+
+
+def _headerthreads(mef):
+    file, ims = mef
+    for trial in range(200):
+        idx = FitsIndex(file)
+        heads = []
+        errors = []
+        start = threading.Barrier(8)
+        def run():
+            start.wait()
+            try:
+                heads.append([idx.header(i, shared=True) for i in range(idx.nextend+1)])
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for t in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert errors==[]
+        # All of them got the same instances
+        for h in heads: assert all(a is b for a,b in zip(h, heads[0]))
+        idx.close()
+
+
+@pytest.mark.parametrize('value', ['/data/'+'x'*80+'/zero.fits', "a'b"*30, 'x'*67+"'",
+                                   'short'])
+def test_fitscard_long_strings(value):
+    # Long strings are cut inside the quotes, the card stays valid FITS
+    card = fitscard('ZEROCOR', value, 'a comment that does not fit with a long value')
+    assert len(card)==80
+    acard = fits.Card.fromstring(card)
+    acard.verify('exception')
+    expect = value.replace("'", "''")[0:68]
+    assert value.startswith(acard.value)
+    assert len(acard.value.replace("'", "''"))>=len(expect)-1
+    assert fitskey([card], 'ZEROCOR')==acard.value
+
+
+def _cards():
+    return [fitscard('SIMPLE', True), fitscard('BITPIX', 16), fitscard('OBJECT', 'M31'),
+            fitscard('HISTORY', 'one'), fitscard('EXPTIME', 30.0), fitscard('OBJECT', 'dup'),
+            '%-80s' % 'END']
+
+
+def test_fitsheader_like_list():
+    # The batched updates give the same cards as the plain list
+    plain = _cards()
+    head = FitsHeader(_cards())
+    for name,value in (('EXPTIME', 45.5), ('FILTER', 'g'), ('OBJECT', 'M33'), ('AIRMASS', 1.2),
+                       ('FILTER', 'r')):
+        fitsaddpar(plain, name, value)
+        fitsaddpar(head, name, value)
+    # Nothing is changed until the cards are needed
+    assert list.__len__(head)==len(_cards())
+    assert head.get('FILTER')=='r' and head.has('airmass') and fitskey(head, 'EXPTIME')==45.5
+    assert list(head)==plain
+    assert len(head)==len(plain) and head[-1]=='%-80s' % 'END'
+    assert head.keys()==['SIMPLE', 'BITPIX', 'OBJECT', 'HISTORY', 'EXPTIME', 'FILTER', 'AIRMASS']
+    # The first of repeated keywords
+    assert head.get('OBJECT')=='M33' and fitskey(plain, 'OBJECT')=='M33'
+    assert not head.has('END') and head.get('NOPE', 5)==5
+
+
+def test_fitsheader_list_changes():
+    head = FitsHeader(_cards())
+    assert head.get('EXPTIME')==30.0
+    # Changes as a list are indexed again
+    head[4] = fitscard('EXPTIME', 60.0)
+    assert head.get('EXPTIME')==60.0
+    del head[2]
+    assert head.get('OBJECT')=='dup'
+    head.insert(0, fitscard('ORIGIN', 'NOAO'))
+    assert head.keys()[0]=='ORIGIN'
+    head.set('NEW', 1)
+    head.append(fitscard('LATE', 2))
+    # The pending card went in before END, the appended one after it
+    assert head.index(fitscard('NEW', 1))<head.index('%-80s' % 'END')<len(head)-1
+    assert head.pop()==fitscard('LATE', 2)
+    head.update([('A', 1), ('B', 'x', 'comment')])
+    assert fitskey(head, 'B')=='x' and list(head)[-2]==fitscard('B', 'x', 'comment')
+
+
+def test_fitsheader_copy_pickle(tmp_path):
+    head = FitsHeader(_cards())
+    head.set('FILTER', 'g')
+    new = head.copy()
+    new.set('FILTER', 'r')
+    assert head.get('FILTER')=='g' and new.get('FILTER')=='r'
+    back = pickle.loads(pickle.dumps(new))
+    assert isinstance(back, FitsHeader) and list(back)==list(new)
+    # The pending cards are written
+    file = str(tmp_path/'head.fits')
+    head.set('AIRMASS', 1.5)
+    assert fitswrite(file, [None, np.zeros((2, 3), dtype=np.int16)], heads=[None, head])==''
+    with fits.open(file) as hdul:
+        assert hdul[1].header['AIRMASS']==1.5 and hdul[1].header['FILTER']=='g'
+        assert hdul[1].header['OBJECT']=='M31'
@@ -0,0 +1,191 @@
+"""
+ The FITS writer (fitswrite and FitsWriter), checked against astropy.
+"""
+
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+fits = pytest.importorskip('astropy.io.fits')
+
+from fitsindex import fitsindex, fitscard, fitskey
+from fitswrite import fitswrite, fitsappend, fitsheader, fitsstarthdu, fitswriterows, \
+    fitsendhdu, fitsscale16, fitsoutsize, FitsWriter, FsyncPolicy
+
+LONGSTR = 'A long string value that does not fit on one card, the rest is cut off'
+
+
+def _images():
+    rng = np.random.default_rng(5)
+    return [rng.integers(-3000, 3000, (40, 30)).astype(np.int16),
+            rng.integers(0, 65535, (40, 30)).astype(np.uint16),
+            rng.integers(-10**6, 10**6, (20, 50)).astype(np.int32),
+            rng.integers(0, 2**32-1, (4, 5), dtype=np.uint32),
+            rng.integers(0, 255, (9, 9)).astype(np.uint8),
+            rng.normal(100.0, 10.0, (40, 30)).astype(np.float32),
+            rng.normal(0.0, 1.0, (7, 11)).astype(np.float64)]
+
+
+def _head():
+    return [fitscard('OBJECT', "M31 'core'", 'target'), fitscard('EXPTIME', 30.5),
+            fitscard('NCOMBINE', 3), fitscard('DOFLAT', True), fitscard('LONGSTR', LONGSTR),
+            fitscard('QUOTES', "'"*40),
+            # Structural cards of the input are replaced
+            fitscard('BITPIX', 8), fitscard('NAXIS1', 1)]
+
+
+def test_fitswrite_astropy(tmp_path):
+    file = str(tmp_path/'mef.fits')
+    ims = _images()
+    heads = [_head()]+[_head() for im in ims]
+    assert fitswrite(file, [None]+ims, heads=heads)==''
+    with fits.open(file) as hdul:
+        hdul.verify('exception')
+        assert len(hdul)==len(ims)+1
+        assert hdul[0].header['EXTEND'] is True
+        for im,hdu in zip(ims, hdul[1:]):
+            assert hdu.data.dtype.newbyteorder('=')==im.dtype
+            np.testing.assert_array_equal(hdu.data, im)
+            assert hdu.header['OBJECT']=="M31 'core'"
+            assert hdu.header['EXPTIME']==30.5
+            assert hdu.header['DOFLAT'] is True
+            assert LONGSTR.startswith(hdu.header['LONGSTR'])
+            assert len(hdu.header['LONGSTR'])==68
+            assert hdu.header['QUOTES']=="'"*34
+            assert hdu.header['NAXIS1']==im.shape[1]
+    # Our reader gets the same
+    idx = fitsindex(file)[0]
+    for i,im in enumerate(ims):
+        np.testing.assert_array_equal(idx.data(i+1), im)
+
+
+def test_pieces_and_append(tmp_path):
+    # An HDU written band by band, then appended extensions
+    im = _images()[5]
+    file = str(tmp_path/'pieces.fits')
+    with open(file, 'wb') as fh:
+        fitsstarthdu(fh, fitsheader(None, _head(), primary=True, nextend=2))
+        fitsendhdu(fh, 0)
+        fitsstarthdu(fh, fitsheader((im.shape, im.dtype), _head(), primary=False))
+        nbytes = 0
+        for y0 in range(0, 40, 7):
+            nbytes += fitswriterows(fh, im[y0:y0+7])
+        fitsendhdu(fh, nbytes)
+    assert fitsappend(file, _images()[0], _head())==''
+    with fits.open(file) as hdul:
+        hdul.verify('exception')
+        np.testing.assert_array_equal(hdul[1].data, im)
+        np.testing.assert_array_equal(hdul[2].data, _images()[0])
+    assert os.path.getsize(file)%2880==0
+
+
+def test_fitswriter_commit_abort(tmp_path):
+    file = str(tmp_path/'out.fits')
+    tmpfile = str(tmp_path/'out_temp.fits')
+    im = _images()[5]
+    # Preallocated, the file is cut to the written size
+    w = FitsWriter(file, tmpfile=tmpfile, size=10**6)
+    w.primary(_head(), nextend=1)
+    w.append(im, _head())
+    w.close()
+    assert os.path.exists(tmpfile) and not os.path.exists(file)
+    w.commit()
+    assert os.path.exists(file) and not os.path.exists(tmpfile)
+    assert w.nbytes==os.path.getsize(file)
+    with fits.open(file) as hdul:
+        np.testing.assert_array_equal(hdul[1].data, im)
+        assert LONGSTR.startswith(hdul[0].header['LONGSTR'])
+    # An aborted writer leaves the old file alone
+    w = FitsWriter(file, tmpfile=tmpfile)
+    w.primary(None, nextend=1)
+    w.abort()
+    assert not os.path.exists(tmpfile)
+    with fits.open(file) as hdul:
+        np.testing.assert_array_equal(hdul[1].data, im)
+
+
+def test_outtypes(tmp_path):
+    im = _images()[6]*1000.0
+    im[2, 3] = np.nan
+    for outtype in ('', 'float32', 'int16', 'quantized'):
+        file = str(tmp_path/('out_%s.fits' % outtype))
+        w = FitsWriter(file, outtype=outtype)
+        w.primary(None, nextend=2)
+        w.append(im, _head())
+        # Integer images are never changed
+        w.append(_images()[0], _head())
+        w.commit()
+        head = fitsindex(file)[0].header(1)
+        with fits.open(file) as hdul:
+            data = hdul[1].data
+            np.testing.assert_array_equal(hdul[2].data, _images()[0])
+            good = np.isfinite(im)
+            assert np.isnan(data[2, 3]) and np.isfinite(data[good]).all()
+            if outtype=='':
+                assert data.dtype==np.dtype('>f8')
+                np.testing.assert_array_equal(data, im)
+            elif outtype=='float32':
+                assert fitskey(head, 'BITPIX')==-32
+                np.testing.assert_array_equal(data, im.astype(np.float32))
+            elif outtype=='int16':
+                assert fitskey(head, 'BITPIX')==16 and fitskey(head, 'BLANK')==-32768
+                bscale = fitskey(head, 'BSCALE')
+                assert np.abs(data[good]-im[good]).max()<=bscale/2*1.001
+            else:
+                assert isinstance(hdul[1], fits.CompImageHDU)
+                assert np.abs(data[good]-im[good]).max()<np.nanstd(im)
+    with pytest.raises(ValueError):
+        FitsWriter(str(tmp_path/'bad.fits'), outtype='int8')
+
+
+def test_fitsscale16():
+    im = np.linspace(-5.0, 100.0, 1000).reshape(20, 50)
+    out, bscale, bzero, blank = fitsscale16(im)
+    assert out.dtype==np.int16 and blank is None
+    assert out.min()==-32767 and out.max()==32767
+    np.testing.assert_allclose(out*bscale+bzero, im, atol=bscale/2)
+    # Constant and undefined images
+    out, bscale, bzero, blank = fitsscale16(np.full((3, 3), 7.0))
+    assert bscale==1.0 and bzero==7.0 and (out==0).all()
+    out, bscale, bzero, blank = fitsscale16(np.full((3, 3), np.nan))
+    assert blank==-32768 and (out==-32768).all()
+
+
+def test_fitsoutsize(tmp_path):
+    file = str(tmp_path/'mef.fits')
+    ims = [im.astype(np.float32) for im in _images()]
+    assert fitswrite(file, [None]+ims, heads=[_head()]+[_head() for im in ims])==''
+    idx = fitsindex(file)[0]
+    assert fitsoutsize(idx.hdu, -32)==os.path.getsize(file)
+    assert fitsoutsize(idx.hdu, 16)<os.path.getsize(file)
+
+
+def test_fsyncpolicy(tmp_path):
+    sync = FsyncPolicy('batch:3')
+    assert sync.mode=='batch' and sync.nbatch==3
+    files = []
+    for k in range(7):
+        file = str(tmp_path/('f%d.fits' % k))
+        w = FitsWriter(file, sync=sync)
+        w.primary(None)
+        files.append(w.commit())
+    assert files[0]==str(tmp_path/'f0.fits')
+    # Every 3 files, the last one at the flush
+    assert sync.nsync==2 and len(sync.pending)==1
+    sync.flush()
+    assert sync.nsync==3 and sync.pending==[]
+    # Worker copies start without pending files
+    sync.pending.append('x')
+    assert pickle.loads(pickle.dumps(sync)).pending==[]
+    assert FsyncPolicy('batch').nbatch==64 and FsyncPolicy('FILE').mode=='file'
+    with pytest.raises(ValueError):
+        FsyncPolicy('always')
+
+
+def test_errors(tmp_path):
+    file = str(tmp_path/'x.fits')
+    assert 'No HDUs' in fitswrite(file, [])
+    assert 'one header per HDU' in fitswrite(file, [None, _images()[0]], heads=[None])
+    assert fitswrite(str(tmp_path/'nodir'/'x.fits'), [None]).startswith('FITSWRITE: ')
@@ -0,0 +1,85 @@
+"""
+ The input list expansion (loadinput and the streaming iloadinput).
+"""
+
+import os
+import types
+
+import pytest
+
+from loadinput import loadinput, iloadinput
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    # night1/c4d_*.fits.fz, night1/sub/deep/, night2/ and hidden files
+    for name in ['night1/c4d_002.fits.fz', 'night1/c4d_001.fits.fz', 'night1/notes.txt',
+                 'night1/sub/deep/c4d_010.fits.fz', 'night1/sub/c4d_005.fits',
+                 'night2/c4d_003.fits.fz', 'night2/.hidden.fits.fz', '.tmp/c4d_009.fits.fz']:
+        path = tmp_path/name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('')
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_wildcards(tree):
+    assert list(iloadinput('night1/*.fits.fz'))==['night1/c4d_001.fits.fz',
+                                                    'night1/c4d_002.fits.fz']
+    assert list(iloadinput('night?/c4d_00[13].fits.fz'))==['night1/c4d_001.fits.fz',
+                                                             'night2/c4d_003.fits.fz']
+    # Nothing matches
+    assert list(iloadinput('night3/*.fits'))==[]
+    assert list(iloadinput('*.nothing'))==[]
+
+
+def test_doublestar(tree):
+    # Any number of directories, including none, hidden ones are skipped
+    assert list(iloadinput('**/*.fits.fz'))==['night1/c4d_001.fits.fz', 'night1/c4d_002.fits.fz',
+                                              'night1/sub/deep/c4d_010.fits.fz',
+                                              'night2/c4d_003.fits.fz']
+    assert list(iloadinput('night1/**/c4d_0*'))==['night1/c4d_001.fits.fz', 'night1/c4d_002.fits.fz',
+                                                  'night1/sub/c4d_005.fits',
+                                                  'night1/sub/deep/c4d_010.fits.fz']
+    # Explicit dots match hidden files
+    assert list(iloadinput('night2/.*'))==['night2/.hidden.fits.fz']
+    # Absolute paths
+    pattern = os.path.join(str(tree), 'night1', '**', '*.fits')
+    assert list(iloadinput(pattern))==[os.path.join(str(tree), 'night1/sub/c4d_005.fits')]
+
+
+def test_listfile(tree):
+    (tree/'list.txt').write_text('# raw files\nnight2/c4d_003.fits.fz\n\n  night1/c4d_001.fits.fz  \n'
+                                 '; other comment\nmissing.fits\n')
+    assert list(iloadinput('@list.txt'))==['night2/c4d_003.fits.fz', 'night1/c4d_001.fits.fz',
+                                           '; other comment', 'missing.fits']
+    assert list(iloadinput('@list.txt', comment=';'))==['# raw files', 'night2/c4d_003.fits.fz',
+                                                        'night1/c4d_001.fits.fz', 'missing.fits']
+
+
+def test_comma_dedup_sort(tree):
+    inp = ['night2/c4d_003.fits.fz, night1/*.fits.fz', './night1/c4d_001.fits.fz',
+           'night1/../night2/c4d_003.fits.fz,,']
+    # The same normalized path only once, in input order
+    assert list(iloadinput(inp))==['night2/c4d_003.fits.fz', 'night1/c4d_001.fits.fz',
+                                   'night1/c4d_002.fits.fz']
+    assert len(list(iloadinput(inp, unique=False)))==5
+    assert list(iloadinput(inp, sort=True))==['night1/c4d_001.fits.fz', 'night1/c4d_002.fits.fz',
+                                              'night2/c4d_003.fits.fz']
+    # Names without wildcards are kept even if they don't exist
+    assert list(iloadinput('a.fits,b.fits'))==['a.fits', 'b.fits']
+
+
+def test_streaming(tree):
+    gen = iloadinput('**/*.fits.fz')
+    assert isinstance(gen, types.GeneratorType)
+    assert next(gen)=='night1/c4d_001.fits.fz'
+
+
+def test_loadinput(tree):
+    files, count = loadinput('night1/*.fits.fz')
+    assert count==2 and files==['night1/c4d_001.fits.fz', 'night1/c4d_002.fits.fz']
+    # A single file is a scalar, no file is None
+    assert loadinput('night2/*.fits.fz')==('night2/c4d_003.fits.fz', 1)
+    assert loadinput('night3/*.fits.fz')==(None, 0)
+    assert loadinput('')==(None, 0)